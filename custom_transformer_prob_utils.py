@@ -1,12 +1,30 @@
+import inspect
+
 import jax.numpy as jnp
+import numpy as np
 
 from functools import partial
+from typing import NamedTuple, Optional
 
 import jax
+from jax.experimental.shard_map import shard_map
+from jax.sharding import Mesh, PartitionSpec
 
 from utils import HashableDict
 
 
+kv_cache_decoding = False # Default for the use_kv_cache arguments below (when they are left as None). Set from the --use_kv_cache flag.
+default_resampling_scheme = "categorical" # Default for smc_procedure (see resample_indices). Set from the --resampling_scheme flag.
+default_resample_criterion = "every_step" # Default for smc_procedure. Set from the --resample_criterion flag.
+vocab_chunk_size = 8192 # Chunk size over the vocab for chunked_logsumexp (the scoring functions never make another full (batch, seq_len, n_vocab) tensor besides the logits)
+vocab_chunked_heads = True # Also chunk the p/twist head projections themselves where possible, so the scoring functions don't materialize the full logits either (see score_selected_tokens_vocab_chunked)
+default_eos_token_id = None # Default for the eos_token_id arguments of the sampling/SMC entry points (None = always generate output_len tokens). Set from the --stop_at_eos flag.
+default_proposal_top_k = None # Defaults for the proposal_top_k/proposal_top_p arguments of the twisted proposal/SMC entry points (see get_truncated_log_psi_all_vocab).
+default_proposal_top_p = None # Set from the --proposal_top_k and --proposal_top_p flags.
+particle_mesh_axis = "particles" # Mesh axis name for smc_sharded
+shard_smc_particles = False # If True, smc_procedure runs "jit"/"partial_jit" calls as smc_sharded where supported. Set from the --shard_smc_particles flag.
+
+
 def kl_div_jax(log_p_target, log_p_curr):
     kl_div = (jnp.exp(log_p_target) * (log_p_target - log_p_curr)).sum()
     return kl_div
@@ -59,21 +77,294 @@ def get_all_new_seqs_single_t(seq, n_vocab):
     return all_new_seqs
 
 
-def get_transformer_p_logits(params_p, full_seq, huggingface_model=None):
+def get_transformer_p_logits(params_p, full_seq, huggingface_model=None, trunk_embeddings=None):
     assert huggingface_model is not None
     if isinstance(huggingface_model, HashableDict):
+        assert trunk_embeddings is None # Only for the shared trunk
         p_logits = huggingface_model['p'](input_ids=full_seq)
     else:
         # should be an apply_fn here?
-        p_logits = huggingface_model(input_ids=full_seq, ret="p", hface_model_params=params_p)
+        p_logits = huggingface_model(input_ids=full_seq, ret="p", hface_model_params=params_p, trunk_embeddings=trunk_embeddings)
 
     return p_logits
 
+def get_transformer_p_embeddings(params_p, full_seq, huggingface_model=None):
+    # Final hidden states (batch, seq_len, d_model) of the base model. With the shared trunk, these can be passed as trunk_embeddings
+    # to the p/twist evaluations of the same sequences below, so that they don't each rerun the trunk
+    assert huggingface_model is not None
+    if isinstance(huggingface_model, HashableDict):
+        return huggingface_model['p'](input_ids=full_seq, ret="p_embeddings")
+    return huggingface_model(input_ids=full_seq, ret="p_embeddings", hface_model_params=params_p)
+
+def init_kv_cache(huggingface_model, batch_size, max_length, model_key="p"):
+    # Zero KV cache for the model that huggingface_model calls (for the HashableDict case, model_key chooses between 'p' and 'twist')
+    # max_length is the total length of sequence that will ever be fed in (e.g. prompt_len + output_len)
+    assert huggingface_model is not None
+    if isinstance(huggingface_model, HashableDict):
+        model_call = huggingface_model[model_key]
+    else:
+        model_call = huggingface_model
+    model = getattr(model_call, "__self__", None) # huggingface_model holds the bound __call__ of CustomLMHeadModel or CustomLMWithTwistHead
+    if model is None or not hasattr(model, "init_cache"):
+        raise NotImplementedError("No KV cache for this model (e.g. the lorax wrapped twist model); --use_kv_cache is rejected with --use_lora")
+    return model.init_cache(batch_size, max_length)
+
+
+def get_transformer_p_logits_kv_cached(params_p, input_ids, position_ids, attention_mask, kv_cache_p, huggingface_model=None, return_embeddings=False):
+    # Same as get_transformer_p_logits but only runs over input_ids (new tokens) using the keys/values in kv_cache_p for all earlier positions
+    # Returns logits for the input_ids positions only, and the updated cache
+    # With return_embeddings, the logits are (logits, final hidden states) instead
+    assert huggingface_model is not None
+    ret = "p_and_embeddings" if return_embeddings else "p"
+    if isinstance(huggingface_model, HashableDict):
+        p_logits, kv_cache_p = huggingface_model['p'](
+            input_ids=input_ids, ret=ret, position_ids=position_ids, attention_mask=attention_mask, past_key_values=kv_cache_p)
+    else:
+        p_logits, kv_cache_p = huggingface_model(
+            input_ids=input_ids, ret=ret, hface_model_params=params_p, position_ids=position_ids,
+            attention_mask=attention_mask, past_key_values=kv_cache_p)
+
+    return p_logits, kv_cache_p
+
+
+def broadcast_kv_cache(kv_cache, batch_size):
+    # Turn a batch size 1 cache into a cache for batch_size (identical) sequences. cache_index entries are scalars and stay as is
+    return jax.tree_util.tree_map(
+        lambda x: x if x.ndim == 0 else jnp.broadcast_to(x, (batch_size,) + x.shape[1:]), kv_cache)
+
+
+def get_position_ids_from_attention_mask(attention_mask):
+    # Positions only count the tokens that are attended to, so a left padded prompt gets the same positions as it would without padding
+    # (for an attention_mask of all ones, this is just arange)
+    return jnp.maximum(jnp.cumsum(attention_mask, axis=-1) - 1, 0)
+
+
+def get_prompt_attention_mask_for_kv_cache(batch_size, max_length, prompt_attention_mask=None):
+    # attention_mask over all max_length positions; everything after the prompt is attended to (the cache itself
+    # masks out the positions that haven't been filled yet). prompt_attention_mask is (batch_size, prompt_len), 0 for padding
+    attention_mask = jnp.ones((batch_size, max_length), dtype=jnp.int32)
+    if prompt_attention_mask is not None:
+        attention_mask = attention_mask.at[:, :prompt_attention_mask.shape[-1]].set(prompt_attention_mask[:batch_size])
+    return attention_mask
+
+
+def left_pad_prompts(prompts, pad_token_id=0):
+    # Stack prompts of different lengths into one (n_prompts, max_prompt_len) array plus the matching attention mask, e.g. for smc_multi_prompt
+    # Padding goes on the left, so the last prompt token (and therefore every generated token) is at the same index for all prompts
+    max_prompt_len = max(prompt.shape[-1] for prompt in prompts)
+    padded_prompts = jnp.full((len(prompts), max_prompt_len), pad_token_id, dtype=jnp.int32)
+    prompt_attention_mask = jnp.zeros((len(prompts), max_prompt_len), dtype=jnp.int32)
+    for i, prompt in enumerate(prompts):
+        padded_prompts = padded_prompts.at[i, max_prompt_len - prompt.shape[-1]:].set(prompt)
+        prompt_attention_mask = prompt_attention_mask.at[i, max_prompt_len - prompt.shape[-1]:].set(1)
+    return padded_prompts, prompt_attention_mask
+
+
+def kv_cache_prefill_p(params_p, batch_prompt, max_length, huggingface_model=None, prompt_is_shared=False):
+    # Feed in all but the last token of the prompt. The last prompt token is then fed in as the first step of the scan,
+    # so that every scan step does exactly the same thing: feed token at prompt_len + t - 1, then sample the token at prompt_len + t
+    # (which also means we never have to run the model on the final sampled token)
+    # If every row of batch_prompt is the same prompt (prompt_is_shared), the prompt is only run once (batch size 1)
+    # and the resulting keys/values are broadcast to all the samples, instead of redoing identical computation for each sample
+    batch_size, prompt_len = batch_prompt.shape
+    prefill_batch_size = 1 if prompt_is_shared else batch_size
+    kv_cache_p = init_kv_cache(huggingface_model, prefill_batch_size, max_length, model_key="p")
+    # No padding so everything is attended to; the cache itself masks out the positions that haven't been filled yet
+    attention_mask = jnp.ones((prefill_batch_size, max_length), dtype=jnp.int32)
+    if prompt_len > 1:
+        position_ids = get_position_ids_from_attention_mask(attention_mask[:, :prompt_len - 1])
+        _, kv_cache_p = get_transformer_p_logits_kv_cached(
+            params_p, batch_prompt[:prefill_batch_size, :-1], position_ids, attention_mask, kv_cache_p, huggingface_model=huggingface_model)
+    if prompt_is_shared:
+        kv_cache_p, attention_mask = broadcast_kv_cache((kv_cache_p, attention_mask), batch_size)
+    return kv_cache_p, attention_mask
+
+
+def resolve_use_kv_cache(use_kv_cache, huggingface_model, params_proposal=None):
+    # use_kv_cache=None means use the kv_cache_decoding default, but only where the KV cached path is supported
+    # (not for the lora twist model, or with a separate proposal model, which still needs full sequence twist evaluations)
+    if use_kv_cache is None:
+        supported = params_proposal is None
+        if isinstance(huggingface_model, HashableDict) and huggingface_model['call_type'] == "lora":
+            supported = False
+        return kv_cache_decoding and supported
+    return use_kv_cache
+
+
+def resolve_proposal_truncation(proposal_top_k, proposal_top_p):
+    # None means use default_proposal_top_k/default_proposal_top_p; proposal_top_k=0 and proposal_top_p=1. explicitly mean
+    # no truncation (e.g. for the SMC inside the twist losses, which train the twist, so need its untruncated values)
+    if proposal_top_k is None:
+        proposal_top_k = default_proposal_top_k
+    if proposal_top_p is None:
+        proposal_top_p = default_proposal_top_p
+    if proposal_top_k == 0:
+        proposal_top_k = None
+    if proposal_top_p is not None and proposal_top_p >= 1.:
+        proposal_top_p = None
+    return proposal_top_k, proposal_top_p
+
+
+def resolve_vocab_chunking(chunk_size, chunked_heads):
+    # None means use vocab_chunk_size/vocab_chunked_heads. Resolved outside of jit, so the jitted scoring functions get them
+    # as static args (and a change of the module settings gives a new compilation, rather than the values from the first trace)
+    if chunk_size is None:
+        chunk_size = vocab_chunk_size
+    if chunked_heads is None:
+        chunked_heads = vocab_chunked_heads
+    return chunk_size, chunked_heads
+
+
+def get_p_logits_and_log_psi_all_vocab_kv_cached(
+    input_ids, position_ids, kv_cache, params_p, params_twist,
+    condition_twist_on_tokens, huggingface_model=None, twist_top_k=None, condition_twist_on_embeddings=None
+):
+    # KV cached version of get_p_logits_and_log_psi_all_vocab. kv_cache is (kv_cache_p, kv_cache_twist, attention_mask)
+    # where kv_cache_twist is None when the twist shares the trunk with p (then one cache serves both)
+    # Returns p logits and log psi (all vocab) for the input_ids positions only (no prompt_len slicing needed), and the updated kv_cache
+    # With twist_top_k, the twist head is only evaluated on the top k tokens under p at the last position, and instead of
+    # log psi (all vocab) this returns (log_psi_candidates, candidate_indices) with shapes (batch, seq_len, k) and (batch, k)
+    assert huggingface_model is not None
+    kv_cache_p, kv_cache_twist, attention_mask = kv_cache
+    if isinstance(huggingface_model, HashableDict):
+        if huggingface_model['call_type'] == "lora":
+            raise NotImplementedError("No KV cached path for the lora twist model; resolve_use_kv_cache never picks it, and --use_kv_cache is rejected with --use_lora")
+        p_logits, kv_cache_p = get_transformer_p_logits_kv_cached(
+            params_p, input_ids, position_ids, attention_mask, kv_cache_p, huggingface_model=huggingface_model)
+        candidate_indices = None
+        if twist_top_k is not None:
+            _, candidate_indices = jax.lax.top_k(p_logits[:, -1, :], twist_top_k)
+        twist_output, kv_cache_twist = huggingface_model['twist'](
+            input_ids=input_ids, ret="twist",
+            hface_model_params=params_twist[0],
+            params_twist_head=params_twist[1],
+            condition_twist_on_tokens=condition_twist_on_tokens,
+            condition_twist_on_embeddings=condition_twist_on_embeddings,
+            position_ids=position_ids, attention_mask=attention_mask, past_key_values=kv_cache_twist,
+            twist_token_indices=candidate_indices
+        )
+        if huggingface_model['call_type'] == "p_psi_combined":
+            if candidate_indices is None:
+                log_psi_all_vocab = twist_output - p_logits # see get_p_logits_and_log_psi_all_vocab
+            else:
+                log_psi_all_vocab = twist_output - jnp.take_along_axis(p_logits, candidate_indices[:, None, :], axis=-1)
+        else:
+            log_psi_all_vocab = twist_output
+        if candidate_indices is not None:
+            log_psi_all_vocab = (log_psi_all_vocab, candidate_indices)
+    else:
+        (p_logits, log_psi_all_vocab), kv_cache_p = huggingface_model(
+            input_ids=input_ids, ret="both", params_twist_head=params_twist,
+            condition_twist_on_tokens=condition_twist_on_tokens,
+            condition_twist_on_embeddings=condition_twist_on_embeddings,
+            position_ids=position_ids, attention_mask=attention_mask, past_key_values=kv_cache_p,
+            twist_top_k=twist_top_k)
+
+    return p_logits, log_psi_all_vocab, (kv_cache_p, kv_cache_twist, attention_mask)
+
+
+def kv_cache_prefill_p_and_twist(params_p, params_twist, batch_prompt, max_length,
+                                 condition_twist_on_tokens, huggingface_model=None, prompt_is_shared=False,
+                                 prompt_attention_mask=None, condition_twist_on_embeddings=None):
+    # Same as kv_cache_prefill_p, but sets up caches for both p and the twist model (if the twist model is separate)
+    # The last prompt token is left for the first SMC step to feed in. Since that step runs per particle,
+    # anything particle specific (e.g. condition_twist_on_tokens in the twist head) only comes in from there on;
+    # the trunk keys/values for the prompt don't depend on it, which is what lets us share them across particles.
+    # prompt_attention_mask (same shape as batch_prompt) is for left padded prompts (see left_pad_prompts); it is kept in the
+    # attention_mask of the cache so the padding is never attended to, and the later steps get their positions from it.
+    batch_size, prompt_len = batch_prompt.shape
+    prefill_batch_size = 1 if prompt_is_shared else batch_size
+    kv_cache_p = init_kv_cache(huggingface_model, prefill_batch_size, max_length, model_key="p")
+    kv_cache_twist = None
+    if isinstance(huggingface_model, HashableDict):
+        kv_cache_twist = init_kv_cache(huggingface_model, prefill_batch_size, max_length, model_key="twist")
+    attention_mask = get_prompt_attention_mask_for_kv_cache(prefill_batch_size, max_length, prompt_attention_mask)
+    kv_cache = (kv_cache_p, kv_cache_twist, attention_mask)
+    if prompt_len > 1:
+        position_ids = get_position_ids_from_attention_mask(attention_mask[:, :prompt_len - 1])
+        condition_twist_on_tokens_for_prefill = condition_twist_on_tokens
+        condition_twist_on_embeddings_for_prefill = condition_twist_on_embeddings
+        if condition_twist_on_tokens is not None:
+            condition_twist_on_tokens_for_prefill = condition_twist_on_tokens[:prefill_batch_size] # head outputs are discarded here anyway
+        if condition_twist_on_embeddings is not None:
+            condition_twist_on_embeddings_for_prefill = condition_twist_on_embeddings[:prefill_batch_size]
+        _, _, kv_cache = get_p_logits_and_log_psi_all_vocab_kv_cached(
+            batch_prompt[:prefill_batch_size, :-1], position_ids, kv_cache, params_p, params_twist,
+            condition_twist_on_tokens_for_prefill, huggingface_model=huggingface_model,
+            condition_twist_on_embeddings=condition_twist_on_embeddings_for_prefill)
+    if prompt_is_shared:
+        kv_cache = broadcast_kv_cache(kv_cache, batch_size)
+    return kv_cache
+
+
+def extend_kv_cache(kv_cache_p, attention_mask, extra_len):
+    # Add room for extra_len more positions at the end of a cache (and its attention_mask), e.g. so that tokens after the
+    # end of the SMC sequences can be fed in. The new positions are attended to, like everything after the prompt
+    if extra_len <= 0:
+        return kv_cache_p, attention_mask
+    def _extend(x):
+        if x.ndim == 0:
+            return x
+        return jnp.pad(x, [(0, 0), (0, extra_len)] + [(0, 0)] * (x.ndim - 2))
+    kv_cache_p = jax.tree_util.tree_map(_extend, kv_cache_p)
+    attention_mask = jnp.pad(attention_mask, [(0, 0), (0, extra_len)], constant_values=1)
+    return kv_cache_p, attention_mask
+
+
+def evaluate_log_p_of_next_tokens_kv_cached(seq, next_tokens, kv_cache, params_p, huggingface_model=None):
+    # log p(next_tokens | seq) per token, shape (batch, next_tokens_len), using the kv_cache left by the final SMC step instead of
+    # rerunning p over seq. That cache holds every position of seq except the last (the final sampled token is never fed in,
+    # see kv_cache_prefill_p), so only that token and next_tokens[:, :-1] are run through the model
+    kv_cache_p, _, attention_mask = kv_cache
+    seq_len = seq.shape[-1]
+    n_next_tokens = next_tokens.shape[-1]
+    kv_cache_p, attention_mask = extend_kv_cache(kv_cache_p, attention_mask, seq_len + n_next_tokens - 1 - attention_mask.shape[-1])
+    input_ids = jnp.concatenate((seq[:, -1:], next_tokens[:, :-1]), axis=-1)
+    position_ids = (attention_mask * (jnp.arange(attention_mask.shape[-1]) < seq_len - 1)).sum(axis=-1)[:, None] + jnp.arange(n_next_tokens)[None, :]
+    p_logits, _ = get_transformer_p_logits_kv_cached(
+        params_p, input_ids, position_ids, attention_mask, kv_cache_p, huggingface_model=huggingface_model)
+    return gather_selected_tokens(p_logits, next_tokens) - chunked_logsumexp(p_logits)
+
+
+def reorder_kv_cache(kv_cache, a_t, true_posterior_sample=None):
+    # Follow the resampled particles: cache rows are reordered by the ancestor indices a_t (same as full_seq)
+    # instead of being recomputed. The cache_index entries are scalars shared across the batch, so they are left alone.
+    def _reorder(x):
+        if x.ndim == 0:
+            return x
+        if true_posterior_sample is not None:
+            return x.at[1:].set(x[a_t])
+        return x[a_t]
+    return jax.tree_util.tree_map(_reorder, kv_cache)
+
+
+def get_condition_twist_on_embeddings(params_twist, condition_twist_on_tokens, huggingface_model=None):
+    # Embedding of condition_twist_on_tokens for twists with conditional_twist_type == "tokens" (see CustomLMWithTwistHead.get_condition_twist_on_embeddings),
+    # to compute once (e.g. per SMC run) and pass as condition_twist_on_embeddings below, instead of rerunning the twist transformer
+    # over condition_twist_on_tokens on every twist call. None if there is nothing to precompute (including for the lora twist model)
+    assert huggingface_model is not None
+    if condition_twist_on_tokens is None:
+        return None
+    if isinstance(huggingface_model, HashableDict):
+        if huggingface_model['call_type'] == "lora":
+            return None
+        model_call = huggingface_model['twist']
+        hface_model_params = params_twist[0]
+    else:
+        model_call = huggingface_model
+        hface_model_params = None # the shared trunk uses the params held by the model, as in _get_log_psi_all_vocab
+    model = getattr(model_call, "__self__", None)
+    if model is None or getattr(model, "conditional_twist_type", None) != "tokens":
+        return None
+    return model.get_condition_twist_on_embeddings(condition_twist_on_tokens, hface_model_params)
+
+
 def _get_log_psi_all_vocab(seq, params_twist, condition_twist_on_tokens,
-                           huggingface_model=None):
+                           huggingface_model=None, condition_twist_on_embeddings=None, trunk_embeddings=None):
     # produces output of size (batch, n_vocab)
     assert huggingface_model is not None
     if isinstance(huggingface_model, HashableDict):
+        assert trunk_embeddings is None # Only for the shared trunk; the separate twist model has its own (trained) transformer
         if huggingface_model['call_type'] == "lora":
 
             # # TODO might have to go through the model_twist and then update the call function
@@ -91,29 +382,34 @@ def _get_log_psi_all_vocab(seq, params_twist, condition_twist_on_tokens,
                 input_ids=seq, ret="twist",
                 hface_model_params=params_twist[0],
                 params_twist_head=params_twist[1],
-                condition_twist_on_tokens=condition_twist_on_tokens
+                condition_twist_on_tokens=condition_twist_on_tokens,
+                condition_twist_on_embeddings=condition_twist_on_embeddings
             )
 
     else:
 
         return huggingface_model(input_ids=seq, ret="twist",
                                  params_twist_head=params_twist,
-                                 condition_twist_on_tokens=condition_twist_on_tokens)
+                                 condition_twist_on_tokens=condition_twist_on_tokens,
+                                 condition_twist_on_embeddings=condition_twist_on_embeddings,
+                                 trunk_embeddings=trunk_embeddings)
 
 
 
 def get_log_psi_all_vocab(
     seq, params_twist, condition_twist_on_tokens,
     huggingface_model=None, params_proposal=None,
-    params_p=None, prompt_len=None
+    params_p=None, prompt_len=None, condition_twist_on_embeddings=None, trunk_embeddings=None
 ):
 
     log_psi_all_vocab = _get_log_psi_all_vocab(seq, params_twist, condition_twist_on_tokens,
-                               huggingface_model=huggingface_model)
+                               huggingface_model=huggingface_model, condition_twist_on_embeddings=condition_twist_on_embeddings,
+                                               trunk_embeddings=trunk_embeddings)
     if params_proposal is None:
         return log_psi_all_vocab[:, prompt_len - 1: -1]
     else:
         assert params_p is not None
+        assert trunk_embeddings is None
         # TODO ensure no circular references/infinite recursion here
         normalized_log_q_1_to_t_minus_1_with_t_all_vocab, log_p_1_to_t_minus_1_with_t_all_vocab = evaluate_normalized_log_q_1_to_t(
             seq, params_p, params_twist, prompt_len,
@@ -126,10 +422,11 @@ def get_log_psi_all_vocab(
 def get_p_logits_and_log_psi_all_vocab(
     full_seq, params_p, params_twist,
     condition_twist_on_tokens, huggingface_model=None,
-    params_proposal=None, prompt_len=None
+    params_proposal=None, prompt_len=None, condition_twist_on_embeddings=None, trunk_embeddings=None
 ):
     assert huggingface_model is not None
     if isinstance(huggingface_model, HashableDict):
+        assert trunk_embeddings is None # Only for the shared trunk
         p_logits = get_transformer_p_logits(params_p, full_seq, huggingface_model=huggingface_model)
         if huggingface_model['call_type'] == "p_psi_combined":
             assert params_proposal is None  # Not yet implemented/tested
@@ -138,7 +435,8 @@ def get_p_logits_and_log_psi_all_vocab(
                 input_ids=full_seq, ret="twist",
                 hface_model_params=params_twist[0],
                 params_twist_head=params_twist[1],
-                condition_twist_on_tokens=condition_twist_on_tokens
+                condition_twist_on_tokens=condition_twist_on_tokens,
+                condition_twist_on_embeddings=condition_twist_on_embeddings
             ) # then taking a logsoftmax of the logit gives you the log(p psi).
             # Note that, say you have p logits a1 a2, and you have psi values b1 b2 (2 vocab)
             # If you were to do logsoftmax on p (say we only care about 1st token in vocab), then you get
@@ -150,6 +448,7 @@ def get_p_logits_and_log_psi_all_vocab(
             # Which is the same, except for a different subtracted constant. But in log space, for sampling, this doesn't matter, this constant will go away
             # That is, we would indeed learn different values of a1 and b1 across the two cases, but they would only differ by a constant
             log_psi_all_vocab = log_p_plus_log_psi_logits_all_vocab - p_logits
+            log_psi_all_vocab = log_psi_all_vocab[:, prompt_len - 1: -1] # same slicing as in get_log_psi_all_vocab
 
         else:
             if params_proposal is not None:
@@ -164,24 +463,27 @@ def get_p_logits_and_log_psi_all_vocab(
 
                                                           params_twist,
                                                           condition_twist_on_tokens,
-                                                          huggingface_model, prompt_len=prompt_len
+                                                          huggingface_model, prompt_len=prompt_len,
+                                                          condition_twist_on_embeddings=condition_twist_on_embeddings
                                                           )
     else:
         assert params_proposal is None  # Not yet implemented/tested
         # TODO NOTE THAT if not specifying the hface_model_params, it defaults to whatever is in the huggingface_model
         # Which is based on the CustomLMWithTwistHead.huggingface_model._params
-        p_logits, log_psi_all_vocab = huggingface_model(input_ids=full_seq, ret="both", params_twist_head=params_twist, condition_twist_on_tokens=condition_twist_on_tokens)
+        p_logits, log_psi_all_vocab = huggingface_model(input_ids=full_seq, ret="both", params_twist_head=params_twist, condition_twist_on_tokens=condition_twist_on_tokens,
+                                                        condition_twist_on_embeddings=condition_twist_on_embeddings,
+                                                        trunk_embeddings=trunk_embeddings)
         log_psi_all_vocab = log_psi_all_vocab[:, prompt_len - 1: -1]
 
 
     return p_logits, log_psi_all_vocab
 
 def get_log_p_plus_log_psi_t(full_seq, params_p, params_twist, prompt_len, t,
-                           condition_twist_on_tokens,   huggingface_model=None):
+                           condition_twist_on_tokens,   huggingface_model=None, condition_twist_on_embeddings=None):
     p_logits, log_psi_all_vocab = get_p_logits_and_log_psi_all_vocab(
         full_seq, params_p, params_twist,
         condition_twist_on_tokens,
-        huggingface_model, prompt_len=prompt_len) # NOTE: purposefully do not send in params_proposal here. Because this is only called within the q sampling, and that should be the original twisted proposal p psi, not q/p * psi'
+        huggingface_model, prompt_len=prompt_len, condition_twist_on_embeddings=condition_twist_on_embeddings) # NOTE: purposefully do not send in params_proposal here. Because this is only called within the q sampling, and that should be the original twisted proposal p psi, not q/p * psi'
 
     # For time step e.g. the first time step, then we want to get the p and psi values e.g. if prompt len is 4, and we want the first time step
     # Then we need index 3 to get the logits (remember 0 based indexing), which we then use for generation
@@ -197,7 +499,62 @@ def get_log_p_plus_log_psi_t(full_seq, params_p, params_twist, prompt_len, t,
     return log_p, log_psi
 
 
-def stochastic_transformer_sample_iter(carry, t, huggingface_model=None, return_p_eval=False):
+def get_eos_finished_mask(full_seq, prompt_len, t, eos_token_id):
+    # True for the sequences that already have an EOS among their first t generated tokens (positions prompt_len to prompt_len + t - 1)
+    # Such sequences are frozen: every later token is EOS (as padding) with probability 1, see _sample_from_log_p_and_log_psi
+    positions = jnp.arange(full_seq.shape[-1])
+    is_generated_so_far = (positions >= prompt_len) & (positions < prompt_len + t)
+    return ((full_seq == eos_token_id) & is_generated_so_far).any(axis=-1)
+
+
+def get_after_eos_mask(full_seq, prompt_len, eos_token_id):
+    # (batch, output_len) mask, True for the output tokens after the first generated EOS (the frozen EOS padding)
+    is_eos = full_seq[:, prompt_len:] == eos_token_id
+    return (jnp.cumsum(is_eos, axis=-1) - is_eos) > 0
+
+
+def pad_after_eos(full_seq, prompt_len, eos_token_id):
+    # Replace everything after the first generated EOS by EOS (what the frozen sequences look like)
+    after_eos = get_after_eos_mask(full_seq, prompt_len, eos_token_id)
+    return full_seq.at[:, prompt_len:].set(jnp.where(after_eos, eos_token_id, full_seq[:, prompt_len:]))
+
+
+# The scores of sequences from the SMC with eos_token_id have to match what the SMC used for the frozen EOS padding
+# (see _sample_from_log_p_and_log_psi and smc_scan_iter_non_final): p = q = 1 for every token after the first EOS,
+# and the twist keeps its value at the EOS. Otherwise the scorers (IWAE bounds, SMC upper bound, twist losses) use
+# the model's log p / log q of the padding, which the SMC doesn't, and the bounds are for a different target.
+def mask_log_probs_after_eos(log_probs, full_seq, prompt_len, eos_token_id):
+    # Per token log p or log q, (batch, output_len)
+    if eos_token_id is None:
+        return log_probs
+    return jnp.where(get_after_eos_mask(full_seq, prompt_len, eos_token_id), 0., log_probs)
+
+
+def freeze_log_psi_after_eos(log_psi, full_seq, prompt_len, eos_token_id):
+    # Per token log psi, (batch, output_len) or (batch, output_len, n_vocab). The all vocab version gets the frozen value for every token
+    if eos_token_id is None:
+        return log_psi
+    after_eos = get_after_eos_mask(full_seq, prompt_len, eos_token_id)
+    first_eos = jnp.argmax(full_seq[:, prompt_len:] == eos_token_id, axis=-1)
+    log_psi_selected = log_psi
+    if log_psi.ndim == 3:
+        log_psi_selected = gather_selected_tokens(log_psi, full_seq[:, prompt_len:])
+    log_psi_at_eos = jnp.take_along_axis(log_psi_selected, first_eos[:, None], axis=-1)
+    if log_psi.ndim == 3:
+        return jnp.where(after_eos[:, :, None], log_psi_at_eos[:, :, None], log_psi)
+    return jnp.where(after_eos, log_psi_at_eos, log_psi)
+
+
+def mask_log_p_all_vocab_after_eos(log_p_all_vocab, full_seq, prompt_len, eos_token_id):
+    # Normalized log p for every next token, (batch, output_len, n_vocab): after the first EOS, all the probability is on EOS
+    if eos_token_id is None:
+        return log_p_all_vocab
+    after_eos = get_after_eos_mask(full_seq, prompt_len, eos_token_id)
+    log_p_frozen = jnp.where(jnp.arange(log_p_all_vocab.shape[-1]) == eos_token_id, 0., -jnp.inf)
+    return jnp.where(after_eos[:, :, None], log_p_frozen, log_p_all_vocab)
+
+
+def stochastic_transformer_sample_iter(carry, t, huggingface_model=None, return_p_eval=False, eos_token_id=None):
     # Essentially the way this works is we pass in a full computation (eg full prompt_len + output_len)
     # but we only use the logit for the time step t, and discard the rest of the computation
     # That is, we are computing logits on the full sequence of length prompt_len + output_len
@@ -217,19 +574,80 @@ def stochastic_transformer_sample_iter(carry, t, huggingface_model=None, return_
     # I needed log_softmax on the other ones in order to properly combine with the other log term.
     indices_to_use = jax.random.categorical(subkey, p_logits[:, prompt_len + t - 1, :],
                                  shape=(p_logits.shape[0],))
+    finished = None
+    if eos_token_id is not None:
+        finished = get_eos_finished_mask(full_seq, prompt_len, t, eos_token_id)
+        indices_to_use = jnp.where(finished, eos_token_id, indices_to_use)
     full_seq = full_seq.at[:, prompt_len + t].set(indices_to_use)
 
     p_eval = None
     if return_p_eval:
         p_eval = jax.nn.log_softmax(p_logits[:, prompt_len + t - 1, :])[jnp.arange(p_logits.shape[0]), indices_to_use]
+        if finished is not None:
+            p_eval = jnp.where(finished, 0., p_eval)
 
     carry = (rng_key, params, full_seq, prompt_len)
     return carry, p_eval
 
 
+def stochastic_transformer_sample_iter_kv_cache(carry, t, huggingface_model=None, return_p_eval=False, eos_token_id=None, return_embeddings=False):
+    # KV cached version of stochastic_transformer_sample_iter: instead of running over the whole prompt_len + output_len buffer,
+    # feed in only the last token (position prompt_len + t - 1); everything before it is already in kv_cache_p
+    # So each step costs a single token forward (attending over the cache) instead of a full sequence forward
+    # With return_embeddings, the output is (p_eval, final hidden state at position prompt_len + t - 1)
+    rng_key, params, full_seq, prompt_len, kv_cache_p, attention_mask = carry
+    last_tokens = full_seq[:, prompt_len + t - 1][:, None]
+    position_ids = jnp.full(last_tokens.shape, prompt_len + t - 1, dtype=jnp.int32)
+    p_logits, kv_cache_p = get_transformer_p_logits_kv_cached(
+        params, last_tokens, position_ids, attention_mask, kv_cache_p, huggingface_model=huggingface_model, return_embeddings=return_embeddings)
+    if return_embeddings:
+        p_logits, embeddings = p_logits
+    p_logits = p_logits[:, -1, :]
+
+    rng_key, subkey = jax.random.split(rng_key)
+    indices_to_use = jax.random.categorical(subkey, p_logits, shape=(p_logits.shape[0],))
+    finished = None
+    if eos_token_id is not None:
+        finished = get_eos_finished_mask(full_seq, prompt_len, t, eos_token_id)
+        indices_to_use = jnp.where(finished, eos_token_id, indices_to_use)
+    full_seq = full_seq.at[:, prompt_len + t].set(indices_to_use)
+
+    p_eval = None
+    if return_p_eval:
+        p_eval = jax.nn.log_softmax(p_logits)[jnp.arange(p_logits.shape[0]), indices_to_use]
+        if finished is not None:
+            p_eval = jnp.where(finished, 0., p_eval)
+
+    carry = (rng_key, params, full_seq, prompt_len, kv_cache_p, attention_mask)
+    if return_embeddings:
+        return carry, (p_eval, embeddings[:, -1, :])
+    return carry, p_eval
+
+
 # lax.scan works on stochastic transformer sample - yes it wastes computation on the later time steps, but still this is faster than not using scan+jit)
-@partial(jax.jit, static_argnames=["output_len", "n_samples", "huggingface_model", "return_p_eval", "prompt_is_already_batch"])
-def stochastic_transformer_sample(rng_key, params, prompt: jnp.ndarray, output_len, n_samples, huggingface_model=None, return_p_eval=False, prompt_is_already_batch=False):
+# use_kv_cache=True avoids the wasted computation (O(T) single token forwards instead of O(T) full sequence forwards); None means use kv_cache_decoding
+# With eos_token_id, sequences stop at EOS (everything after it is EOS, with p_eval 0); None means use default_eos_token_id.
+# This only freezes the finished sequences, see stochastic_transformer_sample_eos_compacted for also skipping their computation
+# With return_output_embeddings, the base model's final hidden states at the output positions (batch, output_len, d_model) are returned
+# last, e.g. as probe features. With the KV cache, they come from the sampling steps themselves (plus a single token step for the
+# last token); without it, from one more full forward pass over the samples.
+def stochastic_transformer_sample(rng_key, params, prompt: jnp.ndarray, output_len, n_samples, huggingface_model=None, return_p_eval=False, prompt_is_already_batch=False, use_kv_cache=None,
+                                  eos_token_id=None, return_output_embeddings=False):
+    # The module defaults are resolved here, before jit, so that they end up in the static arguments (the jit cache key)
+    # rather than being read once at trace time
+    use_kv_cache = resolve_use_kv_cache(use_kv_cache, huggingface_model)
+    if eos_token_id is None:
+        eos_token_id = default_eos_token_id
+    return stochastic_transformer_sample_jitted(rng_key, params, prompt, output_len, n_samples, huggingface_model=huggingface_model,
+                                                return_p_eval=return_p_eval, prompt_is_already_batch=prompt_is_already_batch,
+                                                use_kv_cache=use_kv_cache, eos_token_id=eos_token_id,
+                                                return_output_embeddings=return_output_embeddings)
+
+
+@partial(jax.jit, static_argnames=["output_len", "n_samples", "huggingface_model", "return_p_eval", "prompt_is_already_batch", "use_kv_cache", "eos_token_id",
+                                   "return_output_embeddings"])
+def stochastic_transformer_sample_jitted(rng_key, params, prompt: jnp.ndarray, output_len, n_samples, huggingface_model=None, return_p_eval=False,
+                                         prompt_is_already_batch=False, use_kv_cache=False, eos_token_id=None, return_output_embeddings=False):
     if prompt_is_already_batch:
         prompt_len = prompt.shape[-1]
         batch_prompt = prompt
@@ -241,34 +659,178 @@ def stochastic_transformer_sample(rng_key, params, prompt: jnp.ndarray, output_l
     output = jnp.zeros((n_samples, output_len), dtype=jnp.int32)
     full_seq = jnp.concatenate((batch_prompt, output), axis=1)
 
-    carry = (rng_key, params, full_seq, prompt_len)
-    carry, p_evals = jax.lax.scan(partial(stochastic_transformer_sample_iter, huggingface_model=huggingface_model, return_p_eval=return_p_eval),
-                             carry, jnp.arange(output_len, dtype=jnp.int32), output_len)
+    if use_kv_cache:
+        kv_cache_p, attention_mask = kv_cache_prefill_p(params, batch_prompt, full_seq.shape[-1], huggingface_model=huggingface_model,
+                                                        prompt_is_shared=not prompt_is_already_batch)
+        carry = (rng_key, params, full_seq, prompt_len, kv_cache_p, attention_mask)
+        carry, p_evals = jax.lax.scan(partial(stochastic_transformer_sample_iter_kv_cache, huggingface_model=huggingface_model, return_p_eval=return_p_eval, eos_token_id=eos_token_id,
+                                              return_embeddings=return_output_embeddings),
+                                      carry, jnp.arange(output_len, dtype=jnp.int32), output_len)
+        full_seq = carry[2]
+        if return_output_embeddings:
+            # Step t fed in position prompt_len + t - 1, so steps 1 to output_len - 1 have all the output positions but the last
+            p_evals, step_embeddings = p_evals
+            _, _, _, _, kv_cache_p, attention_mask = carry
+            (_, last_embeddings), _ = get_transformer_p_logits_kv_cached(
+                params, full_seq[:, -1:], jnp.full((n_samples, 1), prompt_len + output_len - 1, dtype=jnp.int32),
+                attention_mask, kv_cache_p, huggingface_model=huggingface_model, return_embeddings=True)
+            output_embeddings = jnp.concatenate((jnp.transpose(step_embeddings[1:], (1, 0, 2)), last_embeddings), axis=1)
+    else:
+        carry = (rng_key, params, full_seq, prompt_len)
+        carry, p_evals = jax.lax.scan(partial(stochastic_transformer_sample_iter, huggingface_model=huggingface_model, return_p_eval=return_p_eval, eos_token_id=eos_token_id),
+                                 carry, jnp.arange(output_len, dtype=jnp.int32), output_len)
 
-    rng_key, params, full_seq, _ = carry
+        rng_key, params, full_seq, _ = carry
+        if return_output_embeddings:
+            output_embeddings = get_transformer_p_embeddings(params, full_seq, huggingface_model=huggingface_model)[:, prompt_len:]
 
+    if return_p_eval and return_output_embeddings:
+        return full_seq, p_evals, output_embeddings
     if return_p_eval:
         return full_seq, p_evals
+    if return_output_embeddings:
+        return full_seq, output_embeddings
 
     return full_seq
 
-@partial(jax.jit, static_argnames=["proposal_is_p", "huggingface_model", "tempered_twist", "beta_prop", "prompt_len"])
-def get_proposal_q_sample(rng_key, full_seq, params_p, params_twist, prompt_len, t,
-                          condition_twist_on_tokens, proposal_is_p=False,
-                          huggingface_model=None, true_posterior_sample=None, tempered_twist=False, beta_prop=None, params_proposal=None):
-    # See comments in get_proposal_q_sample. Same function but rewritten to work well with jit and lax.scan
-    # Wastes some computation (as with all the other such functions) but should still be faster with jit+scan
 
-    if params_proposal is None:
-        params_to_use = params_twist
+@partial(jax.jit, static_argnames=["prompt_len", "huggingface_model", "return_p_eval", "eos_token_id"])
+def stochastic_transformer_sample_steps(rng_key, full_seq, kv_cache, condition_twist_on_tokens, ts, params, prompt_len,
+                                        huggingface_model=None, return_p_eval=False, eos_token_id=None):
+    # The stochastic_transformer_sample scan, but only over the time steps in ts, continuing from a partially generated full_seq
+    # kv_cache is (kv_cache_p, attention_mask) from kv_cache_prefill_p, or None. condition_twist_on_tokens is unused (see generate_with_eos_compaction)
+    if kv_cache is not None:
+        kv_cache_p, attention_mask = kv_cache
+        carry = (rng_key, params, full_seq, prompt_len, kv_cache_p, attention_mask)
+        carry, p_evals = jax.lax.scan(partial(stochastic_transformer_sample_iter_kv_cache, huggingface_model=huggingface_model, return_p_eval=return_p_eval, eos_token_id=eos_token_id),
+                                      carry, ts, ts.shape[0])
+        rng_key, _, full_seq, _, kv_cache_p, attention_mask = carry
+        kv_cache = (kv_cache_p, attention_mask)
     else:
-        params_to_use = params_proposal
+        carry = (rng_key, params, full_seq, prompt_len)
+        carry, p_evals = jax.lax.scan(partial(stochastic_transformer_sample_iter, huggingface_model=huggingface_model, return_p_eval=return_p_eval, eos_token_id=eos_token_id),
+                                      carry, ts, ts.shape[0])
+        rng_key, _, full_seq, _ = carry
+    return rng_key, full_seq, kv_cache, p_evals
+
+
+def generate_with_eos_compaction(rng_key, full_seq, kv_cache, condition_twist_on_tokens, prompt_len, output_len, eos_token_id,
+                                 run_steps, steps_per_chunk=8, min_bucket_size=8):
+    # Python level driver for EOS aware sampling of independent sequences: run_steps (jitted) generates steps_per_chunk tokens at a time,
+    # and in between, sequences that have finished (emitted EOS) are dropped from the batch, so that the later chunks run on fewer sequences.
+    # Batch sizes are rounded up to powers of 2 (buckets; the extra rows repeat a live sequence and are discarded)
+    # so that there are only O(log n_samples) different shapes to compile.
+    # run_steps(rng_key, full_seq, kv_cache, condition_twist_on_tokens, ts) -> (rng_key, full_seq, kv_cache, step_outputs or None)
+    # Returns full_seq in the original row order with EOS after the first EOS, and the (output_len, n_samples) step outputs (0 once finished) or None
+    # Without any compaction (e.g. min_bucket_size >= n_samples) this gives exactly the same samples as a single scan with the same rng_key
+    n_samples = full_seq.shape[0]
+    final_seq = np.full(full_seq.shape, eos_token_id, dtype=np.int32)
+    final_seq[:, :prompt_len] = np.asarray(full_seq[:, :prompt_len])
+    final_step_outputs = None
+    rows = np.arange(n_samples) # row of final_seq for each row of the current batch, -1 for rows that are only there to fill the bucket
+
+    t = 0
+    while t < output_len:
+        n_steps = min(steps_per_chunk, output_len - t)
+        rng_key, full_seq, kv_cache, step_outputs = run_steps(
+            rng_key, full_seq, kv_cache, condition_twist_on_tokens, jnp.arange(t, t + n_steps, dtype=jnp.int32))
+        t += n_steps
+
+        is_real_row = rows >= 0
+        # Only the tokens generated in this chunk: later positions of full_seq are not generated yet (0), and final_seq already has the
+        # EOS padding there for rows that get dropped below
+        new_positions = slice(prompt_len + t - n_steps, prompt_len + t)
+        final_seq[rows[is_real_row], new_positions] = np.asarray(full_seq)[is_real_row, new_positions]
+        if step_outputs is not None:
+            if final_step_outputs is None:
+                final_step_outputs = np.zeros((output_len, n_samples), dtype=np.asarray(step_outputs).dtype)
+            final_step_outputs[t - n_steps:t, rows[is_real_row]] = np.asarray(step_outputs)[:, is_real_row]
+
+        live = is_real_row & ~np.asarray(get_eos_finished_mask(full_seq, prompt_len, t, eos_token_id))
+        n_live = int(live.sum())
+        if n_live == 0:
+            break # Everything after this is EOS padding, which final_seq already has
+
+        bucket_size = min(max(min_bucket_size, 1 << (n_live - 1).bit_length()), full_seq.shape[0])
+        if bucket_size < full_seq.shape[0]:
+            live_rows = np.nonzero(live)[0]
+            batch_idx = np.concatenate((live_rows, np.full(bucket_size - n_live, live_rows[0])))
+            full_seq = full_seq[batch_idx]
+            kv_cache = reorder_kv_cache(kv_cache, batch_idx)
+            condition_twist_on_tokens = jax.tree_util.tree_map(lambda x: x[batch_idx], condition_twist_on_tokens)
+            rows = np.concatenate((rows[live_rows], np.full(bucket_size - n_live, -1)))
+
+    return jnp.array(final_seq), (None if final_step_outputs is None else jnp.array(final_step_outputs))
+
+
+def stochastic_transformer_sample_eos_compacted(rng_key, params, prompt: jnp.ndarray, output_len, n_samples, huggingface_model=None,
+                                                return_p_eval=False, use_kv_cache=None, eos_token_id=None,
+                                                steps_per_chunk=8, min_bucket_size=8):
+    # Same as stochastic_transformer_sample with eos_token_id, but also skips the computation for finished sequences (see generate_with_eos_compaction)
+    if eos_token_id is None:
+        eos_token_id = default_eos_token_id
+    if eos_token_id is None:
+        return stochastic_transformer_sample(rng_key, params, prompt, output_len, n_samples, huggingface_model=huggingface_model,
+                                             return_p_eval=return_p_eval, use_kv_cache=use_kv_cache)
+
+    use_kv_cache = resolve_use_kv_cache(use_kv_cache, huggingface_model)
+    prompt_len = prompt.shape[0]
+    batch_prompt = jnp.full((n_samples, prompt_len), prompt)
+    output = jnp.zeros((n_samples, output_len), dtype=jnp.int32)
+    full_seq = jnp.concatenate((batch_prompt, output), axis=1)
 
+    kv_cache = None
+    if use_kv_cache:
+        kv_cache = jax.jit(kv_cache_prefill_p, static_argnames=["max_length", "huggingface_model", "prompt_is_shared"])(
+            params, batch_prompt, full_seq.shape[-1], huggingface_model=huggingface_model, prompt_is_shared=True)
+
+    run_steps = partial(stochastic_transformer_sample_steps, params=params, prompt_len=prompt_len, huggingface_model=huggingface_model,
+                        return_p_eval=return_p_eval, eos_token_id=eos_token_id)
+
+    full_seq, p_evals = generate_with_eos_compaction(
+        rng_key, full_seq, kv_cache, None, prompt_len, output_len, eos_token_id,
+        run_steps, steps_per_chunk=steps_per_chunk, min_bucket_size=min_bucket_size)
+
+    if return_p_eval:
+        return full_seq, p_evals
+
+    return full_seq
 
-    log_p, log_psi = get_log_p_plus_log_psi_t(full_seq, params_p, params_to_use, prompt_len, t,
-                                            condition_twist_on_tokens,
-                                               huggingface_model=huggingface_model)
 
+def get_truncated_log_psi_all_vocab(log_p, log_psi_candidates, candidate_indices, top_p=None):
+    # Truncated twist for the proposal: log_p is (batch, n_vocab), log_psi_candidates and candidate_indices are (batch, k),
+    # with the candidates sorted by decreasing p (as from jax.lax.top_k). With top_p, only the smallest prefix of the candidates
+    # with total p >= top_p is kept. Every other token gets the same twist value, the p weighted average of psi over the kept candidates,
+    # so only k twist outputs are needed per step. The returned (batch, n_vocab) log psi is a deterministic function of the prefix,
+    # so it is just a different (valid) choice of intermediate twist: sampling from p psi_trunc (normalized over the whole vocab) keeps q exact,
+    # the SMC weights stay correct, and the log Z estimate stays unbiased as long as the final step uses the true final twist.
+    log_p_candidates = jnp.take_along_axis(log_p, candidate_indices, axis=-1)
+    keep = jnp.ones(candidate_indices.shape, dtype=jnp.bool_)
+    if top_p is not None:
+        p_candidates = jnp.exp(log_p_candidates)
+        keep = (jnp.cumsum(p_candidates, axis=-1) - p_candidates) < top_p
+    log_psi_rest = jax.nn.logsumexp(jnp.where(keep, log_p_candidates + log_psi_candidates, -jnp.inf), axis=-1) \
+                   - jax.nn.logsumexp(jnp.where(keep, log_p_candidates, -jnp.inf), axis=-1)
+    log_psi = jnp.broadcast_to(log_psi_rest[:, None], log_p.shape)
+    log_psi = log_psi.at[jnp.arange(log_p.shape[0])[:, None], candidate_indices].set(
+        jnp.where(keep, log_psi_candidates, log_psi_rest[:, None]))
+    return log_psi
+
+
+def truncate_log_psi_all_vocab(log_p, log_psi, top_k=None, top_p=None):
+    # get_truncated_log_psi_all_vocab when log psi is already available for the whole vocab (e.g. the non KV cached proposal),
+    # so that the same truncated proposal is used on both paths (the compute savings are only on the KV cached path)
+    _, candidate_indices = jax.lax.top_k(log_p, log_p.shape[-1] if top_k is None else top_k)
+    log_psi_candidates = jnp.take_along_axis(log_psi, candidate_indices, axis=-1)
+    return get_truncated_log_psi_all_vocab(log_p, log_psi_candidates, candidate_indices, top_p)
+
+
+def _sample_from_log_p_and_log_psi(rng_key, full_seq, log_p, log_psi, prompt_len, t, proposal_is_p=False,
+                                   true_posterior_sample=None, tempered_twist=False, beta_prop=None, eos_token_id=None):
+    # The part of get_proposal_q_sample after the model calls: log_p and log_psi are (batch, n_vocab) for the token at prompt_len + t
+    # Shared between the full sequence and the KV cached versions of the proposal
+    # With eos_token_id, sequences that already have an EOS are frozen: the new token is EOS under both p and q with probability 1
+    # (so log p = log q = 0 for it). The twist value for these is handled by the callers (see smc_scan_iter_non_final)
     if tempered_twist:
         # log_psi = beta_prop * jnp.exp(log_psi) # Now instead of p psi, I will sample from p e^(beta psi)
         # This means that wherever I had log_psi before, I now need beta psi, which is equal to beta (exp(log_psi))
@@ -312,6 +874,11 @@ def get_proposal_q_sample(rng_key, full_seq, params_p, params_twist, prompt_len,
         unnormalized_log_q_t = log_p_plus_log_psi[
             jnp.arange(indices_to_use.shape[0]), indices_to_use]
 
+    finished = None
+    if eos_token_id is not None:
+        finished = get_eos_finished_mask(full_seq, prompt_len, t, eos_token_id)
+        indices_to_use = jnp.where(finished, eos_token_id, indices_to_use)
+
     full_seq = full_seq.at[:, prompt_len + t].set(indices_to_use)
 
     normalized_log_q_t = unnormalized_log_q_t - log_Z_s_1_to_t_minus_1
@@ -319,6 +886,41 @@ def get_proposal_q_sample(rng_key, full_seq, params_p, params_twist, prompt_len,
     log_p_eval_of_new_seqs = log_p[jnp.arange(full_seq.shape[0]), indices_to_use]
     log_psi_eval_of_new_seqs = log_psi[jnp.arange(full_seq.shape[0]), indices_to_use]
 
+    if finished is not None:
+        normalized_log_q_t = jnp.where(finished, 0., normalized_log_q_t)
+        log_p_eval_of_new_seqs = jnp.where(finished, 0., log_p_eval_of_new_seqs)
+
+    return rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs
+
+
+@partial(jax.jit, static_argnames=["proposal_is_p", "huggingface_model", "tempered_twist", "beta_prop", "prompt_len", "eos_token_id", "proposal_top_k", "proposal_top_p"])
+def get_proposal_q_sample(rng_key, full_seq, params_p, params_twist, prompt_len, t,
+                          condition_twist_on_tokens, proposal_is_p=False,
+                          huggingface_model=None, true_posterior_sample=None, tempered_twist=False, beta_prop=None, params_proposal=None,
+                          eos_token_id=None, proposal_top_k=None, proposal_top_p=None, condition_twist_on_embeddings=None):
+    # See comments in get_proposal_q_sample. Same function but rewritten to work well with jit and lax.scan
+    # Wastes some computation (as with all the other such functions) but should still be faster with jit+scan
+
+    if params_proposal is None:
+        params_to_use = params_twist
+    else:
+        assert condition_twist_on_embeddings is None # those are from the params_twist trunk
+        params_to_use = params_proposal
+
+
+    log_p, log_psi = get_log_p_plus_log_psi_t(full_seq, params_p, params_to_use, prompt_len, t,
+                                            condition_twist_on_tokens,
+                                               huggingface_model=huggingface_model, condition_twist_on_embeddings=condition_twist_on_embeddings)
+    if proposal_top_k is not None or proposal_top_p is not None:
+        log_psi = truncate_log_psi_all_vocab(log_p, log_psi, proposal_top_k, proposal_top_p)
+
+    rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs = _sample_from_log_p_and_log_psi(
+        rng_key, full_seq, log_p, log_psi, prompt_len, t, proposal_is_p=proposal_is_p,
+        true_posterior_sample=true_posterior_sample, tempered_twist=tempered_twist, beta_prop=beta_prop,
+        eos_token_id=eos_token_id
+    )
+
+
     if params_proposal is not None: # do the q/p for the twist value for resampling/reweighting/SMC intermediate distribution only
 
         log_psi_eval = evaluate_log_psi_selected_tokens(full_seq, prompt_len, params_twist,
@@ -334,41 +936,253 @@ def get_proposal_q_sample(rng_key, full_seq, params_p, params_twist, prompt_len,
     return rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs
 
 
+@partial(jax.jit, static_argnames=["proposal_is_p", "huggingface_model", "tempered_twist", "beta_prop", "prompt_len", "eos_token_id", "proposal_top_k", "proposal_top_p"])
+def get_proposal_q_sample_kv_cache(rng_key, full_seq, kv_cache, params_p, params_twist, prompt_len, t,
+                                   condition_twist_on_tokens, proposal_is_p=False,
+                                   huggingface_model=None, true_posterior_sample=None, tempered_twist=False, beta_prop=None,
+                                   eos_token_id=None, proposal_top_k=None, proposal_top_p=None, condition_twist_on_embeddings=None):
+    # KV cached version of get_proposal_q_sample (without params_proposal): feed in only the token at prompt_len + t - 1
+    # (the caches hold everything before that, for the current particles), then sample the token at prompt_len + t as usual
+    # With proposal_top_k/proposal_top_p, the proposal uses the truncated twist (see get_truncated_log_psi_all_vocab);
+    # with proposal_top_k the twist head only computes the top k outputs
+    last_tokens = full_seq[:, prompt_len + t - 1][:, None]
+    # Position of that token = number of attended tokens before it (just prompt_len + t - 1, unless the prompt is left padded)
+    attention_mask = kv_cache[2]
+    position_ids = (attention_mask * (jnp.arange(attention_mask.shape[-1]) < prompt_len + t - 1)).sum(axis=-1)[:, None]
+    p_logits, log_psi_all_vocab, kv_cache = get_p_logits_and_log_psi_all_vocab_kv_cached(
+        last_tokens, position_ids, kv_cache, params_p, params_twist,
+        condition_twist_on_tokens, huggingface_model=huggingface_model, twist_top_k=proposal_top_k,
+        condition_twist_on_embeddings=condition_twist_on_embeddings)
+
+    log_p = jax.nn.log_softmax(p_logits[:, -1, :])
+    if proposal_top_k is not None:
+        log_psi_candidates, candidate_indices = log_psi_all_vocab
+        log_psi = get_truncated_log_psi_all_vocab(log_p, log_psi_candidates[:, -1, :], candidate_indices, proposal_top_p)
+    else:
+        log_psi = log_psi_all_vocab[:, -1, :]
+        if proposal_top_p is not None:
+            log_psi = truncate_log_psi_all_vocab(log_p, log_psi, top_p=proposal_top_p)
+
+    rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs = _sample_from_log_p_and_log_psi(
+        rng_key, full_seq, log_p, log_psi, prompt_len, t, proposal_is_p=proposal_is_p,
+        true_posterior_sample=true_posterior_sample, tempered_twist=tempered_twist, beta_prop=beta_prop,
+        eos_token_id=eos_token_id
+    )
+
+    return rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs, kv_cache
+
+
+
+def chunked_logsumexp(logits, other_logits=None, chunk_size=None):
+    # logsumexp over the last (vocab) axis of logits (+ other_logits, if given, e.g. log psi), streaming over chunks of the vocab
+    # with a running max and sum. This way neither exp(logits) nor logits + other_logits is ever materialized at full (..., n_vocab) size,
+    # which is what log_softmax over the whole tensor followed by a gather would do
+    if chunk_size is None:
+        chunk_size = vocab_chunk_size
+    n_vocab = logits.shape[-1]
+
+    def _get_chunk(start, size):
+        chunk = jax.lax.dynamic_slice_in_dim(logits, start, size, axis=-1)
+        if other_logits is not None:
+            chunk = chunk + jax.lax.dynamic_slice_in_dim(other_logits, start, size, axis=-1)
+        return chunk
+
+    dtype = jnp.result_type(logits) if other_logits is None else jnp.result_type(logits, other_logits)
+    running_max_and_sum = _init_running_logsumexp(logits.shape[:-1], dtype)
+
+    n_full_chunks = n_vocab // chunk_size
+    if n_full_chunks > 0:
+        running_max_and_sum = jax.lax.fori_loop(
+            0, n_full_chunks, lambda i, carry: _update_running_logsumexp(carry, _get_chunk(i * chunk_size, chunk_size)), running_max_and_sum)
+    if n_vocab % chunk_size != 0:
+        running_max_and_sum = _update_running_logsumexp(running_max_and_sum, _get_chunk(n_full_chunks * chunk_size, n_vocab % chunk_size))
+
+    return _finalize_running_logsumexp(running_max_and_sum)
+
+
+def _init_running_logsumexp(shape, dtype):
+    # finfo.min instead of -inf so that the first update doesn't do -inf - (-inf)
+    return jnp.full(shape, jnp.finfo(dtype).min, dtype=dtype), jnp.zeros(shape, dtype=dtype)
+
+
+def _update_running_logsumexp(running_max_and_sum, chunk):
+    running_max, running_sum = running_max_and_sum
+    new_max = jnp.maximum(running_max, chunk.max(axis=-1))
+    running_sum = running_sum * jnp.exp(running_max - new_max) + jnp.exp(chunk - new_max[..., None]).sum(axis=-1)
+    return new_max, running_sum
+
+
+def _finalize_running_logsumexp(running_max_and_sum):
+    running_max, running_sum = running_max_and_sum
+    return running_max + jnp.log(running_sum)
+
+
+def _get_p_head_weight(params_p, huggingface_model):
+    # The (d_model, n_vocab) LM head of the base model: the token embeddings when tied (as in CustomLMWithTwistHead.__call__)
+    if isinstance(huggingface_model, HashableDict):
+        params_p = huggingface_model['p'].__self__.huggingface_model.params # CustomLMHeadModel runs with its own params
+    if 'lm_head' in params_p:
+        return params_p['lm_head']['kernel']
+    if 'transformer' in params_p:
+        params_p = params_p['transformer']
+    return jnp.transpose(params_p['wte']['embedding'])
+
+
+def can_score_with_vocab_chunked_heads(huggingface_model, condition_twist_on_tokens, with_log_psi, chunked_heads=None):
+    # Whether score_selected_tokens_vocab_chunked handles this model setup. For log psi, the twist head must have a per token output
+    # (no softmax twist) and there is no conditioning or combined p/psi output; everything else falls back to the full logits
+    # chunked_heads=None means vocab_chunked_heads
+    if chunked_heads is None:
+        chunked_heads = vocab_chunked_heads
+    if not chunked_heads:
+        return False
+    if isinstance(huggingface_model, HashableDict):
+        if getattr(huggingface_model['p'], "__self__", None) is None:
+            return False
+        if not with_log_psi:
+            return True
+        if huggingface_model['call_type'] != "custom":
+            return False
+        model = getattr(huggingface_model['twist'], "__self__", None)
+    else:
+        model = getattr(huggingface_model, "__self__", None)
+        if model is not None and not with_log_psi:
+            return True
+    return model is not None and condition_twist_on_tokens is None and not model.softmax_twist
+
+
+def score_selected_tokens_vocab_chunked(seq, prompt_len, params_p, params_twist, huggingface_model=None, with_log_psi=False,
+                                        chunk_size=None, trunk_embeddings=None):
+    # Scores of the output tokens of seq from the final hidden states, projecting them onto the vocab one chunk at a time,
+    # so that neither the p logits nor the log psi outputs are ever materialized at (batch, output_len, n_vocab) size
+    # (only (batch, output_len, chunk_size) per chunk; jax.checkpoint recomputes a chunk in the backward pass instead of storing all of them).
+    # Returns (selected p logit, logsumexp of the p logits, selected log psi, logsumexp of p logits + log psi), each (batch, output_len);
+    # the last two are None without with_log_psi. Only for the setups in can_score_with_vocab_chunked_heads.
+    # trunk_embeddings (shared trunk only) are the precomputed final hidden states of seq, as in get_sequence_scores
+    if chunk_size is None:
+        chunk_size = vocab_chunk_size
+    seq_selected = seq[:, prompt_len:]
+
+    if trunk_embeddings is None:
+        trunk_embeddings = get_transformer_p_embeddings(params_p, seq, huggingface_model)
+    p_embeddings = trunk_embeddings[:, prompt_len - 1: -1]
+    p_head_weight = _get_p_head_weight(params_p, huggingface_model)
+    n_vocab = p_head_weight.shape[1]
+
+    if with_log_psi:
+        if isinstance(huggingface_model, HashableDict):
+            twist_call = partial(huggingface_model['twist'], input_ids=seq, ret="twist",
+                                 hface_model_params=params_twist[0], params_twist_head=params_twist[1])
+            twist_embeddings = huggingface_model['twist'](input_ids=seq, ret="p_embeddings", hface_model_params=params_twist[0])
+            twist_embeddings = twist_embeddings[:, prompt_len - 1: -1]
+        else:
+            twist_call = partial(huggingface_model, input_ids=seq, ret="twist", params_twist_head=params_twist)
+            twist_embeddings = p_embeddings
+
+    def _update(carry, start, size):
+        p_logits = p_embeddings @ jax.lax.dynamic_slice_in_dim(p_head_weight, start, size, axis=1)
+        in_chunk = (seq_selected >= start) & (seq_selected < start + size)
+        index_in_chunk = jnp.clip(seq_selected - start, 0, size - 1)
+        new_carry = [_update_running_logsumexp(carry[0], p_logits),
+                     carry[1] + jnp.where(in_chunk, gather_selected_tokens(p_logits, index_in_chunk), 0.)]
+        if with_log_psi:
+            log_psi = twist_call(trunk_embeddings=twist_embeddings, twist_token_indices=start + jnp.arange(size))
+            new_carry += [_update_running_logsumexp(carry[2], p_logits + log_psi),
+                          carry[3] + jnp.where(in_chunk, gather_selected_tokens(log_psi, index_in_chunk), 0.)]
+        return tuple(new_carry)
+
+    dtype = p_embeddings.dtype
+    carry = (_init_running_logsumexp(seq_selected.shape, dtype), jnp.zeros(seq_selected.shape, dtype))
+    if with_log_psi:
+        carry += (_init_running_logsumexp(seq_selected.shape, dtype), jnp.zeros(seq_selected.shape, dtype))
+
+    n_full_chunks = n_vocab // chunk_size
+    if n_full_chunks > 0:
+        update_full_chunk = jax.checkpoint(partial(_update, size=chunk_size))
+        carry = jax.lax.fori_loop(0, n_full_chunks, lambda i, carry: update_full_chunk(carry, i * chunk_size), carry)
+    if n_vocab % chunk_size != 0:
+        carry = jax.checkpoint(partial(_update, size=n_vocab % chunk_size))(carry, n_full_chunks * chunk_size)
+
+    if with_log_psi:
+        return carry[1], _finalize_running_logsumexp(carry[0]), carry[3], _finalize_running_logsumexp(carry[2])
+    return carry[1], _finalize_running_logsumexp(carry[0]), None, None
+
+
+def gather_selected_tokens(all_vocab_values, tokens):
+    # all_vocab_values is (batch, seq_len, n_vocab) and tokens is (batch, seq_len); picks out the value for each token
+    return jnp.take_along_axis(all_vocab_values, tokens[..., None], axis=-1)[..., 0]
+
+
+def get_log_p_selected_tokens_from_logits(p_logits, seq, prompt_len, chunk_size=None):
+    # log p(s_t | s_{1:t-1}) for each output token: the selected logit minus the (chunked) logsumexp normalizer,
+    # instead of log_softmax over all of p_logits and then selecting. Returns shape (batch, output_len)
+    p_logits_for_output_time_steps = p_logits[:, prompt_len - 1: -1]
+    return gather_selected_tokens(p_logits_for_output_time_steps, seq[:, prompt_len:]) - chunked_logsumexp(p_logits_for_output_time_steps, chunk_size=chunk_size)
+
 
 # NOTE that what this does is evaluate q(s_1) q(s_2 | s_1) q(s_3 | s_1:2)...
 # Which is equivalent to p(s_1) psi(s_1) / (sum of p(s_1) psi(s_1)) * p(s_2|s_1) psi(s_1:2) / (sum of p(s_2|s_1) psi(s_1:2)) ...
 # which is NOT the same as evaluating p(s_{1:t}) psi(s_{1:t}) / (sum of p(s_{1:t}) psi(s_{1:t})) in general. Only would be the same if "normalization consistency" holds.
 
-@partial(jax.jit, static_argnames=["prompt_len",
-                                   "huggingface_model", "return_cumsum", "return_cumsum_w_last_all"])
+# eos_token_id (None means default_eos_token_id) gives the scores the SMC used for the frozen EOS padding, see mask_log_probs_after_eos
+# chunk_size/chunked_heads None means the module settings vocab_chunk_size/vocab_chunked_heads (see resolve_vocab_chunking)
 def evaluate_normalized_log_q_1_to_t(
     full_seq, params_p, params_twist, prompt_len,
     condition_twist_on_tokens,
-    huggingface_model=None, return_cumsum=False, return_cumsum_w_last_all=False, params_proposal=None):
+    huggingface_model=None, return_cumsum=False, return_cumsum_w_last_all=False, params_proposal=None, eos_token_id=None,
+    chunk_size=None, chunked_heads=None):
+    if eos_token_id is None:
+        eos_token_id = default_eos_token_id
+    chunk_size, chunked_heads = resolve_vocab_chunking(chunk_size, chunked_heads)
+    return evaluate_normalized_log_q_1_to_t_jitted(
+        full_seq, params_p, params_twist, prompt_len, condition_twist_on_tokens, huggingface_model=huggingface_model,
+        return_cumsum=return_cumsum, return_cumsum_w_last_all=return_cumsum_w_last_all, params_proposal=params_proposal,
+        eos_token_id=eos_token_id, chunk_size=chunk_size, chunked_heads=chunked_heads)
+
+
+@partial(jax.jit, static_argnames=["prompt_len",
+                                   "huggingface_model", "return_cumsum", "return_cumsum_w_last_all", "eos_token_id",
+                                   "chunk_size", "chunked_heads"])
+def evaluate_normalized_log_q_1_to_t_jitted(
+    full_seq, params_p, params_twist, prompt_len,
+    condition_twist_on_tokens,
+    huggingface_model=None, return_cumsum=False, return_cumsum_w_last_all=False, params_proposal=None, eos_token_id=None,
+    chunk_size=None, chunked_heads=None):
 
     if params_proposal is None:
         params_to_use = params_twist
     else:
         params_to_use = params_proposal
 
+    if not return_cumsum_w_last_all and can_score_with_vocab_chunked_heads(huggingface_model, condition_twist_on_tokens, with_log_psi=True,
+                                                                           chunked_heads=chunked_heads):
+        # Same as the selected token path at the end, without ever making the full p logits or log psi
+        selected_p_logits, _, selected_log_psi, p_plus_log_psi_logsumexp = score_selected_tokens_vocab_chunked(
+            full_seq, prompt_len, params_p, params_to_use, huggingface_model, with_log_psi=True, chunk_size=chunk_size)
+        normalized_log_q_t_across_t = mask_log_probs_after_eos(
+            selected_p_logits + selected_log_psi - p_plus_log_psi_logsumexp, full_seq, prompt_len, eos_token_id)
+        if return_cumsum:
+            return jnp.cumsum(normalized_log_q_t_across_t, axis=-1)
+        return normalized_log_q_t_across_t.sum(axis=-1)
+
     p_logits, log_psi_all_vocab = get_p_logits_and_log_psi_all_vocab(
         full_seq, params_p, params_to_use,
         condition_twist_on_tokens,
         huggingface_model, prompt_len=prompt_len)  # NOTE: purposefully do not send in params_proposal here. Because this is only called within the q sampling, and that should be the original twisted proposal p psi, not q/p * psi'
 
-    log_p_t = jax.nn.log_softmax(p_logits, axis=-1)[:, prompt_len - 1: -1]
     # log_psi = log_psi_all_vocab[:, prompt_len - 1: -1]
     log_psi = log_psi_all_vocab
-    log_p_plus_log_psi_all_vocab = log_p_t + log_psi
-    normalized_log_q_t_all_vocab = jax.nn.log_softmax(log_p_plus_log_psi_all_vocab, axis=-1)
-
     seq_selected = full_seq[:, prompt_len:]
-    normalized_log_q_t_across_t = normalized_log_q_t_all_vocab[
-        jnp.arange(seq_selected.shape[0])[:, None], jnp.arange(
-            seq_selected.shape[1]), seq_selected]
 
     if return_cumsum_w_last_all:
         assert not return_cumsum
+        # No EOS masking here: this is only used for log psi with params_proposal (get_log_psi_all_vocab), where the value at each
+        # t only uses the tokens before t, so the positions up to the first EOS are unaffected and freeze_log_psi_after_eos does the rest
+        # This needs q and p for all tokens at each t, so here we do need the full (batch, output_len, n_vocab) tensors
+        log_p_t = jax.nn.log_softmax(p_logits, axis=-1)[:, prompt_len - 1: -1]
+        log_p_plus_log_psi_all_vocab = log_p_t + log_psi
+        normalized_log_q_t_all_vocab = jax.nn.log_softmax(log_p_plus_log_psi_all_vocab, axis=-1)
+        normalized_log_q_t_across_t = gather_selected_tokens(normalized_log_q_t_all_vocab, seq_selected)
         # print("return_cumsum_w_last_all")
         normalized_log_q_1_to_t_cumsum = jnp.cumsum(normalized_log_q_t_across_t, axis=-1)
         # print(normalized_log_q_1_to_t_cumsum.shape)
@@ -378,9 +1192,7 @@ def evaluate_normalized_log_q_1_to_t(
         # print(normalized_log_q_1_to_t_minus_1_with_t_all_vocab)
         # print(normalized_log_q_1_to_t_cumsum)
 
-        log_p_t_across_t = log_p_t[
-            jnp.arange(seq_selected.shape[0])[:, None], jnp.arange(
-                seq_selected.shape[1]), seq_selected]
+        log_p_t_across_t = gather_selected_tokens(log_p_t, seq_selected)
         log_p_1_to_t_cumsum = jnp.cumsum(log_p_t_across_t, axis=-1)
         # print(log_p_1_to_t_cumsum.shape)
         log_p_1_to_t_minus_1 = jnp.concatenate((jnp.zeros((log_p_1_to_t_cumsum.shape[0], 1)), log_p_1_to_t_cumsum[:, :-1]), axis=-1)
@@ -398,6 +1210,13 @@ def evaluate_normalized_log_q_1_to_t(
         # Then we can do something similar for p(1 to t), also need this cumsum structure
         # then we can do log psi = log (q/p psi') = log q - log p + log psi' where we directly parameterize log psi' (50257 output). Then this gets plugged into everywhere we have log psi normally.
 
+    # log q(s_t | s_{1:t-1}) = log softmax(log softmax(p logits) + log psi)[s_t] = (p logit + log psi)[s_t] - logsumexp(p logits + log psi)
+    # (the log softmax normalizer of p cancels), so we only need the selected entries and one (chunked) logsumexp
+    p_logits_t = p_logits[:, prompt_len - 1: -1]
+    normalized_log_q_t_across_t = gather_selected_tokens(p_logits_t, seq_selected) + gather_selected_tokens(log_psi, seq_selected) \
+                                  - chunked_logsumexp(p_logits_t, log_psi, chunk_size=chunk_size)
+    normalized_log_q_t_across_t = mask_log_probs_after_eos(normalized_log_q_t_across_t, full_seq, prompt_len, eos_token_id)
+
     if return_cumsum:
         normalized_log_q_1_to_t_cumsum = jnp.cumsum(normalized_log_q_t_across_t, axis=-1)
         return normalized_log_q_1_to_t_cumsum
@@ -409,12 +1228,143 @@ def evaluate_normalized_log_q_1_to_t(
     return normalized_log_q_1_to_t
 
 
+class SequenceScores(NamedTuple):
+    # Per token scores for the output tokens of a batch of sequences, each of shape (batch, output_len); see get_sequence_scores
+    log_p: jnp.ndarray # log p(s_t | s_{1:t-1})
+    log_psi: Optional[jnp.ndarray] # log psi_t(s_{1:t}) (None if not asked for and not free)
+    normalized_log_q: jnp.ndarray # log q(s_t | s_{1:t-1}) of the proposal (log_p if proposal_is_p)
+    log_p_all_vocab: Optional[jnp.ndarray] = None # (batch, output_len, n_vocab) versions, only with with_all_vocab
+    log_psi_all_vocab: Optional[jnp.ndarray] = None
 
-def evaluate_log_psi_t(seq, params_twist, condition_twist_on_tokens,   huggingface_model=None):
+    @property
+    def log_p_1_to_t(self):
+        return jnp.cumsum(self.log_p, axis=-1)
+
+    @property
+    def normalized_log_q_1_to_t(self):
+        return jnp.cumsum(self.normalized_log_q, axis=-1)
+
+    @property
+    def log_p_total(self):
+        return self.log_p.sum(axis=-1)
+
+    @property
+    def normalized_log_q_total(self):
+        return self.normalized_log_q.sum(axis=-1)
+
+
+def get_sequence_scores(
+    seq, prompt_len, params_p, params_twist, condition_twist_on_tokens,
+    huggingface_model=None, proposal_is_p=False, params_proposal=None, with_log_psi=True, with_all_vocab=False,
+    trunk_embeddings=None, eos_token_id=None, chunk_size=None, chunked_heads=None
+):
+    # The score table for seq: log p, log psi (of the learned twist, with params_proposal handled as in get_log_psi_all_vocab)
+    # and the normalized log q of the proposal, from one forward pass of p and one of each twist that's needed.
+    # Use this instead of separate evaluate_log_p_theta_1_to_t / evaluate_normalized_log_q_1_to_t / evaluate_log_psi_selected_tokens
+    # calls on the same sequences, which would each run the models again.
+    # With the shared trunk, trunk_embeddings (get_transformer_p_embeddings of seq) skips the trunk forward pass altogether.
+    # With eos_token_id (None means default_eos_token_id), the scores after the first EOS are those the SMC used (see mask_log_probs_after_eos)
+    # chunk_size/chunked_heads None means the module settings (see resolve_vocab_chunking)
+    if eos_token_id is None:
+        eos_token_id = default_eos_token_id
+    chunk_size, chunked_heads = resolve_vocab_chunking(chunk_size, chunked_heads)
+    return get_sequence_scores_jitted(
+        seq, prompt_len, params_p, params_twist, condition_twist_on_tokens, huggingface_model=huggingface_model,
+        proposal_is_p=proposal_is_p, params_proposal=params_proposal, with_log_psi=with_log_psi, with_all_vocab=with_all_vocab,
+        trunk_embeddings=trunk_embeddings, eos_token_id=eos_token_id, chunk_size=chunk_size, chunked_heads=chunked_heads)
+
+
+def mask_sequence_scores_after_eos(scores, seq, prompt_len, eos_token_id):
+    if eos_token_id is None:
+        return scores
+    log_psi, log_p_all_vocab, log_psi_all_vocab = scores.log_psi, scores.log_p_all_vocab, scores.log_psi_all_vocab
+    if log_psi is not None:
+        log_psi = freeze_log_psi_after_eos(log_psi, seq, prompt_len, eos_token_id)
+    if log_p_all_vocab is not None:
+        log_p_all_vocab = mask_log_p_all_vocab_after_eos(log_p_all_vocab, seq, prompt_len, eos_token_id)
+    if log_psi_all_vocab is not None:
+        log_psi_all_vocab = freeze_log_psi_after_eos(log_psi_all_vocab, seq, prompt_len, eos_token_id)
+    return SequenceScores(mask_log_probs_after_eos(scores.log_p, seq, prompt_len, eos_token_id), log_psi,
+                          mask_log_probs_after_eos(scores.normalized_log_q, seq, prompt_len, eos_token_id),
+                          log_p_all_vocab, log_psi_all_vocab)
+
+
+@partial(jax.jit, static_argnames=["prompt_len", "huggingface_model", "proposal_is_p", "with_log_psi", "with_all_vocab", "eos_token_id",
+                                   "chunk_size", "chunked_heads"])
+def get_sequence_scores_jitted(
+    seq, prompt_len, params_p, params_twist, condition_twist_on_tokens,
+    huggingface_model=None, proposal_is_p=False, params_proposal=None, with_log_psi=True, with_all_vocab=False,
+    trunk_embeddings=None, eos_token_id=None, chunk_size=None, chunked_heads=None
+):
+    return mask_sequence_scores_after_eos(_get_sequence_scores(
+        seq, prompt_len, params_p, params_twist, condition_twist_on_tokens, huggingface_model=huggingface_model,
+        proposal_is_p=proposal_is_p, params_proposal=params_proposal, with_log_psi=with_log_psi, with_all_vocab=with_all_vocab,
+        trunk_embeddings=trunk_embeddings, chunk_size=chunk_size, chunked_heads=chunked_heads), seq, prompt_len, eos_token_id)
+
+
+def _get_sequence_scores(
+    seq, prompt_len, params_p, params_twist, condition_twist_on_tokens,
+    huggingface_model=None, proposal_is_p=False, params_proposal=None, with_log_psi=True, with_all_vocab=False,
+    trunk_embeddings=None, chunk_size=None, chunked_heads=None
+):
+    seq_selected = seq[:, prompt_len:]
+
+    if not with_all_vocab and params_proposal is None \
+            and can_score_with_vocab_chunked_heads(huggingface_model, condition_twist_on_tokens, with_log_psi or not proposal_is_p,
+                                                   chunked_heads=chunked_heads):
+        # The same scores, computed vocab chunk by vocab chunk from the final hidden states (see score_selected_tokens_vocab_chunked)
+        selected_p_logits, p_logsumexp, log_psi, p_plus_log_psi_logsumexp = score_selected_tokens_vocab_chunked(
+            seq, prompt_len, params_p, params_twist, huggingface_model, with_log_psi=with_log_psi or not proposal_is_p,
+            chunk_size=chunk_size, trunk_embeddings=trunk_embeddings)
+        log_p = selected_p_logits - p_logsumexp
+        if proposal_is_p:
+            return SequenceScores(log_p, log_psi, log_p)
+        return SequenceScores(log_p, log_psi, selected_p_logits + log_psi - p_plus_log_psi_logsumexp)
+
+    log_psi_all_vocab = None
+    log_psi_all_vocab_for_q = None
+    if params_proposal is None and (with_log_psi or not proposal_is_p):
+        # The learned twist is also the proposal twist, so one (p, twist) forward gives everything
+        p_logits, log_psi_all_vocab = get_p_logits_and_log_psi_all_vocab(
+            seq, params_p, params_twist, condition_twist_on_tokens, huggingface_model, prompt_len=prompt_len,
+            trunk_embeddings=trunk_embeddings)
+        log_psi_all_vocab_for_q = log_psi_all_vocab
+    elif with_log_psi:
+        p_logits, log_psi_all_vocab = get_p_logits_and_log_psi_all_vocab(
+            seq, params_p, params_twist, condition_twist_on_tokens, huggingface_model,
+            params_proposal=params_proposal, prompt_len=prompt_len, trunk_embeddings=trunk_embeddings)
+    else:
+        p_logits = get_transformer_p_logits(params_p, seq, huggingface_model=huggingface_model, trunk_embeddings=trunk_embeddings)
+    if params_proposal is not None and not proposal_is_p:
+        log_psi_all_vocab_for_q = get_log_psi_all_vocab(
+            seq, params_proposal, condition_twist_on_tokens, huggingface_model, prompt_len=prompt_len)
+
+    p_logits_t = p_logits[:, prompt_len - 1: -1]
+    selected_p_logits = gather_selected_tokens(p_logits_t, seq_selected)
+    log_p = selected_p_logits - chunked_logsumexp(p_logits_t, chunk_size=chunk_size)
+
+    if proposal_is_p:
+        normalized_log_q = log_p
+    else:
+        # Same as in evaluate_normalized_log_q_1_to_t: the log softmax normalizer of p cancels
+        normalized_log_q = selected_p_logits + gather_selected_tokens(log_psi_all_vocab_for_q, seq_selected) \
+                           - chunked_logsumexp(p_logits_t, log_psi_all_vocab_for_q, chunk_size=chunk_size)
+
+    log_psi = None
+    if log_psi_all_vocab is not None:
+        log_psi = gather_selected_tokens(log_psi_all_vocab, seq_selected)
+
+    if with_all_vocab:
+        return SequenceScores(log_p, log_psi, normalized_log_q, jax.nn.log_softmax(p_logits_t, axis=-1), log_psi_all_vocab)
+    return SequenceScores(log_p, log_psi, normalized_log_q)
+
+
+def evaluate_log_psi_t(seq, params_twist, condition_twist_on_tokens,   huggingface_model=None, condition_twist_on_embeddings=None):
     # Takes in sequences s_{1:t} of (n_batch, seq_length) shape
     # Evaluate log psi (s_{1:t})
 
-    log_psi = get_log_psi_all_vocab(seq, params_twist, condition_twist_on_tokens,  huggingface_model=huggingface_model)
+    log_psi = get_log_psi_all_vocab(seq, params_twist, condition_twist_on_tokens,  huggingface_model=huggingface_model,
+                                    condition_twist_on_embeddings=condition_twist_on_embeddings)
 
     # If I use a single transformer, essentially I am doing a kind of weight tying between the different psi_t (which should be desirable)
     # I could use a separate transformer for each psi_t but that seems a little inefficient
@@ -434,21 +1384,37 @@ def evaluate_log_psi_t(seq, params_twist, condition_twist_on_tokens,   huggingfa
     # return log_psi[:,-2,:][jnp.arange(seq.shape[0]), seq[:,-1]]
     return log_psi[:,-1,:][jnp.arange(seq.shape[0]), seq[:,-1]]
 
-@partial(jax.jit, static_argnames = ["prompt_len", "huggingface_model"])
 # Evaluate log psi_t for every t from 1 to T for the sequence seq (not including the prompt)
+# With eos_token_id (None means default_eos_token_id), psi stays at its value at the first EOS, as in the SMC (see freeze_log_psi_after_eos)
 def evaluate_log_psi_selected_tokens(seq, prompt_len, params_twist,
                                      condition_twist_on_tokens,   huggingface_model=None,
-                                     params_proposal=None, params_p=None
+                                     params_proposal=None, params_p=None, condition_twist_on_embeddings=None,
+                                     trunk_embeddings=None, eos_token_id=None
                                      ):
+    if eos_token_id is None:
+        eos_token_id = default_eos_token_id
+    return evaluate_log_psi_selected_tokens_jitted(
+        seq, prompt_len, params_twist, condition_twist_on_tokens, huggingface_model=huggingface_model,
+        params_proposal=params_proposal, params_p=params_p, condition_twist_on_embeddings=condition_twist_on_embeddings,
+        trunk_embeddings=trunk_embeddings, eos_token_id=eos_token_id)
+
+
+@partial(jax.jit, static_argnames = ["prompt_len", "huggingface_model", "eos_token_id"])
+def evaluate_log_psi_selected_tokens_jitted(seq, prompt_len, params_twist,
+                                            condition_twist_on_tokens,   huggingface_model=None,
+                                            params_proposal=None, params_p=None, condition_twist_on_embeddings=None,
+                                            trunk_embeddings=None, eos_token_id=None
+                                            ):
     log_psi = get_log_psi_all_vocab(
         seq, params_twist, condition_twist_on_tokens,
          huggingface_model=huggingface_model,
-        params_proposal=params_proposal, params_p=params_p, prompt_len=prompt_len
+        params_proposal=params_proposal, params_p=params_p, prompt_len=prompt_len,
+        condition_twist_on_embeddings=condition_twist_on_embeddings, trunk_embeddings=trunk_embeddings
     )
     # log_psi_selected = log_psi[:, prompt_len - 1: -1]
     log_psi_selected = log_psi
     seq_selected = seq[:, prompt_len: ]
-    return log_psi_selected[jnp.arange(seq_selected.shape[0])[:, None], jnp.arange(seq_selected.shape[1]), seq_selected]
+    return freeze_log_psi_after_eos(gather_selected_tokens(log_psi_selected, seq_selected), seq, prompt_len, eos_token_id)
 
 def get_log_p_all_tokens(seq, params_p, huggingface_model=None):
     p_logits = get_transformer_p_logits(params_p, seq,
@@ -457,21 +1423,29 @@ def get_log_p_all_tokens(seq, params_p, huggingface_model=None):
     return log_p
 
 
-def evaluate_log_p_selected_tokens(seq, prompt_len, params_p, huggingface_model=None):
+def evaluate_log_p_selected_tokens(seq, prompt_len, params_p, huggingface_model=None, chunk_size=None, chunked_heads=None):
     # p_logits = get_transformer_p_logits(params_p, seq, huggingface_model=huggingface_model)
     # log_p = jax.nn.log_softmax(p_logits, axis=-1)
-    log_p = get_log_p_all_tokens(seq, params_p, huggingface_model)
-    log_p_selected = log_p[:, prompt_len - 1: -1]
-    seq_selected = seq[:, prompt_len: ]
-    return log_p_selected[jnp.arange(seq_selected.shape[0])[:, None], jnp.arange(seq_selected.shape[1]), seq_selected]
+    # Not jitted itself; inside a jitted caller, chunk_size/chunked_heads None means the module settings when it was traced
+    if can_score_with_vocab_chunked_heads(huggingface_model, None, with_log_psi=False, chunked_heads=chunked_heads):
+        selected_p_logits, p_logsumexp, _, _ = score_selected_tokens_vocab_chunked(seq, prompt_len, params_p, None, huggingface_model,
+                                                                                   chunk_size=chunk_size)
+        return selected_p_logits - p_logsumexp
+    p_logits = get_transformer_p_logits(params_p, seq, huggingface_model=huggingface_model)
+    return get_log_p_selected_tokens_from_logits(p_logits, seq, prompt_len, chunk_size=chunk_size)
 
 
 # THIS ONLY WORKS ASSUMING in the case e.g. of phi = e^(-beta r(s)), then log phi = -beta r(s)
-def evaluate_log_phi_final(seq, log_true_final_twist, condition_twist_on_tokens=None):
+# kv_cache is the cache left by the final SMC step; it is only passed on to final twists that can use it (accepts_kv_cache set,
+# e.g. the p_continuation ones in reward_models), which then only need to run p over the tokens after seq
+def evaluate_log_phi_final(seq, log_true_final_twist, condition_twist_on_tokens=None, kv_cache=None):
+    kwargs = {}
+    if kv_cache is not None and getattr(log_true_final_twist, "accepts_kv_cache", False):
+        kwargs["kv_cache"] = kv_cache
     if condition_twist_on_tokens is None:
-        return log_true_final_twist(seq)
+        return log_true_final_twist(seq, **kwargs)
     else:
-        return log_true_final_twist(seq, condition_twist_on_tokens)
+        return log_true_final_twist(seq, condition_twist_on_tokens, **kwargs)
 
 # def evaluate_unnormalized_log_q_t_given_1_to_t_minus_1_final(seq, params_p, log_true_final_twist):
 #     # Takes in batches of sequences s_{1:t}
@@ -479,8 +1453,9 @@ def evaluate_log_phi_final(seq, log_true_final_twist, condition_twist_on_tokens=
 #     # Evaluates p(s_t | s_{1:t-1}) psi(s_{1:t})  (IS UNNORMALIZED)
 #     return evaluate_log_p_theta_t(seq, params_p) + evaluate_log_phi_final(seq, log_true_final_twist)
 
-def evaluate_log_p_theta_1_to_t(seq, params_p, prompt_len, output_len, output_log_p_for_each_t=False, huggingface_model=None):
+def evaluate_log_p_theta_1_to_t(seq, params_p, prompt_len, output_len, output_log_p_for_each_t=False, huggingface_model=None, eos_token_id=None):
     # Evaluate log p_theta(s_{1:t}) (given the prompt)
+    # With eos_token_id (None means default_eos_token_id), the tokens after the first EOS have p = 1, as in the SMC
 
     # This is a slow version used for a check
     # log_p = 0.
@@ -490,24 +1465,13 @@ def evaluate_log_p_theta_1_to_t(seq, params_p, prompt_len, output_len, output_lo
     # seq has shape (batch, seq_len) (NOTE: seq_len includes prompt_len + output_len)
     # p_logits = get_transformer_p_logits(params_p, seq, huggingface_model=huggingface_model)
     # log_p_all_tokens = jax.nn.log_softmax(p_logits, axis=-1)
-    log_p_all_tokens = get_log_p_all_tokens(seq, params_p, huggingface_model)
-    # log_p_all_tokens has shape (batch, seq_len, n_vocab)
-
-    output_tokens = seq[:, prompt_len:]
-    log_p_all_tokens_for_output_time_steps = log_p_all_tokens[:, prompt_len-1:-1, :] # I do this because, e.g. for the first output token, you want the log_p that was generated by the transformer after the last token of the prompt was fed into it. Therefore if the prompt_len is 4, you want position 3 (in 0 based indexing), as that's the 4th token that was passed in, and that gives you logits for the first output token
-    # log_p_all_tokens_for_output_time_steps has shape (batch, output_len, n_vocab)
-
-    # The way this line below works is: the first arange is appended an additional axis to have shape (batch, 1)
-    # The second arange has shape (output_len,).
-    # The way numpy broadcasting works is it checks dimensions from right to left, and requires either a match
-    # or one of the axes to be 1. Since output_tokens has shape (batch, output_len), then the second arange broadcasts fine,
-    # whereas the first one needs an additional axis to broadcast. Then, we have 3 arrays all broadcast to shape (batch, output_len)
-    # The first broadcast array has all 0s in the first row, then all 1s, etc.
-    # The second broadcast array has 0,1,2... in the first row, and in every row
-    # The third array is just the indices of the tokens we want to extract
-    # Finally, jax takes our 3 indices for each of the batch*output_len items, applies across the 3 axes of log_p_all_tokens
-    # for each of the batch*output_len items, resulting in our final matrix of shape (batch, output_len)
-    log_p_select_tokens = log_p_all_tokens_for_output_time_steps[jnp.arange(seq.shape[0])[:, None], jnp.arange(output_tokens.shape[-1]), output_tokens]
+    # We use the logits from position prompt_len - 1 to -1 because, e.g. for the first output token, you want the log_p that was generated by the transformer after the last token of the prompt was fed into it. Therefore if the prompt_len is 4, you want position 3 (in 0 based indexing), as that's the 4th token that was passed in, and that gives you logits for the first output token
+    # Only the selected logits and the log softmax normalizers are computed (see evaluate_log_p_selected_tokens),
+    # rather than the full (batch, output_len, n_vocab) log_softmax, resulting in our final matrix of shape (batch, output_len)
+    log_p_select_tokens = evaluate_log_p_selected_tokens(seq, prompt_len, params_p, huggingface_model=huggingface_model)
+    if eos_token_id is None:
+        eos_token_id = default_eos_token_id
+    log_p_select_tokens = mask_log_probs_after_eos(log_p_select_tokens, seq, prompt_len, eos_token_id)
 
     # output_log_p_for_each_t means returning log_p_theta_t for each of the individual time steps t. (e.g. p(s_t|s_1:t-1), ... , p(s_2|s_1), p(s_1) )
     # The default is False, in which case we would return the sum, e.g. a single probability for the sequence from 1 to t (given the prompt)
@@ -560,25 +1524,143 @@ def evaluate_log_p_theta_t_full_seq(full_seq, params_p, prompt_len_plus_t, huggi
 
 
 
+def _inverse_cdf_indices(normalized_w, uniforms):
+    # For each u in uniforms (in [0, 1)), find the index i with cdf[i-1] <= u < cdf[i]. O(N log N) via searchsorted
+    # Uniforms are scaled by cdf[-1] so that float error in the cumsum can't push us past the last index
+    cdf = jnp.cumsum(normalized_w)
+    indices = jnp.searchsorted(cdf, uniforms * cdf[-1], side='right')
+    return jnp.clip(indices, 0, normalized_w.shape[0] - 1)
+
+
+def _get_resampling_uniforms(rng_key, n_samples, resampling_scheme):
+    if resampling_scheme == "multinomial":
+        # Independent uniforms; same distribution as the categorical draws, without the N x N Gumbel noise
+        return jax.random.uniform(rng_key, (n_samples,))
+    elif resampling_scheme == "stratified":
+        # One uniform within each of the n_samples strata [i/n, (i+1)/n)
+        return (jnp.arange(n_samples) + jax.random.uniform(rng_key, (n_samples,))) / n_samples
+    elif resampling_scheme == "systematic":
+        # Same as stratified but with a single shared offset
+        return (jnp.arange(n_samples) + jax.random.uniform(rng_key, ())) / n_samples
+    else:
+        raise NotImplementedError
+
+
+def _residual_resample_indices(rng_key, normalized_w, n_samples):
+    # Deterministically keep floor(n w_i) copies of particle i, then fill the remaining slots by multinomial resampling on the leftover weights
+    # Everything is fixed size (n_samples) so this works under jit; jnp.where picks the deterministic copies for the first n_deterministic slots
+    n_copies = jnp.floor(n_samples * normalized_w).astype(jnp.int32)
+    n_deterministic = n_copies.sum()
+    deterministic_indices = jnp.searchsorted(jnp.cumsum(n_copies), jnp.arange(n_samples), side='right')
+    residual_w = n_samples * normalized_w - n_copies
+    residual_indices = _inverse_cdf_indices(residual_w, jax.random.uniform(rng_key, (n_samples,)))
+    return jnp.where(jnp.arange(n_samples) < n_deterministic, deterministic_indices, residual_indices)
+
+
+def resample_indices(rng_key, log_w, n_samples, resampling_scheme="categorical"):
+    # Draw n_samples ancestor indices according to the (unnormalized) log weights log_w
+    # "categorical" is the original jax.random.categorical approach, which draws a Gumbel vector of size N for every one of the n_samples draws (O(N^2) time and memory)
+    # The others are inverse cdf methods using cumsum and searchsorted (O(N log N)). Multinomial has the same distribution as categorical;
+    # stratified, systematic and residual are lower variance, while still giving unbiased Z estimates.
+    if resampling_scheme == "categorical":
+        return jax.random.categorical(rng_key, log_w, shape=(n_samples,))
+    normalized_w = jax.nn.softmax(log_w)
+    if resampling_scheme == "residual":
+        return _residual_resample_indices(rng_key, normalized_w, n_samples)
+    uniforms = _get_resampling_uniforms(rng_key, n_samples, resampling_scheme)
+    return _inverse_cdf_indices(normalized_w, uniforms)
+
+
+def conditional_resample_indices(rng_key, log_w, resampling_scheme="categorical"):
+    # Ancestors for the N-1 free particles in conditional SMC (the true posterior sample stays at index 0).
+    # The conditional SMC kernel needs these to be independent draws from the weights, otherwise it no longer leaves the
+    # target invariant and the upper bounds on log Z (smc_backward) are not valid. So stratified, systematic and residual
+    # fall back to multinomial here.
+    if resampling_scheme != "categorical":
+        resampling_scheme = "multinomial"
+    return resample_indices(rng_key, log_w, log_w.shape[0] - 1, resampling_scheme)
+
+
+def _smc_resample_particles(subkey, operands, true_posterior_sample=None, resampling_scheme="categorical"):
+    full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, log_r_psi_t_eval, kv_cache = operands
+
+    if true_posterior_sample is not None:
+        # Keep the true posterior sample at index 0, and resample the rest
+        a_t = conditional_resample_indices(subkey, log_w_t, resampling_scheme)
+
+        full_seq = full_seq.at[1:].set(full_seq[a_t])
+        kv_cache = reorder_kv_cache(kv_cache, a_t, true_posterior_sample)
+        log_gamma_1_to_t_eval = log_gamma_1_to_t_eval.at[1:].set(log_gamma_1_to_t_eval[a_t])
+        log_p_theta_1_to_t_eval = log_p_theta_1_to_t_eval.at[1:].set(log_p_theta_1_to_t_eval[a_t])
+        log_r_psi_t_eval = log_r_psi_t_eval.at[1:].set(log_r_psi_t_eval[a_t])
+
+    else:
+        a_t = resample_indices(subkey, log_w_t, log_w_t.shape[0], resampling_scheme)
+
+        full_seq = full_seq[a_t]
+
+        # The KV caches have to follow the particles too
+        kv_cache = reorder_kv_cache(kv_cache, a_t)
+
+        # Make sure the gamma values also track the correct trajectories
+        log_gamma_1_to_t_eval = log_gamma_1_to_t_eval[a_t]
+
+        # Same for the p values:
+        log_p_theta_1_to_t_eval = log_p_theta_1_to_t_eval[a_t]
+
+        log_r_psi_t_eval = log_r_psi_t_eval[a_t]
+
+    log_w_t = jnp.zeros_like(log_w_t) # (for the true posterior sample case, still set all the weights to 0)
+
+    return full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, log_r_psi_t_eval, kv_cache
+
+
+def _smc_no_resample_particles(subkey, operands, true_posterior_sample=None, resample_for_log_psi_t_eval_list=False, resampling_scheme="categorical"):
+    # Other branch of the lax.cond for the ESS criterion; see the comments on resample_for_log_psi_t_eval_list in smc_scan_iter_non_final
+    full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, log_r_psi_t_eval, kv_cache = operands
+    if resample_for_log_psi_t_eval_list:
+        if true_posterior_sample is not None:
+            raise NotImplementedError
+        a_t = resample_indices(subkey, log_w_t, log_w_t.shape[0], resampling_scheme)
+        log_r_psi_t_eval = log_r_psi_t_eval[a_t]
+    return full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, log_r_psi_t_eval, kv_cache
+
+
 def smc_scan_iter_non_final(
     carry, t, condition_twist_on_tokens, resample=True,
     true_posterior_sample=None, proposal_is_p=False, huggingface_model=None, resample_for_log_psi_t_eval_list=False,
-    tempered_twist=False, beta_prop=None, params_proposal=None, prompt_len=None, resample_criterion="every_step"
+    tempered_twist=False, beta_prop=None, params_proposal=None, prompt_len=None, resample_criterion="every_step",
+    resampling_scheme="categorical", eos_token_id=None, proposal_top_k=None, proposal_top_p=None
 ):
     rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, \
     output_len, params_p, params_twist, \
-    log_z_hat_t = carry
+    log_z_hat_t, kv_cache, condition_twist_on_embeddings = carry
 
     log_w_t_minus_1 = log_w_t
 
+    if eos_token_id is not None:
+        finished = get_eos_finished_mask(full_seq, prompt_len, t, eos_token_id)
+        log_r_psi_t_minus_1_eval = log_gamma_1_to_t_eval - log_p_theta_1_to_t_eval
+
     # print(log_w_t)
 
-    rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs = get_proposal_q_sample(
-        rng_key, full_seq, params_p, params_twist, prompt_len, t,
-        condition_twist_on_tokens,  proposal_is_p=proposal_is_p,
-        huggingface_model=huggingface_model, true_posterior_sample=true_posterior_sample,
-        tempered_twist=tempered_twist, beta_prop=beta_prop, params_proposal=params_proposal
-    )
+    if kv_cache is not None:
+        assert params_proposal is None
+        rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs, kv_cache = get_proposal_q_sample_kv_cache(
+            rng_key, full_seq, kv_cache, params_p, params_twist, prompt_len, t,
+            condition_twist_on_tokens, proposal_is_p=proposal_is_p,
+            huggingface_model=huggingface_model, true_posterior_sample=true_posterior_sample,
+            tempered_twist=tempered_twist, beta_prop=beta_prop, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p,
+            condition_twist_on_embeddings=condition_twist_on_embeddings
+        )
+    else:
+        rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs = get_proposal_q_sample(
+            rng_key, full_seq, params_p, params_twist, prompt_len, t,
+            condition_twist_on_tokens,  proposal_is_p=proposal_is_p,
+            huggingface_model=huggingface_model, true_posterior_sample=true_posterior_sample,
+            tempered_twist=tempered_twist, beta_prop=beta_prop, params_proposal=params_proposal, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p,
+            condition_twist_on_embeddings=condition_twist_on_embeddings
+        )
 
     log_p_theta_t_eval = log_p_eval_of_new_seqs
 
@@ -593,6 +1675,9 @@ def smc_scan_iter_non_final(
     #                                                params_twist,
     #                                                prompt_len + t, condition_twist_on_tokens, token_of_interest_as_int)
     log_r_psi_t_eval = log_psi_eval_of_new_seqs
+    if eos_token_id is not None:
+        # Frozen (finished) particles keep their twist value; with the EOS padding having p = q = 1, their incremental weight is exactly 1
+        log_r_psi_t_eval = jnp.where(finished, log_r_psi_t_minus_1_eval, log_r_psi_t_eval)
 
     log_gamma_1_to_t_eval = log_p_theta_1_to_t_eval + log_r_psi_t_eval
 
@@ -638,63 +1723,34 @@ def smc_scan_iter_non_final(
     do_resample = resample
     ess = None
     if resample:
-        do_resample = True
-        if resample_criterion == "ESS":
-            # TODO FEB if this actually works well and I have to rerun expmts, then I have to figure out how to do the scan with this, otherwise that has to go outside the loop somehow, probably I have to move the resampling operation out of the jitted part.
-            # check ESS criteria, if true, then do_resample = True, otherwise False
-            normalized_w_ts = jax.nn.softmax(log_w_t)
-            ess = 1. / (normalized_w_ts ** 2).sum()
-            if ess < normalized_w_ts.shape[0] / 2:
-                do_resample = True
-            else:
-                do_resample = False
-
-    if do_resample:
-        # Do resampling
-
-        if true_posterior_sample is not None:
-            rng_key, subkey = jax.random.split(rng_key)
-
-            a_t = jax.random.categorical(subkey, log_w_t, shape=log_w_t[1:].shape)
-
-            full_seq = full_seq.at[1:].set(full_seq[a_t])
+        # ESS is cheap to compute, so we record it regardless of the resample criterion
+        normalized_w_ts = jax.nn.softmax(log_w_t)
+        ess = 1. / (normalized_w_ts ** 2).sum()
 
-            log_gamma_1_to_t_eval = log_gamma_1_to_t_eval.at[1:].set(log_gamma_1_to_t_eval[a_t])
+        log_w_t_before_resample = log_w_t
 
-            log_p_theta_1_to_t_eval = log_p_theta_1_to_t_eval.at[1:].set(log_p_theta_1_to_t_eval[a_t])
+        rng_key, subkey = jax.random.split(rng_key)
 
-            log_w_t_before_resample = log_w_t
-
-            log_w_t = jnp.zeros_like(log_w_t) # still set all the weights to 0
-
-            log_r_psi_t_eval_w_potential_resample = log_r_psi_t_eval.at[1:].set(log_r_psi_t_eval[a_t])
-
-            # print("true posterior sample stuff")
-            # print(full_seq)
-            # print(log_gamma_1_to_t_eval)
-            # print(log_gamma_1_to_t_minus_1_eval)
-            # print(normalized_log_q_t)
-            # print(log_w_t)
-            # print(log_w_t_minus_1)
+        resample_operands = (full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, log_r_psi_t_eval, kv_cache)
+        resample_fn = partial(_smc_resample_particles, subkey, true_posterior_sample=true_posterior_sample,
+                              resampling_scheme=resampling_scheme)
 
+        if resample_criterion == "ESS":
+            # Only resample when the ESS drops below N/2. do_resample is a traced value here, so instead of a python if
+            # (which doesn't work under jit/lax.scan) we use lax.cond, which also skips the resampling gathers when they're not needed
+            do_resample = ess < normalized_w_ts.shape[0] / 2
+            no_resample_fn = partial(_smc_no_resample_particles, subkey, true_posterior_sample=true_posterior_sample,
+                                     resample_for_log_psi_t_eval_list=resample_for_log_psi_t_eval_list,
+                                     resampling_scheme=resampling_scheme)
+            resample_outputs = jax.lax.cond(do_resample, resample_fn, no_resample_fn, resample_operands)
         else:
-            rng_key, subkey = jax.random.split(rng_key)
-
-            a_t = jax.random.categorical(subkey, log_w_t, shape=log_w_t.shape)
+            assert resample_criterion == "every_step"
+            do_resample = True
+            resample_outputs = resample_fn(resample_operands)
 
-            full_seq = full_seq[a_t]
-
-            # Make sure the gamma values also track the correct trajectories
-            log_gamma_1_to_t_eval = log_gamma_1_to_t_eval[a_t]
-
-            # Same for the p values:
-            log_p_theta_1_to_t_eval = log_p_theta_1_to_t_eval[a_t]
-
-            log_w_t_before_resample = log_w_t
-
-            log_w_t = jnp.zeros_like(log_w_t)
+        full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, \
+        log_r_psi_t_eval_w_potential_resample, kv_cache = resample_outputs
 
-            log_r_psi_t_eval_w_potential_resample = log_r_psi_t_eval[a_t]
     else: # No resample, but possibly resample for the log_psi_t_eval_list
         # The reason why this is important is because, the samples are created
         # via draws from each of the conditional distributions. If you normalize each of the conditional distributions,
@@ -709,22 +1765,21 @@ def smc_scan_iter_non_final(
                 raise NotImplementedError
             else:
                 rng_key, subkey = jax.random.split(rng_key)
-                a_t = jax.random.categorical(subkey, log_w_t,
-                                             shape=log_w_t.shape)
+                a_t = resample_indices(subkey, log_w_t, log_w_t.shape[0], resampling_scheme)
                 log_r_psi_t_eval_w_potential_resample = log_r_psi_t_eval[a_t]
 
     carry = (rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval,
-    output_len, params_p, params_twist, log_z_hat_t)
+    output_len, params_p, params_twist, log_z_hat_t, kv_cache, condition_twist_on_embeddings)
 
     return carry, (full_seq, log_w_t, log_r_psi_t_eval_w_potential_resample, log_w_t_before_resample, do_resample, ess)
 
 
-@partial(jax.jit, static_argnames=["resample", "resample_for_log_psi_t_eval_list"])
+@partial(jax.jit, static_argnames=["resample", "resample_for_log_psi_t_eval_list", "resampling_scheme"])
 def smc_scan_iter_final_jitted_part(
     rng_key, full_seq, log_p_theta_1_to_t_eval,
     log_z_hat_t, log_psi_eval_of_new_seqs, log_phi_t_eval, log_gamma_1_to_t_minus_1_eval, normalized_log_q_t,
     log_w_t_minus_1,
-    resample=True, true_posterior_sample=None, resample_for_log_psi_t_eval_list=False
+    resample=True, true_posterior_sample=None, resample_for_log_psi_t_eval_list=False, resampling_scheme="categorical"
 ):
     log_r_psi_t_eval = log_psi_eval_of_new_seqs
 
@@ -784,15 +1839,11 @@ def smc_scan_iter_final_jitted_part(
 
         if true_posterior_sample is not None:
             rng_key, subkey = jax.random.split(rng_key)
-            a_t = jax.random.categorical(subkey, log_w_t,
-                                         shape=log_w_t[1:].shape)
+            a_t = conditional_resample_indices(subkey, log_w_t, resampling_scheme)
             full_seq_based_on_true_twist = full_seq.at[1:].set(full_seq[a_t])
 
             rng_key, subkey = jax.random.split(rng_key)
-            a_t_learned = jax.random.categorical(subkey,
-                                                 log_w_t_based_on_learned_twist,
-                                                 shape=log_w_t_based_on_learned_twist[
-                                                       1:].shape)
+            a_t_learned = conditional_resample_indices(subkey, log_w_t_based_on_learned_twist, resampling_scheme)
             full_seq_based_on_learned_twist = full_seq.at[1:].set(
                 full_seq[a_t_learned])
 
@@ -806,13 +1857,11 @@ def smc_scan_iter_final_jitted_part(
 
         else:
             rng_key, subkey = jax.random.split(rng_key)
-            a_t = jax.random.categorical(subkey, log_w_t, shape=log_w_t.shape)
+            a_t = resample_indices(subkey, log_w_t, log_w_t.shape[0], resampling_scheme)
             full_seq_based_on_true_twist = full_seq[a_t]
 
             rng_key, subkey = jax.random.split(rng_key)
-            a_t_learned = jax.random.categorical(subkey,
-                                                 log_w_t_based_on_learned_twist,
-                                                 shape=log_w_t_based_on_learned_twist.shape)
+            a_t_learned = resample_indices(subkey, log_w_t_based_on_learned_twist, log_w_t_based_on_learned_twist.shape[0], resampling_scheme)
             full_seq_based_on_learned_twist = full_seq[a_t_learned]
 
             # IMPORTANT NOTE: use_log_true_final_twist_for_final_weight_calc should always be True if we are using this log_w_t_no_reset for lower bound
@@ -850,9 +1899,7 @@ def smc_scan_iter_final_jitted_part(
                 raise NotImplementedError
             else:
                 rng_key, subkey = jax.random.split(rng_key)
-                a_t_learned = jax.random.categorical(subkey,
-                                                     log_w_t_based_on_learned_twist,
-                                                     shape=log_w_t_based_on_learned_twist.shape)
+                a_t_learned = resample_indices(subkey, log_w_t_based_on_learned_twist, log_w_t_based_on_learned_twist.shape[0], resampling_scheme)
                 log_r_psi_t_eval_w_potential_resample = log_r_psi_t_eval[
                     a_t_learned]
 
@@ -867,12 +1914,18 @@ def smc_scan_iter_final(rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p
                          condition_twist_on_tokens,   resample=True,
                         true_posterior_sample=None, proposal_is_p=False, huggingface_model=None,
                         resample_for_log_psi_t_eval_list=False, tempered_twist=False, beta_prop=None,
-                        use_log_true_final_twist_for_final_weight_calc=True, params_proposal=None):
+                        use_log_true_final_twist_for_final_weight_calc=True, params_proposal=None, kv_cache=None,
+                        resampling_scheme="categorical", eos_token_id=None, proposal_top_k=None, proposal_top_p=None,
+                        condition_twist_on_embeddings=None):
 
     log_w_t_minus_1 = log_w_t
 
     t = output_len - 1
 
+    if eos_token_id is not None:
+        finished = get_eos_finished_mask(full_seq, prompt_len, t, eos_token_id)
+        log_r_psi_t_minus_1_eval = log_gamma_1_to_t_eval - log_p_theta_1_to_t_eval
+
     # if use_log_true_final_twist_for_final_weight_calc:
     #     # Full_seq has shape (n_samples, prompt_len + output_len)
     #     rng_key, full_seq, log_Z_s_1_to_t_minus_1 = get_proposal_q_sample_final(
@@ -882,15 +1935,30 @@ def smc_scan_iter_final(rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p
     # New implementation: do the below always, (proposal always from twists, to avoid absurd amounts of calculation on n_vocab * batch number of seqs for the reward model)
     # If using final twist (ie. sigma samples, the positive samples), the only difference will be in the psi_t_eval later:
 
-    rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs = get_proposal_q_sample(
-        rng_key, full_seq, params_p, params_twist, prompt_len, t,
-        condition_twist_on_tokens,  proposal_is_p=proposal_is_p,
-        huggingface_model=huggingface_model, true_posterior_sample=true_posterior_sample,
-        tempered_twist=tempered_twist, beta_prop=beta_prop, params_proposal=params_proposal
-    )
+    if kv_cache is not None:
+        assert params_proposal is None
+        rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs, kv_cache = get_proposal_q_sample_kv_cache(
+            rng_key, full_seq, kv_cache, params_p, params_twist, prompt_len, t,
+            condition_twist_on_tokens, proposal_is_p=proposal_is_p,
+            huggingface_model=huggingface_model, true_posterior_sample=true_posterior_sample,
+            tempered_twist=tempered_twist, beta_prop=beta_prop, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p,
+            condition_twist_on_embeddings=condition_twist_on_embeddings
+        )
+    else:
+        rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs = get_proposal_q_sample(
+            rng_key, full_seq, params_p, params_twist, prompt_len, t,
+            condition_twist_on_tokens,  proposal_is_p=proposal_is_p,
+            huggingface_model=huggingface_model, true_posterior_sample=true_posterior_sample,
+            tempered_twist=tempered_twist, beta_prop=beta_prop, params_proposal=params_proposal, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p,
+            condition_twist_on_embeddings=condition_twist_on_embeddings
+        )
 
     log_p_theta_t_eval = log_p_eval_of_new_seqs
 
+    if eos_token_id is not None:
+        # As in smc_scan_iter_non_final; only affects the weights based on the learned twist, the true final twist is always applied
+        log_psi_eval_of_new_seqs = jnp.where(finished, log_r_psi_t_minus_1_eval, log_psi_eval_of_new_seqs)
+
     # if true_posterior_sample is not None:
     #     full_seq = full_seq.at[0].set(true_posterior_sample)
     #     if proposal_is_p:
@@ -915,7 +1983,7 @@ def smc_scan_iter_final(rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p
     log_p_theta_1_to_t_eval = log_p_theta_1_to_t_eval + log_p_theta_t_eval
 
     if use_log_true_final_twist_for_final_weight_calc:
-        log_phi_t_eval = evaluate_log_phi_final(full_seq, log_true_final_twist, condition_twist_on_tokens)
+        log_phi_t_eval = evaluate_log_phi_final(full_seq, log_true_final_twist, condition_twist_on_tokens, kv_cache=kv_cache)
     else:
         log_phi_t_eval = log_psi_eval_of_new_seqs
 
@@ -935,7 +2003,7 @@ def smc_scan_iter_final(rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p
     rng_key, full_seq, log_p_theta_1_to_t_eval,
     log_z_hat_t, log_psi_eval_of_new_seqs, log_phi_t_eval, log_gamma_1_to_t_minus_1_eval, normalized_log_q_t,
     log_w_t_minus_1,
-    resample, true_posterior_sample, resample_for_log_psi_t_eval_list)
+    resample, true_posterior_sample, resample_for_log_psi_t_eval_list, resampling_scheme)
     # print(full_seq)
 
     # Observe that the full sequence we get is identical for the true vs learned twist
@@ -953,10 +2021,13 @@ def smc_debug(rng_key, prompt, params_p, params_twist, log_true_final_twist, out
             resample=True, true_posterior_sample=None, proposal_is_p=False,
             huggingface_model=None, resample_for_log_psi_t_eval_list=False,
                     no_final_resample=False, tempered_twist=False, beta_prop=None, use_log_true_final_twist_for_final_weight_calc=True,
-              params_proposal=None, prompt_len=None, resample_criterion="every_step"):
+              params_proposal=None, prompt_len=None, resample_criterion="every_step", use_kv_cache=None,
+              resampling_scheme="categorical", eos_token_id=None, proposal_top_k=None, proposal_top_p=None):
     # print("SMC TIME")
     # start = time.time()
 
+    use_kv_cache = resolve_use_kv_cache(use_kv_cache, huggingface_model, params_proposal)
+
     prompt_len = prompt.shape[-1]
 
     log_z_hat_t = 0.
@@ -968,9 +2039,19 @@ def smc_debug(rng_key, prompt, params_p, params_twist, log_true_final_twist, out
     output = jnp.zeros((n_smc_samples, output_len), dtype=jnp.int32)
     full_seq = jnp.concatenate((batch_prompt, output), axis=1)
 
+    condition_twist_on_embeddings = None
+    if params_proposal is None:
+        condition_twist_on_embeddings = get_condition_twist_on_embeddings(params_twist, condition_twist_on_tokens, huggingface_model)
+
+    kv_cache = None
+    if use_kv_cache:
+        kv_cache = kv_cache_prefill_p_and_twist(params_p, params_twist, batch_prompt, full_seq.shape[-1],
+                                                condition_twist_on_tokens, huggingface_model=huggingface_model,
+                                                prompt_is_shared=True, condition_twist_on_embeddings=condition_twist_on_embeddings)
+
     carry = (
     rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval,
-    output_len, params_p, params_twist, log_z_hat_t)
+    output_len, params_p, params_twist, log_z_hat_t, kv_cache, condition_twist_on_embeddings)
 
     full_seq_list = []
     log_w_t_list = []
@@ -991,7 +2072,8 @@ def smc_debug(rng_key, prompt, params_p, params_twist, log_true_final_twist, out
                     resample_for_log_psi_t_eval_list=resample_for_log_psi_t_eval_list,
                     tempered_twist=tempered_twist, beta_prop=beta_prop, params_proposal=params_proposal,
                     prompt_len=prompt_len,
-                    resample_criterion=resample_criterion
+                    resample_criterion=resample_criterion,
+                    resampling_scheme=resampling_scheme, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p
                     )(carry, t)
         full_seq_list.append(full_seq)
         log_w_t_list.append(log_w_t)
@@ -1000,6 +2082,10 @@ def smc_debug(rng_key, prompt, params_p, params_twist, log_true_final_twist, out
         do_resample_record.append(do_resample)
         ess_record.append(ess)
 
+    if resample:
+        do_resample_record = jnp.stack(do_resample_record)
+        ess_record = jnp.stack(ess_record)
+
     # TODO FEB Remove/comment out later
     print("ESS STATS")
     print(do_resample_record)
@@ -1010,7 +2096,7 @@ def smc_debug(rng_key, prompt, params_p, params_twist, log_true_final_twist, out
     log_psi_t_eval_list = jnp.stack(log_psi_t_eval_list)
 
     rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, \
-    output_len, params_p, params_twist, log_z_hat_t = carry
+    output_len, params_p, params_twist, log_z_hat_t, kv_cache, condition_twist_on_embeddings = carry
 
     # print(time.time() - start)
     # start = time.time()
@@ -1026,7 +2112,9 @@ def smc_debug(rng_key, prompt, params_p, params_twist, log_true_final_twist, out
         output_len, params_p, params_twist, prompt_len, log_true_final_twist, log_z_hat_t,
         condition_twist_on_tokens,  resample_for_final, true_posterior_sample, proposal_is_p,
         huggingface_model=huggingface_model, resample_for_log_psi_t_eval_list=resample_for_log_psi_t_eval_list,
-        tempered_twist=tempered_twist, beta_prop=beta_prop, use_log_true_final_twist_for_final_weight_calc=use_log_true_final_twist_for_final_weight_calc, params_proposal=params_proposal)
+        tempered_twist=tempered_twist, beta_prop=beta_prop, use_log_true_final_twist_for_final_weight_calc=use_log_true_final_twist_for_final_weight_calc, params_proposal=params_proposal,
+        kv_cache=kv_cache, resampling_scheme=resampling_scheme, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p,
+        condition_twist_on_embeddings=condition_twist_on_embeddings)
 
     # print(time.time() - start)
     # start = time.time()
@@ -1046,30 +2134,60 @@ def smc_debug(rng_key, prompt, params_p, params_twist, log_true_final_twist, out
 
 
 
+def smc_init_carry(rng_key, prompt, params_p, params_twist, output_len, n_smc_samples,
+                   condition_twist_on_tokens=None, huggingface_model=None, use_kv_cache=False, prompt_attention_mask=None,
+                   params_proposal=None):
+    # Initial carry for smc_scan_iter_non_final: n_smc_samples copies of the prompt with uniform weights (and prefilled KV caches)
+    # The carry also holds the embedding of condition_twist_on_tokens (see get_condition_twist_on_embeddings), so the
+    # twist transformer only runs over the conditioning tokens once per SMC run instead of at every step
+    log_z_hat_t = 0.
+    log_w_t = jnp.zeros((n_smc_samples,))
+    log_gamma_1_to_t_eval = jnp.zeros((n_smc_samples,))
+    log_p_theta_1_to_t_eval = jnp.zeros((n_smc_samples,))
+
+    batch_prompt = jnp.full((n_smc_samples, prompt.shape[0]), prompt)
+    output = jnp.zeros((n_smc_samples, output_len), dtype=jnp.int32)
+    full_seq = jnp.concatenate((batch_prompt, output), axis=1)
+
+    condition_twist_on_embeddings = None
+    if params_proposal is None:
+        condition_twist_on_embeddings = get_condition_twist_on_embeddings(params_twist, condition_twist_on_tokens, huggingface_model)
+
+    kv_cache = None
+    if use_kv_cache:
+        batch_prompt_attention_mask = None
+        if prompt_attention_mask is not None:
+            batch_prompt_attention_mask = jnp.full((n_smc_samples, prompt.shape[0]), prompt_attention_mask)
+        # Per particle caches for p and the twist trunk, which get reordered along with the particles on resampling
+        kv_cache = kv_cache_prefill_p_and_twist(params_p, params_twist, batch_prompt, full_seq.shape[-1],
+                                                condition_twist_on_tokens, huggingface_model=huggingface_model,
+                                                prompt_is_shared=True, prompt_attention_mask=batch_prompt_attention_mask,
+                                                condition_twist_on_embeddings=condition_twist_on_embeddings)
+    else:
+        assert prompt_attention_mask is None # Padded prompts need the attention mask, which only the KV cached path passes to the models
+
+    return (rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval,
+            output_len, params_p, params_twist, log_z_hat_t, kv_cache, condition_twist_on_embeddings)
+
+
 @partial(jax.jit, static_argnames=[
     'output_len', 'n_smc_samples', "resample", "proposal_is_p",
     "huggingface_model", "resample_for_log_psi_t_eval_list",
-    "tempered_twist", "beta_prop", "prompt_len", "resample_criterion"])
+    "tempered_twist", "beta_prop", "prompt_len", "resample_criterion", "use_kv_cache", "resampling_scheme", "eos_token_id", "proposal_top_k", "proposal_top_p"])
 def smc_jitted_part(rng_key, prompt, prompt_len, params_p, params_twist, output_len,
             n_smc_samples,
             condition_twist_on_tokens=None,
             resample=True, true_posterior_sample=None, proposal_is_p=False,
             huggingface_model=None, resample_for_log_psi_t_eval_list=False,
-                    tempered_twist=False, beta_prop=None, params_proposal=None, resample_criterion="every_step"):
+                    tempered_twist=False, beta_prop=None, params_proposal=None, resample_criterion="every_step", use_kv_cache=False,
+                    resampling_scheme="categorical", prompt_attention_mask=None, eos_token_id=None, proposal_top_k=None, proposal_top_p=None):
     # Generate samples using SMC with twists (learned and final, if use_log_true_final_twist_for_final_weight_calc)
     # IF RESAMPLE=FALSE, MAKE SURE THAT WHATEVER END RESULT RESAMPLES OR REWEIGHTS BASED ON THE RETURNED WEIGHTS (do I even return the weights always though??)
+    # prompt_attention_mask (same shape as prompt) is for a left padded prompt; only supported with the KV cache
 
-    log_z_hat_t = 0.
-    log_w_t = jnp.zeros((n_smc_samples,))
-    log_gamma_1_to_t_eval = jnp.zeros((n_smc_samples,))
-    log_p_theta_1_to_t_eval = jnp.zeros((n_smc_samples,))
-
-    batch_prompt = jnp.full((n_smc_samples, prompt.shape[0]), prompt)
-    output = jnp.zeros((n_smc_samples, output_len), dtype=jnp.int32)
-    full_seq = jnp.concatenate((batch_prompt, output), axis=1)
-
-    carry = (rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval,
-    output_len, params_p, params_twist, log_z_hat_t)
+    carry = smc_init_carry(rng_key, prompt, params_p, params_twist, output_len, n_smc_samples,
+                           condition_twist_on_tokens, huggingface_model=huggingface_model,
+                           use_kv_cache=use_kv_cache, prompt_attention_mask=prompt_attention_mask, params_proposal=params_proposal)
 
     carry, (full_seq_list, log_w_t_list, log_psi_t_eval_list, log_w_t_before_resample_list, do_resample_record, ess_record) = jax.lax.scan(
         partial(smc_scan_iter_non_final, condition_twist_on_tokens=condition_twist_on_tokens, resample=resample,
@@ -1077,53 +2195,92 @@ def smc_jitted_part(rng_key, prompt, prompt_len, params_p, params_twist, output_
                 proposal_is_p=proposal_is_p, huggingface_model=huggingface_model,
                 resample_for_log_psi_t_eval_list=resample_for_log_psi_t_eval_list,
                 tempered_twist=tempered_twist, beta_prop=beta_prop, params_proposal=params_proposal, prompt_len=prompt_len,
-                resample_criterion=resample_criterion),
+                resample_criterion=resample_criterion, resampling_scheme=resampling_scheme, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p),
         carry, jnp.arange(output_len - 1, dtype=jnp.int32), output_len - 1)
 
     rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, \
-    output_len, params_p, params_twist, log_z_hat_t = carry
+    output_len, params_p, params_twist, log_z_hat_t, kv_cache, condition_twist_on_embeddings = carry
 
     return rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, \
            prompt_len, log_z_hat_t, full_seq_list, log_w_t_list, log_psi_t_eval_list, log_w_t_before_resample_list, \
-           do_resample_record, ess_record
+           do_resample_record, ess_record, kv_cache, condition_twist_on_embeddings
 
 
 
 def twisted_proposal_sample_scan_iter(
     carry, t, condition_twist_on_tokens, params_p, params_twist, prompt_len,
-    huggingface_model, tempered_twist, beta_prop, params_proposal
+    huggingface_model, tempered_twist, beta_prop, params_proposal, eos_token_id=None, proposal_top_k=None, proposal_top_p=None,
+    condition_twist_on_embeddings=None
 ):
-    rng_key, full_seq = carry
-
-    rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs = get_proposal_q_sample(
-        rng_key, full_seq, params_p, params_twist, prompt_len, t,
-        condition_twist_on_tokens, proposal_is_p=False,
-        huggingface_model=huggingface_model,
-        true_posterior_sample=None,
-        tempered_twist=tempered_twist, beta_prop=beta_prop,
-        params_proposal=params_proposal
-    )
+    rng_key, full_seq, kv_cache = carry
+
+    if kv_cache is not None:
+        rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs, kv_cache = get_proposal_q_sample_kv_cache(
+            rng_key, full_seq, kv_cache, params_p, params_twist, prompt_len, t,
+            condition_twist_on_tokens, proposal_is_p=False,
+            huggingface_model=huggingface_model,
+            true_posterior_sample=None,
+            tempered_twist=tempered_twist, beta_prop=beta_prop, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p,
+            condition_twist_on_embeddings=condition_twist_on_embeddings
+        )
+    else:
+        rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs = get_proposal_q_sample(
+            rng_key, full_seq, params_p, params_twist, prompt_len, t,
+            condition_twist_on_tokens, proposal_is_p=False,
+            huggingface_model=huggingface_model,
+            true_posterior_sample=None,
+            tempered_twist=tempered_twist, beta_prop=beta_prop,
+            params_proposal=params_proposal, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p,
+            condition_twist_on_embeddings=condition_twist_on_embeddings
+        )
 
-    carry = (rng_key, full_seq)
+    carry = (rng_key, full_seq, kv_cache)
 
     return carry, None
 
 
+def twisted_proposal_sample(
+    rng_key, prompt, params_p, params_twist, output_len,
+    n_samples, condition_twist_on_tokens=None,
+    huggingface_model=None, tempered_twist=False, beta_prop=None,
+    params_proposal=None, prompt_len=None, use_kv_cache=None, eos_token_id=None, proposal_top_k=None, proposal_top_p=None
+):
+    # The module defaults are resolved here, before jit, so that they are static arguments of twisted_proposal_sample_jitted
+    # (as in stochastic_transformer_sample)
+    use_kv_cache = resolve_use_kv_cache(use_kv_cache, huggingface_model, params_proposal)
+    if eos_token_id is None:
+        eos_token_id = default_eos_token_id
+    proposal_top_k, proposal_top_p = resolve_proposal_truncation(proposal_top_k, proposal_top_p)
+    return twisted_proposal_sample_jitted(
+        rng_key, prompt, params_p, params_twist, output_len, n_samples, condition_twist_on_tokens, huggingface_model,
+        tempered_twist, beta_prop, params_proposal, prompt_len, use_kv_cache, eos_token_id, proposal_top_k, proposal_top_p)
+
+
 @partial(jax.jit, static_argnames=[
     'output_len', 'n_samples',
-    "huggingface_model", "tempered_twist", "beta_prop", "prompt_len"])
-def twisted_proposal_sample(
+    "huggingface_model", "tempered_twist", "beta_prop", "prompt_len", "use_kv_cache", "eos_token_id", "proposal_top_k", "proposal_top_p"])
+def twisted_proposal_sample_jitted(
     rng_key, prompt, params_p, params_twist, output_len,
     n_samples, condition_twist_on_tokens=None,
     huggingface_model=None, tempered_twist=False, beta_prop=None,
-    params_proposal=None, prompt_len=None
+    params_proposal=None, prompt_len=None, use_kv_cache=False, eos_token_id=None, proposal_top_k=None, proposal_top_p=None
 ):
     resample = False # No SMC supported in this call
 
     batch_prompt = jnp.full((n_samples, prompt.shape[0]), prompt)
     output = jnp.zeros((n_samples, output_len), dtype=jnp.int32)
     full_seq = jnp.concatenate((batch_prompt, output), axis=1)
-    carry = (rng_key, full_seq)
+
+    condition_twist_on_embeddings = None
+    if params_proposal is None:
+        condition_twist_on_embeddings = get_condition_twist_on_embeddings(params_twist, condition_twist_on_tokens, huggingface_model)
+
+    kv_cache = None
+    if use_kv_cache:
+        kv_cache = kv_cache_prefill_p_and_twist(params_p, params_twist, batch_prompt, full_seq.shape[-1],
+                                                condition_twist_on_tokens, huggingface_model=huggingface_model,
+                                                prompt_is_shared=True, condition_twist_on_embeddings=condition_twist_on_embeddings)
+    carry = (rng_key, full_seq, kv_cache)
 
     carry, _ = jax.lax.scan(partial(
         twisted_proposal_sample_scan_iter,
@@ -1131,11 +2288,74 @@ def twisted_proposal_sample(
         condition_twist_on_tokens=condition_twist_on_tokens,
         huggingface_model=huggingface_model,
         tempered_twist=tempered_twist, beta_prop=beta_prop,
-        params_proposal=params_proposal
+        params_proposal=params_proposal, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p,
+        condition_twist_on_embeddings=condition_twist_on_embeddings
     ), carry, jnp.arange(output_len, dtype=jnp.int32), output_len
     )
 
-    rng_key, full_seq = carry
+    rng_key, full_seq, _ = carry
+
+    return full_seq
+
+
+@partial(jax.jit, static_argnames=[
+    "huggingface_model", "tempered_twist", "beta_prop", "prompt_len", "eos_token_id", "proposal_top_k", "proposal_top_p"])
+def twisted_proposal_sample_steps(
+    rng_key, full_seq, kv_cache, condition_twist_on_tokens, ts, params_p, params_twist, prompt_len,
+    huggingface_model=None, tempered_twist=False, beta_prop=None, params_proposal=None, eos_token_id=None, proposal_top_k=None, proposal_top_p=None
+):
+    # The twisted_proposal_sample scan, but only over the time steps in ts, continuing from a partially generated full_seq
+    carry = (rng_key, full_seq, kv_cache)
+    carry, _ = jax.lax.scan(partial(
+        twisted_proposal_sample_scan_iter,
+        params_p=params_p, params_twist=params_twist, prompt_len=prompt_len,
+        condition_twist_on_tokens=condition_twist_on_tokens,
+        huggingface_model=huggingface_model,
+        tempered_twist=tempered_twist, beta_prop=beta_prop,
+        params_proposal=params_proposal, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p
+    ), carry, ts, ts.shape[0])
+    rng_key, full_seq, kv_cache = carry
+    return rng_key, full_seq, kv_cache, None
+
+
+def twisted_proposal_sample_eos_compacted(
+    rng_key, prompt, params_p, params_twist, output_len,
+    n_samples, condition_twist_on_tokens=None,
+    huggingface_model=None, tempered_twist=False, beta_prop=None,
+    params_proposal=None, use_kv_cache=None, eos_token_id=None, proposal_top_k=None, proposal_top_p=None,
+    steps_per_chunk=8, min_bucket_size=8
+):
+    # Same as twisted_proposal_sample with eos_token_id, but also skips the computation for finished sequences
+    # (see generate_with_eos_compaction). Fine here since there is no resampling, so the samples are independent of each other
+    if eos_token_id is None:
+        eos_token_id = default_eos_token_id
+    if eos_token_id is None:
+        return twisted_proposal_sample(rng_key, prompt, params_p, params_twist, output_len, n_samples,
+                                       condition_twist_on_tokens, huggingface_model, tempered_twist, beta_prop,
+                                       params_proposal, prompt.shape[-1], use_kv_cache,
+                                       proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p)
+    proposal_top_k, proposal_top_p = resolve_proposal_truncation(proposal_top_k, proposal_top_p)
+
+    use_kv_cache = resolve_use_kv_cache(use_kv_cache, huggingface_model, params_proposal)
+    prompt_len = prompt.shape[-1]
+
+    batch_prompt = jnp.full((n_samples, prompt_len), prompt)
+    output = jnp.zeros((n_samples, output_len), dtype=jnp.int32)
+    full_seq = jnp.concatenate((batch_prompt, output), axis=1)
+
+    kv_cache = None
+    if use_kv_cache:
+        kv_cache = jax.jit(kv_cache_prefill_p_and_twist, static_argnames=["max_length", "huggingface_model", "prompt_is_shared"])(
+            params_p, params_twist, batch_prompt, full_seq.shape[-1], condition_twist_on_tokens,
+            huggingface_model=huggingface_model, prompt_is_shared=True)
+
+    run_steps = partial(twisted_proposal_sample_steps, params_p=params_p, params_twist=params_twist, prompt_len=prompt_len,
+                        huggingface_model=huggingface_model, tempered_twist=tempered_twist, beta_prop=beta_prop,
+                        params_proposal=params_proposal, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p)
+
+    full_seq, _ = generate_with_eos_compaction(
+        rng_key, full_seq, kv_cache, condition_twist_on_tokens, prompt_len, output_len, eos_token_id,
+        run_steps, steps_per_chunk=steps_per_chunk, min_bucket_size=min_bucket_size)
 
     return full_seq
 
@@ -1147,15 +2367,19 @@ def smc_partial_jit(
     resample=True, true_posterior_sample=None, proposal_is_p=False,
     huggingface_model=None, resample_for_log_psi_t_eval_list=False,
     no_final_resample=False, tempered_twist=False, beta_prop=None, use_log_true_final_twist_for_final_weight_calc=True,
-    params_proposal=None, prompt_len=None, resample_criterion="every_step"
+    params_proposal=None, prompt_len=None, resample_criterion="every_step", use_kv_cache=None,
+    resampling_scheme="categorical", eos_token_id=None, proposal_top_k=None, proposal_top_p=None
 ):
     # print("SMC TIME")
     # start = time.time()
 
     print_ess_stats = False
 
+    use_kv_cache = resolve_use_kv_cache(use_kv_cache, huggingface_model, params_proposal)
+
     rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, _, \
-    log_z_hat_t, full_seq_list, log_w_t_list, log_psi_t_eval_list, log_w_t_before_resample_list, do_resample_record, ess_record = \
+    log_z_hat_t, full_seq_list, log_w_t_list, log_psi_t_eval_list, log_w_t_before_resample_list, do_resample_record, ess_record, kv_cache, \
+    condition_twist_on_embeddings = \
         smc_jitted_part(rng_key, prompt, prompt_len, params_p,
                         params_twist,
                         output_len,
@@ -1163,7 +2387,8 @@ def smc_partial_jit(
                         condition_twist_on_tokens,
                         resample, true_posterior_sample, proposal_is_p,
                         huggingface_model, resample_for_log_psi_t_eval_list,
-                        tempered_twist, beta_prop, params_proposal=params_proposal, resample_criterion=resample_criterion)
+                        tempered_twist, beta_prop, params_proposal=params_proposal, resample_criterion=resample_criterion,
+                        use_kv_cache=use_kv_cache, resampling_scheme=resampling_scheme, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p)
 
     if print_ess_stats:
         print("ESS STATS")
@@ -1180,7 +2405,9 @@ def smc_partial_jit(
         output_len, params_p, params_twist, prompt_len, log_true_final_twist, log_z_hat_t,
         condition_twist_on_tokens,  resample_for_final, true_posterior_sample, proposal_is_p,
         huggingface_model=huggingface_model, resample_for_log_psi_t_eval_list=resample_for_log_psi_t_eval_list,
-        tempered_twist=tempered_twist, beta_prop=beta_prop, use_log_true_final_twist_for_final_weight_calc=use_log_true_final_twist_for_final_weight_calc, params_proposal=params_proposal)
+        tempered_twist=tempered_twist, beta_prop=beta_prop, use_log_true_final_twist_for_final_weight_calc=use_log_true_final_twist_for_final_weight_calc, params_proposal=params_proposal,
+        kv_cache=kv_cache, resampling_scheme=resampling_scheme, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p,
+        condition_twist_on_embeddings=condition_twist_on_embeddings)
 
     # print(time.time() - start)
     # start = time.time()
@@ -1210,7 +2437,378 @@ smc_jit = partial(jax.jit,
                                    "get_intermediate_sample_history_based_on_learned_twists",
                                    "resample", "proposal_is_p",
                                    "huggingface_model", "resample_for_log_psi_t_eval_list", "no_final_resample",
-                                   "tempered_twist", "beta_prop", "use_log_true_final_twist_for_final_weight_calc", "prompt_len", "resample_criterion"])(smc_partial_jit)
+                                   "tempered_twist", "beta_prop", "use_log_true_final_twist_for_final_weight_calc", "prompt_len", "resample_criterion",
+                                   "use_kv_cache", "resampling_scheme", "eos_token_id", "proposal_top_k", "proposal_top_p"])(smc_partial_jit)
+
+
+@partial(jax.jit, static_argnames=[
+    'output_len', 'n_smc_samples', "resample", "proposal_is_p",
+    "huggingface_model", "resample_for_log_psi_t_eval_list",
+    "tempered_twist", "beta_prop", "resample_criterion", "resampling_scheme", "eos_token_id", "proposal_top_k", "proposal_top_p"])
+def smc_multi_prompt_jitted_part(rng_keys, prompts, prompt_attention_mask, params_p, params_twist, output_len,
+                                 n_smc_samples, condition_twist_on_tokens=None, resample=True, proposal_is_p=False,
+                                 huggingface_model=None, resample_for_log_psi_t_eval_list=False,
+                                 tempered_twist=False, beta_prop=None, resample_criterion="every_step",
+                                 resampling_scheme="categorical", eos_token_id=None, proposal_top_k=None, proposal_top_p=None):
+    # Everything in SMC up to the final twist, for a left padded batch of prompts (see left_pad_prompts) in one call:
+    # smc_jitted_part plus the proposal for the last token, vmapped over the prompts, so each prompt has its own particles,
+    # weights, resampling and log Z estimate, while the model calls are batched over all of them.
+    # prompt_len is the padded length for all prompts, so new prompt lengths don't cause recompilation as long as they fit.
+    prompt_len = prompts.shape[-1]
+
+    def _smc_single_prompt(rng_key, prompt, prompt_attention_mask, condition_twist_on_tokens):
+        rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, _, \
+        log_z_hat_t, full_seq_list, log_w_t_list, log_psi_t_eval_list, log_w_t_before_resample_list, _, _, kv_cache, \
+        condition_twist_on_embeddings = \
+            smc_jitted_part(rng_key, prompt, prompt_len, params_p, params_twist, output_len, n_smc_samples,
+                            condition_twist_on_tokens=condition_twist_on_tokens, resample=resample,
+                            proposal_is_p=proposal_is_p, huggingface_model=huggingface_model,
+                            resample_for_log_psi_t_eval_list=resample_for_log_psi_t_eval_list,
+                            tempered_twist=tempered_twist, beta_prop=beta_prop, resample_criterion=resample_criterion,
+                            use_kv_cache=True, resampling_scheme=resampling_scheme,
+                            prompt_attention_mask=prompt_attention_mask, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p)
+
+        # Proposal for the last token (the first part of smc_scan_iter_final); the weights need the final twist, which is applied outside of jit
+        if eos_token_id is not None:
+            finished = get_eos_finished_mask(full_seq, prompt_len, output_len - 1, eos_token_id)
+            log_r_psi_t_minus_1_eval = log_gamma_1_to_t_eval - log_p_theta_1_to_t_eval
+        rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs, _ = get_proposal_q_sample_kv_cache(
+            rng_key, full_seq, kv_cache, params_p, params_twist, prompt_len, output_len - 1,
+            condition_twist_on_tokens, proposal_is_p=proposal_is_p, huggingface_model=huggingface_model,
+            tempered_twist=tempered_twist, beta_prop=beta_prop, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p,
+            condition_twist_on_embeddings=condition_twist_on_embeddings
+        )
+        if eos_token_id is not None:
+            log_psi_eval_of_new_seqs = jnp.where(finished, log_r_psi_t_minus_1_eval, log_psi_eval_of_new_seqs)
+        log_p_theta_1_to_t_eval = log_p_theta_1_to_t_eval + log_p_eval_of_new_seqs
+
+        return rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, log_z_hat_t, \
+               normalized_log_q_t, log_psi_eval_of_new_seqs, full_seq_list, log_w_t_list, log_psi_t_eval_list, log_w_t_before_resample_list
+
+    condition_twist_on_tokens_axis = None if condition_twist_on_tokens is None else 0
+    return jax.vmap(_smc_single_prompt, in_axes=(0, 0, 0, condition_twist_on_tokens_axis))(
+        rng_keys, prompts, prompt_attention_mask, condition_twist_on_tokens)
+
+
+def evaluate_log_phi_final_multi_prompt(full_seqs, n_padding_tokens, log_true_final_twists, condition_twist_on_tokens=None):
+    # evaluate_log_phi_final for each prompt of a left padded batch of sequences (n_prompts, n_samples, seq_len), on the sequences
+    # without padding. The prompts with the same final twist and the same number of padding tokens are evaluated in one call
+    # (all of them, for a single final twist and prompts of the same length). n_padding_tokens is a numpy array.
+    n_prompts, n_samples = full_seqs.shape[:2]
+    groups = {}
+    for i in range(n_prompts):
+        groups.setdefault((id(log_true_final_twists[i]), n_padding_tokens[i]), []).append(i)
+
+    log_phi_t_evals = [None] * n_prompts
+    for (_, n_pad), prompt_indices in groups.items():
+        prompt_indices = np.array(prompt_indices)
+        seqs = full_seqs[prompt_indices, :, n_pad:].reshape(-1, full_seqs.shape[-1] - n_pad)
+        condition_twist_on_tokens_group = None
+        if condition_twist_on_tokens is not None:
+            condition_twist_on_tokens_group = condition_twist_on_tokens[prompt_indices].reshape(-1, *condition_twist_on_tokens.shape[2:])
+        log_phi_t_eval = evaluate_log_phi_final(seqs, log_true_final_twists[prompt_indices[0]], condition_twist_on_tokens_group)
+        for j, i in enumerate(prompt_indices):
+            log_phi_t_evals[i] = log_phi_t_eval[j * n_samples: (j + 1) * n_samples]
+    return jnp.stack(log_phi_t_evals)
+
+
+@partial(jax.jit, static_argnames=["resample", "resample_for_log_psi_t_eval_list", "resampling_scheme"])
+def smc_multi_prompt_final_jitted_part(rng_keys, full_seqs, log_p_theta_1_to_t_evals, log_z_hat_ts, log_psi_T_evals, log_phi_t_evals,
+                                       log_gamma_1_to_t_minus_1_evals, normalized_log_q_ts, log_w_t_minus_1s,
+                                       resample=True, resample_for_log_psi_t_eval_list=False, resampling_scheme="categorical"):
+    # The rest of smc_scan_iter_final (after the final twist), vmapped over the prompts, on the padded sequences
+    return jax.vmap(partial(smc_scan_iter_final_jitted_part, resample=resample, true_posterior_sample=None,
+                            resample_for_log_psi_t_eval_list=resample_for_log_psi_t_eval_list, resampling_scheme=resampling_scheme))(
+        rng_keys, full_seqs, log_p_theta_1_to_t_evals, log_z_hat_ts, log_psi_T_evals, log_phi_t_evals,
+        log_gamma_1_to_t_minus_1_evals, normalized_log_q_ts, log_w_t_minus_1s)
+
+
+def smc_multi_prompt(
+    rng_key, prompts, params_p, params_twist, log_true_final_twists, output_len,
+    n_smc_samples, prompt_attention_mask=None, get_intermediate_sample_history_based_on_learned_twists=False,
+    condition_twist_on_tokens=None, resample=True, proposal_is_p=False,
+    huggingface_model=None, resample_for_log_psi_t_eval_list=False,
+    no_final_resample=False, tempered_twist=False, beta_prop=None, use_log_true_final_twist_for_final_weight_calc=True,
+    resample_criterion=None, resampling_scheme=None, eos_token_id=None, proposal_top_k=None, proposal_top_p=None
+):
+    # Runs SMC with n_smc_samples particles for each of the prompts in one compiled call (instead of one smc_procedure call per prompt)
+    # prompts is either a list of prompts (possibly of different lengths), or an already left padded (n_prompts, max_prompt_len) array
+    # together with prompt_attention_mask. log_true_final_twists is a list with one final twist per prompt (or a single final twist for all).
+    # condition_twist_on_tokens, if used, has a leading n_prompts axis.
+    # Uses the KV cached path (the attention mask is needed for the padding), so lora twists and params_proposal are not supported here.
+    # Returns the same as smc_procedure, but with a leading n_prompts axis on everything: (log_w_t, log_z_hat_t, log_psi_t_eval_list), full_seqs
+    # where full_seqs is a list of (n_smc_samples, prompt_len + output_len) arrays with the padding removed
+    if resampling_scheme is None:
+        resampling_scheme = default_resampling_scheme
+    if resample_criterion is None:
+        resample_criterion = default_resample_criterion
+    if eos_token_id is None:
+        eos_token_id = default_eos_token_id
+    proposal_top_k, proposal_top_p = resolve_proposal_truncation(proposal_top_k, proposal_top_p)
+
+    if prompt_attention_mask is None:
+        prompts, prompt_attention_mask = left_pad_prompts(prompts)
+    n_prompts = prompts.shape[0]
+    if not isinstance(log_true_final_twists, (list, tuple)):
+        log_true_final_twists = [log_true_final_twists] * n_prompts
+    assert len(log_true_final_twists) == n_prompts
+
+    rng_keys = jax.random.split(rng_key, n_prompts)
+    rng_keys, full_seqs, log_w_ts, log_gamma_1_to_t_evals, log_p_theta_1_to_t_evals, log_z_hat_ts, \
+    normalized_log_q_ts, log_psi_T_evals, full_seq_lists, log_w_t_lists, log_psi_t_eval_lists, log_w_t_before_resample_lists = \
+        smc_multi_prompt_jitted_part(rng_keys, prompts, prompt_attention_mask, params_p, params_twist, output_len,
+                                     n_smc_samples, condition_twist_on_tokens, resample, proposal_is_p,
+                                     huggingface_model, resample_for_log_psi_t_eval_list, tempered_twist, beta_prop,
+                                     resample_criterion=resample_criterion, resampling_scheme=resampling_scheme,
+                                     eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p)
+
+    resample_for_final = resample
+    if no_final_resample:
+        resample_for_final = False
+
+    n_padding_tokens = np.asarray(prompts.shape[-1] - prompt_attention_mask.sum(axis=-1)) # One transfer to the host for all prompts
+
+    if use_log_true_final_twist_for_final_weight_calc:
+        log_phi_t_evals = evaluate_log_phi_final_multi_prompt(full_seqs, n_padding_tokens, log_true_final_twists, condition_twist_on_tokens)
+    else:
+        log_phi_t_evals = log_psi_T_evals
+
+    (log_w_t, log_w_t_based_on_learned_twist, log_z_hat_t, log_learned_psi_T_eval), full_seqs_based_on_true_twist, full_seqs_based_on_learned_twist = \
+        smc_multi_prompt_final_jitted_part(
+            rng_keys, full_seqs, log_p_theta_1_to_t_evals, log_z_hat_ts, log_psi_T_evals, log_phi_t_evals,
+            log_gamma_1_to_t_evals, normalized_log_q_ts, log_w_ts,
+            resample_for_final, resample_for_log_psi_t_eval_list, resampling_scheme)
+    full_seqs_based_on_true_twist = [full_seqs_based_on_true_twist[i, :, n_pad:] for i, n_pad in enumerate(n_padding_tokens)]
+
+    log_psi_t_eval_lists = jnp.concatenate((log_psi_t_eval_lists, log_learned_psi_T_eval[:, None, :]), axis=1)
+
+    if get_intermediate_sample_history_based_on_learned_twists:
+        full_seq_lists = [
+            jnp.concatenate((full_seq_lists[i][:, :, n_pad:], full_seqs_based_on_learned_twist[i, None, :, n_pad:]))
+            for i, n_pad in enumerate(n_padding_tokens)]
+        log_w_t_lists = jnp.concatenate((log_w_t_lists, log_w_t_based_on_learned_twist[:, None, :]), axis=1)
+        return (log_w_t, log_z_hat_t, log_psi_t_eval_lists), full_seqs_based_on_true_twist, (full_seq_lists, log_w_t_lists, log_w_t_before_resample_lists)
+
+    return (log_w_t, log_z_hat_t, log_psi_t_eval_lists), full_seqs_based_on_true_twist
+
+
+def get_particle_mesh(devices=None):
+    # 1D device mesh for smc_sharded: each device holds one island of n_smc_samples / n_devices particles
+    # On CPU, more (host) devices can be made with XLA_FLAGS=--xla_force_host_platform_device_count=N (set before jax starts)
+    if devices is None:
+        devices = jax.devices()
+    return Mesh(np.array(devices), (particle_mesh_axis,))
+
+
+def _island_exchange(rng_key, island_state, log_z_hat_t, island_log_z_base, log_z_exchange,
+                     n_islands, island_ess_threshold=0.5, resampling_scheme="categorical"):
+    # Island level resampling (run inside shard_map, one island per device). The island weight is the island's log Z estimate
+    # since its last exchange; the islands are only resampled (whole islands copied between devices) when the ESS over islands
+    # drops below island_ess_threshold * n_islands. On resampling, log mean(island weights) goes into log_z_exchange and
+    # the island weights are reset, so the global log Z estimate log_z_exchange + log mean(island weights) stays unbiased
+    # (this is the double bootstrap / island particle filter of Verge et al.)
+    # rng_key has to be the same on all devices, so that they all agree on the island ancestors.
+    island_log_w = log_z_hat_t - island_log_z_base
+    all_island_log_w = jax.lax.all_gather(island_log_w, particle_mesh_axis)
+    normalized_island_w = jax.nn.softmax(all_island_log_w)
+    island_ess = 1. / (normalized_island_w ** 2).sum()
+    do_exchange = island_ess < island_ess_threshold * n_islands
+
+    def _exchange(operands):
+        island_state, log_z_hat_t, island_log_z_base, log_z_exchange = operands
+        a = resample_indices(rng_key, all_island_log_w, n_islands, resampling_scheme)[jax.lax.axis_index(particle_mesh_axis)]
+        island_state, log_z_hat_t = jax.tree_util.tree_map(
+            lambda x: jax.lax.all_gather(x, particle_mesh_axis)[a], (island_state, log_z_hat_t))
+        log_z_exchange = log_z_exchange + jax.nn.logsumexp(all_island_log_w) - jnp.log(n_islands)
+        return island_state, log_z_hat_t, log_z_hat_t, log_z_exchange
+
+    island_state, log_z_hat_t, island_log_z_base, log_z_exchange = jax.lax.cond(
+        do_exchange, _exchange, lambda operands: operands, (island_state, log_z_hat_t, island_log_z_base, log_z_exchange))
+
+    return island_state, log_z_hat_t, island_log_z_base, log_z_exchange, do_exchange, island_ess
+
+
+@partial(jax.jit, static_argnames=[
+    'output_len', 'n_smc_samples', "mesh", "resample", "proposal_is_p",
+    "huggingface_model", "resample_for_log_psi_t_eval_list",
+    "tempered_twist", "beta_prop", "resample_criterion", "use_kv_cache", "resampling_scheme", "eos_token_id",
+    "proposal_top_k", "proposal_top_p", "island_ess_threshold"])
+def smc_sharded_jitted_part(rng_keys, island_rng_key, prompt, params_p, params_twist, output_len, n_smc_samples, mesh,
+                            condition_twist_on_tokens=None, resample=True, proposal_is_p=False,
+                            huggingface_model=None, resample_for_log_psi_t_eval_list=False,
+                            tempered_twist=False, beta_prop=None, params_proposal=None, resample_criterion="every_step",
+                            use_kv_cache=False, resampling_scheme="categorical", eos_token_id=None,
+                            proposal_top_k=None, proposal_top_p=None, island_ess_threshold=0.5):
+    # Everything in SMC up to the final twist (as in smc_multi_prompt_jitted_part), with the particles split into one island per device of mesh.
+    # Each island runs smc_scan_iter_non_final on its own particles (so the usual within-batch resampling is local to the device),
+    # and after every step the islands may be resampled as a whole (see _island_exchange), which is the only cross-device communication
+    # besides one all_gather of the island weights per step.
+    # rng_keys has one key per island; island_rng_key is shared by all islands. Per particle arrays are returned concatenated over the islands,
+    # per island values (log_z_hat_t, island_log_z_base, log_z_exchange) have shape (n_islands,)
+    prompt_len = prompt.shape[-1]
+    n_islands = mesh.devices.size
+    assert n_smc_samples % n_islands == 0
+    n_smc_samples_per_island = n_smc_samples // n_islands
+
+    def _smc_island(rng_key, condition_twist_on_tokens):
+        carry = smc_init_carry(rng_key[0], prompt, params_p, params_twist, output_len, n_smc_samples_per_island,
+                               condition_twist_on_tokens, huggingface_model=huggingface_model, use_kv_cache=use_kv_cache,
+                               params_proposal=params_proposal)
+        island_log_z_base = jnp.zeros(())
+        log_z_exchange = jnp.zeros(())
+
+        def _island_scan_iter(island_carry, t):
+            carry, island_log_z_base, log_z_exchange = island_carry
+            carry, (_, _, log_r_psi_t_eval_w_potential_resample, _, _, _) = smc_scan_iter_non_final(
+                carry, t, condition_twist_on_tokens, resample=resample, proposal_is_p=proposal_is_p,
+                huggingface_model=huggingface_model, resample_for_log_psi_t_eval_list=resample_for_log_psi_t_eval_list,
+                tempered_twist=tempered_twist, beta_prop=beta_prop, params_proposal=params_proposal, prompt_len=prompt_len,
+                resample_criterion=resample_criterion, resampling_scheme=resampling_scheme, eos_token_id=eos_token_id,
+                proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p)
+            rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, \
+            output_len_, params_p_, params_twist_, log_z_hat_t, kv_cache, condition_twist_on_embeddings = carry
+            do_exchange = jnp.array(False)
+            island_ess = jnp.array(n_islands, dtype=jnp.float32)
+            if resample:
+                # The rng_key stays with the island, so copies of the same island continue independently
+                (full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, kv_cache), log_z_hat_t, island_log_z_base, log_z_exchange, \
+                do_exchange, island_ess = _island_exchange(
+                    jax.random.fold_in(island_rng_key, t),
+                    (full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, kv_cache),
+                    log_z_hat_t, island_log_z_base, log_z_exchange, n_islands, island_ess_threshold, resampling_scheme)
+            carry = (rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval,
+                     output_len_, params_p_, params_twist_, log_z_hat_t, kv_cache, condition_twist_on_embeddings)
+            return (carry, island_log_z_base, log_z_exchange), (log_r_psi_t_eval_w_potential_resample, do_exchange, island_ess)
+
+        (carry, island_log_z_base, log_z_exchange), (log_psi_t_eval_list, do_exchange_record, island_ess_record) = jax.lax.scan(
+            _island_scan_iter, (carry, island_log_z_base, log_z_exchange), jnp.arange(output_len - 1, dtype=jnp.int32), output_len - 1)
+
+        rng_key, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, \
+        _, _, _, log_z_hat_t, kv_cache, condition_twist_on_embeddings = carry
+
+        # Proposal for the last token (the first part of smc_scan_iter_final); the weights need the final twist, which is applied outside
+        if eos_token_id is not None:
+            finished = get_eos_finished_mask(full_seq, prompt_len, output_len - 1, eos_token_id)
+            log_r_psi_t_minus_1_eval = log_gamma_1_to_t_eval - log_p_theta_1_to_t_eval
+        if kv_cache is not None:
+            rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs, _ = get_proposal_q_sample_kv_cache(
+                rng_key, full_seq, kv_cache, params_p, params_twist, prompt_len, output_len - 1,
+                condition_twist_on_tokens, proposal_is_p=proposal_is_p, huggingface_model=huggingface_model,
+                tempered_twist=tempered_twist, beta_prop=beta_prop, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p,
+                condition_twist_on_embeddings=condition_twist_on_embeddings
+            )
+        else:
+            rng_key, full_seq, normalized_log_q_t, log_p_eval_of_new_seqs, log_psi_eval_of_new_seqs = get_proposal_q_sample(
+                rng_key, full_seq, params_p, params_twist, prompt_len, output_len - 1,
+                condition_twist_on_tokens, proposal_is_p=proposal_is_p, huggingface_model=huggingface_model,
+                tempered_twist=tempered_twist, beta_prop=beta_prop, params_proposal=params_proposal,
+                eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p,
+                condition_twist_on_embeddings=condition_twist_on_embeddings
+            )
+        if eos_token_id is not None:
+            log_psi_eval_of_new_seqs = jnp.where(finished, log_r_psi_t_minus_1_eval, log_psi_eval_of_new_seqs)
+        log_p_theta_1_to_t_eval = log_p_theta_1_to_t_eval + log_p_eval_of_new_seqs
+
+        return rng_key[None], full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, \
+               log_z_hat_t[None], island_log_z_base[None], log_z_exchange[None], \
+               normalized_log_q_t, log_psi_eval_of_new_seqs, log_psi_t_eval_list, do_exchange_record[:, None], island_ess_record[:, None]
+
+    particles = PartitionSpec(particle_mesh_axis)
+    steps_by_particles = PartitionSpec(None, particle_mesh_axis)
+    condition_twist_on_tokens_spec = None if condition_twist_on_tokens is None else particles
+    return shard_map(
+        _smc_island, mesh=mesh, in_specs=(particles, condition_twist_on_tokens_spec),
+        out_specs=(particles,) * 10 + (steps_by_particles,) * 3, check_rep=False
+    )(rng_keys, condition_twist_on_tokens)
+
+
+@partial(jax.jit, static_argnames=["n_islands", "resample", "resample_for_log_psi_t_eval_list", "resampling_scheme"])
+def smc_sharded_final_part(
+    rng_keys, island_rng_key, full_seq, log_p_theta_1_to_t_eval, log_z_hat_t, island_log_z_base, log_z_exchange,
+    log_psi_eval_of_new_seqs, log_phi_t_eval, log_gamma_1_to_t_minus_1_eval, normalized_log_q_t, log_w_t_minus_1, n_islands,
+    resample=True, resample_for_log_psi_t_eval_list=False, resampling_scheme="categorical"
+):
+    # The rest of smc_scan_iter_final for smc_sharded: the final weights and resampling within each island,
+    # then the global log Z estimate, and a final island level resampling so that the returned particles are (equally weighted) global samples.
+    # Without resampling, the returned log_w_t are the global particle weights instead (island weight times normalized weight within the island)
+    def _to_islands(x):
+        return x.reshape((n_islands, -1) + x.shape[1:])
+
+    (log_w_t, log_w_t_based_on_learned_twist, log_z_hat_t, log_learned_psi_T_eval), full_seq_based_on_true_twist, _ = jax.vmap(
+        partial(smc_scan_iter_final_jitted_part, resample=resample, true_posterior_sample=None,
+                resample_for_log_psi_t_eval_list=resample_for_log_psi_t_eval_list, resampling_scheme=resampling_scheme)
+    )(rng_keys, _to_islands(full_seq), _to_islands(log_p_theta_1_to_t_eval), log_z_hat_t, _to_islands(log_psi_eval_of_new_seqs),
+      _to_islands(log_phi_t_eval), _to_islands(log_gamma_1_to_t_minus_1_eval), _to_islands(normalized_log_q_t), _to_islands(log_w_t_minus_1))
+
+    island_log_w = log_z_hat_t - island_log_z_base
+    log_z_hat_t = log_z_exchange[0] + jax.nn.logsumexp(island_log_w) - jnp.log(n_islands)
+
+    if resample:
+        a = resample_indices(jax.random.fold_in(island_rng_key, -1), island_log_w, n_islands, resampling_scheme)
+        full_seq_based_on_true_twist = full_seq_based_on_true_twist[a]
+    else:
+        log_w_t = log_w_t - jax.nn.logsumexp(log_w_t, axis=-1, keepdims=True) + island_log_w[:, None] + jnp.log(log_w_t.shape[-1])
+
+    return log_w_t.reshape(-1), log_z_hat_t, log_learned_psi_T_eval.reshape(-1), \
+           full_seq_based_on_true_twist.reshape((-1,) + full_seq_based_on_true_twist.shape[2:])
+
+
+def smc_sharded(
+    rng_key, prompt, params_p, params_twist, log_true_final_twist, output_len,
+    n_smc_samples, get_intermediate_sample_history_based_on_learned_twists=False,
+    condition_twist_on_tokens=None,
+    resample=True, true_posterior_sample=None, proposal_is_p=False,
+    huggingface_model=None, resample_for_log_psi_t_eval_list=False,
+    no_final_resample=False, tempered_twist=False, beta_prop=None, use_log_true_final_twist_for_final_weight_calc=True,
+    params_proposal=None, prompt_len=None, resample_criterion="every_step", use_kv_cache=None,
+    resampling_scheme="categorical", eos_token_id=None, proposal_top_k=None, proposal_top_p=None,
+    mesh=None, island_ess_threshold=0.5
+):
+    # Same as smc_partial_jit, but with the particles sharded over the devices of mesh (default: all devices), so that the number of
+    # particles can grow with the number of devices. Each device runs SMC on its own island of particles, and whole islands are
+    # only exchanged between devices when the ESS over islands drops below island_ess_threshold * n_islands (see _island_exchange).
+    # log_z_hat_t is still an unbiased estimate of Z (in expectation over exp). Returns the same as smc_partial_jit;
+    # with n_islands = 1 (and resample), this is the same as smc_partial_jit up to the rng.
+    # smc_procedure (with shard_smc_particles) runs these calls unsharded
+    assert not get_intermediate_sample_history_based_on_learned_twists, "no intermediate sample history with sharded particles"
+    assert true_posterior_sample is None, "no conditional SMC (true_posterior_sample) with sharded particles"
+    if mesh is None:
+        mesh = get_particle_mesh()
+    n_islands = mesh.devices.size
+
+    use_kv_cache = resolve_use_kv_cache(use_kv_cache, huggingface_model, params_proposal)
+
+    rng_key, island_rng_key = jax.random.split(rng_key)
+    rng_keys = jax.random.split(rng_key, n_islands)
+
+    rng_keys, full_seq, log_w_t, log_gamma_1_to_t_eval, log_p_theta_1_to_t_eval, log_z_hat_t, island_log_z_base, log_z_exchange, \
+    normalized_log_q_t, log_psi_T_eval, log_psi_t_eval_list, do_exchange_record, island_ess_record = \
+        smc_sharded_jitted_part(rng_keys, island_rng_key, prompt, params_p, params_twist, output_len, n_smc_samples, mesh,
+                                condition_twist_on_tokens, resample, proposal_is_p,
+                                huggingface_model, resample_for_log_psi_t_eval_list, tempered_twist, beta_prop,
+                                params_proposal=params_proposal, resample_criterion=resample_criterion,
+                                use_kv_cache=use_kv_cache, resampling_scheme=resampling_scheme, eos_token_id=eos_token_id,
+                                proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p,
+                                island_ess_threshold=island_ess_threshold)
+
+    resample_for_final = resample
+    if no_final_resample:
+        resample_for_final = False
+
+    if use_log_true_final_twist_for_final_weight_calc:
+        log_phi_t_eval = evaluate_log_phi_final(full_seq, log_true_final_twist, condition_twist_on_tokens)
+    else:
+        log_phi_t_eval = log_psi_T_eval
+
+    log_w_t, log_z_hat_t, log_learned_psi_T_eval, full_seq_based_on_true_twist = smc_sharded_final_part(
+        rng_keys, island_rng_key, full_seq, log_p_theta_1_to_t_eval, log_z_hat_t, island_log_z_base, log_z_exchange,
+        log_psi_T_eval, log_phi_t_eval, log_gamma_1_to_t_eval, normalized_log_q_t, log_w_t, n_islands,
+        resample_for_final, resample_for_log_psi_t_eval_list, resampling_scheme)
+
+    log_psi_t_eval_list = jnp.concatenate((log_psi_t_eval_list, log_learned_psi_T_eval[None, :]))
+
+    return (log_w_t, log_z_hat_t, log_psi_t_eval_list), full_seq_based_on_true_twist
+
 
 
 
@@ -1233,25 +2831,15 @@ def iwae_backward(
     # if condition_twist_on_tokens is not None:
     #     log_phi_final_seqs = jnp.concatenate((seqs, condition_twist_on_tokens), axis=-1)
 
-    log_unnormalized_sigma_vals = evaluate_log_p_theta_1_to_t(seqs,
-                                                              params_p,
-                                                              prompt_len,
-                                                              output_len,
-                                                              huggingface_model=huggingface_model) \
+    scores = get_sequence_scores(seqs, prompt_len, params_p, params_twist, condition_twist_on_tokens,
+                                 huggingface_model=huggingface_model, proposal_is_p=proposal_is_p,
+                                 params_proposal=params_proposal, with_log_psi=False)
+
+    log_unnormalized_sigma_vals = scores.log_p_total \
                                   + evaluate_log_phi_final(seqs,
                                                            log_true_final_twist,
                                                            condition_twist_on_tokens)
-    if proposal_is_p:
-        log_normalized_q_1_to_t = evaluate_log_p_theta_1_to_t(seqs,
-                                                              params_p,
-                                                              prompt_len,
-                                                              output_len,
-                                                              huggingface_model=huggingface_model)
-    else:
-        log_normalized_q_1_to_t = evaluate_normalized_log_q_1_to_t(
-            seqs, params_p, params_twist,
-            prompt_len, condition_twist_on_tokens,
-             huggingface_model=huggingface_model, params_proposal=params_proposal)
+    log_normalized_q_1_to_t = scores.normalized_log_q_total
 
     target_dist_weights = log_unnormalized_sigma_vals - log_normalized_q_1_to_t
     return target_dist_weights
@@ -1361,6 +2949,47 @@ def iwae_forward_and_backward(
 
     return proposal_dist_weights, target_dist_weights, f_q_estimate
 
+
+def get_iwae_bounds_from_subsets(iwae_log_w_lower, iwae_log_w_upper, n_samples_list):
+    # IWAE log Z bounds for each number of samples in n_samples_list, from one iwae_forward_and_backward run with at least max(n_samples_list) samples.
+    # Lower bound: average of the bounds over the len(iwae_log_w_lower) // n disjoint blocks of n samples (each block is an independent n sample IWAE run).
+    # Upper bound: only index 0 is the true posterior sample, so this uses the nested subsets [:n] (which all contain it).
+    # Returns two arrays of shape (len(n_samples_list),)
+    iwae_lower_bounds = []
+    iwae_upper_bounds = []
+    for n in n_samples_list:
+        n_blocks = iwae_log_w_lower.shape[0] // n
+        blocks = iwae_log_w_lower[:n_blocks * n].reshape(n_blocks, n)
+        iwae_lower_bounds.append((jax.nn.logsumexp(blocks, axis=-1) - jnp.log(n)).mean())
+        iwae_upper_bounds.append(jax.nn.logsumexp(iwae_log_w_upper[:n]) - jnp.log(n))
+    return jnp.stack(iwae_lower_bounds), jnp.stack(iwae_upper_bounds)
+
+
+def smc_bounds_over_subpopulations(rng_key, true_posterior_sample, prompt, params_p, params_twist, log_true_final_twist,
+                                   output_len, n_smc_samples, n_subpopulations,
+                                   condition_twist_on_tokens, smc_procedure_type,
+                                   proposal_is_p=False, huggingface_model=None, params_proposal=None):
+    # SMC log Z lower bound (log_z_hat_t from smc_procedure) and upper bound (smc_backward), each averaged over n_subpopulations
+    # independent SMC runs of n_smc_samples particles, vmapped so they run as one batch. Needs smc_procedure_type == "jit"
+    rng_key, sk_lower, sk_upper = jax.random.split(rng_key, 3)
+
+    def _smc_lower_bound(sk):
+        (_, log_z_hat_t, _), _ = smc_procedure(
+            sk, prompt, params_p, params_twist, log_true_final_twist, output_len, n_smc_samples,
+            smc_procedure_type=smc_procedure_type, condition_twist_on_tokens=condition_twist_on_tokens,
+            resample=True, proposal_is_p=proposal_is_p, huggingface_model=huggingface_model, params_proposal=params_proposal)
+        return log_z_hat_t
+
+    def _smc_upper_bound(sk):
+        return smc_backward(sk, true_posterior_sample, prompt, params_p, params_twist, log_true_final_twist,
+                            output_len, n_smc_samples, condition_twist_on_tokens, smc_procedure_type,
+                            proposal_is_p=proposal_is_p, huggingface_model=huggingface_model, params_proposal=params_proposal)
+
+    smc_lower_bounds = jax.vmap(_smc_lower_bound)(jax.random.split(sk_lower, n_subpopulations))
+    smc_upper_bounds = jax.vmap(_smc_upper_bound)(jax.random.split(sk_upper, n_subpopulations))
+    return smc_lower_bounds.mean(), smc_upper_bounds.mean()
+
+
 def smc_backward(rng_key, true_posterior_sample, prompt, params_p, params_twist, log_true_final_twist,
                                   output_len, n_smc_samples,
                                   condition_twist_on_tokens, smc_procedure_type,
@@ -1387,16 +3016,12 @@ def upper_bound_log_Z_sigma_estimate(
     output_len, condition_twist_on_tokens,
     proposal_is_p=False, huggingface_model=None, params_proposal=None
 ):
-    log_unnormalized_sigma_vals = evaluate_log_p_theta_1_to_t(posterior_samples, params_p, prompt_len, output_len, huggingface_model=huggingface_model) \
+    scores = get_sequence_scores(posterior_samples, prompt_len, params_p, params_twist, condition_twist_on_tokens,
+                                 huggingface_model=huggingface_model, proposal_is_p=proposal_is_p,
+                                 params_proposal=params_proposal, with_log_psi=False)
+    log_unnormalized_sigma_vals = scores.log_p_total \
                                   + evaluate_log_phi_final(posterior_samples, log_true_final_twist, condition_twist_on_tokens)
-    if proposal_is_p:
-        log_normalized_q_1_to_t = evaluate_log_p_theta_1_to_t(posterior_samples, params_p, prompt_len, output_len, huggingface_model=huggingface_model)
-    else:
-        log_normalized_q_1_to_t = evaluate_normalized_log_q_1_to_t(
-            posterior_samples, params_p, params_twist, prompt_len,
-            condition_twist_on_tokens,
-            huggingface_model=huggingface_model, params_proposal=params_proposal
-        )
+    log_normalized_q_1_to_t = scores.normalized_log_q_total
 
     # print(log_unnormalized_sigma_vals)
     # print(log_unnormalized_sigma_vals.shape)
@@ -1409,11 +3034,9 @@ def upper_bound_log_Z_sigma_estimate(
 
 def get_kl_vals(q_seqs, params_p, params_twist, prompt_len, output_len,
                 condition_twist_on_tokens, huggingface_model, params_proposal=None):
-    log_q = evaluate_normalized_log_q_1_to_t(
-        q_seqs, params_p, params_twist, prompt_len,
-        condition_twist_on_tokens, huggingface_model=huggingface_model, params_proposal=params_proposal)
-    log_p = evaluate_log_p_selected_tokens(q_seqs, prompt_len, params_p, huggingface_model).sum(axis=-1)
-    kl_vals = log_q - log_p
+    scores = get_sequence_scores(q_seqs, prompt_len, params_p, params_twist, condition_twist_on_tokens,
+                                 huggingface_model=huggingface_model, params_proposal=params_proposal, with_log_psi=False)
+    kl_vals = scores.normalized_log_q_total - scores.log_p_total
     return kl_vals
 
 
@@ -1437,20 +3060,39 @@ def calculate_entropy_gradient_term(seqs_p, params_p, prompt_len, output_len):
     return ent_term
 
 
-def smc_procedure(rng_key, prompt, *args, smc_procedure_type="jit", **kwargs):
-    resample_criterion = "every_step"
-    # resample_criterion = "ESS" # TODO Mar figure out a way to make this into a flag nicely. Of course can go as an argument, but then I have to pass this everywhere like I pass in smc_procedure_type everywhere
-
-    if resample_criterion == "ESS":
-        smc_procedure_type = "debug" # Because right now the ESS calculation doesn't work with traced arrays e.g. in jax.lax.scan
+def smc_procedure(rng_key, prompt, *args, smc_procedure_type="jit", resampling_scheme=None, resample_criterion=None, eos_token_id=None, proposal_top_k=None, proposal_top_p=None, **kwargs):
+    if resampling_scheme is None:
+        resampling_scheme = default_resampling_scheme
+    if resample_criterion is None:
+        resample_criterion = default_resample_criterion # "every_step" or "ESS" (resample only when ESS < N/2; works with all smc_procedure_types)
+    if eos_token_id is None:
+        eos_token_id = default_eos_token_id
+    # Truncated proposal (see get_truncated_log_psi_all_vocab); only saves compute with the KV cache
+    proposal_top_k, proposal_top_p = resolve_proposal_truncation(proposal_top_k, proposal_top_p)
+    # Likewise use_kv_cache (None means kv_cache_decoding where supported): resolved here, before any jit, so it is a static argument below
+    smc_args = {**dict(zip(inspect.signature(smc_partial_jit).parameters, (rng_key, prompt) + args)), **kwargs}
+    kwargs["use_kv_cache"] = resolve_use_kv_cache(kwargs.get("use_kv_cache"), smc_args.get("huggingface_model"), smc_args.get("params_proposal"))
+    # With eos_token_id, particles that emit EOS are frozen (padded with EOS, incremental weights of 1) for the rest of the SMC steps.
+    # Unlike in stochastic_transformer_sample_eos_compacted, they are not dropped from the batch: resampling can
+    # bring them back to any number of copies, so the particle population has to stay fixed size
 
     prompt_len = prompt.shape[-1]
+    if shard_smc_particles and smc_procedure_type in ["jit", "partial_jit"]:
+        # The calls smc_sharded doesn't support (conditional SMC for the upper bounds, the intermediate sample history for
+        # the twist losses) stay unsharded; the main particle counts are checked against the device count at startup
+        smc_args = inspect.signature(smc_sharded).bind(rng_key, prompt, *args, **kwargs).arguments
+        if smc_args.get("true_posterior_sample") is None and not smc_args.get("get_intermediate_sample_history_based_on_learned_twists", False) \
+                and smc_args["n_smc_samples"] % jax.device_count() == 0:
+            smc_procedure_type = "sharded"
     if smc_procedure_type == "jit":
-        return smc_jit(rng_key, prompt, *args, **kwargs, prompt_len=prompt_len, resample_criterion=resample_criterion)
+        return smc_jit(rng_key, prompt, *args, **kwargs, prompt_len=prompt_len, resample_criterion=resample_criterion, resampling_scheme=resampling_scheme, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p)
     elif smc_procedure_type == "partial_jit":
-        return smc_partial_jit(rng_key, prompt, *args, **kwargs, prompt_len=prompt_len, resample_criterion=resample_criterion)
+        return smc_partial_jit(rng_key, prompt, *args, **kwargs, prompt_len=prompt_len, resample_criterion=resample_criterion, resampling_scheme=resampling_scheme, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p)
     elif smc_procedure_type == "debug":
-        return smc_debug(rng_key, prompt, *args, **kwargs, prompt_len=prompt_len, resample_criterion=resample_criterion)
+        return smc_debug(rng_key, prompt, *args, **kwargs, prompt_len=prompt_len, resample_criterion=resample_criterion, resampling_scheme=resampling_scheme, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p)
+    elif smc_procedure_type == "sharded":
+        # Particles split over all devices (see smc_sharded); the final twist is applied outside of jit, as in partial_jit
+        return smc_sharded(rng_key, prompt, *args, **kwargs, prompt_len=prompt_len, resample_criterion=resample_criterion, resampling_scheme=resampling_scheme, eos_token_id=eos_token_id, proposal_top_k=proposal_top_k, proposal_top_p=proposal_top_p)
     else:
         raise NotImplementedError
 
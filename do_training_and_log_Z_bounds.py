@@ -26,26 +26,21 @@ matplotlib.use('PDF')
 import matplotlib.pyplot as plt
 from transformers import AutoTokenizer, FlaxAutoModelForSequenceClassification
 import copy
+import custom_transformer_prob_utils
 from custom_transformer_prob_utils import *
+import reward_models
 from reward_models import *
+import losses
 from losses import *
 from plot_utils import *
+from posterior_sample_store import PosteriorSampleStore
+from twist_updates import get_new_params_twist_and_optim_twist_state, twist_update_step, scan_twist_update_steps
 
-from huggingface_models_custom import CustomLMWithTwistHead, get_tokenizer, CustomLMHeadModel
+from huggingface_models_custom import CustomLMWithTwistHead, get_tokenizer, CustomLMHeadModel, REMAT_POLICIES
 
 
 n_trueposts_for_evals = 4
 
-# @partial(jax.jit, static_argnames=["optimizer_twist"])
-def get_new_params_twist_and_optim_twist_state(optimizer_twist, grad_params_twist, optim_twist_state, params_twist):
-    updates_twist, optim_twist_state = optimizer_twist.update(
-        grad_params_twist, optim_twist_state, params_twist)
-
-    params_twist = optax.apply_updates(params_twist, updates_twist)
-
-    return params_twist, optim_twist_state
-
-
 class ExperimentConfig:
     def __init__(self, n_vocab, twist_learn_type, rm_type, beta_temp=1., num_last_tokens_to_condition_on=0,
                  sentiment_class=1, n_twist_ebm_vmap=0, alpha=0.5, train_on_true_posterior_samples=False
@@ -80,197 +75,211 @@ class ExperimentConfig:
         self.num_last_tokens_to_condition_on = num_last_tokens_to_condition_on
 
 
-        if self.rm_type in ["toxicity_threshold", "exp_beta_toxicity_class_logprob", "sentiment_threshold", "exp_beta_sentiment_class_logprob", "sent_cond_twist"]:
+        # Reward models that go through the tokenizers on the host can't run inside jit, so the final twist is evaluated
+        # separately (smc_scan_iter_final) unless the LM tokens get translated to RM inputs directly in jnp
+        self.final_twist_needs_partial_jit = self.rm_type in ["toxicity_threshold", "exp_beta_toxicity_class_logprob", "sentiment_threshold", "exp_beta_sentiment_class_logprob", "sent_cond_twist"] \
+                                             and not reward_models.translate_rm_tokens
+        if self.final_twist_needs_partial_jit:
             self.smc_procedure_type = "partial_jit"
         else:
             self.smc_procedure_type = "jit"
 
         self.twist_grad_fn = self._get_twist_grad_fn()
+        self.twist_value_and_grad_fn = self._get_twist_grad_fn(with_loss=True)
+
+        # Whether a whole twist update (sampling, loss, grad, optimizer step) can be traced into one jitted call.
+        # Anything that goes through host-side tokenizers/classifiers, or a loss that is only partially jitted, can't.
+        self.twist_update_is_jittable = not self.final_twist_needs_partial_jit \
+                                        and not self.train_on_true_posterior_samples \
+                                        and self.rm_type != "sent_cond_twist" \
+                                        and "partial_jit" not in self.twist_learn_type \
+                                        and self.twist_learn_type != "ebm_combined"
 
         self.sentiment_class_zero_index = sentiment_class - 1 # This is important because we need 0 based indexing, ie 0,1,2,3,4. Why not just use those as the args? Because the stars are 1,2,3,4,5
 
 
-    def _get_twist_grad_fn(self):
-        standard_argnum = 3 # For the params_twist argument
+    def _get_twist_loss_fn(self):
+        # The twist loss for twist_learn_type (params_twist is its positional argument 3); _get_twist_grad_fn differentiates it
 
         get_l_ebm_fn = get_l_ebm_ml_jit
-        if self.rm_type in ["toxicity_threshold", "exp_beta_toxicity_class_logprob", "sentiment_threshold", "exp_beta_sentiment_class_logprob", "sent_cond_twist"]:
+        if self.final_twist_needs_partial_jit:
             get_l_ebm_fn = get_l_ebm_ml_partial_jit
 
         if self.twist_learn_type == "ebm_old":
-            twist_grad_fn = jax.grad(get_l_ebm_fn, argnums=standard_argnum)
+            twist_loss_fn = get_l_ebm_fn
         elif self.twist_learn_type == "ebm_one_sample":
-            twist_grad_fn = jax.grad(partial(get_l_ebm_fn, only_one_sample=True), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_ebm_fn, only_one_sample=True)
         elif self.twist_learn_type == "ebm_reweight":
-            twist_grad_fn = jax.grad(partial(get_l_ebm_fn, reweight_for_second_term=True), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_ebm_fn, reweight_for_second_term=True)
         elif self.twist_learn_type == "ebm_partial_jit":
-            twist_grad_fn = jax.grad(get_l_ebm_ml_partial_jit, argnums=standard_argnum)
+            twist_loss_fn = get_l_ebm_ml_partial_jit
         # elif self.twist_learn_type == "ebm_q_rsmp":
-        #     twist_grad_fn = jax.grad(get_l_ebm_ml_w_q_resample_jit, argnums=standard_argnum)
+        #     twist_loss_fn = get_l_ebm_ml_w_q_resample_jit
         elif self.twist_learn_type == "ebm_mixed_p_q":
-            twist_grad_fn = jax.grad(partial(get_l_ebm_fn, mixed_p_q_sample=True), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_ebm_fn, mixed_p_q_sample=True)
         elif self.twist_learn_type == "ebm_mixed_p_q_reweight":
-            twist_grad_fn = jax.grad(partial(get_l_ebm_fn, reweight_for_second_term=True, mixed_p_q_sample=True), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_ebm_fn, reweight_for_second_term=True, mixed_p_q_sample=True)
         elif self.twist_learn_type == "ebm_ml_jit_vmapped_over_condition_tokens":
-            twist_grad_fn = jax.grad(partial(get_l_ebm_ml_jit_vmapped_over_condition_tokens, reweight_for_second_term=True, n_twist_ebm_vmap=self.n_twist_ebm_vmap), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_ebm_ml_jit_vmapped_over_condition_tokens, reweight_for_second_term=True, n_twist_ebm_vmap=self.n_twist_ebm_vmap)
         elif self.twist_learn_type == "ebm_ml_jit_vmapped_over_condition_tokens_finalrl":
-            twist_grad_fn = jax.grad(
+            twist_loss_fn = (
                 partial(get_l_ebm_ml_jit_vmapped_over_condition_tokens, add_rl_final_twist_loss=True,
-                        reweight_for_second_term=True, n_twist_ebm_vmap=self.n_twist_ebm_vmap),
-                argnums=standard_argnum
-            )
+                        reweight_for_second_term=True, n_twist_ebm_vmap=self.n_twist_ebm_vmap))
         elif self.twist_learn_type == "ebm_ml_partial_jit_vmapped_over_condition_tokens":
-            twist_grad_fn = jax.grad(
+            twist_loss_fn = (
                 partial(get_l_ebm_ml_partial_jit_vmapped_over_condition_tokens,
                         reweight_for_second_term=True,
-                        n_twist_ebm_vmap=self.n_twist_ebm_vmap), argnums=standard_argnum)
+                        n_twist_ebm_vmap=self.n_twist_ebm_vmap))
         elif self.twist_learn_type == "ebm_vmap_os":
-            twist_grad_fn = jax.grad(
+            twist_loss_fn = (
                 partial(get_l_ebm_ml_os_jit_vmapped_over_condition_tokens,
-                        n_twist_ebm_vmap=self.n_twist_ebm_vmap), argnums=standard_argnum)
+                        n_twist_ebm_vmap=self.n_twist_ebm_vmap))
         elif self.twist_learn_type == "ebm_ml_pprop_jit_vmapped_over_condition_tokens":
-            twist_grad_fn = jax.grad(
+            twist_loss_fn = (
                 partial(get_l_ebm_ml_jit_vmapped_over_condition_tokens,
                         reweight_for_second_term=True, proposal_is_p=True,
-                        n_twist_ebm_vmap=self.n_twist_ebm_vmap), argnums=standard_argnum)
+                        n_twist_ebm_vmap=self.n_twist_ebm_vmap))
         elif self.twist_learn_type == "ebm_ml_jit_vmapped_over_condition_tokens_nosmcub":
-            twist_grad_fn = jax.grad(partial(
+            twist_loss_fn = (partial(
                 get_l_ebm_ml_jit_vmapped_over_condition_tokens, reweight_for_second_term=True,
-                n_twist_ebm_vmap=self.n_twist_ebm_vmap, use_smc_ub_for_pos_samples=False), argnums=standard_argnum)
+                n_twist_ebm_vmap=self.n_twist_ebm_vmap, use_smc_ub_for_pos_samples=False))
         elif self.twist_learn_type == "ebm_ml_pprop_jit_vmapped_over_condition_tokens_nosmcub":
-            twist_grad_fn = jax.grad(partial(
+            twist_loss_fn = (partial(
                 get_l_ebm_ml_jit_vmapped_over_condition_tokens, reweight_for_second_term=True, proposal_is_p=True,
-                n_twist_ebm_vmap=self.n_twist_ebm_vmap, use_smc_ub_for_pos_samples=False), argnums=standard_argnum)
+                n_twist_ebm_vmap=self.n_twist_ebm_vmap, use_smc_ub_for_pos_samples=False))
         elif self.twist_learn_type == "ebm_ml_vmap_with_one_total_kl":
-            twist_grad_fn = jax.grad(partial(get_l_ebm_ml_vmap_with_one_total_kl, reweight_for_second_term=True, n_twist_ebm_vmap=self.n_twist_ebm_vmap, alpha=self.alpha), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_ebm_ml_vmap_with_one_total_kl, reweight_for_second_term=True, n_twist_ebm_vmap=self.n_twist_ebm_vmap, alpha=self.alpha)
         elif self.twist_learn_type == "ebm_combined":
-            twist_grad_fn = jax.grad(partial(get_l_ebm_ml_combined_objective_partial_jit, alpha=self.alpha), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_ebm_ml_combined_objective_partial_jit, alpha=self.alpha)
         elif self.twist_learn_type == "nvi_partial_jit":
-            twist_grad_fn = jax.grad(get_l_nvi_partial_jit , argnums=standard_argnum)
+            twist_loss_fn = get_l_nvi_partial_jit
         elif self.twist_learn_type == "nvi_jit":
-            twist_grad_fn = jax.grad(get_l_nvi_jit,
-                                   argnums=standard_argnum)
+            twist_loss_fn = get_l_nvi_jit
         elif self.twist_learn_type == "nvi_vmapped_over_condition_tokens":
-            twist_grad_fn = jax.grad(
+            twist_loss_fn = (
                 partial(get_l_nvi_jit_vmapped_over_condition_tokens,
-                        n_twist_ebm_vmap=self.n_twist_ebm_vmap),
-                argnums=standard_argnum
-            )
+                        n_twist_ebm_vmap=self.n_twist_ebm_vmap))
         elif self.twist_learn_type == "one_total_kl":
-            twist_grad_fn = jax.grad(get_l_one_total_kl_jit, argnums=standard_argnum)
+            twist_loss_fn = get_l_one_total_kl_jit
         elif self.twist_learn_type == "one_total_kl_mixed_p_q":
-            twist_grad_fn = jax.grad(partial(get_l_one_total_kl_jit, mixed_p_q_sample=True), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_one_total_kl_jit, mixed_p_q_sample=True)
         elif self.twist_learn_type == "one_total_kl_sample":
-            twist_grad_fn = jax.grad(partial(get_l_one_total_kl_jit, exact_expectation=False), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_one_total_kl_jit, exact_expectation=False)
         elif self.twist_learn_type == "one_total_kl_sample_mixed_p_q":
-            twist_grad_fn = jax.grad(partial(get_l_one_total_kl_jit, mixed_p_q_sample=True, exact_expectation=False), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_one_total_kl_jit, mixed_p_q_sample=True, exact_expectation=False)
         elif self.twist_learn_type == "one_total_kl_partial_jit":
-            twist_grad_fn = jax.grad(get_l_one_total_kl, argnums=standard_argnum)
+            twist_loss_fn = get_l_one_total_kl
         elif self.twist_learn_type == "one_total_kl_with_rl_lsq_sgtarget":
-            twist_grad_fn = jax.grad(partial(get_l_combined_rl_onekl, alpha=self.alpha,
-                                           rl_loss_type="squared_error_in_log_space", rl_stop_grad="target"), argnums=standard_argnum)
+            twist_loss_fn = (partial(get_l_combined_rl_onekl, alpha=self.alpha,
+                                           rl_loss_type="squared_error_in_log_space", rl_stop_grad="target"))
         elif self.twist_learn_type == "one_total_kl_with_rl_lsq_sgvalue":
-            twist_grad_fn = jax.grad(partial(get_l_combined_rl_onekl, alpha=self.alpha,
-                                           rl_loss_type="squared_error_in_log_space", rl_stop_grad="value"), argnums=standard_argnum)
+            twist_loss_fn = (partial(get_l_combined_rl_onekl, alpha=self.alpha,
+                                           rl_loss_type="squared_error_in_log_space", rl_stop_grad="value"))
         elif self.twist_learn_type == "one_total_kl_with_rl_lsq_sgnone":
-            twist_grad_fn = jax.grad(
+            twist_loss_fn = (
                 partial(get_l_combined_rl_onekl, alpha=self.alpha,
                         rl_loss_type="squared_error_in_log_space",
-                        rl_stop_grad=None), argnums=standard_argnum)
+                        rl_stop_grad=None))
         elif self.twist_learn_type == "one_total_kl_with_rl_sq_sgtarget":
-            twist_grad_fn = jax.grad(partial(get_l_combined_rl_onekl, alpha=self.alpha,
-                                           rl_loss_type="squared_error", rl_stop_grad="target"), argnums=standard_argnum)
+            twist_loss_fn = (partial(get_l_combined_rl_onekl, alpha=self.alpha,
+                                           rl_loss_type="squared_error", rl_stop_grad="target"))
         elif self.twist_learn_type == "one_total_kl_with_rl_sq_sgvalue":
-            twist_grad_fn = jax.grad(partial(get_l_combined_rl_onekl, alpha=self.alpha,
-                                           rl_loss_type="squared_error", rl_stop_grad="value"), argnums=standard_argnum)
+            twist_loss_fn = (partial(get_l_combined_rl_onekl, alpha=self.alpha,
+                                           rl_loss_type="squared_error", rl_stop_grad="value"))
         elif self.twist_learn_type == "one_total_kl_with_rl_sq_sgnone":
-            twist_grad_fn = jax.grad(
+            twist_loss_fn = (
                 partial(get_l_combined_rl_onekl, alpha=self.alpha,
                         rl_loss_type="squared_error",
-                        rl_stop_grad=None), argnums=standard_argnum)
+                        rl_stop_grad=None))
         elif self.twist_learn_type == "one_total_kl_with_rl_ratio_sgtarget":
-            twist_grad_fn = jax.grad(partial(get_l_combined_rl_onekl, alpha=self.alpha,
-                                           rl_loss_type="ratio", rl_stop_grad="target"), argnums=standard_argnum)
+            twist_loss_fn = (partial(get_l_combined_rl_onekl, alpha=self.alpha,
+                                           rl_loss_type="ratio", rl_stop_grad="target"))
         elif self.twist_learn_type == "one_total_kl_with_rl_ratio_sgvalue":
-            twist_grad_fn = jax.grad(partial(get_l_combined_rl_onekl, alpha=self.alpha,
-                                           rl_loss_type="ratio", rl_stop_grad="value"), argnums=standard_argnum)
+            twist_loss_fn = (partial(get_l_combined_rl_onekl, alpha=self.alpha,
+                                           rl_loss_type="ratio", rl_stop_grad="value"))
         elif self.twist_learn_type == "one_total_kl_with_rl_ratio_sgnone":
-            twist_grad_fn = jax.grad(
+            twist_loss_fn = (
                 partial(get_l_combined_rl_onekl, alpha=self.alpha,
                         rl_loss_type="ratio",
-                        rl_stop_grad=None), argnums=standard_argnum)
+                        rl_stop_grad=None))
         elif self.twist_learn_type == "one_total_kl_with_sixo":
-            twist_grad_fn = jax.grad(get_l_combined_sixo_onekl, argnums=standard_argnum)
+            twist_loss_fn = get_l_combined_sixo_onekl
         elif self.twist_learn_type == "rl_p_sq":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="p", loss_type="squared_error"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="p", loss_type="squared_error")
         elif self.twist_learn_type == "rl_q_sq":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="q", loss_type="squared_error"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="q", loss_type="squared_error")
         elif self.twist_learn_type == "rl_qrsmp_sq":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="qrsmp", loss_type="squared_error"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="qrsmp", loss_type="squared_error")
         elif self.twist_learn_type == "rl_sigma_sq":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="sigma", loss_type="squared_error"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="sigma", loss_type="squared_error")
         elif self.twist_learn_type == "rl_mixed_p_q_sq":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="mixed_p_q", loss_type="squared_error"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="mixed_p_q", loss_type="squared_error")
         elif self.twist_learn_type == "rl_p_lsq":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="p", loss_type="squared_error_in_log_space"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="p", loss_type="squared_error_in_log_space")
         elif self.twist_learn_type == "rl_q_lsq":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="q", loss_type="squared_error_in_log_space"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="q", loss_type="squared_error_in_log_space")
         elif self.twist_learn_type == "rl_qsigma_lsq":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="q", loss_type="squared_error_in_log_space", append_sigma_samples=True), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="q", loss_type="squared_error_in_log_space", append_sigma_samples=True)
         elif self.twist_learn_type == "rl_qsigma_lsq_partial_jit":
-            twist_grad_fn = jax.grad(
+            twist_loss_fn = (
                 partial(get_l_rl_based_partial_jit, evaluate_over_samples_from="q",
                         loss_type="squared_error_in_log_space",
-                        append_sigma_samples=True), argnums=standard_argnum)
+                        append_sigma_samples=True))
         elif self.twist_learn_type == "rl_qsigma_gcd":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="q", loss_type="googleCD", append_sigma_samples=True), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="q", loss_type="googleCD", append_sigma_samples=True)
         elif self.twist_learn_type == "rl_q_gcd":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="q", loss_type="googleCD"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="q", loss_type="googleCD")
         elif self.twist_learn_type == "rl_q_sq_partial_jit":
-            twist_grad_fn = jax.grad(
+            twist_loss_fn = (
                 partial(get_l_rl_based_partial_jit, evaluate_over_samples_from="q",
-                        loss_type="squared_error"), argnums=standard_argnum)
+                        loss_type="squared_error"))
         elif self.twist_learn_type == "rl_q_lsq_partial_jit":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_partial_jit, evaluate_over_samples_from="q", loss_type="squared_error_in_log_space"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_partial_jit, evaluate_over_samples_from="q", loss_type="squared_error_in_log_space")
         elif self.twist_learn_type == "rl_q_gcd_partial_jit":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_partial_jit, evaluate_over_samples_from="q", loss_type="googleCD"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_partial_jit, evaluate_over_samples_from="q", loss_type="googleCD")
         elif self.twist_learn_type == "rl_q_lsq_nostopgrad":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, stop_grad=False, evaluate_over_samples_from="q", loss_type="squared_error_in_log_space"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, stop_grad=False, evaluate_over_samples_from="q", loss_type="squared_error_in_log_space")
         elif self.twist_learn_type == "rl_q_lsq_partial_jit_nostopgrad":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_partial_jit, stop_grad=False, evaluate_over_samples_from="q", loss_type="squared_error_in_log_space"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_partial_jit, stop_grad=False, evaluate_over_samples_from="q", loss_type="squared_error_in_log_space")
         elif self.twist_learn_type == "rl_q_multistep":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="q", loss_type="multistep"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="q", loss_type="multistep")
         elif self.twist_learn_type == "rl_q_multistep_partial_jit":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_partial_jit, evaluate_over_samples_from="q", loss_type="multistep"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_partial_jit, evaluate_over_samples_from="q", loss_type="multistep")
         elif self.twist_learn_type == "rl_qrsmp_lsq":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="qrsmp", loss_type="squared_error_in_log_space"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="qrsmp", loss_type="squared_error_in_log_space")
         elif self.twist_learn_type == "rl_sigma_lsq":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="sigma", loss_type="squared_error_in_log_space"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="sigma", loss_type="squared_error_in_log_space")
         elif self.twist_learn_type == "rl_mixed_p_q_lsq":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="mixed_p_q", loss_type="squared_error_in_log_space"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="mixed_p_q", loss_type="squared_error_in_log_space")
         elif self.twist_learn_type == "rl_mixed_p_q_lsq_partial_jit":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_partial_jit, evaluate_over_samples_from="mixed_p_q", loss_type="squared_error_in_log_space"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_partial_jit, evaluate_over_samples_from="mixed_p_q", loss_type="squared_error_in_log_space")
         elif self.twist_learn_type == "rl_mc":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_jit, evaluate_over_samples_from="p", loss_type="monte_carlo"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_jit, evaluate_over_samples_from="p", loss_type="monte_carlo")
         elif self.twist_learn_type == "rl_mc_partial_jit":
-            twist_grad_fn = jax.grad(partial(get_l_rl_based_partial_jit, evaluate_over_samples_from="p", loss_type="monte_carlo"), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_rl_based_partial_jit, evaluate_over_samples_from="p", loss_type="monte_carlo")
         elif self.twist_learn_type == "sixo":
-            twist_grad_fn = jax.grad(get_l_dre_sixo_jit, argnums=standard_argnum)
+            twist_loss_fn = get_l_dre_sixo_jit
         elif self.twist_learn_type == "sixo_mixed_p_q":
-            twist_grad_fn = jax.grad(partial(get_l_dre_sixo_jit, mixed_p_q_sample=True), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_dre_sixo_jit, mixed_p_q_sample=True)
         elif self.twist_learn_type == "sixo_partial_jit":
-            twist_grad_fn = jax.grad(get_l_dre_sixo, argnums=standard_argnum)
+            twist_loss_fn = get_l_dre_sixo
         elif self.twist_learn_type == "sixo_mixed_p_q_partial_jit":
-            twist_grad_fn = jax.grad(partial(get_l_dre_sixo, mixed_p_q_sample=True), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_dre_sixo, mixed_p_q_sample=True)
         elif self.twist_learn_type == "bce_sigma":
-            twist_grad_fn = jax.grad(partial(get_l_bce_sigma, rm_type=self.rm_type, beta_temp=self.beta_temp), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_bce_sigma, rm_type=self.rm_type, beta_temp=self.beta_temp)
         elif self.twist_learn_type == "bce_psigma":
-            twist_grad_fn = jax.grad(partial(get_l_bce_p_sigma, rm_type=self.rm_type, beta_temp=self.beta_temp), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_bce_p_sigma, rm_type=self.rm_type, beta_temp=self.beta_temp)
         elif "bce" in self.twist_learn_type: # in ["bce_p", "bce_q"]:
-            twist_grad_fn = jax.grad(partial(get_l_bce, rm_type=self.rm_type, beta_temp=self.beta_temp), argnums=standard_argnum)
+            twist_loss_fn = partial(get_l_bce, rm_type=self.rm_type, beta_temp=self.beta_temp)
         else:
             raise NotImplementedError
-        return twist_grad_fn
+        return twist_loss_fn
+
+    def _get_twist_grad_fn(self, with_loss=False):
+        standard_argnum = 3 # For the params_twist argument
+        if with_loss:
+            return jax.value_and_grad(self._get_twist_loss_fn(), argnums=standard_argnum)
+        return jax.grad(self._get_twist_loss_fn(), argnums=standard_argnum)
 
     def _get_sigma_samples_and_cond_tokens_infilling(
         self, rng_key, params_p, prompt, output_len, n_twist, huggingface_model,
@@ -381,7 +390,10 @@ class ExperimentConfig:
     def get_grad_params_twist(self, rng_key, prompt, n_twist, output_len,
                               params_p, params_twist, log_true_final_twist,
                               proposal_is_p=False, huggingface_model=None,
-                              tempered_twist=False, beta_prop=None, replay_buffer=None, replay_buffer_log_w_ts=None, params_proposal=None):
+                              tempered_twist=False, beta_prop=None, replay_buffer=None, replay_buffer_log_w_ts=None, params_proposal=None,
+                              return_loss=False):
+        # With return_loss, returns (rng_key, grad_params_twist, loss) instead of (rng_key, grad_params_twist)
+        twist_grad_fn = self.twist_value_and_grad_fn if return_loss else self.twist_grad_fn
 
         true_sigma_samples = None
         condition_twist_on_tokens = None
@@ -478,7 +490,7 @@ class ExperimentConfig:
                 true_sigma_samples = samples_to_evaluate_over # Yeah I know these are not true sigma samples, I just didn't rename. Check the BCE loss, it just needs a set of samples passed in. Kind of like the set of samples we evaluate RL loss over
 
             rng_key, sk = jax.random.split(rng_key)
-            grad_params_twist = self.twist_grad_fn(
+            grad_params_twist = twist_grad_fn(
                 sk, prompt, params_p,
                 params_twist, log_true_final_twist, output_len,
                 n_twist, smc_procedure_type=self.smc_procedure_type,
@@ -491,6 +503,9 @@ class ExperimentConfig:
                 replay_buffer_log_w_ts=replay_buffer_log_w_ts, log_prob_class=log_prob_class,
                 params_proposal=params_proposal
             )
+            if return_loss:
+                loss, grad_params_twist = grad_params_twist
+                return rng_key, grad_params_twist, loss
             return rng_key, grad_params_twist
 
         if self.train_on_true_posterior_samples:
@@ -529,7 +544,7 @@ class ExperimentConfig:
             true_sigma_samples = None
 
         rng_key, sk = jax.random.split(rng_key)
-        grad_params_twist = self.twist_grad_fn(
+        grad_params_twist = twist_grad_fn(
             sk, prompt, params_p,
             params_twist, log_true_final_twist, output_len,
             n_twist, smc_procedure_type=self.smc_procedure_type,
@@ -540,6 +555,9 @@ class ExperimentConfig:
             replay_buffer_log_w_ts=replay_buffer_log_w_ts,
             params_proposal=params_proposal
         )
+        if return_loss:
+            loss, grad_params_twist = grad_params_twist
+            return rng_key, grad_params_twist, loss
         return rng_key, grad_params_twist
 
 
@@ -569,6 +587,48 @@ class ExperimentConfig:
 
         return rng_key, params_twist, optim_twist_state
 
+    def _get_grad_params_twist_and_loss_fn(self, prompt, params_p, n_twist, output_len, log_true_final_twist, proposal_is_p,
+                                          huggingface_model, tempered_twist, beta_prop, params_proposal=None):
+        # get_grad_params_twist with everything but (rng_key, params_twist) filled in, for twist_updates.twist_update_step
+        def get_grad_params_twist_and_loss(rng_key, params_twist):
+            return self.get_grad_params_twist(
+                rng_key, prompt, n_twist,
+                output_len, params_p,
+                params_twist, log_true_final_twist,
+                proposal_is_p=proposal_is_p,
+                huggingface_model=huggingface_model,
+                tempered_twist=tempered_twist, beta_prop=beta_prop,
+                params_proposal=params_proposal, return_loss=True
+            )
+        return get_grad_params_twist_and_loss
+
+    # Jitted version of update_twist (without the replay buffer; needs twist_update_is_jittable), with the loss and grad norm.
+    # params_twist and optim_twist_state are donated, so the arrays passed in can't be used after the call; use the returned ones.
+    @partial(jax.jit, static_argnames=[
+        "self", "n_twist", "output_len", "log_true_final_twist", "proposal_is_p",
+        "huggingface_model", "optimizer_twist", "tempered_twist", "beta_prop"],
+             donate_argnums=(2, 3))
+    def update_twist_jitted(self, rng_key, params_twist, optim_twist_state, prompt, params_p,
+                            n_twist, output_len, log_true_final_twist, proposal_is_p, huggingface_model,
+                            optimizer_twist, tempered_twist, beta_prop, params_proposal=None):
+        get_grad_params_twist_and_loss = self._get_grad_params_twist_and_loss_fn(
+            prompt, params_p, n_twist, output_len, log_true_final_twist, proposal_is_p,
+            huggingface_model, tempered_twist, beta_prop, params_proposal)
+        return twist_update_step(get_grad_params_twist_and_loss, optimizer_twist, rng_key, params_twist, optim_twist_state)
+
+    # n_updates twist updates in a single dispatch (twist_updates.scan_twist_update_steps). Donates like update_twist_jitted.
+    @partial(jax.jit, static_argnames=[
+        "self", "n_twist", "output_len", "log_true_final_twist", "proposal_is_p",
+        "huggingface_model", "optimizer_twist", "tempered_twist", "beta_prop", "n_updates"],
+             donate_argnums=(2, 3))
+    def update_twist_scanned(self, rng_key, params_twist, optim_twist_state, prompt, params_p,
+                             n_twist, output_len, log_true_final_twist, proposal_is_p, huggingface_model,
+                             optimizer_twist, tempered_twist, beta_prop, n_updates, params_proposal=None):
+        get_grad_params_twist_and_loss = self._get_grad_params_twist_and_loss_fn(
+            prompt, params_p, n_twist, output_len, log_true_final_twist, proposal_is_p,
+            huggingface_model, tempered_twist, beta_prop, params_proposal)
+        return scan_twist_update_steps(get_grad_params_twist_and_loss, optimizer_twist, rng_key, params_twist, optim_twist_state, n_updates)
+
     def get_and_plot_logZ_bounds_based_on_cfg(
         self, rng_key, prompt, output_len, params_p, params_twist,
         log_true_final_twist, start, epoch, huggingface_model, proposal_is_p,
@@ -1019,10 +1079,103 @@ class ExperimentConfig:
 
         return log_true_final_twists, true_posterior_samples_by_prompt_and_by_token
 
+    def get_true_posterior_sample_acceptors(
+        self, rng_key, jnp_prompts, rm_type, output_len, indices_of_continuation=None,
+        rewardModel=None, tokenizer_RM=None, tokenizer=None, threshold=0, pos_threshold=True,
+        params_p=None, huggingface_model=None, n_samples_at_a_time=None
+    ):
+        # The accept/reject step that the build_*_twists functions use for true posterior samples, for each prompt,
+        # along with how many tokens past the prompt to sample (see collect_true_posterior_samples_pipelined)
+        # With rm_screen_calibration_samples > 0, the threshold RMs get a cheap screen first (see ThresholdScreen)
+        n_tokens_to_sample = output_len
+        self.threshold_screens = []
+        if rm_type in ["toxicity_threshold", "sentiment_threshold"] and rm_screen_calibration_samples > 0:
+            if rm_type == "toxicity_threshold":
+                rm_score_fn = partial(reward_model_toxicity, rewardModel=rewardModel, tokenizer_RM=tokenizer_RM, tokenizer=tokenizer)
+            else:
+                rm_score_fn = partial(reward_model_sentiment_score, rewardModel=rewardModel, tokenizer_RM=tokenizer_RM, tokenizer=tokenizer)
+            exact_accept_fn = accept_toxicity_threshold if rm_type == "toxicity_threshold" else accept_sentiment_threshold
+            accept_fns = []
+            for jnp_prompt in jnp_prompts:
+                rng_key, screen = fit_threshold_screen(
+                    rng_key, params_p, huggingface_model, jnp_prompt, output_len, n_samples_at_a_time,
+                    rm_screen_calibration_samples, rm_score_fn, threshold, pos_threshold,
+                    fn_target=rm_screen_fn_target, audit_rate=rm_screen_audit_rate, min_positives=rm_screen_min_positives
+                )
+                self.threshold_screens.append(screen)
+                if screen is None: # too few positives to calibrate on; score everything exactly for this prompt
+                    accept_fns.append(partial(exact_accept_fn, rewardModel=rewardModel, tokenizer_RM=tokenizer_RM, tokenizer=tokenizer,
+                                              threshold=threshold, pos_threshold=pos_threshold))
+                    continue
+                accept_fn = partial(
+                    accept_threshold_cascaded, screen=screen, params_p=params_p, huggingface_model=huggingface_model,
+                    prompt_len=jnp_prompt.shape[-1], rm_score_fn=rm_score_fn, threshold=threshold, pos_threshold=pos_threshold)
+                accept_fn.accepts_probe_features = True # so collect_true_posterior_samples_pipelined passes the features from the sampling pass
+                accept_fns.append(accept_fn)
+            if any(screen is not None for screen in self.threshold_screens):
+                print("WARNING: with the reward model screen, the true posterior samples are approximate (a screen false negative "
+                      "rejects a sample that the reward model would accept)", flush=True)
+            return rng_key, n_tokens_to_sample, accept_fns
+        if rm_type == "exp_beta_toxicity_class_logprob":
+            assert self.beta_temp == 1
+            class_num = 1 if pos_threshold else 0
+            accept_fn = partial(accept_stochastic_class, classifier=rewardModel, tokenizer_RM=tokenizer_RM, tokenizer=tokenizer,
+                                class_num=class_num, singledimlogit=True)
+        elif rm_type == "exp_beta_sentiment_class_logprob":
+            assert self.beta_temp == 1
+            accept_fn = partial(accept_stochastic_class, classifier=rewardModel, tokenizer_RM=tokenizer_RM, tokenizer=tokenizer,
+                                class_num=self.sentiment_class_zero_index, singledimlogit=False)
+        elif rm_type == "toxicity_threshold":
+            accept_fn = partial(accept_toxicity_threshold, rewardModel=rewardModel, tokenizer_RM=tokenizer_RM, tokenizer=tokenizer,
+                                threshold=threshold, pos_threshold=pos_threshold)
+        elif rm_type == "sentiment_threshold":
+            accept_fn = partial(accept_sentiment_threshold, rewardModel=rewardModel, tokenizer_RM=tokenizer_RM, tokenizer=tokenizer,
+                                threshold=threshold, pos_threshold=pos_threshold)
+        elif rm_type == "p_continuation" or rm_type == "hard_p_continuation":
+            assert indices_of_continuation is not None
+            n_tokens_to_sample = output_len + indices_of_continuation.shape[0]
+            return rng_key, n_tokens_to_sample, [
+                partial(accept_p_of_continuation, prompt_len=jnp_prompt.shape[-1], output_len=output_len,
+                        indices_of_continuation=indices_of_continuation)
+                for jnp_prompt in jnp_prompts
+            ]
+        elif rm_type == "p_last_tokens":
+            n_tokens_to_sample = output_len + self.num_last_tokens_to_condition_on
+            accept_fn = accept_all
+        elif rm_type == "sent_cond_twist":
+            accept_fn = accept_all
+        else:
+            raise NotImplementedError
+
+        return rng_key, n_tokens_to_sample, [accept_fn for _ in jnp_prompts]
+
 
 # TODO: make into separate files, training of twists vs plotting code??
 
 print_smc_samples = False
+nested_subset_evals = False # Get the log Z bounds for all of n_samples_for_plots from one set of runs (see inspect_and_record_evidence_setting_for_index_nested)
+eval_seed_batch_size = None # Max number of seeds (true posterior indices) per compiled call in collect_info_across_trueposts_batched (None: all at once)
+posterior_scoring_threads = 2 # Threads scoring base model samples with the reward model while the next batches get sampled (collect_true_posterior_samples)
+rm_screen_calibration_samples = 0 # > 0: screen threshold RM candidates with a linear probe calibrated on this many exactly scored samples (ThresholdScreen)
+rm_screen_audit_rate = 0.02
+rm_screen_fn_target = 1e-2
+rm_screen_min_positives = 100
+
+def broadcast_condition_twist_on_tokens_for_index(condition_twist_on_tokens, index_of_true_posterior_sample, n_test_smc_samples):
+    if condition_twist_on_tokens is None:
+        return None
+    # What I'm doing here is: if we want to do n>1, essentially I take the conditioning tokens associated with the true posterior sample
+    # and then I'm broacasting it to however many n samples we want, so that we can do SMC or whatever we want with everything conditioned on the same set of tokens
+    condition_twist_on_tokens_for_chosen_posterior_sample = condition_twist_on_tokens[index_of_true_posterior_sample]
+    print(condition_twist_on_tokens_for_chosen_posterior_sample.shape)
+
+    if args.rm_type == "sent_cond_twist":
+        condition_twist_on_tokens_broadcasted = jnp.full((n_test_smc_samples,), condition_twist_on_tokens_for_chosen_posterior_sample)
+    else:
+        condition_twist_on_tokens_broadcasted = jnp.full((n_test_smc_samples, condition_twist_on_tokens.shape[-1]), condition_twist_on_tokens_for_chosen_posterior_sample)
+    print(condition_twist_on_tokens_broadcasted.shape)
+    return condition_twist_on_tokens_broadcasted
+
 
 def inspect_and_record_evidence_setting_for_index(
     rng_key, prompt, params_p,
@@ -1043,18 +1196,8 @@ def inspect_and_record_evidence_setting_for_index(
     # Deterministic may be better so that you always have a consistent set against which you're evaluating at each epoch...
     posterior_sample = true_posterior_samples[index_of_true_posterior_sample]
 
-    condition_twist_on_tokens_broadcasted = None
-    if condition_twist_on_tokens is not None:
-        # What I'm doing here is: if we want to do n>1, essentially I take the conditioning tokens associated with the true posterior sample
-        # and then I'm broacasting it to however many n samples we want, so that we can do SMC or whatever we want with everything conditioned on the same set of tokens
-        condition_twist_on_tokens_for_chosen_posterior_sample = condition_twist_on_tokens[index_of_true_posterior_sample]
-        print(condition_twist_on_tokens_for_chosen_posterior_sample.shape)
-
-        if args.rm_type == "sent_cond_twist":
-            condition_twist_on_tokens_broadcasted = jnp.full((n_test_smc_samples,), condition_twist_on_tokens_for_chosen_posterior_sample)
-        else:
-            condition_twist_on_tokens_broadcasted = jnp.full((n_test_smc_samples, condition_twist_on_tokens.shape[-1]), condition_twist_on_tokens_for_chosen_posterior_sample)
-        print(condition_twist_on_tokens_broadcasted.shape)
+    condition_twist_on_tokens_broadcasted = broadcast_condition_twist_on_tokens_for_index(
+        condition_twist_on_tokens, index_of_true_posterior_sample, n_test_smc_samples)
 
 
     rng_key, sk_i = jax.random.split(rng_key)
@@ -1164,6 +1307,106 @@ inspect_and_record_evidence_setting_for_index_jit = partial(jax.jit, static_argn
 ])(inspect_and_record_evidence_setting_for_index)
 
 
+def inspect_and_record_evidence_setting_for_index_nested(
+    rng_key, prompt, params_p,
+    params_twist, output_len, log_true_final_twist,
+    n_samples_for_plots, true_posterior_samples,
+    smc_procedure_type,
+    proposal_is_p=False,
+    condition_twist_on_tokens=None, huggingface_model=None, index_of_true_posterior_sample=0, params_proposal=None):
+    # Same as inspect_and_record_evidence_setting_for_index, but for every number of samples in n_samples_for_plots (a tuple, largest last) at once:
+    # IWAE is run once with the largest number of samples, and the bounds for the smaller numbers come from subsets of it (see get_iwae_bounds_from_subsets);
+    # for SMC, each n is n_samples_for_plots[-1] // n independent runs of n particles in one batch (see smc_bounds_over_subpopulations),
+    # so every n uses about the same memory as the largest one.
+    # Returns the same list as inspect_and_record_evidence_setting_for_index, except that the four log Z bounds have a leading axis over n_samples_for_plots;
+    # f_qs and the KL(q||sigma) estimates are for the largest number of samples
+    n_samples_max = n_samples_for_plots[-1]
+    posterior_sample = true_posterior_samples[index_of_true_posterior_sample]
+
+    rng_key, sk_i = jax.random.split(rng_key)
+    iwae_log_w_lower, iwae_log_w_upper, f_q_estimate = iwae_forward_and_backward(
+        sk_i, posterior_sample, prompt, params_p, params_twist, log_true_final_twist,
+        output_len, n_samples_max, smc_procedure_type=smc_procedure_type,
+        condition_twist_on_tokens=broadcast_condition_twist_on_tokens_for_index(
+            condition_twist_on_tokens, index_of_true_posterior_sample, n_samples_max),
+        proposal_is_p=proposal_is_p, huggingface_model=huggingface_model, params_proposal=params_proposal
+    )
+    iwae_lower_bound_estimates, iwae_upper_bound_estimates = get_iwae_bounds_from_subsets(
+        iwae_log_w_lower, iwae_log_w_upper, n_samples_for_plots)
+    f_qs = iwae_log_w_lower
+
+    smc_lower_bound_estimates = []
+    smc_upper_bound_estimates = []
+    for n_test_smc_samples in n_samples_for_plots:
+        rng_key, sk_smc = jax.random.split(rng_key)
+        smc_lower_bound_estimate, smc_upper_bound_estimate = smc_bounds_over_subpopulations(
+            sk_smc, posterior_sample, prompt, params_p, params_twist, log_true_final_twist,
+            output_len, n_test_smc_samples, n_samples_max // n_test_smc_samples,
+            broadcast_condition_twist_on_tokens_for_index(condition_twist_on_tokens, index_of_true_posterior_sample, n_test_smc_samples),
+            smc_procedure_type, proposal_is_p=proposal_is_p, huggingface_model=huggingface_model, params_proposal=params_proposal)
+        smc_lower_bound_estimates.append(smc_lower_bound_estimate)
+        smc_upper_bound_estimates.append(smc_upper_bound_estimate)
+    smc_lower_bound_estimates = jnp.stack(smc_lower_bound_estimates)
+    smc_upper_bound_estimates = jnp.stack(smc_upper_bound_estimates)
+
+    list_of_things_to_append_for_record_list = \
+        [iwae_upper_bound_estimates, iwae_lower_bound_estimates,
+         smc_upper_bound_estimates, smc_lower_bound_estimates,
+         f_qs,
+         iwae_upper_bound_estimates[-1] - f_q_estimate,
+         iwae_lower_bound_estimates[-1] - f_q_estimate,
+         smc_upper_bound_estimates[-1] - f_q_estimate,
+         smc_lower_bound_estimates[-1] - f_q_estimate]
+
+    return list_of_things_to_append_for_record_list
+
+
+@partial(jax.jit, static_argnames=[
+    "log_true_final_twist", 'output_len', 'n_samples_for_plots', "proposal_is_p",
+    "huggingface_model", "smc_procedure_type"
+])
+def inspect_and_record_evidence_setting_for_indices_nested_jit(
+    rng_keys, prompt, params_p,
+    params_twist, output_len, log_true_final_twist,
+    n_samples_for_plots, true_posterior_samples,
+    smc_procedure_type,
+    proposal_is_p=False,
+    condition_twist_on_tokens=None, huggingface_model=None, indices_of_true_posterior_samples=None, params_proposal=None):
+    # inspect_and_record_evidence_setting_for_index_nested vmapped over the seeds (see inspect_and_record_evidence_setting_for_indices_jit)
+    def _for_index(rng_key, index_of_true_posterior_sample):
+        return inspect_and_record_evidence_setting_for_index_nested(
+            rng_key, prompt, params_p, params_twist, output_len, log_true_final_twist,
+            n_samples_for_plots, true_posterior_samples, smc_procedure_type, proposal_is_p,
+            condition_twist_on_tokens=condition_twist_on_tokens, huggingface_model=huggingface_model,
+            index_of_true_posterior_sample=index_of_true_posterior_sample, params_proposal=params_proposal)
+
+    return jax.vmap(_for_index)(rng_keys, indices_of_true_posterior_samples)
+
+
+@partial(jax.jit, static_argnames=[
+    "log_true_final_twist", 'output_len', 'n_test_smc_samples', "proposal_is_p",
+    "huggingface_model", "smc_procedure_type"
+])
+def inspect_and_record_evidence_setting_for_indices_jit(
+    rng_keys, prompt, params_p,
+    params_twist, output_len, log_true_final_twist,
+    n_test_smc_samples, true_posterior_samples,
+    smc_procedure_type,
+    proposal_is_p=False,
+    condition_twist_on_tokens=None, huggingface_model=None, indices_of_true_posterior_samples=None, params_proposal=None):
+    # inspect_and_record_evidence_setting_for_index vmapped over (rng_keys, indices_of_true_posterior_samples), so that
+    # all the seeds are evaluated in one compiled call. Returns the same, with a leading seed axis on everything
+    # Needs everything inside to be jittable (so not for smc_procedure_type == "partial_jit")
+    def _for_index(rng_key, index_of_true_posterior_sample):
+        return inspect_and_record_evidence_setting_for_index(
+            rng_key, prompt, params_p, params_twist, output_len, log_true_final_twist,
+            n_test_smc_samples, true_posterior_samples, smc_procedure_type, proposal_is_p,
+            condition_twist_on_tokens=condition_twist_on_tokens, huggingface_model=huggingface_model,
+            index_of_true_posterior_sample=index_of_true_posterior_sample, params_proposal=params_proposal)
+
+    return jax.vmap(_for_index)(rng_keys, indices_of_true_posterior_samples)
+
+
 
 
 
@@ -1280,6 +1523,192 @@ def collect_info_across_trueposts(
            list_of_stuff_across_trueposts_only_largest_n_samples
 
 
+def collect_info_across_trueposts_batched(
+    rng_key, start, n_trueposts_for_evals, n_samples_for_plots,
+    prompt, params_p, params_twist,
+    output_len, log_true_final_twist, true_posterior_samples,
+    smc_procedure_type, proposal_is_p,
+    condition_twist_on_tokens, huggingface_model,
+    params_proposal,
+    logZ_ubs_iwae_across_samples_and_trueposts,
+    logZ_lbs_iwae_across_samples_and_trueposts,
+    logZ_ubs_smc_across_samples_and_trueposts,
+    logZ_lbs_smc_across_samples_and_trueposts,
+    list_of_stuff_across_trueposts_only_largest_n_samples,
+    seed_batch_size=None
+):
+    # Same as collect_info_across_trueposts, but all the true posterior indices (seeds) for each n_test_smc_samples are done
+    # in one compiled call (inspect_and_record_evidence_setting_for_indices_jit), or in chunks of seed_batch_size seeds if that's set (to limit memory)
+    if seed_batch_size is None:
+        seed_batch_size = n_trueposts_for_evals
+
+    for n in range(len(n_samples_for_plots)):
+        n_test_smc_samples = n_samples_for_plots[n]
+        print(f"n_smc: {n_test_smc_samples}")
+        print(f"TIME: {time.time() - start}", flush=True)
+
+        rng_key, sk = jax.random.split(rng_key)
+        sks = jax.random.split(sk, n_trueposts_for_evals)
+        outputs = []
+        for batch_start in range(0, n_trueposts_for_evals, seed_batch_size):
+            batch_end = min(batch_start + seed_batch_size, n_trueposts_for_evals)
+            list_of_things_to_append_for_record_list, _ = inspect_and_record_evidence_setting_for_indices_jit(
+                sks[batch_start:batch_end], prompt, params_p,
+                params_twist,
+                output_len, log_true_final_twist,
+                n_test_smc_samples,
+                true_posterior_samples,
+                smc_procedure_type,
+                proposal_is_p,
+                condition_twist_on_tokens=condition_twist_on_tokens,
+                huggingface_model=huggingface_model,
+                indices_of_true_posterior_samples=jnp.arange(batch_start, batch_end),
+                params_proposal=params_proposal
+            )
+            outputs.append(list_of_things_to_append_for_record_list)
+        (iwae_upper_bound_estimates, iwae_lower_bound_estimates,
+         smc_upper_bound_estimates, smc_lower_bound_estimates,
+         f_qs,
+         kl_q_sigma_iwae_upper_bound_estimates,
+         kl_q_sigma_iwae_lower_bound_estimates,
+         kl_q_sigma_smc_upper_bound_estimates,
+         kl_q_sigma_smc_lower_bound_estimates) = [
+            np.concatenate([np.asarray(output[i]) for output in outputs]) for i in range(len(outputs[0]))]
+
+        print(f"F_q Estimate: {f_qs.mean()}")
+        print(f"IWAE Lower Bound estimates: {iwae_lower_bound_estimates}")
+        print(f"IWAE Upper Bound Estimates: {iwae_upper_bound_estimates}")
+        print(f"SMC lower bound estimates: {smc_lower_bound_estimates}")
+        print(f"SMC upper bound estimates: {smc_upper_bound_estimates}")
+
+        logZ_ubs_iwae_across_samples_and_trueposts[n] += list(iwae_upper_bound_estimates)
+        logZ_lbs_iwae_across_samples_and_trueposts[n] += list(iwae_lower_bound_estimates)
+        logZ_ubs_smc_across_samples_and_trueposts[n] += list(smc_upper_bound_estimates)
+        logZ_lbs_smc_across_samples_and_trueposts[n] += list(smc_lower_bound_estimates)
+
+        if n_test_smc_samples == n_samples_for_plots[-1]:
+            list_of_things_to_add_across_trueposts_for_largest_n_samples = [
+                f_qs, kl_q_sigma_iwae_upper_bound_estimates,
+                kl_q_sigma_iwae_lower_bound_estimates, kl_q_sigma_smc_upper_bound_estimates,
+                kl_q_sigma_smc_lower_bound_estimates,
+                iwae_upper_bound_estimates, iwae_lower_bound_estimates,
+                smc_upper_bound_estimates, smc_lower_bound_estimates,
+            ]
+            list_of_stuff_across_trueposts_only_largest_n_samples[0] += list(f_qs)
+            for i in range(1, len(list_of_stuff_across_trueposts_only_largest_n_samples)):
+                list_of_stuff_across_trueposts_only_largest_n_samples[i] += list_of_things_to_add_across_trueposts_for_largest_n_samples[i].sum()
+
+            print(f"Avg KL(q||sigma) upper bound (using IWAE bound on log Z): {kl_q_sigma_iwae_upper_bound_estimates.mean()}")
+            print(f"Avg KL(q||sigma) lower bound (using IWAE bound on log Z): {kl_q_sigma_iwae_lower_bound_estimates.mean()}")
+            print(f"Avg KL(q||sigma) upper bound (using SMC bound on log Z): {kl_q_sigma_smc_upper_bound_estimates.mean()}")
+            print(f"Avg KL(q||sigma) lower bound (using SMC bound on log Z): {kl_q_sigma_smc_lower_bound_estimates.mean()}")
+            print("IWAE AND SMC Log Z BOUND ESTIMATES")
+            print("IWAE LB AND UB")
+            print(iwae_lower_bound_estimates.mean())
+            print(iwae_upper_bound_estimates.mean())
+            print("SMC LB AND UB")
+            print(smc_lower_bound_estimates.mean())
+            print(smc_upper_bound_estimates.mean())
+
+    return logZ_ubs_iwae_across_samples_and_trueposts, logZ_lbs_iwae_across_samples_and_trueposts, \
+           logZ_ubs_smc_across_samples_and_trueposts, logZ_lbs_smc_across_samples_and_trueposts, \
+           list_of_stuff_across_trueposts_only_largest_n_samples
+
+
+def collect_info_across_trueposts_nested(
+    rng_key, start, n_trueposts_for_evals, n_samples_for_plots,
+    prompt, params_p, params_twist,
+    output_len, log_true_final_twist, true_posterior_samples,
+    smc_procedure_type, proposal_is_p,
+    condition_twist_on_tokens, huggingface_model,
+    params_proposal,
+    logZ_ubs_iwae_across_samples_and_trueposts,
+    logZ_lbs_iwae_across_samples_and_trueposts,
+    logZ_ubs_smc_across_samples_and_trueposts,
+    logZ_lbs_smc_across_samples_and_trueposts,
+    list_of_stuff_across_trueposts_only_largest_n_samples,
+    seed_batch_size=None
+):
+    # Same as collect_info_across_trueposts_batched, but one call gives the bounds for all of n_samples_for_plots
+    # (see inspect_and_record_evidence_setting_for_index_nested)
+    if seed_batch_size is None:
+        seed_batch_size = n_trueposts_for_evals
+
+    print(f"n_smc: {n_samples_for_plots}")
+    print(f"TIME: {time.time() - start}", flush=True)
+
+    rng_key, sk = jax.random.split(rng_key)
+    sks = jax.random.split(sk, n_trueposts_for_evals)
+    outputs = []
+    for batch_start in range(0, n_trueposts_for_evals, seed_batch_size):
+        batch_end = min(batch_start + seed_batch_size, n_trueposts_for_evals)
+        outputs.append(inspect_and_record_evidence_setting_for_indices_nested_jit(
+            sks[batch_start:batch_end], prompt, params_p,
+            params_twist,
+            output_len, log_true_final_twist,
+            tuple(n_samples_for_plots),
+            true_posterior_samples,
+            smc_procedure_type,
+            proposal_is_p,
+            condition_twist_on_tokens=condition_twist_on_tokens,
+            huggingface_model=huggingface_model,
+            indices_of_true_posterior_samples=jnp.arange(batch_start, batch_end),
+            params_proposal=params_proposal
+        ))
+    (iwae_upper_bound_estimates, iwae_lower_bound_estimates,
+     smc_upper_bound_estimates, smc_lower_bound_estimates,
+     f_qs,
+     kl_q_sigma_iwae_upper_bound_estimates,
+     kl_q_sigma_iwae_lower_bound_estimates,
+     kl_q_sigma_smc_upper_bound_estimates,
+     kl_q_sigma_smc_lower_bound_estimates) = [
+        np.concatenate([np.asarray(output[i]) for output in outputs]) for i in range(len(outputs[0]))]
+
+    for n in range(len(n_samples_for_plots)):
+        print(f"n_smc: {n_samples_for_plots[n]}")
+        print(f"IWAE Lower Bound estimate: {iwae_lower_bound_estimates[:, n].mean()}")
+        print(f"IWAE Upper Bound Estimate: {iwae_upper_bound_estimates[:, n].mean()}")
+        print(f"SMC lower bound estimate: {smc_lower_bound_estimates[:, n].mean()}")
+        print(f"SMC upper bound estimate: {smc_upper_bound_estimates[:, n].mean()}")
+
+        logZ_ubs_iwae_across_samples_and_trueposts[n] += list(iwae_upper_bound_estimates[:, n])
+        logZ_lbs_iwae_across_samples_and_trueposts[n] += list(iwae_lower_bound_estimates[:, n])
+        logZ_ubs_smc_across_samples_and_trueposts[n] += list(smc_upper_bound_estimates[:, n])
+        logZ_lbs_smc_across_samples_and_trueposts[n] += list(smc_lower_bound_estimates[:, n])
+
+    print(f"F_q Estimate: {f_qs.mean()}")
+    print(f"Avg KL(q||sigma) upper bound (using IWAE bound on log Z): {kl_q_sigma_iwae_upper_bound_estimates.mean()}")
+    print(f"Avg KL(q||sigma) lower bound (using IWAE bound on log Z): {kl_q_sigma_iwae_lower_bound_estimates.mean()}")
+    print(f"Avg KL(q||sigma) upper bound (using SMC bound on log Z): {kl_q_sigma_smc_upper_bound_estimates.mean()}")
+    print(f"Avg KL(q||sigma) lower bound (using SMC bound on log Z): {kl_q_sigma_smc_lower_bound_estimates.mean()}")
+
+    list_of_things_to_add_across_trueposts_for_largest_n_samples = [
+        f_qs, kl_q_sigma_iwae_upper_bound_estimates,
+        kl_q_sigma_iwae_lower_bound_estimates, kl_q_sigma_smc_upper_bound_estimates,
+        kl_q_sigma_smc_lower_bound_estimates,
+        iwae_upper_bound_estimates[:, -1], iwae_lower_bound_estimates[:, -1],
+        smc_upper_bound_estimates[:, -1], smc_lower_bound_estimates[:, -1],
+    ]
+    list_of_stuff_across_trueposts_only_largest_n_samples[0] += list(f_qs)
+    for i in range(1, len(list_of_stuff_across_trueposts_only_largest_n_samples)):
+        list_of_stuff_across_trueposts_only_largest_n_samples[i] += list_of_things_to_add_across_trueposts_for_largest_n_samples[i].sum()
+
+    return logZ_ubs_iwae_across_samples_and_trueposts, logZ_lbs_iwae_across_samples_and_trueposts, \
+           logZ_ubs_smc_across_samples_and_trueposts, logZ_lbs_smc_across_samples_and_trueposts, \
+           list_of_stuff_across_trueposts_only_largest_n_samples
+
+
+def get_nested_n_samples_for_plots(n_samples_for_plots_smaller, n_samples_for_plots_larger):
+    # Grid of numbers of samples for --nested_n_samples_for_plots: n_samples_for_plots_smaller, doubling up to (and always including) n_samples_for_plots_larger
+    n_samples_for_plots = []
+    n = n_samples_for_plots_smaller
+    while n < n_samples_for_plots_larger:
+        n_samples_for_plots.append(n)
+        n *= 2
+    n_samples_for_plots.append(n_samples_for_plots_larger)
+    return n_samples_for_plots
+
+
 # Collect and print info pertaining to stuff like bounds, only using the largest number of SMC samples (e.g. n_samples_for_plots_larger)
 def collect_and_print_info_over_largest_n_samples(
     list_of_stuff_across_trueposts_only_largest_n_samples,
@@ -1369,28 +1798,45 @@ def get_and_plot_logZ_bounds(
         for n in range(len(n_samples_for_plots)):
             lst.append([])
 
-    inspect_and_record_evidence_setting_fn = inspect_and_record_evidence_setting_for_index_jit
     if smc_procedure_type == "partial_jit" or print_smc_samples:
-        inspect_and_record_evidence_setting_fn = inspect_and_record_evidence_setting_for_index
-
-    logZ_ubs_iwae_across_samples_and_trueposts, logZ_lbs_iwae_across_samples_and_trueposts, \
-    logZ_ubs_smc_across_samples_and_trueposts, logZ_lbs_smc_across_samples_and_trueposts, \
-    list_of_stuff_across_trueposts_only_largest_n_samples = \
-        collect_info_across_trueposts(
-        rng_key, start, n_trueposts_for_evals, n_samples_for_plots,
-        inspect_and_record_evidence_setting_fn,
-        prompt, params_p, params_twist,
-        output_len, log_true_final_twist,
-        true_posterior_samples,
-        smc_procedure_type, proposal_is_p,
-        condition_twist_on_tokens, huggingface_model,
-        params_proposal, tokenizer,
-        logZ_ubs_iwae_across_samples_and_trueposts,
-        logZ_lbs_iwae_across_samples_and_trueposts,
-        logZ_ubs_smc_across_samples_and_trueposts,
-        logZ_lbs_smc_across_samples_and_trueposts,
-        list_of_stuff_across_trueposts_only_largest_n_samples
-    )
+        logZ_ubs_iwae_across_samples_and_trueposts, logZ_lbs_iwae_across_samples_and_trueposts, \
+        logZ_ubs_smc_across_samples_and_trueposts, logZ_lbs_smc_across_samples_and_trueposts, \
+        list_of_stuff_across_trueposts_only_largest_n_samples = \
+            collect_info_across_trueposts(
+            rng_key, start, n_trueposts_for_evals, n_samples_for_plots,
+            inspect_and_record_evidence_setting_for_index,
+            prompt, params_p, params_twist,
+            output_len, log_true_final_twist,
+            true_posterior_samples,
+            smc_procedure_type, proposal_is_p,
+            condition_twist_on_tokens, huggingface_model,
+            params_proposal, tokenizer,
+            logZ_ubs_iwae_across_samples_and_trueposts,
+            logZ_lbs_iwae_across_samples_and_trueposts,
+            logZ_ubs_smc_across_samples_and_trueposts,
+            logZ_lbs_smc_across_samples_and_trueposts,
+            list_of_stuff_across_trueposts_only_largest_n_samples
+        )
+    else:
+        collect_info_fn = collect_info_across_trueposts_nested if nested_subset_evals else collect_info_across_trueposts_batched
+        logZ_ubs_iwae_across_samples_and_trueposts, logZ_lbs_iwae_across_samples_and_trueposts, \
+        logZ_ubs_smc_across_samples_and_trueposts, logZ_lbs_smc_across_samples_and_trueposts, \
+        list_of_stuff_across_trueposts_only_largest_n_samples = \
+            collect_info_fn(
+            rng_key, start, n_trueposts_for_evals, n_samples_for_plots,
+            prompt, params_p, params_twist,
+            output_len, log_true_final_twist,
+            true_posterior_samples,
+            smc_procedure_type, proposal_is_p,
+            condition_twist_on_tokens, huggingface_model,
+            params_proposal,
+            logZ_ubs_iwae_across_samples_and_trueposts,
+            logZ_lbs_iwae_across_samples_and_trueposts,
+            logZ_ubs_smc_across_samples_and_trueposts,
+            logZ_lbs_smc_across_samples_and_trueposts,
+            list_of_stuff_across_trueposts_only_largest_n_samples,
+            seed_batch_size=eval_seed_batch_size
+        )
 
     for n in range(len(n_samples_for_plots)):
         logZ_ubs_iwae_across_samples_and_trueposts[n] = np.stack(logZ_ubs_iwae_across_samples_and_trueposts[n])
@@ -1465,53 +1911,71 @@ def get_and_plot_logZ_bounds(
     return plot_over_time_list
 
 
+def get_rm_screen_store_setting(rm_type):
+    # The samples collected with the reward model screen (ThresholdScreen) are approximate, so they are stored under the screen's
+    # settings and never pooled with exact samples, which have None here (as do the entries written before this field existed)
+    if rm_type in ["toxicity_threshold", "sentiment_threshold"] and rm_screen_calibration_samples > 0:
+        return {"calibration_samples": rm_screen_calibration_samples, "fn_target": rm_screen_fn_target, "min_positives": rm_screen_min_positives}
+    return None
+
+
+def get_posterior_sample_store_settings(jnp_prompts, rm_type, hface_model_type, output_len, threshold, pos_threshold,
+                                        sentiment_class, num_last_tokens_to_condition_on, seed=None):
+    # What identifies a set of true posterior samples in the PosteriorSampleStore, for each prompt (no seed: pool over all seeds)
+    settings = []
+    for jnp_prompt in jnp_prompts:
+        setting = {
+            "prompt": [int(x) for x in np.asarray(jnp_prompt)], "rm_type": rm_type, "hface_model_type": hface_model_type,
+            "output_len": output_len, "threshold": threshold, "pos_threshold": pos_threshold,
+            "sentiment_class": sentiment_class, "num_last_tokens_to_condition_on": num_last_tokens_to_condition_on,
+            "rm_screen": get_rm_screen_store_setting(rm_type)
+        }
+        if seed is not None:
+            setting["seed"] = seed
+        settings.append(setting)
+    return settings
+
+
 def collect_true_posterior_samples(
     rng_key, experiment_cfg, jnp_prompts, params_p, rm_type,
     output_len, n_samples_at_a_time, huggingface_model,
     indices_of_continuation, rewardModel,
-    tokenizer_RM, tokenizer, threshold, pos_threshold, num_samples_if_only_collect_true_posterior_samples
+    tokenizer_RM, tokenizer, threshold, pos_threshold, num_samples_if_only_collect_true_posterior_samples,
+    sample_store=None, store_settings=None
 ):
-    # TODO this is inefficient, should not rebuild the log true final twists every time, should separate the posterior collection from the building of the twist
-    new_start = time.time()
-    enough_samples = False
-    combined_true_posterior_samples = None
-    while not enough_samples:
-        rng_key, sk = jax.random.split(rng_key)
-        log_true_final_twists, true_posterior_samples_by_prompt_and_by_token \
-            = experiment_cfg.get_log_true_final_twists(
-            sk, jnp_prompts, params_p, rm_type,
-            output_len, n_samples_at_a_time, huggingface_model,
-            indices_of_continuation, rewardModel,
-            tokenizer_RM, tokenizer, threshold, pos_threshold, get_true_posterior_samples=True
-        )
-        if combined_true_posterior_samples is None:
-            combined_true_posterior_samples = true_posterior_samples_by_prompt_and_by_token
-        else:
-            for i in range(len(combined_true_posterior_samples)):
-                print("----")
-                print(combined_true_posterior_samples[i].shape)
-                print(true_posterior_samples_by_prompt_and_by_token[i].shape)
-                combined_true_posterior_samples[i] = jnp.concatenate((combined_true_posterior_samples[i], true_posterior_samples_by_prompt_and_by_token[i]))
-                print(combined_true_posterior_samples[i].shape)
-        enough_samples = True
-        for i in range(len(combined_true_posterior_samples)):
-            if combined_true_posterior_samples[i].shape[0] < num_samples_if_only_collect_true_posterior_samples:
-                enough_samples = False # do a check over all, essentially. Only stop collecting samples if we have enough for EACH prompt
-                break
-
-        print(f"TIME: {time.time() - new_start}", flush=True)
+    # Only the accept/reject step is needed here, so the final twists don't get built at all
+    # With a sample_store, accepted samples are written out as they come in (under store_settings[i] for prompt i),
+    # and whatever is already stored for those settings counts towards the total, so an interrupted collection resumes
+    rng_key, n_tokens_to_sample, accept_fns = experiment_cfg.get_true_posterior_sample_acceptors(
+        rng_key, jnp_prompts, rm_type, output_len, indices_of_continuation,
+        rewardModel, tokenizer_RM, tokenizer, threshold, pos_threshold,
+        params_p=params_p, huggingface_model=huggingface_model, n_samples_at_a_time=n_samples_at_a_time
+    )
+    initial_samples, on_accepted = None, None
+    if sample_store is not None:
+        initial_samples = [sample_store.load(setting, max_samples=num_samples_if_only_collect_true_posterior_samples) for setting in store_settings]
+        for i, samples in enumerate(initial_samples):
+            print(f"Resuming prompt {i} with {0 if samples is None else samples.shape[0]} stored posterior samples", flush=True)
+        # Don't redraw the same samples as the run(s) that wrote what is already in the store
+        rng_key = jax.random.fold_in(rng_key, sample_store.n_shards())
+        on_accepted = lambda i, accepted: sample_store.append(store_settings[i], accepted)
+
+    rng_key, combined_true_posterior_samples = collect_true_posterior_samples_pipelined(
+        rng_key, jnp_prompts, params_p, n_tokens_to_sample, n_samples_at_a_time, huggingface_model,
+        accept_fns, num_samples_if_only_collect_true_posterior_samples, n_scoring_threads=posterior_scoring_threads,
+        initial_samples=initial_samples, on_accepted=on_accepted
+    )
 
     for i in range(len(combined_true_posterior_samples)):
         print(combined_true_posterior_samples[i].shape)
-        if combined_true_posterior_samples[i].shape[0] > num_samples_if_only_collect_true_posterior_samples:
-            combined_true_posterior_samples[i] = combined_true_posterior_samples[i][:num_samples_if_only_collect_true_posterior_samples]
-            print("reduce to n true post samples size")
-            print(combined_true_posterior_samples[i].shape)
+    for i, screen in enumerate(experiment_cfg.threshold_screens):
+        if screen is not None:
+            print(f"Prompt {i} screen: {screen.stats()}", flush=True)
 
     return rng_key, combined_true_posterior_samples
 
 
-def get_tokenizer_and_rewardModel(rm_type):
+def get_tokenizer_and_rewardModel(rm_type, rm_bf16=False):
     if rm_type in ["toxicity_threshold", "exp_beta_toxicity_class_logprob"]:
         model_name = "nicholasKluge/ToxicityModel"
     elif rm_type == "sentiment_threshold":
@@ -1522,7 +1986,12 @@ def get_tokenizer_and_rewardModel(rm_type):
         return None, None # e.g. for stuff like infilling where you don't need a separate reward model
 
     tokenizer_RM = AutoTokenizer.from_pretrained(model_name)
-    rewardModel = FlaxAutoModelForSequenceClassification.from_pretrained(model_name, from_pt=True) # Throws a warning message but as far as I can see in my testing, there's no difference in the outputs under this flax version vs the pytorch original version
+    if rm_bf16:
+        # Compute (and store the params) in bf16; call_rm casts the logits back to fp32
+        rewardModel = FlaxAutoModelForSequenceClassification.from_pretrained(model_name, from_pt=True, dtype=jnp.bfloat16)
+        rewardModel.params = rewardModel.to_bf16(rewardModel.params)
+    else:
+        rewardModel = FlaxAutoModelForSequenceClassification.from_pretrained(model_name, from_pt=True) # Throws a warning message but as far as I can see in my testing, there's no difference in the outputs under this flax version vs the pytorch original version
 
     return tokenizer_RM, rewardModel
 
@@ -1567,10 +2036,14 @@ def get_jnp_prompts(hface_model_type, rm_type, tokenizer):
                 "This man is a",
                 # "This woman is a"
             ]
-    input_ids_and_mask = tokenizer(prompts, return_tensors="np",
-                                   padding=False)  # What happens if the prompts are different lengths? TODO
+    input_ids_and_mask = tokenizer(prompts, padding=False)
 
-    jnp_prompts = input_ids_and_mask['input_ids']
+    # Prompts of different lengths can't be stacked into one array, so then jnp_prompts is a list of per prompt arrays instead
+    # (training goes prompt by prompt; smc_multi_prompt left pads them to run SMC on all of them at once, see --multi_prompt_smc_log_z)
+    if len(set(len(input_ids) for input_ids in input_ids_and_mask['input_ids'])) == 1:
+        jnp_prompts = np.array(input_ids_and_mask['input_ids'])
+    else:
+        jnp_prompts = [np.array(input_ids) for input_ids in input_ids_and_mask['input_ids']]
 
     return indices_of_continuation, jnp_prompts
 
@@ -1617,7 +2090,8 @@ def get_final_twists_and_posterior_samples(
     output_len, n_samples_at_a_time, huggingface_model,
     indices_of_continuation, rewardModel,
     tokenizer_RM, tokenizer, threshold, pos_threshold,
-    load_dir_posterior_samples, load_prefix_posterior_samples
+    load_dir_posterior_samples, load_prefix_posterior_samples,
+    sample_store=None, store_settings=None, max_posterior_samples_to_load=None
 ):
     get_true_posterior_samples = True
     if load_posterior_samples:
@@ -1633,7 +2107,13 @@ def get_final_twists_and_posterior_samples(
         tokenizer_RM, tokenizer, threshold, pos_threshold, get_true_posterior_samples
     )
 
-    if load_posterior_samples:
+    if load_posterior_samples and sample_store is not None:
+        true_posterior_samples_by_prompt_and_by_token = []
+        for setting in store_settings:
+            samples = sample_store.load(setting, max_samples=max_posterior_samples_to_load)
+            assert samples is not None, f"No posterior samples in {sample_store.store_dir} for {setting}"
+            true_posterior_samples_by_prompt_and_by_token.append(jnp.asarray(samples))
+    elif load_posterior_samples:
         x = checkpoints.restore_checkpoint(ckpt_dir=load_dir_posterior_samples, target=None, prefix=load_prefix_posterior_samples)
         # print(x['0']['0'].shape)
         # print(list(x['0'].values()))
@@ -1679,8 +2159,10 @@ def get_model_config_and_conditional_twist_settings(hface_model_type, rm_type):
 def setup_model_and_params(
     rng_key, separate_hface_twist_model, model_config, from_pt, experiment_cfg, hface_nn_twist, softmax_twist,
     conditional_twist_type, num_last_tokens_to_condition_on, n_layers_twist, hidden_units_multiplier,
-    one_hot_dim, lr_twist, beta1, beta2, eps, weight_decay, output_p_psi, use_lora, lora_rank
+    one_hot_dim, lr_twist, beta1, beta2, eps, weight_decay, output_p_psi, use_lora, lora_rank, twist_remat_policy="none"
 ):
+    # twist_remat_policy (see REMAT_POLICIES in huggingface_models_custom) only applies to the separate twist model; with a shared trunk
+    # the transformer isn't trained, so there is nothing to rematerialise
     rng_key, sk = jax.random.split(rng_key, 2)
 
     if separate_hface_twist_model:
@@ -1695,7 +2177,7 @@ def setup_model_and_params(
             softmax_twist=softmax_twist, conditional_twist_type=conditional_twist_type,
             num_last_tokens_to_condition_on=num_last_tokens_to_condition_on, from_pt=from_pt,
             n_layers_twist=n_layers_twist, hidden_units_multiplier=hidden_units_multiplier,
-            one_hot_dim=one_hot_dim, log_sigmoid_twist=log_sigmoid_twist
+            one_hot_dim=one_hot_dim, log_sigmoid_twist=log_sigmoid_twist, remat_policy=twist_remat_policy
         )
 
         params_p = model_p.huggingface_model.params
@@ -1785,7 +2267,8 @@ def setup_cfg(
     load_posterior_samples=False, load_prefix_posterior_samples=None,
     sentiment_class=1, use_lora=False, lora_rank=4, hidden_units_multiplier=1.,
     softmax_twist=False, n_twist_ebm_vmap=0, ebm_combined_alpha=0.5, train_on_true_posterior_samples=False,
-    output_p_psi=False, separate_proposal_and_twist=False
+    output_p_psi=False, separate_proposal_and_twist=False, stop_at_eos=False,
+    posterior_sample_store_dir=None, max_posterior_samples_to_load=None, rm_bf16=False, twist_remat_policy="none"
 ):
     experiment_cfg = ExperimentConfig(
         n_vocab=n_vocab,
@@ -1807,6 +2290,9 @@ def setup_cfg(
 
     tokenizer = get_tokenizer(model_config)
 
+    if stop_at_eos:
+        custom_transformer_prob_utils.default_eos_token_id = tokenizer.eos_token_id
+
     if hface_nn_twist:
         print("Using NN for huggingface model twist head", flush=True)
 
@@ -1820,10 +2306,10 @@ def setup_cfg(
         conditional_twist_type, num_last_tokens_to_condition_on, n_layers_twist,
         hidden_units_multiplier,
         one_hot_dim, lr_twist, beta1, beta2, eps, weight_decay, output_p_psi,
-        use_lora, lora_rank
+        use_lora, lora_rank, twist_remat_policy
     )
 
-    tokenizer_RM, rewardModel = get_tokenizer_and_rewardModel(rm_type)
+    tokenizer_RM, rewardModel = get_tokenizer_and_rewardModel(rm_type, rm_bf16)
 
     indices_of_continuation, jnp_prompts = get_jnp_prompts(hface_model_type, rm_type, tokenizer)
 
@@ -1831,13 +2317,21 @@ def setup_cfg(
     experiment_cfg.tokenizer_RM = tokenizer_RM
     experiment_cfg.tokenizer = tokenizer
 
+    sample_store = None
+    if posterior_sample_store_dir is not None:
+        sample_store = PosteriorSampleStore(posterior_sample_store_dir)
+
     if only_collect_true_posterior_samples:
+        store_settings = get_posterior_sample_store_settings(
+            jnp_prompts, rm_type, hface_model_type, output_len, threshold, pos_threshold,
+            sentiment_class, num_last_tokens_to_condition_on, seed=seed)
         rng_key, combined_true_posterior_samples = collect_true_posterior_samples(
             rng_key, experiment_cfg, jnp_prompts, params_p, rm_type,
             output_len, n_samples_at_a_time, huggingface_model,
             indices_of_continuation, rewardModel,
             tokenizer_RM, tokenizer, threshold, pos_threshold,
-            num_samples_if_only_collect_true_posterior_samples
+            num_samples_if_only_collect_true_posterior_samples,
+            sample_store=sample_store, store_settings=store_settings
         )
         return combined_true_posterior_samples
 
@@ -1858,7 +2352,11 @@ def setup_cfg(
         output_len, n_samples_at_a_time, huggingface_model,
         indices_of_continuation, rewardModel,
         tokenizer_RM, tokenizer, threshold, pos_threshold,
-        load_dir_posterior_samples, load_prefix_posterior_samples
+        load_dir_posterior_samples, load_prefix_posterior_samples,
+        sample_store=sample_store, max_posterior_samples_to_load=max_posterior_samples_to_load,
+        store_settings=get_posterior_sample_store_settings(
+            jnp_prompts, rm_type, hface_model_type, output_len, threshold, pos_threshold,
+            sentiment_class, num_last_tokens_to_condition_on)
     )
 
     print("Finished building final twists and getting posterior samples", flush=True)
@@ -1997,7 +2495,7 @@ def do_twist_updates(
     replay_buffers_by_prompt, replay_buffer_log_w_ts_by_prompt,
     replay_buffer_log_prob_eval_by_prompt,
     print_every_twist_updates,
-    n_twist, optimizer_twist, optim_twist_state
+    n_twist, optimizer_twist, optim_twist_state, fused_twist_updates=False, twist_updates_per_dispatch=1
 ):
     num_twist_updates_to_do = twist_updates_per_epoch
 
@@ -2007,6 +2505,34 @@ def do_twist_updates(
         else:
             num_twist_updates_to_do = 2 ** epoch
 
+    if fused_twist_updates and experiment_cfg.twist_update_is_jittable and not use_replay_buffer:
+        # Fused, jitted updates, twist_updates_per_dispatch of them (scanned over on device) per call.
+        # params_twist and optim_twist_state are donated, so params_twist must not share buffers with the params the models
+        # hold (main copies them before the first update with --fused_twist_updates).
+        twist_update = 0
+        while twist_update < num_twist_updates_to_do:
+            n_updates = min(twist_updates_per_dispatch, num_twist_updates_to_do - twist_update)
+            if n_updates == 1:
+                rng_key, params_twist, optim_twist_state, metrics = experiment_cfg.update_twist_jitted(
+                    rng_key, params_twist, optim_twist_state, prompt, params_p,
+                    n_twist, output_len, log_true_final_twist, proposal_is_p, huggingface_model,
+                    optimizer_twist, tempered_twist, beta_prop, params_proposal
+                )
+            else:
+                rng_key, params_twist, optim_twist_state, metrics = experiment_cfg.update_twist_scanned(
+                    rng_key, params_twist, optim_twist_state, prompt, params_p,
+                    n_twist, output_len, log_true_final_twist, proposal_is_p, huggingface_model,
+                    optimizer_twist, tempered_twist, beta_prop, n_updates, params_proposal
+                )
+            twist_update += n_updates
+
+            if twist_update // print_every_twist_updates > (twist_update - n_updates) // print_every_twist_updates:
+                print(f"Twist update: {twist_update}")
+                print(f"Twist loss (mean over last {n_updates} updates): {metrics['loss']}; grad norm: {metrics['grad_norm']}")
+                print(f"TIME: {time.time() - start}", flush=True)
+
+        return rng_key, params_twist, optim_twist_state
+
     for twist_update in range(num_twist_updates_to_do):
 
         if use_replay_buffer:
@@ -2078,6 +2604,18 @@ def do_twist_updates(
 
     return rng_key, params_twist, optim_twist_state
 
+def print_multi_prompt_smc_log_z(rng_key, jnp_prompts, params_p, params_twist, log_true_final_twists, output_len,
+                                 n_smc_samples, huggingface_model, proposal_is_p):
+    # SMC log Z estimates for all the prompts from one smc_multi_prompt call, instead of one smc_procedure call per prompt
+    rng_key, sk = jax.random.split(rng_key)
+    (_, log_z_hat_t, _), _ = smc_multi_prompt(
+        sk, list(jnp_prompts), params_p, params_twist, log_true_final_twists, output_len, n_smc_samples,
+        huggingface_model=huggingface_model, proposal_is_p=proposal_is_p)
+    for prompt_num, log_z in enumerate(np.asarray(log_z_hat_t)):
+        print(f"Prompt {prompt_num}: SMC log Z estimate ({n_smc_samples} samples, all prompts in one call): {log_z}")
+    return rng_key
+
+
 def do_test_sampling_time(
     rng_key, jnp_prompts, params_p, params_twist, log_true_final_twists,
     huggingface_model, experiment_cfg, output_len, batch_size, iters=10, num_last_tokens_to_condition_on=0
@@ -2201,7 +2739,10 @@ def main():
         "sentiment_class": args.sentiment_class, "use_lora": args.use_lora, "lora_rank": args.lora_rank, "hidden_units_multiplier": args.hidden_units_multiplier,
         "softmax_twist": False, "n_twist_ebm_vmap": args.n_twist_ebm_vmap, "ebm_combined_alpha": args.ebm_combined_alpha,
         "train_on_true_posterior_samples": args.train_on_true_posterior_samples,
-        "output_p_psi": args.output_p_psi, "separate_proposal_and_twist": args.separate_proposal_and_twist
+        "output_p_psi": args.output_p_psi, "separate_proposal_and_twist": args.separate_proposal_and_twist,
+        "stop_at_eos": args.stop_at_eos, "posterior_sample_store_dir": args.posterior_sample_store_dir,
+        "max_posterior_samples_to_load": args.max_posterior_samples_to_load, "rm_bf16": args.rm_bf16,
+        "twist_remat_policy": args.twist_remat_policy
     }
 
     if args.only_collect_true_posterior_samples:
@@ -2223,6 +2764,11 @@ def main():
     true_posterior_samples_by_prompt_and_by_token, records_list_by_prompt_then_twist, \
     indices_of_continuation, tokenizer, params_proposal = setup_cfg(**setup_args)
 
+    if args.fused_twist_updates:
+        # The fused updates donate params_twist, whose arrays from setup are the models' own (model_twist.huggingface_model.params,
+        # model.twist_head_params, which the models fall back on when not passed params, and params_p with the shared trunk)
+        params_twist = jax.tree_util.tree_map(jnp.copy, params_twist)
+
     if args.test_sampling_time:
         do_test_sampling_time(
             rng_key, jnp_prompts, params_p, params_twist, log_true_final_twists,
@@ -2248,6 +2794,11 @@ def main():
         if (epoch + 1) % args.print_every == 0:
             print(f"Epoch: {epoch + 1}", flush=True)
 
+        if args.multi_prompt_smc_log_z and (epoch + 1) % args.print_every == 0:
+            rng_key = print_multi_prompt_smc_log_z(
+                rng_key, jnp_prompts, params_p, params_twist, log_true_final_twists, args.output_len,
+                args.n_samples_for_plots_larger, huggingface_model, args.proposal_is_p)
+
         prompt_num = 0
         for prompt in jnp_prompts:
             replay_buffer = replay_buffers_by_prompt[prompt_num]
@@ -2284,7 +2835,6 @@ def main():
             # ----- DO TWIST UPDATES -----
             print(f"TWIST UPDATES STARTING", flush=True)
             print(f"TIME: {time.time() - start}", flush=True)
-            # TODO Jul 17 Consider scan loop and jit these too.
             rng_key, params_twist, optim_twist_state = do_twist_updates(
                 rng_key, start, experiment_cfg, prompt, params_p,
                 params_twist, log_true_final_twist, huggingface_model,
@@ -2302,7 +2852,8 @@ def main():
                 replay_buffers_by_prompt, replay_buffer_log_w_ts_by_prompt,
                 replay_buffer_log_prob_eval_by_prompt,
                 args.print_every_twist_updates,
-                args.n_twist, optimizer_twist, optim_twist_state
+                args.n_twist, optimizer_twist, optim_twist_state,
+                fused_twist_updates=args.fused_twist_updates, twist_updates_per_dispatch=args.twist_updates_per_dispatch
             )
 
             plot_and_print_at_end = True
@@ -2366,6 +2917,14 @@ if __name__ == "__main__":
     parser.add_argument("--epochs", type=int, default=100)
     parser.add_argument("--print_every", type=int, default=1)
     parser.add_argument("--print_every_twist_updates", type=int, default=50)
+    parser.add_argument("--lean_twist_grad", action="store_true",
+                        help="Run the SMC inside the twist losses under stop_gradient, and get the log psi values along the trajectories from one differentiable twist forward pass over the final samples, instead of backpropagating through every SMC step. Lowers peak memory in twist training. Not supported with --stop_at_eos, or with the twist learn types that resample the log psi values (ebm_old, ebm_partial_jit, ebm_mixed_p_q)")
+    parser.add_argument("--cache_trunk_embeddings", action="store_true",
+                        help="With the shared (frozen) trunk, run the trunk once over each batch of sequences in a twist loss and reuse its final hidden states for all the p and twist head evaluations on them (see losses.get_trunk_embeddings_for_twist_loss)")
+    parser.add_argument("--fused_twist_updates", action="store_true",
+                        help="Run each twist update (loss, grad, optimizer step) as one jitted call, donating the twist params and optimizer state. Only used when the twist update is jittable (see ExperimentConfig.twist_update_is_jittable) and there is no replay buffer")
+    parser.add_argument("--twist_updates_per_dispatch", type=int, default=1,
+                        help="With --fused_twist_updates, number of twist updates run in one jitted call (lax.scan over the fused update step)")
 
     parser.add_argument("--n_layers_twist", type=int, default=3,
                         help="Number of layers")
@@ -2443,6 +3002,10 @@ if __name__ == "__main__":
     parser.add_argument("--load_posterior_samples", action="store_true", help="load posterior samples from saved checkpoint instead of creating new ones")
     parser.add_argument("--load_dir_posterior_samples", type=str, default='.', help="Where to load from for posterior samples")
     parser.add_argument("--load_prefix_posterior_samples", type=str, default='.')
+    parser.add_argument("--posterior_sample_store_dir", type=str, default=None,
+                        help="Directory of an append-only posterior sample store (.npy shards + manifest.json). With --only_collect_true_posterior_samples, samples are written there as they are accepted and an interrupted collection resumes from what is stored; with --load_posterior_samples, samples are loaded from there (pooled over seeds) instead of from a checkpoint")
+    parser.add_argument("--max_posterior_samples_to_load", type=int, default=None,
+                        help="With --posterior_sample_store_dir and --load_posterior_samples, only read this many posterior samples per prompt from the store")
 
 
     parser.add_argument("--n_samples_at_a_time_for_true_post", type=int, default=500, help="This is the batch size used in collecting true posterior samples; we repeat drawing n_samples_at_a_time from the base model and then accept whatever number of exact target dist samples. As soon as >0 posterior samples are collected, the true posterior sample collection stops (unless we are doing only collection of true posterior samples). This is the num true posterior samples for infilling where every draw is a true posterior") # TODO possible refactor of this
@@ -2488,12 +3051,17 @@ if __name__ == "__main__":
 
     parser.add_argument("--use_lora", action="store_true", help="Use LORA for training instead of training the full model")
     parser.add_argument("--lora_rank", type=int, default=4, help="Rank of LORA")
+    parser.add_argument("--twist_remat_policy", type=str, default="none", choices=REMAT_POLICIES,
+                        help="Rematerialisation (gradient checkpointing) policy for the blocks of the separate twist model (see huggingface_models_custom): trades recomputation in the backward pass for memory, to allow larger n_twist")
 
     parser.add_argument("--n_samples_for_plots_smaller", type=int, default=32)
     parser.add_argument("--n_samples_for_plots_larger", type=int, default=500)
+    parser.add_argument("--nested_n_samples_for_plots", action="store_true",
+                        help="Plot the log Z bounds for n_samples_for_plots_smaller, doubling up to n_samples_for_plots_larger, all from one set of runs with n_samples_for_plots_larger total samples: IWAE bounds from subsets of one large run, SMC bounds from batches of independent smaller runs. In partial_jit (reward model) settings, each number of samples is still a separate run")
 
     parser.add_argument("--overwrite_n_plot_seeds", action="store_true", help="Use custom # of plot seeds")
     parser.add_argument("--n_plot_seeds", type=int, default=4, help="Only used in conjunction with --overwrite_n_plot_seeds")
+    parser.add_argument("--eval_seed_batch_size", type=int, default=None, help="Max number of plot seeds to evaluate the log Z bounds for in one (vmapped) compiled call; default is all of them at once. Lower this if evaluation runs out of memory")
 
     parser.add_argument("--ebm_combined_alpha", type=float, help="Weight to place on Roger's EBM update (or RL); 1-alpha goes on Rob's update (now also allows for alpha * RL + (1-alpha) * Rob for the rl-onekl update)",
                         default=0.5)
@@ -2505,11 +3073,79 @@ if __name__ == "__main__":
     parser.add_argument("--test_sampling_time", action="store_true")
     parser.add_argument("--test_sampling_time_iters", type=int, default=10, help="Only used in conjunction with --test_sampling_time: how many times to repeat sampling")
 
+    parser.add_argument("--resampling_scheme", type=str, default="categorical", choices=["categorical", "multinomial", "systematic", "stratified", "residual"],
+                        help="Resampling scheme for SMC. categorical is the original O(N^2) implementation; the others are O(N log N) (cumsum + searchsorted). systematic/stratified/residual are lower variance")
+    parser.add_argument("--resample_criterion", type=str, default="every_step", choices=["every_step", "ESS"],
+                        help="every_step resamples at every SMC step; ESS only resamples when the effective sample size drops below half the number of particles")
+    parser.add_argument("--stop_at_eos", action="store_true",
+                        help="Stop generating at the tokenizer's EOS token: sequences that emit EOS are padded with EOS for the rest of output_len, and in SMC their weights are no longer updated until the final twist")
+    parser.add_argument("--use_kv_cache", action="store_true", help="Use KV cached (incremental) decoding for sampling from the base model and for the twisted proposal within SMC, instead of a full sequence forward pass at every time step")
+    parser.add_argument("--proposal_top_k", type=int, default=None,
+                        help="Truncated twisted proposal: only evaluate the twist on the top k tokens under the base model at each step (all other tokens share one twist value; the weights stay exact). Only saves compute with --use_kv_cache")
+    parser.add_argument("--proposal_top_p", type=float, default=None,
+                        help="Truncated twisted proposal: only use the twist on the smallest set of top tokens under the base model with total probability >= top_p (can be combined with --proposal_top_k)")
+    parser.add_argument("--shard_smc_particles", action="store_true",
+                        help="Split the SMC particles over all devices (one island of particles per device, with islands only exchanged when the ESS over islands collapses). --n_twist and --n_samples_for_plots_* must be multiples of the number of devices. Conditional SMC (with a true posterior sample) and the SMC calls that keep the intermediate sample history stay unsharded. On CPU, use XLA_FLAGS=--xla_force_host_platform_device_count=N to get N devices")
+    parser.add_argument("--posterior_scoring_threads", type=int, default=2,
+                        help="When collecting true posterior samples by rejection sampling, number of threads running the reward model on sampled batches while the next batches are sampled on the device")
+    parser.add_argument("--rm_screen_calibration_samples", type=int, default=0,
+                        help="For toxicity_threshold / sentiment_threshold true posterior sample collection: if > 0, first screen samples with a linear probe on the base LM hidden states (fit and calibrated on this many exactly scored samples), and only run the reward model on samples passing the screen. The reward model threshold still decides acceptance, but the samples are approximate (the screen can reject samples the reward model would accept), and are stored apart from exact ones in --posterior_sample_store_dir")
+    parser.add_argument("--rm_screen_audit_rate", type=float, default=0.02, help="Fraction of screened out samples that still get scored exactly, to check for (and report) screen false negatives")
+    parser.add_argument("--rm_screen_fn_target", type=float, default=1e-2,
+                        help="Target false negative rate used to calibrate the screen cutoff (on the held out calibration samples that pass the threshold; needs about 1 / fn_target of them)")
+    parser.add_argument("--rm_screen_min_positives", type=int, default=100,
+                        help="The screen is disabled for a prompt (everything scored exactly) if fewer held out calibration samples than this pass the threshold")
+    parser.add_argument("--rm_token_translation", action="store_true",
+                        help="Map LM token ids directly to reward model input ids in jnp (falling back to decoding + retokenizing only for sequences that can't be translated exactly), so that the reward model can be called inside jit and SMC doesn't need the partial_jit split")
+    parser.add_argument("--rm_batch_chunk_size", type=int, default=256,
+                        help="Max number of sequences per reward model call (sequences are sorted by length and each chunk is padded to a length bucket); 0 means no limit")
+    parser.add_argument("--rm_bf16", action="store_true", help="Run the reward model in bf16 (logits are still returned in fp32)")
+    parser.add_argument("--multi_prompt_smc_log_z", action="store_true",
+                        help="Every print_every epochs, print the SMC log Z estimates for all the prompts, from one batched SMC call over the (left padded) prompts (see smc_multi_prompt)")
+    parser.add_argument("--rm_score_cache_size", type=int, default=100000,
+                        help="Max number of sequences (per reward model) whose reward model outputs are memoized in an LRU cache keyed on the token ids; 0 disables the cache")
+
 
     args = parser.parse_args()
 
     if args.use_lora:
         assert args.separate_hface_twist_model
+        assert not args.use_kv_cache # The lorax wrapped twist model has no KV cache (see init_kv_cache)
+    if args.twist_remat_policy != "none":
+        assert args.separate_hface_twist_model
+    if args.cache_trunk_embeddings:
+        assert not args.separate_hface_twist_model # The trunk is only frozen when it is shared with p
+        assert not args.separate_proposal_and_twist # The proposal has its own twist model, which the trunk embeddings of p don't serve
+    assert args.rm_batch_chunk_size >= 0
+    if args.multi_prompt_smc_log_z:
+        # smc_multi_prompt only runs the KV cached path, and the twist isn't conditioned on tokens here
+        assert not args.use_lora
+        assert not args.separate_proposal_and_twist
+        assert args.num_last_tokens_to_condition_on == 0 and args.rm_type != "sent_cond_twist"
+    if args.lean_twist_grad:
+        # The single twist forward pass over the final samples in smc_procedure_for_twist_loss needs every trajectory to
+        # survive to the end. The losses already run those SMC calls with resample=False; the rest is set here
+        assert not args.stop_at_eos, "The SMC freezes the twist values of finished sequences, the single forward pass in smc_procedure_for_twist_loss doesn't"
+        assert args.twist_learn_type not in ["ebm_old", "ebm_partial_jit", "ebm_mixed_p_q"], \
+            f"{args.twist_learn_type} resamples the log psi values along the trajectories (resample_for_log_psi_t_eval_list), which --lean_twist_grad doesn't support"
+
+    custom_transformer_prob_utils.kv_cache_decoding = args.use_kv_cache
+    custom_transformer_prob_utils.default_resampling_scheme = args.resampling_scheme
+    custom_transformer_prob_utils.default_resample_criterion = args.resample_criterion
+    custom_transformer_prob_utils.default_proposal_top_k = args.proposal_top_k
+    custom_transformer_prob_utils.default_proposal_top_p = args.proposal_top_p
+    if args.shard_smc_particles:
+        # Otherwise these SMC calls would quietly run unsharded (see smc_procedure)
+        for n_particles in [args.n_twist, args.n_samples_for_plots_smaller, args.n_samples_for_plots_larger]:
+            assert n_particles % jax.device_count() == 0, f"{n_particles} particles can't be split over {jax.device_count()} devices"
+    custom_transformer_prob_utils.shard_smc_particles = args.shard_smc_particles
+    reward_models.rm_score_cache_size = args.rm_score_cache_size
+    reward_models.translate_rm_tokens = args.rm_token_translation
+    reward_models.rm_batch_chunk_size = None if args.rm_batch_chunk_size == 0 else args.rm_batch_chunk_size
+    assert args.twist_updates_per_dispatch >= 1
+    assert args.fused_twist_updates or args.twist_updates_per_dispatch == 1 # Only the fused updates are scanned over
+    losses.lean_twist_grad = args.lean_twist_grad
+    losses.cache_trunk_embeddings = args.cache_trunk_embeddings
 
     assert args.n_vocab == 50257 # Used to support other options e.g. with toy transformer
 
@@ -2525,6 +3161,9 @@ if __name__ == "__main__":
 
 
     n_samples_for_plots = [args.n_samples_for_plots_smaller, args.n_samples_for_plots_larger]
+    if args.nested_n_samples_for_plots:
+        nested_subset_evals = True
+        n_samples_for_plots = get_nested_n_samples_for_plots(args.n_samples_for_plots_smaller, args.n_samples_for_plots_larger)
 
     if args.twist_learn_type in ["ebm_ml_jit_vmapped_over_condition_tokens", "ebm_vmap_os", "ebm_ml_jit_vmapped_over_condition_tokens_nosmcub", "ebm_ml_jit_vmapped_over_condition_tokens_finalrl",
                                  "ebm_ml_pprop_jit_vmapped_over_condition_tokens", "ebm_ml_pprop_jit_vmapped_over_condition_tokens_nosmcub",
@@ -2539,6 +3178,12 @@ if __name__ == "__main__":
     if args.overwrite_n_plot_seeds:
         n_trueposts_for_evals = args.n_plot_seeds
         print(f"Overwriting n plot seeds: {n_trueposts_for_evals}")
+    eval_seed_batch_size = args.eval_seed_batch_size
+    posterior_scoring_threads = args.posterior_scoring_threads
+    rm_screen_calibration_samples = args.rm_screen_calibration_samples
+    rm_screen_audit_rate = args.rm_screen_audit_rate
+    rm_screen_fn_target = args.rm_screen_fn_target
+    rm_screen_min_positives = args.rm_screen_min_positives
 
     if args.train_on_true_posterior_samples:
         assert args.beta_temp == 1
@@ -2,14 +2,102 @@ import jax.numpy as jnp
 import jax
 from transformers import FlaxAutoModelForCausalLM, FlaxAutoModel
 from transformers import AutoTokenizer
+from transformers.models.gpt2.modeling_flax_gpt2 import FlaxGPT2Block, FlaxGPT2BlockCollection, FlaxGPT2Module
+import flax.linen as nn
 from utils import linear_init_normal, linear
 
 
+# Rematerialisation (gradient checkpointing) policies for the twist transformer blocks. With a separate twist model,
+# backprop through the whole transformer over n_twist particles keeps every block's activations alive, which limits n_twist;
+# rematerialising trades recomputation in the backward pass for memory.
+# "none": no remat (store everything, as before). "per_block": only the inputs to each block are stored, everything
+# inside the block is recomputed. "dots": also store the matmul outputs, so only the cheap elementwise ops are recomputed.
+# "offload": like "dots", but the saved matmul outputs are moved to host memory. Only offered when the installed jax has
+# offloading policies (jax.checkpoint_policies.offload_dot_with_no_batch_dims), so that --twist_remat_policy never lists one that can't run.
+REMAT_POLICIES = ["none", "per_block", "dots"]
+if hasattr(jax.checkpoint_policies, "offload_dot_with_no_batch_dims"):
+    REMAT_POLICIES.append("offload")
+
+
+def get_checkpoint_policy(remat_policy):
+    if remat_policy == "per_block":
+        return None # Default jax.checkpoint behaviour: save nothing inside the block
+    elif remat_policy == "dots":
+        return jax.checkpoint_policies.checkpoint_dots_with_no_batch_dims
+    elif remat_policy == "offload" and remat_policy in REMAT_POLICIES:
+        return jax.checkpoint_policies.offload_dot_with_no_batch_dims("device", "pinned_host")
+    else:
+        raise NotImplementedError
+
+
+class RematFlaxGPT2BlockCollection(FlaxGPT2BlockCollection):
+    # Same blocks (and parameter names) as FlaxGPT2BlockCollection, but each block is wrapped in nn.remat
+    remat_policy: str = "per_block"
+
+    def setup(self):
+        # deterministic, init_cache, output_attentions are python bools; the block is called positionally so these can be static
+        # (flax counts self as argument 0)
+        block_class = nn.remat(FlaxGPT2Block, static_argnums=(5, 6, 7), policy=get_checkpoint_policy(self.remat_policy))
+        self.blocks = [
+            block_class(self.config, name=str(i), dtype=self.dtype) for i in range(self.config.num_hidden_layers)
+        ]
+
+    def __call__(self, hidden_states, attention_mask=None, encoder_hidden_states=None, encoder_attention_mask=None,
+                 deterministic=True, init_cache=False, output_attentions=False, output_hidden_states=False, return_dict=True):
+        all_attentions = () if output_attentions else None
+        all_hidden_states = () if output_hidden_states else None
+        all_cross_attentions = () if (output_attentions and encoder_hidden_states is not None) else None
+
+        for block in self.blocks:
+            if output_hidden_states:
+                all_hidden_states += (hidden_states,)
+            layer_outputs = block(hidden_states, attention_mask, encoder_hidden_states, encoder_attention_mask,
+                                  deterministic, init_cache, output_attentions)
+            hidden_states = layer_outputs[0]
+            if output_attentions:
+                all_attentions += (layer_outputs[1],)
+                if encoder_hidden_states is not None:
+                    all_cross_attentions += (layer_outputs[2],)
+
+        return (hidden_states, all_hidden_states, all_attentions, all_cross_attentions)
+
+
+class RematFlaxGPT2Module(FlaxGPT2Module):
+    remat_policy: str = "per_block"
+
+    def setup(self):
+        # As in FlaxGPT2Module.setup, except for the block collection
+        self.embed_dim = self.config.hidden_size
+        self.wte = nn.Embed(
+            self.config.vocab_size, self.embed_dim,
+            embedding_init=jax.nn.initializers.normal(stddev=self.config.initializer_range), dtype=self.dtype
+        )
+        self.wpe = nn.Embed(
+            self.config.max_position_embeddings, self.embed_dim,
+            embedding_init=jax.nn.initializers.normal(stddev=self.config.initializer_range), dtype=self.dtype
+        )
+        self.dropout = nn.Dropout(rate=self.config.embd_pdrop)
+        self.h = RematFlaxGPT2BlockCollection(self.config, dtype=self.dtype, remat_policy=self.remat_policy)
+        self.ln_f = nn.LayerNorm(epsilon=self.config.layer_norm_epsilon, dtype=self.dtype)
+
+
+def set_remat_policy(huggingface_model, remat_policy):
+    # Swap the module of a Flax GPT2 model (FlaxAutoModel) for one with rematerialised blocks. The parameters are unchanged,
+    # so this can be done after loading the pretrained weights.
+    if remat_policy == "none":
+        return
+    assert remat_policy in REMAT_POLICIES, f"remat policy {remat_policy} isn't available (with this jax version: {REMAT_POLICIES})"
+    if not isinstance(huggingface_model.module, FlaxGPT2Module):
+        raise NotImplementedError("Remat policies are only implemented for GPT2 models")
+    huggingface_model._module = RematFlaxGPT2Module(huggingface_model.config, dtype=huggingface_model.dtype, remat_policy=remat_policy)
+
+
 class CustomLMWithTwistHead:
     def __init__(self, key, model_name, output_size=-1, hface_nn_twist=False, softmax_twist=False,
                  conditional_twist_type=None, num_last_tokens_to_condition_on=0, from_pt=False,
-                 n_layers_twist=3, hidden_units_multiplier=1., one_hot_dim=0, log_sigmoid_twist=False):
+                 n_layers_twist=3, hidden_units_multiplier=1., one_hot_dim=0, log_sigmoid_twist=False, remat_policy="none"):
         self.huggingface_model = FlaxAutoModel.from_pretrained(model_name, from_pt=from_pt)  # Produces embeddings of d_model size
+        set_remat_policy(self.huggingface_model, remat_policy)
         self.conditional_twist_type = conditional_twist_type
         if conditional_twist_type == "tokens":
             assert num_last_tokens_to_condition_on > 0
@@ -77,25 +165,36 @@ class CustomLMWithTwistHead:
 
 
 
-    def _get_model_log_psi(self, params_twist_head, embeddings):
+    def _get_model_log_psi(self, params_twist_head, embeddings, token_indices=None):
+        # With token_indices (batch, k), only those outputs of the last layer are computed (the same ones for every position)
+        # giving (batch, seq_len, k) instead of (batch, seq_len, n_vocab). token_indices (k,) uses the same ones for every sequence too
+        def _output_layer(params, x):
+            if token_indices is None:
+                return linear(params, x)
+            if token_indices.ndim == 1:
+                return x @ params['w'][:, token_indices] + params['b'][token_indices]
+            return jnp.einsum('bld,dbk->blk', x, params['w'][:, token_indices]) + params['b'][token_indices][:, None, :]
+
         if self.hface_nn_twist:
             if 'linear_layers' in params_twist_head:
                 x = embeddings
-                for i in range(self.n_layers_twist):
+                for i in range(self.n_layers_twist - 1):
                     x = linear(params_twist_head['linear_layers'][i], x)
-                    if i != self.n_layers_twist - 1:
-                        x = jax.nn.relu(x)
+                    x = jax.nn.relu(x)
+                x = _output_layer(params_twist_head['linear_layers'][self.n_layers_twist - 1], x)
             else:
                 x = linear(params_twist_head['linear1'], embeddings)
                 x = jax.nn.relu(x)
                 x = linear(params_twist_head['linear2'], x)
                 x = jax.nn.relu(x)
-                x = linear(params_twist_head['linear3'], x)
+                x = _output_layer(params_twist_head['linear3'], x)
             model_log_psi = x
         else:
-            model_log_psi = linear(params_twist_head, embeddings)
+            model_log_psi = _output_layer(params_twist_head, embeddings)
 
         if self.softmax_twist:
+            if token_indices is not None:
+                raise NotImplementedError # needs the normalizer over the whole vocab
             assert not self.log_sigmoid_twist
             model_log_psi = jax.nn.log_softmax(model_log_psi, axis=-1)
 
@@ -105,7 +204,32 @@ class CustomLMWithTwistHead:
 
         return model_log_psi
 
-    def __call__(self, ret="both", train=False, params_twist_head=None, hface_model_params=None, input_ids=None, condition_twist_on_tokens=None, **kwargs):
+    def init_cache(self, batch_size, max_length):
+        # Zero filled KV cache for incremental decoding (see the past_key_values argument in __call__)
+        # Only the shapes/dtypes from the huggingface init_cache are used (through eval_shape), so this doesn't run an actual forward pass
+        cache_shapes = jax.eval_shape(lambda: self.huggingface_model.init_cache(batch_size, max_length))
+        return jax.tree_util.tree_map(lambda x: jnp.zeros(x.shape, x.dtype), cache_shapes)
+
+    def get_condition_twist_on_embeddings(self, condition_twist_on_tokens, hface_model_params=None, train=False, **kwargs):
+        # For conditional_twist_type == "tokens": the embedding of the tokens to condition on (the last hidden state, shape (batch, d_model)).
+        # This only depends on condition_twist_on_tokens, so it can be computed once (e.g. per SMC run) and passed to __call__
+        # as condition_twist_on_embeddings, instead of rerunning the transformer over condition_twist_on_tokens on every call
+        assert self.conditional_twist_type == "tokens"
+        if hface_model_params is None:
+            hface_model_params = self.huggingface_model._params
+        return self.huggingface_model(train=train, params=hface_model_params, input_ids=condition_twist_on_tokens, **kwargs)[0][:, -1, :]
+
+    def __call__(self, ret="both", train=False, params_twist_head=None, hface_model_params=None, input_ids=None, condition_twist_on_tokens=None,
+                 past_key_values=None, attention_mask=None, position_ids=None, twist_token_indices=None, twist_top_k=None,
+                 condition_twist_on_embeddings=None, trunk_embeddings=None, **kwargs):
+        # If past_key_values (from init_cache) is passed in, input_ids should only contain the new tokens (e.g. the prompt first, then one token at a time)
+        # and the keys/values for all earlier positions are taken from the cache. In that case attention_mask needs to have the full cache length
+        # and position_ids must be given. The outputs are then only for the input_ids positions, and the updated cache is returned as well, ie (outputs, past_key_values)
+        # twist_token_indices (batch, k) restricts the twist output to those tokens (see _get_model_log_psi).
+        # twist_top_k (with ret="both") uses the top k tokens under the p logits at the last position instead; the twist output is then (log_psi, twist_token_indices)
+        # condition_twist_on_embeddings (from get_condition_twist_on_embeddings, same hface_model_params) replaces running the model over condition_twist_on_tokens
+        # trunk_embeddings (from ret="p_embeddings" on the same input_ids and hface_model_params) replaces running the model over input_ids,
+        # e.g. to share one trunk forward pass between several p/twist evaluations of the same sequences when only the head is trained
 
         assert input_ids is not None
 
@@ -115,16 +239,32 @@ class CustomLMWithTwistHead:
         if hface_model_params is None:
             hface_model_params = self.huggingface_model._params
 
+        use_kv_cache = past_key_values is not None
+        cache_kwargs = {}
+        if use_kv_cache:
+            assert position_ids is not None
+            cache_kwargs = {"past_key_values": past_key_values, "attention_mask": attention_mask, "position_ids": position_ids}
+        else:
+            if attention_mask is not None:
+                cache_kwargs["attention_mask"] = attention_mask
+            if position_ids is not None:
+                cache_kwargs["position_ids"] = position_ids
+
+        if trunk_embeddings is not None:
+            assert not use_kv_cache
+            hface_outputs = (trunk_embeddings,)
+        else:
+            hface_outputs = self.huggingface_model(train=train, params=hface_model_params, input_ids=input_ids, **cache_kwargs, **kwargs)
+
         if condition_twist_on_tokens is not None: # TODO should we call it something other than condition_twist_on_tokens, if I also use it for sentiment?
             assert self.conditional_twist_type is not None
-            prompt_plus_output_embeddings = \
-            self.huggingface_model(train=train, params=hface_model_params,
-                                   input_ids=input_ids, **kwargs)[0]
+            prompt_plus_output_embeddings = hface_outputs[0]
             embeddings_p = prompt_plus_output_embeddings
 
             if self.conditional_twist_type == "tokens":
-                condition_on_embeddings = self.huggingface_model(train=train, params=hface_model_params, input_ids=condition_twist_on_tokens, **kwargs)[0]
-                condition_on_embeddings = condition_on_embeddings[:, -1, :][:, None, :] # Take the last embedding - this embeds all the information of the entire sequence of last tokens (what we want to condition on)
+                if condition_twist_on_embeddings is None:
+                    condition_twist_on_embeddings = self.get_condition_twist_on_embeddings(condition_twist_on_tokens, hface_model_params, train=train, **kwargs)
+                condition_on_embeddings = condition_twist_on_embeddings[:, None, :] # Take the last embedding - this embeds all the information of the entire sequence of last tokens (what we want to condition on)
                 condition_on_embeddings = jnp.broadcast_to(condition_on_embeddings, embeddings_p.shape)
             elif self.conditional_twist_type == "one_hot":
                 condition_on_embeddings = jax.nn.one_hot(condition_twist_on_tokens, self.one_hot_dim) # get one hot version of inputs
@@ -139,23 +279,37 @@ class CustomLMWithTwistHead:
 
         else:
             # embeddings have d_model shape. Attribute name of the [0] element is "last_hidden_state"
-            embeddings_p = self.huggingface_model(train=train, params=hface_model_params, input_ids=input_ids, **kwargs)[0]
+            embeddings_p = hface_outputs[0]
             embeddings_twist = embeddings_p
 
 
-        if ret not in ["p", "twist", "both"]:
+        if ret == "p_embeddings": # final hidden states of the base model, e.g. as features for a probe
+            assert not use_kv_cache
+            return embeddings_p
+        if ret not in ["p", "twist", "both", "p_and_embeddings"]:
             raise NotImplementedError
-        if ret == "p" or ret == "both":
+        if ret == "p" or ret == "both" or ret == "p_and_embeddings":
             model_logits = embeddings_p @ jnp.transpose(hface_model_params['wte']['embedding'])
             if ret == "p":
-                return model_logits
+                output = model_logits
+            elif ret == "p_and_embeddings": # both of the above, e.g. for probe features from the same (KV cached) pass that samples
+                output = (model_logits, embeddings_p)
         if ret == "twist" or ret == "both":
-            model_log_psi = self._get_model_log_psi(params_twist_head, embeddings_twist)
+            if twist_top_k is not None:
+                assert ret == "both"
+                _, twist_token_indices = jax.lax.top_k(model_logits[:, -1, :], twist_top_k)
+            model_log_psi = self._get_model_log_psi(params_twist_head, embeddings_twist, twist_token_indices)
+            if twist_top_k is not None:
+                model_log_psi = (model_log_psi, twist_token_indices)
 
             if ret == "twist":
-                return model_log_psi
+                output = model_log_psi
             else:
-                return model_logits, model_log_psi
+                output = (model_logits, model_log_psi)
+
+        if use_kv_cache:
+            return output, hface_outputs.past_key_values
+        return output
 
 
 
@@ -165,7 +319,24 @@ class CustomLMHeadModel:
         self.huggingface_model = FlaxAutoModelForCausalLM.from_pretrained(model_name, from_pt=from_pt)
         # Output size is n_vocab, ie. 50257
 
-    def __call__(self, **kwargs):
+    def init_cache(self, batch_size, max_length):
+        # See CustomLMWithTwistHead.init_cache
+        cache_shapes = jax.eval_shape(lambda: self.huggingface_model.init_cache(batch_size, max_length))
+        return jax.tree_util.tree_map(lambda x: jnp.zeros(x.shape, x.dtype), cache_shapes)
+
+    def __call__(self, past_key_values=None, ret="p", **kwargs):
+        # With past_key_values, returns (logits, past_key_values) - see CustomLMWithTwistHead.__call__
+        # ret="p_embeddings" gives the final hidden states instead of the logits, ret="p_and_embeddings" gives (logits, final hidden states)
+        if ret == "p_embeddings":
+            return self.huggingface_model(output_hidden_states=True, **kwargs).hidden_states[-1]
+        if ret == "p_and_embeddings":
+            outputs = self.huggingface_model(output_hidden_states=True, past_key_values=past_key_values, **kwargs)
+            if past_key_values is not None:
+                return (outputs.logits, outputs.hidden_states[-1]), outputs.past_key_values
+            return outputs.logits, outputs.hidden_states[-1]
+        if past_key_values is not None:
+            outputs = self.huggingface_model(past_key_values=past_key_values, **kwargs)
+            return outputs.logits, outputs.past_key_values
         logits = self.huggingface_model(**kwargs)[0]
         return logits
 
@@ -1,16 +1,82 @@
 import jax
 import jax.numpy as jnp
+import custom_transformer_prob_utils
 from custom_transformer_prob_utils import smc_procedure, \
     stochastic_transformer_sample, evaluate_log_psi_selected_tokens, get_proposal_q_sample, \
     get_p_logits_and_log_psi_all_vocab, evaluate_log_phi_final, \
-    evaluate_normalized_log_q_1_to_t, evaluate_log_p_selected_tokens, evaluate_log_p_theta_1_to_t
+    evaluate_normalized_log_q_1_to_t, evaluate_log_p_selected_tokens, evaluate_log_p_theta_1_to_t, \
+    get_sequence_scores, get_transformer_p_embeddings, mask_log_p_all_vocab_after_eos, freeze_log_psi_after_eos
 
 from functools import partial
 
+from utils import HashableDict
+
 no_final_resample = True # False # Turn this off (set to false) if you want the old versions of these updates that used the resampled sigma samples
 
 resample_for_sigma_samples = False # True # Try true again. # True was what I had before; false to try no resampling (since we use the twist info already) on the approximate sigma samples
 
+cache_trunk_embeddings = False # If True, with the shared (frozen) trunk, each batch of sequences in a loss goes through the trunk once, and all the p/twist head evaluations on them reuse its final hidden states (see get_trunk_embeddings_for_twist_loss). Set from the --cache_trunk_embeddings flag.
+
+lean_twist_grad = False # If True, the SMC inside the twist losses runs under stop_gradient, and the log psi values along the SMC trajectories come from one differentiable twist forward pass over the final samples (see smc_procedure_for_twist_loss). Set from the --lean_twist_grad flag.
+
+
+def get_trunk_embeddings_for_twist_loss(seq, params_p, huggingface_model):
+    # With cache_trunk_embeddings and the shared trunk, the trunk's final hidden states for seq, to pass as trunk_embeddings to
+    # every p/twist evaluation of seq in a loss. Only the twist head is trained there, so no gradient goes into the trunk,
+    # and the head-only gradient is just the backward of the head on top of these.
+    # None otherwise (including with a separate twist model, whose transformer is trained); each evaluation then runs the model(s) itself.
+    if not cache_trunk_embeddings or isinstance(huggingface_model, HashableDict):
+        return None
+    return jax.lax.stop_gradient(get_transformer_p_embeddings(params_p, seq, huggingface_model))
+
+
+def smc_procedure_for_twist_loss(rng_key, prompt, params_p, params_twist, log_true_final_twist, output_len, n_twist,
+                                 smc_procedure_type, differentiable_log_psi_t_eval_list=False, return_trunk_embeddings=False, **kwargs):
+    # smc_procedure for use inside the twist losses. Only log_psi_t_eval_list (from the intermediate sample history) carries
+    # gradient there; the samples are discrete and the weights are always used under stop_gradient.
+    # Without lean_twist_grad, this is just smc_procedure, and gradients go through the whole SMC scan, keeping the
+    # activations of every sampling step for the backward pass.
+    # With lean_twist_grad, the SMC runs on stop_gradient(params_twist), and if differentiable_log_psi_t_eval_list, then
+    # log_psi_t_eval_list is rebuilt from a single twist forward pass over the final samples (so peak memory is that of one
+    # forward pass instead of output_len of them). That needs every trajectory to survive to the end (resample=False), with
+    # log_psi_t_eval_list not resampled along them either (resample_for_log_psi_t_eval_list=False), and no EOS handling.
+    # With return_trunk_embeddings, get_trunk_embeddings_for_twist_loss of the final samples is appended to the outputs,
+    # for the caller to reuse (the rebuild of log_psi_t_eval_list above uses the same ones).
+    # The proposal is never truncated here (--proposal_top_k/--proposal_top_p): log_psi_t_eval_list would then have
+    # the truncated twist's values, which is not the twist being trained (see resolve_proposal_truncation)
+    kwargs = {"proposal_top_k": 0, "proposal_top_p": 1., **kwargs}
+    if not lean_twist_grad:
+        smc_outputs = smc_procedure(rng_key, prompt, params_p, params_twist, log_true_final_twist, output_len, n_twist,
+                                    smc_procedure_type=smc_procedure_type, **kwargs)
+    else:
+        smc_outputs = smc_procedure(rng_key, prompt, params_p, jax.lax.stop_gradient(params_twist), log_true_final_twist,
+                                    output_len, n_twist, smc_procedure_type=smc_procedure_type, **kwargs)
+    if not (lean_twist_grad and differentiable_log_psi_t_eval_list):
+        if return_trunk_embeddings:
+            return (*smc_outputs, get_trunk_embeddings_for_twist_loss(smc_outputs[1], params_p, kwargs.get("huggingface_model")))
+        return smc_outputs
+
+    # These are also checked at startup with --lean_twist_grad (see do_training_and_log_Z_bounds)
+    assert kwargs.get("get_intermediate_sample_history_based_on_learned_twists", False)
+    assert not kwargs.get("resample", True), "Trajectories that die out in resampling are not in the final samples"
+    assert not kwargs.get("resample_for_log_psi_t_eval_list", False), "The resampled log psi values are those of the SMC's ancestors, which the final samples don't record"
+    assert custom_transformer_prob_utils.default_eos_token_id is None, "The SMC freezes the twist values of finished sequences, a forward pass over the padded samples doesn't"
+
+    (log_w_t, log_z_hat_t, _), samples, (intermediate_twist_samples_hist, intermediate_log_w_t_hist,
+                                         log_w_t_before_resample_hist) = smc_outputs
+
+    trunk_embeddings = get_trunk_embeddings_for_twist_loss(samples, params_p, kwargs.get("huggingface_model"))
+    log_psi_t_eval_list = jnp.transpose(evaluate_log_psi_selected_tokens(
+        samples, prompt.shape[-1], params_twist, kwargs.get("condition_twist_on_tokens"),
+        kwargs.get("huggingface_model"), params_proposal=kwargs.get("params_proposal"), params_p=params_p,
+        trunk_embeddings=trunk_embeddings))
+
+    smc_outputs = (log_w_t, log_z_hat_t, log_psi_t_eval_list), samples, (
+        intermediate_twist_samples_hist, intermediate_log_w_t_hist, log_w_t_before_resample_hist)
+    if return_trunk_embeddings:
+        return (*smc_outputs, trunk_embeddings)
+    return smc_outputs
+
 
 def get_l_dre_sixo(rng_key, prompt, params_p, params_twist, log_true_final_twist,
                    output_len, n_twist, condition_twist_on_tokens, smc_procedure_type,
@@ -34,7 +100,7 @@ def get_l_dre_sixo(rng_key, prompt, params_p, params_twist, log_true_final_twist
                     proposal_is_p, huggingface_model, tempered_twist, beta_prop, params_proposal=params_proposal
                 )
         else:
-            (log_w_t_sigma_samples, _, _), prompt_w_sigma_sample_s_1_to_t = smc_procedure(
+            (log_w_t_sigma_samples, _, _), prompt_w_sigma_sample_s_1_to_t = smc_procedure_for_twist_loss(
                 sk1, prompt, params_p,
                 params_twist, log_true_final_twist, output_len, n_twist,
                 smc_procedure_type=smc_procedure_type,
@@ -101,6 +167,7 @@ def get_l_ebm_ml_partial_jit(
                               return_proposal_samples, sk2, smc_procedure_type,
                               true_sigma_samples)
 
+    trunk_embeddings = None
     if true_sigma_samples is not None:
         # if we have true posteriors (e.g. one true posterior, every example is from the
         prompt_w_sigma_sample_s_1_to_t = true_sigma_samples
@@ -114,7 +181,7 @@ def get_l_ebm_ml_partial_jit(
                                         replay_buffer, replay_buffer_log_w_ts,
                                         return_proposal_samples, rng_key)
     else:
-        normalized_w_t_sigma_samples, prompt_w_sigma_sample_s_1_to_t = get_positive_samples_and_weights_ebm(
+        normalized_w_t_sigma_samples, prompt_w_sigma_sample_s_1_to_t, trunk_embeddings = get_positive_samples_and_weights_ebm(
             beta_prop, condition_twist_on_tokens, huggingface_model,
             log_true_final_twist, mixed_p_q_sample, n_twist, output_len,
             params_p, params_proposal, params_twist, posterior_sample, prompt,
@@ -122,7 +189,7 @@ def get_l_ebm_ml_partial_jit(
 
     log_psi_on_truncated_sigma_samples = evaluate_log_psi_selected_tokens(
         prompt_w_sigma_sample_s_1_to_t, prompt_len, params_twist, condition_twist_on_tokens,
-        huggingface_model, params_proposal=params_proposal, params_p=params_p)
+        huggingface_model, params_proposal=params_proposal, params_p=params_p, trunk_embeddings=trunk_embeddings)
 
     ebm_first_term = jnp.dot(log_psi_on_truncated_sigma_samples.mean(axis=-1),
             normalized_w_t_sigma_samples)
@@ -150,11 +217,12 @@ def calculate_l_ebm_negative_sample_term(condition_twist_on_tokens,
     if reweight_for_second_term:  # Get approximate p(s_{1:t}) psi_t(s_{1:t}) samples by reweighting the produce of conditionals q(s_1) q(s_2|s_1)...
         (_, _, log_psi_t_eval_list_proposal_samples), proposal_samples, (
             intermediate_twist_samples_hist,
-            intermediate_log_w_t_hist, _) = smc_procedure(
+            intermediate_log_w_t_hist, _) = smc_procedure_for_twist_loss(
             sk2, prompt, params_p, params_twist,
             log_true_final_twist, output_len, n_twist,
             smc_procedure_type=smc_procedure_type,
             get_intermediate_sample_history_based_on_learned_twists=True,
+            differentiable_log_psi_t_eval_list=True,
             condition_twist_on_tokens=condition_twist_on_tokens,
             proposal_is_p=proposal_is_p, huggingface_model=huggingface_model,
             resample=False,
@@ -181,11 +249,12 @@ def calculate_l_ebm_negative_sample_term(condition_twist_on_tokens,
         # Get q samples with no resampling anywhere
         (_, _, log_psi_t_eval_list_proposal_samples), proposal_samples, (
             intermediate_twist_samples_hist,
-            intermediate_log_w_t_hist, _) = smc_procedure(
+            intermediate_log_w_t_hist, _) = smc_procedure_for_twist_loss(
             sk2, prompt, params_p, params_twist,
             log_true_final_twist, output_len, n_twist,
             smc_procedure_type=smc_procedure_type,
             get_intermediate_sample_history_based_on_learned_twists=True,
+            differentiable_log_psi_t_eval_list=True,
             condition_twist_on_tokens=condition_twist_on_tokens,
             proposal_is_p=proposal_is_p, huggingface_model=huggingface_model,
             resample=False,
@@ -209,19 +278,22 @@ def get_positive_samples_and_weights_ebm(beta_prop, condition_twist_on_tokens,
                                     posterior_sample, prompt, proposal_is_p,
                                     rng_key, sk1, smc_procedure_type,
                                     tempered_twist):
+    # The last output is the trunk embeddings of the samples when the weighting already computed them (the mixed p/q
+    # samples), None otherwise
+    trunk_embeddings = None
     if mixed_p_q_sample:
-        rng_key, prompt_w_sigma_sample_s_1_to_t, normalized_w_t_sigma_samples, _, _, _ = \
+        rng_key, prompt_w_sigma_sample_s_1_to_t, normalized_w_t_sigma_samples, _, _, _, trunk_embeddings = \
             get_mixed_p_q_samples(rng_key, prompt, params_p, params_twist,
                                   log_true_final_twist,
                                   output_len, n_twist,
                                   condition_twist_on_tokens, smc_procedure_type,
                                   proposal_is_p, huggingface_model,
                                   tempered_twist, beta_prop,
-                                  params_proposal=params_proposal)
+                                  params_proposal=params_proposal, return_trunk_embeddings=True)
     else:
         if posterior_sample is not None:
             (log_w_t_sigma_samples, _,
-             _), prompt_w_sigma_sample_s_1_to_t = smc_procedure(
+             _), prompt_w_sigma_sample_s_1_to_t = smc_procedure_for_twist_loss(
                 sk1, prompt, params_p,
                 params_twist, log_true_final_twist, output_len, n_twist,
                 smc_procedure_type=smc_procedure_type,
@@ -236,7 +308,7 @@ def get_positive_samples_and_weights_ebm(beta_prop, condition_twist_on_tokens,
             )
         else:
             (log_w_t_sigma_samples, _,
-             _), prompt_w_sigma_sample_s_1_to_t = smc_procedure(
+             _), prompt_w_sigma_sample_s_1_to_t = smc_procedure_for_twist_loss(
                 sk1, prompt, params_p,
                 params_twist, log_true_final_twist, output_len, n_twist,
                 smc_procedure_type=smc_procedure_type,
@@ -252,7 +324,7 @@ def get_positive_samples_and_weights_ebm(beta_prop, condition_twist_on_tokens,
 
         normalized_w_t_sigma_samples = jax.nn.softmax(
             jax.lax.stop_gradient(log_w_t_sigma_samples))
-    return normalized_w_t_sigma_samples, prompt_w_sigma_sample_s_1_to_t
+    return normalized_w_t_sigma_samples, prompt_w_sigma_sample_s_1_to_t, trunk_embeddings
 
 
 def get_l_ebm_one_sample(condition_twist_on_tokens, huggingface_model,
@@ -268,11 +340,12 @@ def get_l_ebm_one_sample(condition_twist_on_tokens, huggingface_model,
     (log_w_t_sigma_samples, _,
      log_psi_t_eval_list_proposal_samples), proposal_samples, (
         intermediate_twist_samples_hist,
-        intermediate_log_w_t_hist, _) = smc_procedure(
+        intermediate_log_w_t_hist, _), trunk_embeddings = smc_procedure_for_twist_loss(
         sk2, prompt, params_p, params_twist,
         log_true_final_twist, output_len, n_twist,
         smc_procedure_type=smc_procedure_type,
         get_intermediate_sample_history_based_on_learned_twists=True,
+        differentiable_log_psi_t_eval_list=True, return_trunk_embeddings=True,
         condition_twist_on_tokens=condition_twist_on_tokens,
         proposal_is_p=proposal_is_p, huggingface_model=huggingface_model,
         resample=False,
@@ -289,7 +362,7 @@ def get_l_ebm_one_sample(condition_twist_on_tokens, huggingface_model,
         proposal_samples, prompt_len, params_twist,
         condition_twist_on_tokens,
         huggingface_model,
-        params_proposal=params_proposal, params_p=params_p)
+        params_proposal=params_proposal, params_p=params_p, trunk_embeddings=trunk_embeddings)
     ebm_second_term = 0.
     for i in range(intermediate_log_w_t_hist.shape[0]):
         ebm_second_term += jnp.dot(
@@ -511,11 +584,12 @@ def get_l_nvi_partial_jit(
     assert posterior_sample is None
     (log_w_t_sigma_samples, _, log_psi_t_eval_list_proposal_samples), proposal_samples, (
         intermediate_twist_samples_hist,
-        intermediate_log_w_t_hist, _) = smc_procedure(
+        intermediate_log_w_t_hist, _) = smc_procedure_for_twist_loss(
         sk2, prompt, params_p, params_twist,
         log_true_final_twist, output_len, n_twist,
         smc_procedure_type=smc_procedure_type,
         get_intermediate_sample_history_based_on_learned_twists=True,
+        differentiable_log_psi_t_eval_list=True,
         condition_twist_on_tokens=condition_twist_on_tokens,
         proposal_is_p=proposal_is_p, huggingface_model=huggingface_model,
         resample=False,
@@ -653,7 +727,10 @@ def get_proposal_q_sample_in_scan_non_modify(carry, t, original_seq, condition_t
 # or use those weights in some weighted expectation which approximates draws from sigma.
 def get_mixed_p_q_samples(rng_key, prompt, params_p, params_twist, log_true_final_twist,
                         output_len, n_twist, condition_twist_on_tokens, smc_procedure_type,
-                       proposal_is_p=False, huggingface_model=None, tempered_twist=False, beta_prop=None, params_proposal=None):
+                       proposal_is_p=False, huggingface_model=None, tempered_twist=False, beta_prop=None, params_proposal=None,
+                       return_trunk_embeddings=False):
+    # With return_trunk_embeddings, get_trunk_embeddings_for_twist_loss of the returned samples is appended to the outputs
+    # (the importance weights below are computed from the same ones), for the caller to reuse
     prompt_len = prompt.shape[-1]
 
     rng_key, sk1, sk2 = jax.random.split(rng_key, 3)
@@ -661,7 +738,7 @@ def get_mixed_p_q_samples(rng_key, prompt, params_p, params_twist, log_true_fina
 
     (log_w_t_sigma_samples, _, _), q_samples, (
         intermediate_twist_samples_hist,
-        intermediate_log_w_t_hist, _) = smc_procedure(
+        intermediate_log_w_t_hist, _) = smc_procedure_for_twist_loss(
         sk2, prompt, params_p, params_twist,
         log_true_final_twist, output_len, n_twist // 2,
         smc_procedure_type=smc_procedure_type,
@@ -681,19 +758,13 @@ def get_mixed_p_q_samples(rng_key, prompt, params_p, params_twist, log_true_fina
     # p_evals = jnp.transpose(p_evals)
 
     combined_seqs = jnp.concatenate((p_samples, q_samples), axis=0)
+    trunk_embeddings = get_trunk_embeddings_for_twist_loss(combined_seqs, params_p, huggingface_model)
     # log_p_eval = evaluate_log_p_selected_tokens(combined_seqs, prompt_len, params_p, huggingface_model).sum(axis=1)
-    log_p_eval = evaluate_log_p_theta_1_to_t(combined_seqs, params_p,
-                                             prompt_len, output_len,
-                                             huggingface_model=huggingface_model)
-
-    log_q_eval = evaluate_normalized_log_q_1_to_t(combined_seqs,
-                                                  params_p,
-                                                  params_twist,
-                                                  prompt_len,
-                                                  condition_twist_on_tokens,
-
-                                                  huggingface_model,
-                                                  params_proposal=params_proposal)  # No tempered twist for this evaluation
+    scores = get_sequence_scores(combined_seqs, prompt_len, params_p, params_twist, condition_twist_on_tokens,
+                                 huggingface_model=huggingface_model, params_proposal=params_proposal,
+                                 with_log_psi=False, trunk_embeddings=trunk_embeddings)
+    log_p_eval = scores.log_p_total
+    log_q_eval = scores.normalized_log_q_total  # No tempered twist for this evaluation
     mixture_prob_eval = 1. / 2. * (jnp.exp(log_p_eval) + jnp.exp(
         log_q_eval))  # 50/50 mixture of the two distributions, so for the density, just take 50% prob of each
     mixture_log_prob_eval = jnp.log(mixture_prob_eval)
@@ -709,7 +780,10 @@ def get_mixed_p_q_samples(rng_key, prompt, params_p, params_twist, log_true_fina
     normalized_w_t_sigma_samples = jax.nn.softmax(
         log_w_t_tilde_sigma_over_q_mix)
 
-    return rng_key, combined_seqs, normalized_w_t_sigma_samples, log_w_t_tilde_sigma_over_q_mix, jax.lax.stop_gradient(mixture_log_prob_eval), log_phi_final_eval
+    outputs = rng_key, combined_seqs, normalized_w_t_sigma_samples, log_w_t_tilde_sigma_over_q_mix, jax.lax.stop_gradient(mixture_log_prob_eval), log_phi_final_eval
+    if return_trunk_embeddings:
+        return (*outputs, trunk_embeddings)
+    return outputs
 
 
 # TODO Oct 29 - I guess that the sigma samples should come from outside of this function, since this works for any set of (approximate) sigma samples
@@ -724,16 +798,19 @@ def get_l_one_total_kl(rng_key, prompt, params_p, params_twist, log_true_final_t
 
     rng_key, sk1, sk2, sk3 = jax.random.split(rng_key, 4)
 
-    normalized_w_t_sigma_samples, prompt_w_sigma_sample_s_1_to_t, rng_key = get_positive_samples_and_weights_one_total_kl(
+    normalized_w_t_sigma_samples, prompt_w_sigma_sample_s_1_to_t, rng_key, trunk_embeddings = get_positive_samples_and_weights_one_total_kl(
         beta_prop, condition_twist_on_tokens, huggingface_model,
         log_true_final_twist, mixed_p_q_sample, n_twist, output_len, params_p,
         params_proposal, params_twist, prompt, proposal_is_p, replay_buffer,
         replay_buffer_log_w_ts, rng_key, sk2, smc_procedure_type,
         tempered_twist, true_sigma_samples)
 
+    if trunk_embeddings is None:
+        trunk_embeddings = get_trunk_embeddings_for_twist_loss(prompt_w_sigma_sample_s_1_to_t, params_p, huggingface_model)
+
     log_psi_on_truncated_sigma_samples = evaluate_log_psi_selected_tokens(
         prompt_w_sigma_sample_s_1_to_t, prompt_len, params_twist, condition_twist_on_tokens,
-        huggingface_model, params_proposal=params_proposal, params_p=params_p)
+        huggingface_model, params_proposal=params_proposal, params_p=params_p, trunk_embeddings=trunk_embeddings)
 
     l_kl_first_term = log_psi_on_truncated_sigma_samples # mean along the time dimension; we can debate if we want to use sum. Ultimately doesn't really matter because of the learning rate, is just a question of what's more convenient to avoid scaling lr with output_len. Mean means that the earlier twists get constant-ish scale of signal, but sum means the later twists get constant-ish scale of signal
 
@@ -743,7 +820,7 @@ def get_l_one_total_kl(rng_key, prompt, params_p, params_twist, log_true_final_t
                                             params_p, params_proposal,
                                             params_twist, prompt_len,
                                             prompt_w_sigma_sample_s_1_to_t,
-                                            proposal_is_p, rng_key)
+                                            proposal_is_p, rng_key, trunk_embeddings=trunk_embeddings)
 
 
     l_kl = jnp.dot((l_kl_first_term - l_kl_second_term).mean(axis=1), normalized_w_t_sigma_samples) # This dot with the sigma weighting gives us the expectation over sigma (s_1:t-1)
@@ -757,6 +834,9 @@ def get_positive_samples_and_weights_one_total_kl(
     prompt, proposal_is_p, replay_buffer, replay_buffer_log_w_ts, rng_key, sk2,
     smc_procedure_type, tempered_twist, true_sigma_samples
 ):
+    # The last output is the trunk embeddings of the samples when the weighting already computed them (the mixed p/q
+    # samples), None otherwise
+    trunk_embeddings = None
     if true_sigma_samples is not None:
         assert replay_buffer is None
         # if we have true posteriors (e.g. one true posterior, every example is from the
@@ -774,7 +854,7 @@ def get_positive_samples_and_weights_one_total_kl(
 
     else:
         if mixed_p_q_sample:
-            rng_key, prompt_w_sigma_sample_s_1_to_t, normalized_w_t_sigma_samples, _, _, _ = \
+            rng_key, prompt_w_sigma_sample_s_1_to_t, normalized_w_t_sigma_samples, _, _, _, trunk_embeddings = \
                 get_mixed_p_q_samples(rng_key, prompt, params_p, params_twist,
                                       log_true_final_twist,
                                       output_len, n_twist,
@@ -782,13 +862,13 @@ def get_positive_samples_and_weights_one_total_kl(
                                       smc_procedure_type,
                                       proposal_is_p, huggingface_model,
                                       tempered_twist, beta_prop,
-                                      params_proposal=params_proposal)
+                                      params_proposal=params_proposal, return_trunk_embeddings=True)
 
         else:
             # The first part is the same as CTL/EBM-ML approach; the first term is going to be the same
             (log_w_t_sigma_samples, _, _), prompt_w_sigma_sample_s_1_to_t, (
                 intermediate_twist_samples_hist,
-                intermediate_log_w_t_hist, _) = smc_procedure(
+                intermediate_log_w_t_hist, _) = smc_procedure_for_twist_loss(
                 sk2, prompt, params_p, params_twist,
                 log_true_final_twist, output_len, n_twist,
                 smc_procedure_type=smc_procedure_type,
@@ -805,14 +885,14 @@ def get_positive_samples_and_weights_one_total_kl(
 
             normalized_w_t_sigma_samples = jax.nn.softmax(
                 jax.lax.stop_gradient(log_w_t_sigma_samples))
-    return normalized_w_t_sigma_samples, prompt_w_sigma_sample_s_1_to_t, rng_key
+    return normalized_w_t_sigma_samples, prompt_w_sigma_sample_s_1_to_t, rng_key, trunk_embeddings
 
 
 def get_l_kl_second_term(condition_twist_on_tokens, exact_expectation,
                          huggingface_model, output_len, params_p,
                          params_proposal, params_twist, prompt_len,
                          prompt_w_sigma_sample_s_1_to_t, proposal_is_p,
-                         rng_key):
+                         rng_key, trunk_embeddings=None):
     if exact_expectation:
         # Instead of sampling, just directly calculate the expectation over sigma samples. Basically for every sigma sample truncated at time step t-1 where t = 1 ... T
         # We calculate the probability over all the next tokens, and take expectation of
@@ -825,7 +905,7 @@ def get_l_kl_second_term(condition_twist_on_tokens, exact_expectation,
             prompt_w_sigma_sample_s_1_to_t, params_p, params_twist,
             condition_twist_on_tokens,
             huggingface_model, params_proposal=params_proposal,
-            prompt_len=prompt_len)
+            prompt_len=prompt_len, trunk_embeddings=trunk_embeddings)
 
         # For time step e.g. the first time step, then we want to get the p and psi values e.g. if prompt len is 4, and we want the first time step
         # Then we need index 3 to get the logits (remember 0 based indexing), which we then use for generation
@@ -833,6 +913,10 @@ def get_l_kl_second_term(condition_twist_on_tokens, exact_expectation,
         log_p = jax.nn.log_softmax(p_logits, axis=-1)[:, prompt_len - 1: -1]
         # log_psi = log_psi_all_vocab[:, prompt_len - 1: -1]
         log_psi = log_psi_all_vocab
+        # After EOS, q is all on the EOS padding and psi is frozen, as in the SMC (and in the first term)
+        eos_token_id = custom_transformer_prob_utils.default_eos_token_id
+        log_p = mask_log_p_all_vocab_after_eos(log_p, prompt_w_sigma_sample_s_1_to_t, prompt_len, eos_token_id)
+        log_psi = freeze_log_psi_after_eos(log_psi, prompt_w_sigma_sample_s_1_to_t, prompt_len, eos_token_id)
         log_p_plus_log_psi_all_vocab_for_expectation = jax.lax.stop_gradient(
             log_p + log_psi)  # stop gradient, no gradient on this
         # p_psi_all_vocab_for_expectation = jnp.exp(log_p_plus_log_psi_all_vocab_for_expectation)
@@ -960,18 +1044,12 @@ def calculate_rl_values_and_target_term(condition_twist_on_tokens,
                                         params_p, params_proposal, params_twist,
                                         prompt_len, samples_to_evaluate_over,
                                         stop_grad, train_final_twist_only):
-    p_logits, log_psi = \
-        get_p_logits_and_log_psi_all_vocab(samples_to_evaluate_over, params_p,
-                                           params_twist,
-                                           condition_twist_on_tokens,
-                                           huggingface_model=huggingface_model,
-                                           params_proposal=params_proposal,
-                                           prompt_len=prompt_len)
-    log_psi = log_psi[:,
+    scores = get_sequence_scores(samples_to_evaluate_over, prompt_len, params_p, params_twist, condition_twist_on_tokens,
+                                 huggingface_model=huggingface_model, params_proposal=params_proposal,
+                                 with_all_vocab=True)
+    log_psi = scores.log_psi_all_vocab[:,
               1:]  # because the current formulation gives prompt_len-1:-1, so 1: gives prompt_len:-1
-    log_p = jax.nn.log_softmax(p_logits,
-                               axis=-1)  # gives you the normalized p values, since the regular output is the unnormalized log p values
-    log_p = log_p[:, prompt_len:-1]
+    log_p = scores.log_p_all_vocab[:, 1:] # normalized log p, also for prompt_len:-1
     if loss_type == "googleCD":
         target_term = (jnp.exp(log_p) * log_psi).sum(
             axis=-1)  # first we get log(p psi), then we do exp, so we have p psi (psi = e^V), then we sum all the (p psi), then we log again. Therefore logsumexp. We use axis = -1 because we want to preserve the different values across different time steps. Essentially doing all the different time steps in one go
@@ -994,10 +1072,15 @@ def calculate_rl_values_and_target_term(condition_twist_on_tokens,
     # target_term = target_term.at[:, -1].set(log_phi_final_eval)
     if stop_grad:
         target_term = jax.lax.stop_gradient(target_term)
-    values = evaluate_log_psi_selected_tokens(
-        samples_to_evaluate_over, prompt_len, params_twist,
-        condition_twist_on_tokens,
-        huggingface_model, params_proposal=params_proposal, params_p=params_p)
+    if isinstance(huggingface_model, HashableDict) and huggingface_model['call_type'] == "p_psi_combined":
+        # For this call type, evaluate_log_psi_selected_tokens gives the raw twist output (log p psi rather than log psi),
+        # which is what the values have always been
+        values = evaluate_log_psi_selected_tokens(
+            samples_to_evaluate_over, prompt_len, params_twist,
+            condition_twist_on_tokens,
+            huggingface_model, params_proposal=params_proposal, params_p=params_p)
+    else:
+        values = scores.log_psi  # Same as evaluate_log_psi_selected_tokens, without another twist forward pass
     if train_final_twist_only:
         values = values[:, -1][:, None]
         target_term = target_term[:, -1][:,
@@ -1090,7 +1173,7 @@ def get_samples_to_evaluate_over_and_log_w_t_for_rl(
         elif evaluate_over_samples_from == "q":
             # Get q samples with no resampling anywhere
             (_, _, _), _, (intermediate_twist_samples_hist,
-                           intermediate_log_w_t_hist, _) = smc_procedure(
+                           intermediate_log_w_t_hist, _) = smc_procedure_for_twist_loss(
                 sk2, prompt, params_p, params_twist,
                 log_true_final_twist, output_len, n_twist,
                 smc_procedure_type=smc_procedure_type,
@@ -1110,7 +1193,7 @@ def get_samples_to_evaluate_over_and_log_w_t_for_rl(
         elif evaluate_over_samples_from == "qrsmp":
             # Get q samples with no resampling anywhere
             (log_w_t, _, _), _, (intermediate_twist_samples_hist,
-                                 intermediate_log_w_t_hist, _) = smc_procedure(
+                                 intermediate_log_w_t_hist, _) = smc_procedure_for_twist_loss(
                 sk2, prompt, params_p, params_twist,
                 log_true_final_twist, output_len, n_twist,
                 smc_procedure_type=smc_procedure_type,
@@ -1128,7 +1211,7 @@ def get_samples_to_evaluate_over_and_log_w_t_for_rl(
 
         elif evaluate_over_samples_from == "sigma":
             # Approximate sigma samples
-            (log_w_t, _, _), samples_to_evaluate_over = smc_procedure(
+            (log_w_t, _, _), samples_to_evaluate_over = smc_procedure_for_twist_loss(
                 sk2, prompt, params_p, params_twist,
                 log_true_final_twist, output_len, n_twist,
                 smc_procedure_type=smc_procedure_type,
@@ -1158,7 +1241,7 @@ def get_samples_to_evaluate_over_and_log_w_t_for_rl(
                                                                  :]
 
             (_, _, _), _, (intermediate_twist_samples_hist,
-                           intermediate_log_w_t_hist, _) = smc_procedure(
+                           intermediate_log_w_t_hist, _) = smc_procedure_for_twist_loss(
                 sk2, prompt, params_p, params_twist,
                 log_true_final_twist, output_len, n_twist // 2,
                 smc_procedure_type=smc_procedure_type,
@@ -93,6 +93,18 @@ def save_logZ_bounds_plot(
     linestyle_list_for_smc_ub_plots = ['dashed', 'dashed']
     linestyle_list_for_smc_lb_plots = ['solid', 'solid']
 
+    if len(n_samples_for_plots) > 2:
+        # e.g. with --nested_n_samples_for_plots: shades from light (fewest samples) to dark (most samples)
+        shades = np.linspace(0.35, 1., len(n_samples_for_plots))
+        color_list_for_iwae_ub_plots = [plt.cm.Blues(x) for x in shades]
+        color_list_for_iwae_lb_plots = [plt.cm.Greens(x) for x in shades]
+        color_list_for_smc_ub_plots = [plt.cm.Reds(x) for x in shades]
+        color_list_for_smc_lb_plots = [plt.cm.Oranges(x) for x in shades]
+        linestyle_list_for_iwae_ub_plots = ['dashed'] * len(n_samples_for_plots)
+        linestyle_list_for_iwae_lb_plots = ['solid'] * len(n_samples_for_plots)
+        linestyle_list_for_smc_ub_plots = ['dashed'] * len(n_samples_for_plots)
+        linestyle_list_for_smc_lb_plots = ['solid'] * len(n_samples_for_plots)
+
     plt.clf()
     # x_range = np.arange(1, len(kl_ubs_iwae) + 1)
     plt.xlabel(plt_xlabel_text)
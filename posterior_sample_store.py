@@ -0,0 +1,99 @@
+import os
+import json
+import uuid
+import fcntl
+import hashlib
+import numpy as np
+
+
+# Append-only, chunked store for true posterior samples, so a long collection can be flushed as it goes and resumed after a crash.
+# Each flush writes one .npy shard (never modified afterwards); a JSON manifest lists the shards for each setting.
+# A setting is a dict like {"prompt": [...token ids...], "rm_type": ..., "threshold": ..., "output_len": ..., "seed": ...};
+# its canonical JSON is the key in the manifest. Shards are loaded with mmap, so reading the first n rows only touches those rows.
+# Both the shards and the manifest are written to a temporary file first and then renamed, so a crash never leaves
+# a partially written file in the manifest (at worst, an orphaned shard that the manifest doesn't list).
+# Several runs can append to the same store at once: shard names are unique (uuid), and the manifest is only updated
+# under an exclusive lock on LOCK_NAME, re-reading it from disk first so other runs' entries are merged rather than overwritten.
+
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = "manifest.lock"
+
+
+def setting_to_key(setting):
+    return json.dumps(setting, sort_keys=True)
+
+
+class PosteriorSampleStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.manifest_path = os.path.join(store_dir, MANIFEST_NAME)
+        self.lock_path = os.path.join(store_dir, LOCK_NAME)
+        self.reload()
+
+    def reload(self):
+        # Picks up shards appended by other runs since this store was opened (the manifest is always replaced atomically, so no lock needed)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"entries": {}}
+
+    def _write_manifest(self):
+        # Only call with the lock held; the tmp name is unique too in case something else writes the manifest without it
+        tmp_path = f"{self.manifest_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def n_samples(self, setting):
+        entry = self.manifest["entries"].get(setting_to_key(setting))
+        return 0 if entry is None else entry["n_samples"]
+
+    def n_shards(self):
+        return sum(len(entry["shards"]) for entry in self.manifest["entries"].values())
+
+    def append(self, setting, samples):
+        samples = np.asarray(samples)
+        if samples.shape[0] == 0:
+            return
+        key = setting_to_key(setting)
+        key_hash = hashlib.sha1(key.encode()).hexdigest()[:16]
+        file_name = f"{key_hash}_{uuid.uuid4().hex}.npy"
+        tmp_path = os.path.join(self.store_dir, file_name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, samples)
+        os.replace(tmp_path, os.path.join(self.store_dir, file_name))
+
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX) # released when the file is closed
+            self.reload()
+            entry = self.manifest["entries"].setdefault(key, {"setting": setting, "shards": [], "n_samples": 0})
+            entry["shards"].append({"file": file_name, "n_samples": int(samples.shape[0])})
+            entry["n_samples"] += int(samples.shape[0])
+            self._write_manifest()
+
+    def matching_settings(self, setting):
+        # All stored settings that agree with setting on every field it has (e.g. leave out "seed" to pool over seeds)
+        matches = []
+        for entry in self.manifest["entries"].values():
+            if all(entry["setting"].get(k) == v for k, v in setting.items()):
+                matches.append(entry["setting"])
+        return sorted(matches, key=setting_to_key)
+
+    def load(self, setting, max_samples=None):
+        # First max_samples rows (all if None) of the samples for every stored setting matching setting, as one numpy array.
+        # Shards past max_samples are never opened, and the ones that are get memory mapped, so only the needed rows are read.
+        rows = []
+        n_loaded = 0
+        for matching_setting in self.matching_settings(setting):
+            for shard in self.manifest["entries"][setting_to_key(matching_setting)]["shards"]:
+                if max_samples is not None and n_loaded >= max_samples:
+                    break
+                shard_samples = np.load(os.path.join(self.store_dir, shard["file"]), mmap_mode="r")
+                n_to_take = shard["n_samples"] if max_samples is None else min(shard["n_samples"], max_samples - n_loaded)
+                rows.append(np.array(shard_samples[:n_to_take]))
+                n_loaded += n_to_take
+        if len(rows) == 0:
+            return None
+        return np.concatenate(rows, axis=0)
@@ -1,10 +1,16 @@
 import jax
 from jax import vmap
 import jax.numpy as jnp
+import numpy as np
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 from custom_transformer_prob_utils import evaluate_log_p_theta_t, \
-    stochastic_transformer_sample, evaluate_log_p_selected_tokens
+    stochastic_transformer_sample, evaluate_log_p_selected_tokens, get_transformer_p_embeddings, \
+    evaluate_log_p_of_next_tokens_kv_cached
 
 
 # curry the prompt_len... TODO think about whether this structure or the one where you pass in (e.g. like batch_reward_model below) makes more sense
@@ -57,7 +63,9 @@ def curried_reward_model_log_p_of_token(params_p, index_of_fixed_token):
 @partial(jax.jit, static_argnames=["beta_temp", "huggingface_model", "return_log_w_no_temp", "divide_by_p", "prompt_len"])
 def log_reward_model_p_of_continuation(
     seq, params_p, indices_of_continuation, beta_temp=None,
-    huggingface_model=None, return_log_w_no_temp=False, divide_by_p=False, prompt_len=None):
+    huggingface_model=None, return_log_w_no_temp=False, divide_by_p=False, prompt_len=None, kv_cache=None):
+    # kv_cache (optional) is the cache left by the final SMC step on seq, for the same params_p (see evaluate_log_p_of_next_tokens_kv_cached);
+    # then only the continuation is run through p. divide_by_p also needs log p of the output tokens, so it always reruns the full sequence
 
     do_reshape = False
     if len(seq.shape) == 3:
@@ -68,6 +76,13 @@ def log_reward_model_p_of_continuation(
     jnp_continuation = indices_of_continuation
     batch_continuation = jnp.full((seq.shape[0], jnp_continuation.shape[-1]), jnp_continuation)
 
+    if kv_cache is not None and not divide_by_p:
+        log_prob_of_continuation = evaluate_log_p_of_next_tokens_kv_cached(seq, batch_continuation, kv_cache, params_p, huggingface_model=huggingface_model)
+        if return_log_w_no_temp:
+            return log_prob_of_continuation.sum(axis=-1)
+        assert beta_temp is not None
+        return jnp.exp(log_prob_of_continuation.sum(axis=-1)) * beta_temp
+
     seq = jnp.concatenate((seq, batch_continuation), axis=1)
 
     if divide_by_p:
@@ -91,15 +106,18 @@ def log_reward_model_p_of_continuation(
             return jnp.exp(log_prob_of_continuation.sum(axis=-1)) * beta_temp # in the phi = e^(beta r) formulation, the log phi is going to be just beta * r
 
 
+# accepts_kv_cache tells evaluate_log_phi_final that these can take the final SMC step's kv_cache
 def curried_log_reward_model_p_of_continuation(params_p, indices_of_continuation, beta_temp, huggingface_model=None, divide_by_p=False, prompt_len=None):
-    def new_rm(seq):
-        return log_reward_model_p_of_continuation(seq, params_p, indices_of_continuation, beta_temp, huggingface_model=huggingface_model, divide_by_p=divide_by_p, prompt_len=prompt_len)
+    def new_rm(seq, kv_cache=None):
+        return log_reward_model_p_of_continuation(seq, params_p, indices_of_continuation, beta_temp, huggingface_model=huggingface_model, divide_by_p=divide_by_p, prompt_len=prompt_len, kv_cache=kv_cache)
+    new_rm.accepts_kv_cache = not divide_by_p
     return new_rm
 
 
 def curried_log_p_of_continuation(params_p, indices_of_continuation, huggingface_model=None):
-    def new_rm(seq):
-        return log_reward_model_p_of_continuation(seq, params_p, indices_of_continuation, beta_temp=None, huggingface_model=huggingface_model, return_log_w_no_temp=True)
+    def new_rm(seq, kv_cache=None):
+        return log_reward_model_p_of_continuation(seq, params_p, indices_of_continuation, beta_temp=None, huggingface_model=huggingface_model, return_log_w_no_temp=True, kv_cache=kv_cache)
+    new_rm.accepts_kv_cache = True
     return new_rm
 
 
@@ -111,7 +129,13 @@ def curried_log_p_of_continuation(params_p, indices_of_continuation, huggingface
 @partial(jax.jit, static_argnames=["beta_temp", "huggingface_model", "continuation_len"])
 def log_reward_model_p_of_last_tokens(
     seq, params_p, continuation_len, beta_temp=1.,
-    huggingface_model=None):
+    huggingface_model=None, kv_cache=None):
+    # kv_cache (optional) is the final SMC step's cache on seq[:, :-continuation_len] (see log_reward_model_p_of_continuation)
+
+    if kv_cache is not None:
+        log_prob_of_continuation = evaluate_log_p_of_next_tokens_kv_cached(
+            seq[:, :-continuation_len], seq[:, -continuation_len:], kv_cache, params_p, huggingface_model=huggingface_model)
+        return log_prob_of_continuation.sum(axis=-1) * beta_temp
 
     seq_len_incl_prompt = seq.shape[-1]
 
@@ -129,10 +153,11 @@ def log_reward_model_p_of_last_tokens(
     # And then all your other calculations should work
 
 def curried_log_reward_model_p_of_last_tokens(params_p, huggingface_model=None, beta_temp=1.):
-    def new_rm(seq, condition_twist_on_tokens):
+    def new_rm(seq, condition_twist_on_tokens, kv_cache=None):
         continuation_len = condition_twist_on_tokens.shape[-1]
         new_seq = jnp.concatenate((seq, condition_twist_on_tokens), axis=-1)
-        return log_reward_model_p_of_last_tokens(new_seq, params_p, continuation_len, beta_temp=beta_temp, huggingface_model=huggingface_model)
+        return log_reward_model_p_of_last_tokens(new_seq, params_p, continuation_len, beta_temp=beta_temp, huggingface_model=huggingface_model, kv_cache=kv_cache)
+    new_rm.accepts_kv_cache = True
     return new_rm
 
 
@@ -155,6 +180,376 @@ def batch_check_array_contained_in_other_array(big_array, small_array):
 eps = 1e-16 # just to avoid inf when taking log of 0
 
 
+rm_score_cache_size = 100000 # Max number of sequences to memoize reward model outputs for (per reward model); 0 disables the cache
+
+
+class RMScoreCache:
+    # Bounded LRU memo of reward model outputs (the raw logits row) keyed by a hash of the LM token ids of each sequence.
+    # Resampling in SMC and the rejection loops for true posterior samples produce many exact duplicate sequences,
+    # and decoding + retokenizing + running the classifier on the host is by far the most expensive part of those.
+    # Everything works on a whole batch at once: the rows are hashed column by column (see hash_rows), and the table is kept as
+    # arrays sorted by the first hash, so a lookup is one np.searchsorted. Recency is a per entry counter (the batch number it was
+    # last used in); when an insert goes over max_size, the least recently used entries are evicted and the table is re-sorted.
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.keys = np.zeros((2, 0), dtype=np.uint64) # sorted by keys[0]; keys[1] guards against collisions in keys[0]
+        self.last_used = np.zeros((0,), dtype=np.int64)
+        self.outputs = None # (size, ...) once the first outputs get inserted
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock() # reward models may be called from several threads (see collect_true_posterior_samples_pipelined)
+
+    @staticmethod
+    def hash_rows(seq):
+        # Two 64 bit hashes of each row, shape (2, batch): FNV-1a style over the token ids (with different offsets and primes),
+        # vectorized over the rows with a loop over the columns, then the splitmix64 finalizer
+        seq = np.asarray(seq).astype(np.uint64)
+        h = np.empty((2, seq.shape[0]), dtype=np.uint64)
+        h[0], h[1] = np.uint64(0xcbf29ce484222325), np.uint64(0x84222325cbf29ce4)
+        primes = np.array([[0x100000001b3], [0x9e3779b97f4a7c15]], dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            for j in range(seq.shape[1]):
+                h = (h ^ seq[:, j]) * primes
+            h = h ^ np.uint64(seq.shape[1])
+            h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+            h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+            h = h ^ (h >> np.uint64(31))
+        return h
+
+    def _find(self, keys):
+        # Positions of keys in the table, and which of them are there
+        positions = np.searchsorted(self.keys[0], keys[0])
+        in_range = positions < self.keys.shape[1]
+        positions = np.where(in_range, positions, 0)
+        found = in_range & (self.keys[0][positions] == keys[0]) & (self.keys[1][positions] == keys[1])
+        return positions, found
+
+    def lookup(self, keys):
+        # Returns which keys were found, and the cached outputs for those, in order
+        with self.lock:
+            if self.keys.shape[1] == 0:
+                return np.zeros((keys.shape[1],), dtype=bool), None
+            positions, found = self._find(keys)
+            self.clock += 1
+            self.last_used[positions[found]] = self.clock
+            return found, self.outputs[positions[found]]
+
+    def insert(self, keys, outputs):
+        outputs = np.asarray(outputs)
+        with self.lock:
+            if self.keys.shape[1] > 0:
+                _, already_there = self._find(keys) # e.g. inserted by another thread since the lookup
+                keys, outputs = keys[:, ~already_there], outputs[~already_there]
+            self.clock += 1
+            all_keys = np.concatenate((self.keys, keys), axis=1)
+            last_used = np.concatenate((self.last_used, np.full((keys.shape[1],), self.clock, dtype=np.int64)))
+            all_outputs = outputs if self.outputs is None else np.concatenate((self.outputs, outputs))
+            keep = np.arange(all_keys.shape[1])
+            if keep.shape[0] > self.max_size:
+                keep = np.argsort(-last_used, kind="stable")[:self.max_size]
+            order = keep[np.argsort(all_keys[0][keep], kind="stable")]
+            self.keys, self.last_used, self.outputs = all_keys[:, order], last_used[order], all_outputs[order]
+
+    def record(self, n_hits, n_misses):
+        with self.lock:
+            self.hits += n_hits
+            self.misses += n_misses
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate(), "size": self.keys.shape[1]}
+
+
+rm_score_caches = {} # id(reward model) -> RMScoreCache
+rm_score_caches_lock = threading.Lock()
+
+
+def get_rm_score_cache(rewardModel):
+    with rm_score_caches_lock:
+        if id(rewardModel) not in rm_score_caches:
+            rm_score_caches[id(rewardModel)] = RMScoreCache(rm_score_cache_size)
+        return rm_score_caches[id(rewardModel)]
+
+
+def print_rm_score_cache_stats():
+    for cache in rm_score_caches.values():
+        print(f"RM score cache: {cache.stats()}", flush=True)
+
+
+rm_length_buckets = (16, 32, 64, 128, 256, 512) # RM inputs get padded up to one of these lengths, so the RM only compiles once per bucket
+rm_batch_chunk_size = 256 # Max number of sequences per RM call (None for no limit); batches are also padded up to a power of 2 (at most this)
+
+rm_jitted_calls = {} # id(reward model) -> jitted (params, input_ids, attention_mask) -> logits
+
+
+def call_rm(rewardModel, input_ids, attention_mask):
+    # Flax HF models aren't jitted on their own; jit with the params as an argument (not baked in as constants).
+    # Logits always come back in fp32 (e.g. when the RM was loaded with dtype=bfloat16, see get_tokenizer_and_rewardModel)
+    if not hasattr(rewardModel, "params"):
+        return rewardModel(input_ids=input_ids, attention_mask=attention_mask)[0].astype(jnp.float32)
+    if id(rewardModel) not in rm_jitted_calls:
+        rm_jitted_calls[id(rewardModel)] = jax.jit(
+            lambda params, input_ids, attention_mask: rewardModel(input_ids=input_ids, attention_mask=attention_mask, params=params)[0].astype(jnp.float32))
+    return rm_jitted_calls[id(rewardModel)](rewardModel.params, input_ids, attention_mask)
+
+
+def get_rm_length_bucket(length):
+    for bucket in rm_length_buckets:
+        if length <= bucket:
+            return bucket
+    return length
+
+
+def get_rm_batch_bucket(batch_size):
+    bucket = 8
+    while bucket < batch_size:
+        bucket *= 2
+    if rm_batch_chunk_size is not None:
+        bucket = min(bucket, rm_batch_chunk_size)
+    return bucket
+
+
+def get_rm_logits_from_text(seq, rewardModel, tokenizer_RM, tokenizer):
+    # Rather than padding everything to the longest sequence in the batch (a new shape, so a recompile, nearly every call),
+    # sort by length and score chunks of at most rm_batch_chunk_size sequences, each padded to a length bucket and batch bucket
+    text_outputs = tokenizer.batch_decode(seq, skip_special_tokens=True)
+    token_ids = tokenizer_RM(text_outputs,
+                             truncation=True,
+                             padding=False,
+                             max_length=512,
+                             return_token_type_ids=False,
+                             return_attention_mask=False)["input_ids"]
+    lengths = np.array([len(ids) for ids in token_ids])
+    order = np.argsort(lengths, kind="stable")
+    chunk_size = len(token_ids) if rm_batch_chunk_size is None else rm_batch_chunk_size
+
+    logits = None
+    for chunk_start in range(0, len(token_ids), chunk_size):
+        chunk = order[chunk_start:chunk_start + chunk_size]
+        padded_len = get_rm_length_bucket(lengths[chunk].max())
+        padded_batch = get_rm_batch_bucket(chunk.shape[0])
+        input_ids = np.full((padded_batch, padded_len), tokenizer_RM.pad_token_id, dtype=np.int32)
+        attention_mask = np.zeros((padded_batch, padded_len), dtype=np.int32)
+        attention_mask[:, 0] = 1 # padding rows attend to one (pad) token rather than nothing
+        for row, i in enumerate(chunk):
+            input_ids[row, :lengths[i]] = token_ids[i]
+            attention_mask[row, :lengths[i]] = 1
+
+        chunk_logits = np.asarray(call_rm(rewardModel, input_ids, attention_mask))[:chunk.shape[0]]
+        if logits is None:
+            logits = np.empty((len(token_ids),) + chunk_logits.shape[1:], dtype=np.float32)
+        logits[chunk] = chunk_logits
+
+    return jnp.asarray(logits)
+
+
+translate_rm_tokens = False # If True, map LM token ids straight to reward model input ids (in jnp) instead of decoding to text and retokenizing
+
+# Character classes used to decide whether the boundary between two adjacent LM tokens is also a boundary for the RM tokenizer
+CHAR_SPACE, CHAR_ALPHA, CHAR_DIGIT, CHAR_PUNCT, CHAR_APOSTROPHE = 0, 1, 2, 3, 4
+# Replacements done by transformers' clean_up_tokenization (applied by batch_decode on the whole string)
+CLEANUP_PATTERNS = (" .", " ?", " !", " ,", " ' ", " n't", " 'm", " 's", " 've", " 're")
+
+
+def char_class(c):
+    if c.isspace():
+        return CHAR_SPACE
+    if c.isalpha():
+        return CHAR_ALPHA
+    if c.isdigit():
+        return CHAR_DIGIT
+    if c == "'":
+        return CHAR_APOSTROPHE
+    return CHAR_PUNCT
+
+
+class RMTokenTranslator:
+    # Precomputed table from LM token ids (GPT2/TinyStories) to reward model input ids, so that the padded RM inputs
+    # can be built entirely in jnp (and therefore under jit) instead of going through batch_decode + tokenizer_RM on the host.
+    # Each LM token is encoded on its own by the RM tokenizer. Concatenating these pieces only reproduces what
+    # tokenizer_RM(tokenizer.batch_decode(seq)) would give if every boundary between adjacent LM tokens is also a
+    # boundary for the RM tokenizer's pretokenization, so we are conservative here: a boundary only counts as safe if the
+    # next token starts with a space, or if it goes between a word character (letter/digit) and punctuation (but not an
+    # apostrophe followed by a letter, since BPE RMs treat 's, 't etc. as one piece), or after a newline.
+    # Tokens we can't handle context free (partial utf-8 bytes, the start of a clean_up_tokenization pattern that could
+    # continue into the next token, odd whitespace)
+    # and special tokens other than trailing ones (e.g. EOS padding) are marked untranslatable.
+    # Sequences that contain any untranslatable token or unsafe boundary are flagged as not exact; those go through the text path.
+    def __init__(self, tokenizer, tokenizer_RM, max_pieces_per_token=8, max_length=512):
+        special_with_empty = tokenizer_RM.build_inputs_with_special_tokens([])
+        assert len(special_with_empty) == 2 # e.g. [CLS] ... [SEP] or <s> ... </s>
+        self.prefix_id, self.suffix_id = special_with_empty
+        self.pad_id = tokenizer_RM.pad_token_id
+        self.max_length = max_length
+
+        vocab_size = len(tokenizer)
+        self.vocab_size = vocab_size
+        all_ids = [[i] for i in range(vocab_size)]
+        raw_texts = tokenizer.batch_decode(all_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+        # Cleanup patterns all start with a space, and tokens only ever have a leading space, so (apart from the
+        # patterns that span several tokens, excluded below) cleaning up each token on its own matches cleaning up in context
+        texts = tokenizer.batch_decode(all_ids, skip_special_tokens=True)
+        cleanup = (texts != raw_texts)
+        rm_pieces = tokenizer_RM(texts, add_special_tokens=False, return_token_type_ids=False, return_attention_mask=False)["input_ids"]
+
+        special_ids = set(tokenizer.all_special_ids)
+        max_pieces = max([len(p) for p in rm_pieces if len(p) <= max_pieces_per_token] + [1])
+
+        pieces = np.full((vocab_size, max_pieces), self.pad_id, dtype=np.int32)
+        n_pieces = np.zeros((vocab_size,), dtype=np.int32)
+        translatable = np.zeros((vocab_size,), dtype=bool)
+        is_special = np.zeros((vocab_size,), dtype=bool)
+        first_class = np.full((vocab_size,), CHAR_PUNCT, dtype=np.int32)
+        last_class = np.full((vocab_size,), CHAR_PUNCT, dtype=np.int32)
+
+        for i in range(vocab_size):
+            if i in special_ids:
+                is_special[i] = True
+                continue
+            text, raw_text = texts[i], raw_texts[i]
+            if text == "" or "\ufffd" in text:
+                continue
+            if cleanup and any(pattern.startswith(raw_text) and len(pattern) > len(raw_text) for pattern in CLEANUP_PATTERNS):
+                continue
+            is_newlines = (text.strip("\n") == "")
+            if len(rm_pieces[i]) > max_pieces or (len(rm_pieces[i]) == 0 and not is_newlines):
+                continue
+            has_single_leading_space = (text[0] == " " and len(text) > 1 and not text[1:].isspace())
+            inner = text[1:] if has_single_leading_space else text
+            if not is_newlines and any(c.isspace() for c in inner):
+                continue
+            pieces[i, :len(rm_pieces[i])] = rm_pieces[i]
+            n_pieces[i] = len(rm_pieces[i])
+            translatable[i] = True
+            first_class[i] = char_class(text[0])
+            last_class[i] = char_class(text[-1])
+
+        # Kept as numpy (the translator may first get built while tracing) and become constants when indexed by jnp arrays
+        self.pieces = pieces
+        self.n_pieces = n_pieces
+        self.translatable = translatable
+        self.is_special = is_special
+        self.first_class = first_class
+        self.last_class = last_class
+
+    def safe_boundaries(self, last_class_left, first_class_right):
+        left_word = (last_class_left == CHAR_ALPHA) | (last_class_left == CHAR_DIGIT)
+        right_word = (first_class_right == CHAR_ALPHA) | (first_class_right == CHAR_DIGIT)
+        left_punct = (last_class_left == CHAR_PUNCT) | (last_class_left == CHAR_APOSTROPHE)
+        right_punct = (first_class_right == CHAR_PUNCT) | (first_class_right == CHAR_APOSTROPHE)
+        starts_new_word = (first_class_right == CHAR_SPACE) & (last_class_left != CHAR_SPACE)
+        after_newline = (last_class_left == CHAR_SPACE) & (first_class_right != CHAR_SPACE)
+        apostrophe_letter = (last_class_left == CHAR_APOSTROPHE) & (first_class_right == CHAR_ALPHA)
+        return starts_new_word | after_newline | (left_word & right_punct) | (left_punct & right_word & ~apostrophe_letter)
+
+    def __call__(self, seq):
+        # seq: (batch, seq_len) LM token ids
+        # Returns RM input_ids and attention_mask of shape (batch, rm_len) and a (batch,) bool of which rows are exact
+        batch_size, seq_len = seq.shape
+        rm_len = min(seq_len * self.pieces.shape[-1] + 2, self.max_length)
+
+        in_vocab = (seq >= 0) & (seq < self.vocab_size)
+        seq = jnp.where(in_vocab, seq, 0)
+        is_special = jnp.asarray(self.is_special)[seq]
+        # Special tokens (e.g. EOS padding) are dropped by batch_decode; only allow them at the end, where dropping them can't join two words
+        trailing_special = jnp.flip(jnp.cumprod(jnp.flip(is_special, axis=-1), axis=-1), axis=-1).astype(bool)
+        n_pieces = jnp.where(is_special, 0, jnp.asarray(self.n_pieces)[seq])
+
+        token_ok = in_vocab & (jnp.asarray(self.translatable)[seq] | trailing_special)
+        boundary_ok = self.safe_boundaries(jnp.asarray(self.last_class)[seq[:, :-1]], jnp.asarray(self.first_class)[seq[:, 1:]]) | trailing_special[:, 1:]
+        total_len = n_pieces.sum(axis=-1)
+        exact = token_ok.all(axis=-1) & boundary_ok.all(axis=-1) & (total_len + 2 <= self.max_length)
+
+        # Scatter the pieces of each token into place after the prefix special token; out of range positions get dropped
+        start = jnp.cumsum(n_pieces, axis=-1) - n_pieces + 1
+        piece_positions = start[:, :, None] + jnp.arange(self.pieces.shape[-1])[None, None, :]
+        piece_positions = jnp.where(jnp.arange(self.pieces.shape[-1])[None, None, :] < n_pieces[:, :, None], piece_positions, rm_len)
+        batch_index = jnp.broadcast_to(jnp.arange(batch_size)[:, None, None], piece_positions.shape)
+
+        input_ids = jnp.full((batch_size, rm_len), self.pad_id, dtype=jnp.int32)
+        input_ids = input_ids.at[batch_index, piece_positions].set(jnp.asarray(self.pieces)[seq], mode="drop")
+        input_ids = input_ids.at[:, 0].set(self.prefix_id)
+        input_ids = input_ids.at[jnp.arange(batch_size), total_len + 1].set(self.suffix_id, mode="drop")
+        attention_mask = (jnp.arange(rm_len)[None, :] < (total_len + 2)[:, None]).astype(jnp.int32)
+
+        return input_ids, attention_mask, exact
+
+
+rm_token_translators = {} # (id(tokenizer), id(tokenizer_RM)) -> RMTokenTranslator
+rm_token_translators_lock = threading.Lock()
+
+
+def get_rm_token_translator(tokenizer_RM, tokenizer):
+    key = (id(tokenizer), id(tokenizer_RM))
+    with rm_token_translators_lock:
+        if key not in rm_token_translators:
+            rm_token_translators[key] = RMTokenTranslator(tokenizer, tokenizer_RM)
+        return rm_token_translators[key]
+
+
+def get_rm_logits_translated(seq, rewardModel, tokenizer_RM, tokenizer):
+    # Jittable: rows that translate exactly are scored from the jnp-built RM inputs; any others fall back to the
+    # text path through a host callback (which is skipped entirely when every row is exact, outside of vmap)
+    translator = get_rm_token_translator(tokenizer_RM, tokenizer)
+    input_ids, attention_mask, exact = translator(seq)
+    logits = call_rm(rewardModel, input_ids, attention_mask)
+
+    def text_fallback(seq, exact):
+        # Under vmap this gets extra leading batch dims (vectorized=True), so flatten those first
+        batch_shape = exact.shape
+        seq = np.broadcast_to(np.asarray(seq), batch_shape + seq.shape[-1:]).reshape(-1, seq.shape[-1])
+        exact = np.asarray(exact).reshape(-1)
+        fallback_logits = np.zeros((exact.shape[0], logits.shape[-1]), dtype=logits.dtype)
+        if not exact.all():
+            fallback_logits[~exact] = np.asarray(get_rm_logits_from_text(seq[~exact], rewardModel, tokenizer_RM, tokenizer))
+        return fallback_logits.reshape(batch_shape + (logits.shape[-1],))
+
+    fallback_logits = jax.lax.cond(
+        exact.all(), lambda: jnp.zeros_like(logits),
+        lambda: jax.pure_callback(text_fallback, jax.ShapeDtypeStruct(logits.shape, logits.dtype), seq, exact, vectorized=True)
+    )
+    return jnp.where(exact[:, None], logits, fallback_logits)
+
+
+def get_rm_logits_uncached(seq, rewardModel, tokenizer_RM, tokenizer):
+    if translate_rm_tokens:
+        return get_rm_logits_translated(seq, rewardModel, tokenizer_RM, tokenizer)
+    return get_rm_logits_from_text(seq, rewardModel, tokenizer_RM, tokenizer)
+
+
+def get_rm_logits(seq, rewardModel, tokenizer_RM, tokenizer):
+    # Raw reward model / classifier output (batch, n_classes) for a batch of LM token sequences.
+    # Deduplicates the batch (np.unique), then looks up the unique rows in the LRU cache, and only decodes and scores the misses, in one RM batch.
+    # Tracers (e.g. under jit, only possible with translate_rm_tokens) can't be hashed so they bypass the cache.
+    if rm_score_cache_size <= 0 or isinstance(seq, jax.core.Tracer):
+        return get_rm_logits_uncached(seq, rewardModel, tokenizer_RM, tokenizer)
+
+    cache = get_rm_score_cache(rewardModel)
+    seq_np = np.asarray(seq)
+    unique_seqs, inverse = np.unique(seq_np, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    keys = cache.hash_rows(unique_seqs)
+    found, found_outputs = cache.lookup(keys)
+
+    n_misses = int((~found).sum())
+    # A miss is a sequence that actually goes through the reward model; duplicates within the batch count as hits
+    cache.record(seq_np.shape[0] - n_misses, n_misses)
+
+    if n_misses == 0:
+        return jnp.asarray(found_outputs[inverse])
+    miss_outputs = np.asarray(get_rm_logits_uncached(unique_seqs[~found], rewardModel, tokenizer_RM, tokenizer))
+    cache.insert(keys[:, ~found], miss_outputs)
+    unique_outputs = np.empty((unique_seqs.shape[0],) + miss_outputs.shape[1:], dtype=miss_outputs.dtype)
+    unique_outputs[~found] = miss_outputs
+    if found_outputs is not None:
+        unique_outputs[found] = found_outputs
+    return jnp.asarray(unique_outputs[inverse])
+
+
 # @partial(jax.jit, static_argnames=["toxicityModel"])
 def get_toxicity_score(tokens, rewardModel):
     score = rewardModel(**tokens)[0]
@@ -167,16 +562,7 @@ def reward_model_toxicity(seq, rewardModel, tokenizer_RM, tokenizer):
         raise NotImplementedError
 
     seq = jax.lax.stop_gradient(seq)
-    text_outputs = tokenizer.batch_decode(seq, skip_special_tokens=True)
-    tokens = tokenizer_RM(text_outputs,
-                          truncation=True,
-                          padding=True,
-                          max_length=512,
-                          return_token_type_ids=False,
-                          return_tensors="np",
-                          return_attention_mask=True)
-
-    score = get_toxicity_score(tokens, rewardModel)
+    score = get_rm_logits(seq, rewardModel, tokenizer_RM, tokenizer).squeeze(-1)
 
     return score
 
@@ -264,20 +650,17 @@ def curried_log_sentclass_cond(rewardModel, tokenizer_RM, tokenizer, beta_temp):
 
 def stochastic_classify(rng_key, seq, classifier, tokenizer_RM, tokenizer, singledimlogit=False):
     rng_key, subkey = jax.random.split(rng_key)
-    text_outputs = tokenizer.batch_decode(seq, skip_special_tokens=True)
-    tokens = tokenizer_RM(
-        text_outputs, truncation=True, padding=True, max_length=512,
-        return_token_type_ids=False, return_tensors="np", return_attention_mask=True
-    )
+    # Only the classifier output is memoized; the class is still drawn fresh every call
+    classifier_output = get_rm_logits(seq, classifier, tokenizer_RM, tokenizer)
 
     if singledimlogit:
-        score = get_toxicity_score(tokens, classifier)
+        score = classifier_output.squeeze(-1)
         nontoxic_class_prob = jax.nn.sigmoid(score)
         toxic_class_prob = 1 - nontoxic_class_prob
         classification_logits = jnp.log(jnp.concatenate((toxic_class_prob[:, None], nontoxic_class_prob[:, None]), axis=-1))
         # print(classification_logits.shape)
     else:
-        classification_logits = classifier(**tokens)[0]
+        classification_logits = classifier_output
 
     classes = jax.random.categorical(subkey, classification_logits, shape=(classification_logits.shape[0],))
 
@@ -294,6 +677,10 @@ def get_sentiment_score(tokens, rewardModel):
 
 def get_sentiment_class_prob(tokens, sentimentClassifier, class_num, varying_class_num=False):
     classification_logits = sentimentClassifier(**tokens)[0]
+    return get_sentiment_class_prob_from_logits(classification_logits, class_num, varying_class_num)
+
+
+def get_sentiment_class_prob_from_logits(classification_logits, class_num, varying_class_num=False):
     classification_probs = jax.nn.softmax(classification_logits, axis=-1)
     if varying_class_num:
         print("class prob")
@@ -313,36 +700,25 @@ def reward_model_sentiment_class_prob(seq, sentimentClassifier, tokenizer_RM, to
     if len(seq.shape) == 3:
         raise NotImplementedError
 
-    text_outputs = tokenizer.batch_decode(seq, skip_special_tokens=True)
-    tokens = tokenizer_RM(text_outputs,
-                          truncation=True,
-                          padding=True,
-                          max_length=512,
-                          return_token_type_ids=False,
-                          return_tensors="np",
-                          return_attention_mask=True)
-
-    class_prob = get_sentiment_class_prob(tokens, sentimentClassifier, class_num, varying_class_num)
+    classification_logits = get_rm_logits(seq, sentimentClassifier, tokenizer_RM, tokenizer)
+    class_prob = get_sentiment_class_prob_from_logits(classification_logits, class_num, varying_class_num)
 
     return class_prob
 
 
 
-def reward_model_sentiment_threshold(seq, rewardModel, tokenizer_RM, tokenizer, threshold, pos_threshold):
+def reward_model_sentiment_score(seq, rewardModel, tokenizer_RM, tokenizer):
     if len(seq.shape) == 3:
         raise NotImplementedError
 
     seq = jax.lax.stop_gradient(seq)
-    text_outputs = tokenizer.batch_decode(seq, skip_special_tokens=True)
-    tokens = tokenizer_RM(text_outputs,
-                          truncation=True,
-                          padding=True,
-                          max_length=512,
-                          return_token_type_ids=False,
-                          return_tensors="np",
-                          return_attention_mask=True)
+    classification_logits = get_rm_logits(seq, rewardModel, tokenizer_RM, tokenizer)
+    score = classification_logits[:, 1] - classification_logits[:, 0] # same as get_sentiment_score
+    return score
+
 
-    score = get_sentiment_score(tokens, rewardModel)
+def reward_model_sentiment_threshold(seq, rewardModel, tokenizer_RM, tokenizer, threshold, pos_threshold):
+    score = reward_model_sentiment_score(seq, rewardModel, tokenizer_RM, tokenizer)
 
     if pos_threshold:
         return (score > threshold)
@@ -360,6 +736,279 @@ def curried_log_sentiment_threshold(rewardModel, tokenizer_RM, tokenizer, thresh
 
 
 
+# Accept/reject steps for getting exact posterior samples out of a batch of base model samples p_samples.
+# All of these take and return an rng_key (like stochastic_classify) so the build_*_twists functions keep the same random stream
+def accept_toxicity_threshold(rng_key, p_samples, rewardModel, tokenizer_RM, tokenizer, threshold, pos_threshold):
+    return rng_key, p_samples[reward_model_toxicity_threshold(p_samples, rewardModel, tokenizer_RM, tokenizer, threshold, pos_threshold)]
+
+
+def accept_sentiment_threshold(rng_key, p_samples, rewardModel, tokenizer_RM, tokenizer, threshold, pos_threshold):
+    return rng_key, p_samples[reward_model_sentiment_threshold(p_samples, rewardModel, tokenizer_RM, tokenizer, threshold, pos_threshold)]
+
+
+def accept_stochastic_class(rng_key, p_samples, classifier, tokenizer_RM, tokenizer, class_num, singledimlogit=False):
+    # Draw c ~ p(c|s) for each sample and keep the ones with c = class_num; these are then exact samples from p(s|c)
+    rng_key, classes = stochastic_classify(rng_key, p_samples, classifier, tokenizer_RM, tokenizer, singledimlogit=singledimlogit)
+    return rng_key, p_samples[classes == class_num]
+
+
+def accept_p_of_continuation(rng_key, p_samples, prompt_len, output_len, indices_of_continuation):
+    # p_samples go output_len + len(continuation) past the prompt; keep (without the continuation) the ones that end in the continuation
+    check_satisfies_posterior = (batch_check_array_contained_in_other_array(p_samples[:, prompt_len + output_len:], indices_of_continuation) == 1)
+    return rng_key, p_samples[check_satisfies_posterior][:, :prompt_len + output_len]
+
+
+@jax.jit
+def get_probe_features_from_output_embeddings(output_embeddings):
+    # Base LM final hidden states at the output positions (batch, output_len, d_model), averaged over the output tokens, and at the last token
+    return jnp.concatenate((output_embeddings.mean(axis=1), output_embeddings[:, -1, :]), axis=-1)
+
+
+@partial(jax.jit, static_argnames=["huggingface_model", "prompt_len"])
+def get_probe_features(params_p, seq, prompt_len, huggingface_model=None):
+    # get_probe_features_from_output_embeddings from a forward pass over seq. When the samples are drawn here, use
+    # stochastic_transformer_sample with return_output_embeddings instead, which gets them from the sampling pass
+    embeddings = get_transformer_p_embeddings(params_p, seq, huggingface_model=huggingface_model)
+    return get_probe_features_from_output_embeddings(embeddings[:, prompt_len:, :])
+
+
+class ThresholdScreen:
+    # Cheap first stage of a cascade for the threshold reward models: a linear probe on the base LM's own hidden states that
+    # predicts the RM score, with a cutoff set so that (almost) no sample that would pass the threshold gets screened out.
+    # The cutoff is calibrated on the predicted scores of the held out samples that actually pass the threshold (see fit_threshold_screen);
+    # the residuals over all samples would not do, since ridge shrinkage under-predicts exactly the rare high scoring samples we care about.
+    # Only samples passing the screen get scored exactly, and the exact check still decides acceptance, so accepted samples are
+    # exact posterior samples as long as the screen has no false negatives. Since that can't be guaranteed (the calibration only
+    # bounds the false negative rate), the accepted samples are only approximate posterior samples: the posterior restricted to
+    # what passes the screen. So the screen is opt-in, and its samples are stored apart from exact ones (see get_rm_screen_store_setting).
+    # A random audit_rate fraction of the screened out samples is also scored exactly and any false negatives found are reported.
+    # The cutoff stays fixed for the whole run: moving it based on what was accepted so far would make the acceptance
+    # depend on the earlier samples.
+    def __init__(self, weights, feature_mean, feature_sd, cutoff, threshold, pos_threshold, audit_rate):
+        self.weights = weights
+        self.feature_mean = feature_mean
+        self.feature_sd = feature_sd
+        self.cutoff = cutoff
+        self.threshold = threshold
+        self.pos_threshold = pos_threshold
+        self.audit_rate = audit_rate
+        self.n_screened = 0
+        self.n_passed_screen = 0
+        self.n_audited = 0
+        self.n_false_negatives = 0
+        self.lock = threading.Lock()
+
+    def predict(self, features):
+        features = (np.asarray(features) - self.feature_mean) / self.feature_sd
+        return features @ self.weights[:-1] + self.weights[-1]
+
+    def passes(self, predicted_scores):
+        with self.lock:
+            if self.pos_threshold:
+                return predicted_scores >= self.cutoff
+            return predicted_scores <= self.cutoff
+
+    def record(self, n_screened, n_passed_screen, n_audited, false_negative_predictions):
+        with self.lock:
+            self.n_screened += n_screened
+            self.n_passed_screen += n_passed_screen
+            self.n_audited += n_audited
+            self.n_false_negatives += false_negative_predictions.shape[0]
+            if false_negative_predictions.shape[0] > 0:
+                print(f"WARNING: screen false negative found in audit ({self.n_false_negatives} of {self.n_audited} audited so far, "
+                      f"predicted scores {false_negative_predictions.tolist()} vs cutoff {self.cutoff})", flush=True)
+
+    def stats(self):
+        return {"screened": self.n_screened, "pass_rate": self.n_passed_screen / max(self.n_screened, 1),
+                "audited": self.n_audited, "false_negatives": self.n_false_negatives,
+                "audited_fn_rate": self.n_false_negatives / max(self.n_audited, 1), "cutoff": self.cutoff}
+
+
+def fit_threshold_screen(
+    rng_key, params_p, huggingface_model, jnp_prompt, output_len, n_samples_at_a_time, n_calibration_samples,
+    rm_score_fn, threshold, pos_threshold, fn_target=1e-2, audit_rate=0.02, l2_reg=1., min_positives=100, margin_sds=0.25
+):
+    # Score n_calibration_samples base model samples exactly with rm_score_fn, then fit and calibrate the screen on them
+    # (see calibrate_threshold_screen; returns None instead of a screen when there are too few positives to calibrate on)
+    prompt_len = jnp_prompt.shape[-1]
+    features, scores = [], []
+    n_collected = 0
+    while n_collected < n_calibration_samples:
+        rng_key, sk = jax.random.split(rng_key)
+        p_samples, output_embeddings = stochastic_transformer_sample(sk, params_p, jnp_prompt, output_len, n_samples_at_a_time,
+                                                                     huggingface_model=huggingface_model, return_output_embeddings=True)
+        features.append(np.asarray(get_probe_features_from_output_embeddings(output_embeddings)))
+        scores.append(np.asarray(rm_score_fn(p_samples)))
+        n_collected += p_samples.shape[0]
+    features = np.concatenate(features)[:n_calibration_samples]
+    scores = np.concatenate(scores)[:n_calibration_samples]
+    return rng_key, calibrate_threshold_screen(features, scores, threshold, pos_threshold, fn_target=fn_target, audit_rate=audit_rate,
+                                               l2_reg=l2_reg, min_positives=min_positives, margin_sds=margin_sds)
+
+
+def calibrate_threshold_screen(features, scores, threshold, pos_threshold, fn_target=1e-2, audit_rate=0.02, l2_reg=1., min_positives=100, margin_sds=0.25):
+    # Fit a ridge regression probe on the first half of (features, exact scores), and set the ThresholdScreen cutoff from the
+    # predicted scores of the positives (samples passing the threshold) in the other half. The cutoff is the k-th lowest of those
+    # predictions with k = floor(fn_target * (n_positives + 1)) (the k-th highest for the negative threshold), which keeps the false
+    # negative rate on new positives at most fn_target (split conformal), moved a further margin_sds held out residual sds towards
+    # letting more through. With fewer than min_positives held out positives, or too few for k >= 1 (the bound would then be
+    # 1 / (n_positives + 1), not fn_target), the calibration can't be trusted and this returns None, i.e. no screen
+    n_fit = features.shape[0] // 2
+    feature_mean = features[:n_fit].mean(axis=0)
+    feature_sd = features[:n_fit].std(axis=0) + 1e-6
+    x_fit = np.concatenate(((features[:n_fit] - feature_mean) / feature_sd, np.ones((n_fit, 1))), axis=-1)
+    reg = l2_reg * np.eye(x_fit.shape[-1])
+    reg[-1, -1] = 0. # don't shrink the bias
+    weights = np.linalg.solve(x_fit.T @ x_fit + reg, x_fit.T @ scores[:n_fit])
+
+    screen = ThresholdScreen(weights, feature_mean, feature_sd, None, threshold, pos_threshold, audit_rate)
+    predicted_scores = screen.predict(features[n_fit:])
+    residual_sd = (predicted_scores - scores[n_fit:]).std()
+    is_positive = (scores[n_fit:] > threshold) if pos_threshold else (scores[n_fit:] < threshold)
+    n_positives = int(is_positive.sum())
+    k = int(np.floor(fn_target * (n_positives + 1)))
+    if n_positives < min_positives or k == 0:
+        print(f"Screen disabled: {n_positives} of {is_positive.shape[0]} held out calibration samples pass the threshold, "
+              f"need at least {max(min_positives, int(np.ceil(1. / fn_target)) - 1)} for fn_target {fn_target}", flush=True)
+        return None
+    if pos_threshold:
+        screen.cutoff = float(np.sort(predicted_scores[is_positive])[k - 1]) - margin_sds * residual_sd
+    else:
+        screen.cutoff = float(np.sort(predicted_scores[is_positive])[::-1][k - 1]) + margin_sds * residual_sd
+    print(f"Screen calibration: {n_positives} held out positives, residual sd {residual_sd:.4f}, cutoff {screen.cutoff:.4f} for threshold {threshold}; "
+          f"held out pass rate {screen.passes(predicted_scores).mean():.4f}", flush=True)
+    return screen
+
+
+def accept_threshold_cascaded(rng_key, p_samples, screen, params_p, huggingface_model, prompt_len, rm_score_fn, threshold, pos_threshold, probe_features=None):
+    # Like accept_toxicity_threshold / accept_sentiment_threshold, but only samples that pass the screen (plus audits) are scored exactly
+    # probe_features (get_probe_features_from_output_embeddings from the sampling pass) saves the forward pass of get_probe_features
+    rng_key, sk = jax.random.split(rng_key)
+    if probe_features is None:
+        probe_features = get_probe_features(params_p, p_samples, prompt_len, huggingface_model=huggingface_model)
+    predicted_scores = screen.predict(probe_features)
+    passed_screen = screen.passes(predicted_scores)
+    audit = ~passed_screen & (np.asarray(jax.random.uniform(sk, passed_screen.shape)) < screen.audit_rate)
+    to_score = passed_screen | audit
+
+    p_samples_np = np.asarray(p_samples)
+    if to_score.any():
+        scores = np.asarray(rm_score_fn(p_samples_np[to_score]))
+        passed_exact = (scores > threshold) if pos_threshold else (scores < threshold)
+    else:
+        passed_exact = np.zeros((0,), dtype=bool)
+
+    was_audit = audit[to_score]
+    screen.record(p_samples_np.shape[0], int(passed_screen.sum()), int(audit.sum()),
+                  predicted_scores[to_score][was_audit & passed_exact])
+    accepted = p_samples_np[to_score][passed_exact & ~was_audit]
+    return rng_key, jnp.asarray(accepted)
+
+
+def accept_all(rng_key, p_samples):
+    # For settings where every base model sample is a posterior sample (e.g. infilling, where we condition on what was sampled)
+    return rng_key, p_samples
+
+
+class GrowableSampleBuffer:
+    # Host buffer for accepted samples, preallocated for the number of samples we want and doubled when it runs out
+    # (rather than a jnp.concatenate, i.e. a new device array, for every batch)
+    def __init__(self, capacity):
+        self.capacity = max(capacity, 1)
+        self.data = None
+        self.size = 0
+
+    def append(self, samples):
+        samples = np.asarray(samples)
+        if self.data is None:
+            self.data = np.empty((self.capacity,) + samples.shape[1:], dtype=samples.dtype)
+        new_size = self.size + samples.shape[0]
+        if new_size > self.data.shape[0]:
+            new_data = np.empty((max(new_size, 2 * self.data.shape[0]),) + self.data.shape[1:], dtype=self.data.dtype)
+            new_data[:self.size] = self.data[:self.size]
+            self.data = new_data
+        self.data[self.size:new_size] = samples
+        self.size = new_size
+
+    def get(self, max_samples=None):
+        n = self.size if max_samples is None else min(self.size, max_samples)
+        return jnp.asarray(self.data[:n])
+
+
+def collect_true_posterior_samples_pipelined(
+    rng_key, jnp_prompts, params_p, n_tokens_to_sample, n_samples_at_a_time, huggingface_model,
+    accept_fns, n_samples_needed, n_scoring_threads=2, initial_samples=None, on_accepted=None
+):
+    # Rejection sampling for exact posterior samples, with sampling from the base model on the device overlapped with the
+    # reward model accept/reject step on the host. stochastic_transformer_sample only dispatches the work and returns,
+    # so we keep queueing batches (up to n_scoring_threads + 1 per prompt) while a thread pool scores the earlier ones.
+    # Results are consumed in the order the batches were queued, so the result for a given rng_key is deterministic.
+    # accept_fns[i] is one of the accept_* functions above (for prompt i) with everything but (rng_key, p_samples) filled in.
+    # initial_samples[i] (e.g. from a previous, interrupted run) count towards n_samples_needed, and on_accepted(i, accepted)
+    # is called with every new batch of accepted samples, e.g. to write them out as they come in.
+    # accept_fns with accepts_probe_features set (accept_threshold_cascaded) get the probe features from the sampling pass.
+    n_prompts = len(jnp_prompts)
+    buffers = [GrowableSampleBuffer(n_samples_needed) for _ in range(n_prompts)]
+    if initial_samples is not None:
+        for i in range(n_prompts):
+            if initial_samples[i] is not None:
+                buffers[i].append(initial_samples[i])
+    n_initial = [buffer.size for buffer in buffers]
+    n_proposed = [0] * n_prompts
+    n_queued = [0] * n_prompts
+    max_batches_in_flight = n_scoring_threads + 1
+
+    def score_batch(accept_fn, rng_key, p_samples, **kwargs):
+        _, accepted = accept_fn(rng_key, p_samples, **kwargs)
+        return np.asarray(accepted)
+
+    start = time.time()
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=n_scoring_threads) as pool:
+        while True:
+            for i in range(n_prompts):
+                while buffers[i].size < n_samples_needed and n_queued[i] < max_batches_in_flight:
+                    rng_key, sk_sample, sk_accept = jax.random.split(rng_key, 3)
+                    accept_kwargs = {}
+                    if getattr(accept_fns[i], "accepts_probe_features", False):
+                        p_samples, output_embeddings = stochastic_transformer_sample(
+                            sk_sample, params_p, jnp_prompts[i], n_tokens_to_sample,
+                            n_samples_at_a_time, huggingface_model=huggingface_model, return_output_embeddings=True
+                        )
+                        accept_kwargs["probe_features"] = get_probe_features_from_output_embeddings(output_embeddings)
+                    else:
+                        p_samples = stochastic_transformer_sample(
+                            sk_sample, params_p, jnp_prompts[i], n_tokens_to_sample,
+                            n_samples_at_a_time, huggingface_model=huggingface_model
+                        )
+                    in_flight.append((i, pool.submit(score_batch, accept_fns[i], sk_accept, p_samples, **accept_kwargs)))
+                    n_queued[i] += 1
+
+            if all(buffer.size >= n_samples_needed for buffer in buffers):
+                for _, future in in_flight:
+                    future.cancel()
+                break
+
+            i, future = in_flight.popleft()
+            accepted = future.result()
+            n_queued[i] -= 1
+            n_proposed[i] += n_samples_at_a_time
+            if accepted.shape[0] > 0:
+                buffers[i].append(accepted)
+                if on_accepted is not None:
+                    on_accepted(i, accepted)
+
+            elapsed = time.time() - start
+            print(f"Prompt {i}: {buffers[i].size}/{n_samples_needed} posterior samples; "
+                  f"acceptance rate {(buffers[i].size - n_initial[i]) / n_proposed[i]:.5f}; "
+                  f"{n_proposed[i] / elapsed:.1f} proposed/s, {(buffers[i].size - n_initial[i]) / elapsed:.3f} accepted/s; "
+                  f"TIME: {elapsed:.1f}", flush=True)
+
+    print_rm_score_cache_stats()
+
+    return rng_key, [buffer.get(n_samples_needed) for buffer in buffers]
+
+
 def build_rew_p_of_continuation_twists(jnp_prompts, params_p, indices_of_continuation, beta_temp, huggingface_model=None, divide_by_p=False):
     # This here is a reward model in the framework phi = e^(beta r) where r = probability of continuation | prompt, s_{1:T} (r = p(continuation | s_{1:T}, prompt))
     # No posterior samples here
@@ -400,17 +1049,15 @@ def build_exp_beta_twists(
                 # Classify the p samples, then draw categorical according to the p(c|s). This then gives you a sample from the joint p(c,s) = p(s|c)p(c). Suppose we want samples from p(s|c=4) = p(s,c=4)/p(c=4) propto p(s,c=4) = p(c=4|s)p(s) which is exactly how we drew these samples - for each class, we drew base samples s, and then proportionally according to p(c|s) drew the class c.
                 # But you have to reject all the ones outside of the class you want, in the current formulation...
                 # Anyway, just set up the check satisfies posterior here, which is now done stochastically...
-                rng_key, classes = stochastic_classify(rng_key, p_samples, rewardModel, tokenizer_RM, tokenizer, singledimlogit=singledimlogit)
-
-                check_satisfies_posterior = (classes == class_num_zero_index)
-
-                posterior_samples = p_samples[check_satisfies_posterior]
+                rng_key, posterior_samples = accept_stochastic_class(rng_key, p_samples, rewardModel, tokenizer_RM, tokenizer, class_num_zero_index, singledimlogit=singledimlogit)
 
                 num_posterior_samples = \
                 posterior_samples.shape[0]
                 print("NUM samples", flush=True)
                 print(num_posterior_samples)
 
+            print_rm_score_cache_stats()
+
             print(posterior_samples)
             print(posterior_samples.shape)
             print(log_true_final_twist(posterior_samples))
@@ -511,9 +1158,7 @@ def build_p_of_continuation_twists(rng_key, jnp_prompts, params_p, indices_of_co
                                                           n_samples_at_a_time,
                                                           huggingface_model=huggingface_model)
 
-                check_satisfies_posterior = (batch_check_array_contained_in_other_array(p_samples[:, prompt_len + output_len:], indices_of_continuation) == 1)
-
-                posterior_samples = p_samples[check_satisfies_posterior][:, :prompt_len + output_len]
+                _, posterior_samples = accept_p_of_continuation(None, p_samples, prompt_len, output_len, indices_of_continuation)
 
                 num_posterior_samples = \
                 posterior_samples.shape[0]
@@ -617,13 +1262,15 @@ def build_toxicity_threshold_twists(rng_key, jnp_prompts, params_p, output_len,
                                                           output_len, n_samples_at_a_time,
                                                           huggingface_model=huggingface_model)
 
-                posterior_samples_satisfying_threshold = p_samples[
-                    reward_model_toxicity_threshold(p_samples, rewardModel, tokenizer_RM, tokenizer, threshold, pos_threshold)]
+                _, posterior_samples_satisfying_threshold = accept_toxicity_threshold(
+                    None, p_samples, rewardModel, tokenizer_RM, tokenizer, threshold, pos_threshold)
 
                 num_samples_satisfying_threshold = posterior_samples_satisfying_threshold.shape[0]
                 print("NUM samples", flush=True)
                 print(num_samples_satisfying_threshold)
 
+            print_rm_score_cache_stats()
+
             print(posterior_samples_satisfying_threshold)
             print(posterior_samples_satisfying_threshold.shape)
             print(log_true_final_twist(posterior_samples_satisfying_threshold))
@@ -664,8 +1311,8 @@ def build_sentiment_threshold_twists(rng_key, jnp_prompts, params_p, output_len,
                                                           output_len, n_samples_at_a_time,
                                                           huggingface_model=huggingface_model)
 
-                posterior_samples_satisfying_threshold = p_samples[
-                    reward_model_sentiment_threshold(p_samples, rewardModel, tokenizer_RM, tokenizer, threshold, pos_threshold)]
+                _, posterior_samples_satisfying_threshold = accept_sentiment_threshold(
+                    None, p_samples, rewardModel, tokenizer_RM, tokenizer, threshold, pos_threshold)
 
 
 
@@ -673,6 +1320,8 @@ def build_sentiment_threshold_twists(rng_key, jnp_prompts, params_p, output_len,
                 print("NUM samples", flush=True)
                 print(num_samples_satisfying_threshold)
 
+            print_rm_score_cache_stats()
+
             print(posterior_samples_satisfying_threshold)
             print(posterior_samples_satisfying_threshold.shape)
             print(log_true_final_twist(posterior_samples_satisfying_threshold))
@@ -0,0 +1,53 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jax
+import jax.numpy as jnp
+import pytest
+from transformers import GPT2Config, FlaxGPT2LMHeadModel
+
+from huggingface_models_custom import CustomLMHeadModel, CustomLMWithTwistHead
+from utils import HashableDict
+
+
+# Small randomly initialised GPT2 so the tests run on CPU in seconds, without downloading anything
+@pytest.fixture(scope="session")
+def tiny_gpt2_dir(tmp_path_factory):
+    path = tmp_path_factory.mktemp("tiny_gpt2")
+    config = GPT2Config(vocab_size=50, n_embd=32, n_layer=2, n_head=2, n_positions=64)
+    FlaxGPT2LMHeadModel(config, seed=0).save_pretrained(path)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def shared_trunk_model(tiny_gpt2_dir):
+    # (huggingface_model, params_p, params_twist) as set up in setup_model_and_params without --separate_hface_twist_model
+    model = CustomLMWithTwistHead(jax.random.PRNGKey(0), tiny_gpt2_dir)
+    return model.__call__, model.huggingface_model.params, model.twist_head_params
+
+
+@pytest.fixture(scope="session")
+def separate_twist_model(tiny_gpt2_dir):
+    # Same as with --separate_hface_twist_model
+    model_p = CustomLMHeadModel(tiny_gpt2_dir)
+    model_twist = CustomLMWithTwistHead(jax.random.PRNGKey(1), tiny_gpt2_dir)
+    huggingface_model = HashableDict({'p': model_p.__call__, 'twist': model_twist.__call__, 'call_type': "custom"})
+    return huggingface_model, model_p.huggingface_model.params, [model_twist.huggingface_model.params, model_twist.twist_head_params]
+
+
+@pytest.fixture(scope="session")
+def p_psi_combined_model(separate_twist_model):
+    # Same as with --separate_hface_twist_model --output_p_psi: the twist model outputs log p + log psi
+    huggingface_model, params_p, params_twist = separate_twist_model
+    return HashableDict({**huggingface_model, 'call_type': "p_psi_combined"}), params_p, params_twist
+
+
+@pytest.fixture
+def prompt():
+    return jnp.array([3, 7, 11, 2], dtype=jnp.int32)
+
+
+def final_twist_last_token_mod_3(seq, condition_twist_on_tokens=None):
+    return -(seq[:, -1] % 3).astype(jnp.float32)
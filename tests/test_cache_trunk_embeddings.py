@@ -0,0 +1,71 @@
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+import pytest
+
+import losses
+from conftest import final_twist_last_token_mod_3
+
+
+def _one_total_kl_loss(params_twist, params_p, huggingface_model, prompt, mixed_p_q_sample):
+    return losses.get_l_one_total_kl(
+        jax.random.PRNGKey(4), prompt, params_p, params_twist, final_twist_last_token_mod_3, 5, 8, None, "jit",
+        huggingface_model=huggingface_model, mixed_p_q_sample=mixed_p_q_sample)
+
+
+def _ebm_loss(params_twist, params_p, huggingface_model, prompt, mixed_p_q_sample):
+    return losses.get_l_ebm_ml_partial_jit(
+        jax.random.PRNGKey(4), prompt, params_p, params_twist, final_twist_last_token_mod_3, 5, 8, None, "jit",
+        huggingface_model=huggingface_model, mixed_p_q_sample=mixed_p_q_sample, reweight_for_second_term=True)
+
+
+def _ebm_one_sample_loss(params_twist, params_p, huggingface_model, prompt, mixed_p_q_sample):
+    return losses.get_l_ebm_ml_partial_jit(
+        jax.random.PRNGKey(4), prompt, params_p, params_twist, final_twist_last_token_mod_3, 5, 8, None, "jit",
+        huggingface_model=huggingface_model, only_one_sample=True)
+
+
+LOSSES = {
+    "one_total_kl": partial(_one_total_kl_loss, mixed_p_q_sample=False),
+    "one_total_kl_mixed_p_q": partial(_one_total_kl_loss, mixed_p_q_sample=True),
+    "ebm_reweight_mixed_p_q": partial(_ebm_loss, mixed_p_q_sample=True),
+    "ebm_one_sample": partial(_ebm_one_sample_loss, mixed_p_q_sample=False),
+}
+
+
+@pytest.mark.parametrize("lean", [False, True])
+@pytest.mark.parametrize("loss_name", LOSSES)
+def test_cached_trunk_losses_match_uncached(monkeypatch, shared_trunk_model, prompt, loss_name, lean):
+    # The trunk embeddings are those the p/twist evaluations would compute themselves, so the losses and twist gradients agree
+    huggingface_model, params_p, params_twist = shared_trunk_model
+    monkeypatch.setattr(losses, "lean_twist_grad", lean)
+    results = []
+    for cache in [False, True]:
+        monkeypatch.setattr(losses, "cache_trunk_embeddings", cache)
+        results.append(jax.value_and_grad(LOSSES[loss_name])(params_twist, params_p, huggingface_model, prompt))
+    (loss_uncached, grads_uncached), (loss_cached, grads_cached) = results
+
+    assert jnp.allclose(loss_uncached, loss_cached, atol=1e-5)
+    for g_uncached, g_cached in zip(jax.tree_util.tree_leaves(grads_uncached), jax.tree_util.tree_leaves(grads_cached)):
+        assert jnp.allclose(g_uncached, g_cached, atol=1e-5)
+    assert any(jnp.abs(g).max() > 0 for g in jax.tree_util.tree_leaves(grads_cached))
+
+
+def test_mixed_p_q_weights_use_the_trunk_embeddings(monkeypatch, shared_trunk_model, prompt):
+    # The importance weights of the mixed p/q samples come from one trunk pass, which is returned for the loss to reuse
+    huggingface_model, params_p, params_twist = shared_trunk_model
+    monkeypatch.setattr(losses, "cache_trunk_embeddings", True)
+    outputs = losses.get_mixed_p_q_samples(
+        jax.random.PRNGKey(4), prompt, params_p, params_twist, final_twist_last_token_mod_3, 5, 8, None, "jit",
+        huggingface_model=huggingface_model, return_trunk_embeddings=True)
+    _, samples, normalized_w_t, *_, trunk_embeddings = outputs
+    assert trunk_embeddings.shape[:2] == samples.shape
+    assert (trunk_embeddings == losses.get_transformer_p_embeddings(params_p, samples, huggingface_model)).all()
+
+    monkeypatch.setattr(losses, "cache_trunk_embeddings", False)
+    uncached_outputs = losses.get_mixed_p_q_samples(
+        jax.random.PRNGKey(4), prompt, params_p, params_twist, final_twist_last_token_mod_3, 5, 8, None, "jit",
+        huggingface_model=huggingface_model, return_trunk_embeddings=True)
+    assert uncached_outputs[-1] is None
+    assert jnp.allclose(normalized_w_t, uncached_outputs[2], atol=1e-6)
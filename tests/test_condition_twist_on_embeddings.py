@@ -0,0 +1,59 @@
+import jax
+import jax.numpy as jnp
+import pytest
+
+import custom_transformer_prob_utils
+from custom_transformer_prob_utils import smc_procedure
+from huggingface_models_custom import CustomLMWithTwistHead
+from conftest import final_twist_last_token_mod_3
+
+
+def _conditional_twist_model(tiny_gpt2_dir):
+    # As setup_model_and_params with a "tokens" conditional twist (e.g. rm_type p_last_tokens), shared trunk
+    model = CustomLMWithTwistHead(jax.random.PRNGKey(0), tiny_gpt2_dir, hface_nn_twist=True, conditional_twist_type="tokens",
+                                  num_last_tokens_to_condition_on=3)
+    return model, model.__call__, model.huggingface_model.params, model.twist_head_params
+
+
+def test_precomputed_embeddings_give_the_same_outputs(tiny_gpt2_dir, prompt):
+    model, huggingface_model, params_p, params_twist = _conditional_twist_model(tiny_gpt2_dir)
+    seq = jax.random.randint(jax.random.PRNGKey(1), (5, 8), 1, 50)
+    condition_twist_on_tokens = jax.random.randint(jax.random.PRNGKey(2), (5, 3), 1, 50)
+    embeddings = model.get_condition_twist_on_embeddings(condition_twist_on_tokens)
+    assert embeddings.shape == (5, 32)
+    p_logits, log_psi = huggingface_model(input_ids=seq, params_twist_head=params_twist, condition_twist_on_tokens=condition_twist_on_tokens)
+    p_logits_precomputed, log_psi_precomputed = huggingface_model(
+        input_ids=seq, params_twist_head=params_twist, condition_twist_on_tokens=condition_twist_on_tokens,
+        condition_twist_on_embeddings=embeddings)
+    assert jnp.allclose(p_logits, p_logits_precomputed, atol=1e-5)
+    assert jnp.allclose(log_psi, log_psi_precomputed, atol=1e-5)
+
+
+@pytest.mark.parametrize("use_kv_cache", [False, True])
+def test_smc_runs_the_conditioning_pass_once(monkeypatch, tiny_gpt2_dir, prompt, use_kv_cache):
+    # The SMC with the embedding precomputed once gives the same samples and log Z as running the transformer over the
+    # conditioning tokens in every twist call. Each run gets its own model, so its own trace
+    condition_twist_on_tokens = jnp.broadcast_to(jnp.array([4, 9, 17]), (8, 3))
+    results = []
+    for precompute in [False, True]:
+        model, huggingface_model, params_p, params_twist = _conditional_twist_model(tiny_gpt2_dir)
+        n_conditioning_passes = []
+        get_embeddings = model.get_condition_twist_on_embeddings
+        monkeypatch.setattr(model, "get_condition_twist_on_embeddings",
+                            lambda *args, **kwargs: n_conditioning_passes.append(1) or get_embeddings(*args, **kwargs))
+        if not precompute:
+            monkeypatch.setattr(custom_transformer_prob_utils, "get_condition_twist_on_embeddings", lambda *args: None)
+        (log_w_t, log_z_hat_t, _), samples = smc_procedure(
+            jax.random.PRNGKey(3), prompt, params_p, params_twist, final_twist_last_token_mod_3, 5, 8,
+            condition_twist_on_tokens=condition_twist_on_tokens, huggingface_model=huggingface_model,
+            use_kv_cache=use_kv_cache, resampling_scheme="multinomial", resample_criterion="every_step")
+        monkeypatch.undo()
+        results.append((log_w_t, log_z_hat_t, samples, len(n_conditioning_passes)))
+
+    (log_w_t, log_z_hat_t, samples, n_passes), (log_w_t_pre, log_z_hat_t_pre, samples_pre, n_passes_pre) = results
+    assert (samples == samples_pre).all()
+    assert jnp.allclose(log_w_t, log_w_t_pre, atol=1e-4)
+    assert jnp.allclose(log_z_hat_t, log_z_hat_t_pre, atol=1e-4)
+    # Counted while tracing: one pass per SMC run, instead of one per twist call
+    assert n_passes_pre == 1
+    assert n_passes > 1
@@ -0,0 +1,33 @@
+import jax
+import jax.numpy as jnp
+import pytest
+
+from custom_transformer_prob_utils import smc_procedure, stochastic_transformer_sample, conditional_resample_indices
+from conftest import final_twist_last_token_mod_3
+
+
+@pytest.mark.parametrize("resampling_scheme", ["categorical", "multinomial", "stratified", "systematic", "residual"])
+@pytest.mark.parametrize("smc_procedure_type", ["jit", "debug"])
+def test_conditional_smc_keeps_true_posterior_sample(shared_trunk_model, prompt, resampling_scheme, smc_procedure_type):
+    huggingface_model, params_p, params_twist = shared_trunk_model
+    output_len = 6
+    true_posterior_sample = stochastic_transformer_sample(
+        jax.random.PRNGKey(5), params_p, prompt, output_len, 1, huggingface_model=huggingface_model)[0]
+
+    (log_w_t, log_z_hat_t, _), samples = smc_procedure(
+        jax.random.PRNGKey(3), prompt, params_p, params_twist, final_twist_last_token_mod_3, output_len, 16,
+        smc_procedure_type=smc_procedure_type, huggingface_model=huggingface_model, resample=True,
+        true_posterior_sample=true_posterior_sample, resampling_scheme=resampling_scheme, resample_criterion="every_step")
+
+    assert (samples[0] == true_posterior_sample).all()
+    assert jnp.isfinite(log_z_hat_t)
+
+
+@pytest.mark.parametrize("resampling_scheme", ["stratified", "systematic", "residual"])
+def test_conditional_resampling_is_multinomial(resampling_scheme):
+    # The free ancestors must be independent draws, so the low variance schemes fall back to multinomial
+    log_w = jnp.log(jnp.array([0.5, 0.2, 0.2, 0.1]))
+    key = jax.random.PRNGKey(0)
+    assert (conditional_resample_indices(key, log_w, resampling_scheme)
+            == conditional_resample_indices(key, log_w, "multinomial")).all()
+    assert conditional_resample_indices(key, log_w, resampling_scheme).shape == (3,)
@@ -0,0 +1,66 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+from custom_transformer_prob_utils import generate_with_eos_compaction, get_eos_finished_mask, \
+    stochastic_transformer_sample, stochastic_transformer_sample_eos_compacted
+
+
+EOS = 7
+N_VOCAB = 50
+
+
+def deterministic_run_steps(rng_key, full_seq, kv_cache, condition_twist_on_tokens, ts, prompt_len):
+    # Stand in for stochastic_transformer_sample_steps whose next token only depends on the row itself,
+    # so that dropping other rows from the batch can't change it
+    for t in np.asarray(ts):
+        next_token = (full_seq[:, :prompt_len + t].sum(axis=-1) * 7 + 3 * t) % N_VOCAB
+        next_token = jnp.where(get_eos_finished_mask(full_seq, prompt_len, t, EOS), EOS, next_token)
+        full_seq = full_seq.at[:, prompt_len + t].set(next_token)
+    return rng_key, full_seq, kv_cache, None
+
+
+def assert_eos_padded(seqs, prompt_len):
+    for seq in np.asarray(seqs)[:, prompt_len:]:
+        eos_positions = np.nonzero(seq == EOS)[0]
+        if eos_positions.shape[0] > 0:
+            assert (seq[eos_positions[0]:] == EOS).all()
+
+
+@pytest.mark.parametrize("steps_per_chunk", [1, 3, 8])
+def test_compaction_gives_same_sequences_as_no_compaction(steps_per_chunk):
+    prompt_len, output_len, n_samples = 2, 20, 32
+    full_seq = jnp.concatenate((jnp.arange(2 * n_samples).reshape(n_samples, 2) % N_VOCAB,
+                                jnp.zeros((n_samples, output_len), dtype=jnp.int32)), axis=1).astype(jnp.int32)
+    run_steps = lambda *args: deterministic_run_steps(*args, prompt_len=prompt_len)
+
+    uncompacted, _ = generate_with_eos_compaction(jax.random.PRNGKey(0), full_seq, None, None, prompt_len, output_len, EOS,
+                                                  run_steps, steps_per_chunk=output_len, min_bucket_size=n_samples)
+    compacted, _ = generate_with_eos_compaction(jax.random.PRNGKey(0), full_seq, None, None, prompt_len, output_len, EOS,
+                                                run_steps, steps_per_chunk=steps_per_chunk, min_bucket_size=1)
+
+    finished = np.asarray(get_eos_finished_mask(uncompacted, prompt_len, output_len, EOS))
+    assert 0 < finished.sum() < n_samples # Some rows are actually compacted out, and some survive to the end
+    assert (np.asarray(compacted) == np.asarray(uncompacted)).all()
+    assert_eos_padded(compacted, prompt_len)
+
+
+def test_eos_compacted_sampling_matches_scan_without_compaction(shared_trunk_model, prompt):
+    huggingface_model, params_p, _ = shared_trunk_model
+    scanned = stochastic_transformer_sample(jax.random.PRNGKey(1), params_p, prompt, 12, 16,
+                                            huggingface_model=huggingface_model, eos_token_id=EOS)
+    chunked = stochastic_transformer_sample_eos_compacted(jax.random.PRNGKey(1), params_p, prompt, 12, 16,
+                                                          huggingface_model=huggingface_model, eos_token_id=EOS,
+                                                          steps_per_chunk=4, min_bucket_size=16)
+    assert (scanned == chunked).all()
+
+
+def test_eos_compacted_sampling_is_eos_padded(shared_trunk_model, prompt):
+    huggingface_model, params_p, _ = shared_trunk_model
+    seqs = stochastic_transformer_sample_eos_compacted(jax.random.PRNGKey(2), params_p, prompt, 40, 64,
+                                                       huggingface_model=huggingface_model, eos_token_id=EOS,
+                                                       steps_per_chunk=2, min_bucket_size=1)
+    assert (seqs[:, :prompt.shape[0]] == prompt).all()
+    assert (np.asarray(seqs)[:, prompt.shape[0]:] == EOS).any(axis=-1).sum() > 0
+    assert_eos_padded(seqs, prompt.shape[0])
@@ -0,0 +1,84 @@
+import jax
+import jax.numpy as jnp
+import pytest
+
+import custom_transformer_prob_utils
+from custom_transformer_prob_utils import smc_procedure, iwae_backward, get_sequence_scores, evaluate_log_p_theta_1_to_t, \
+    evaluate_log_phi_final
+
+EOS = 5
+OUTPUT_LEN = 2
+
+
+def final_twist_rewards_eos(seq, condition_twist_on_tokens=None):
+    return 2. * (seq[:, -OUTPUT_LEN:] == EOS).any(axis=-1) - 0.5 * (seq[:, -1] % 3)
+
+
+@pytest.fixture
+def eos_setup(monkeypatch, shared_trunk_model, prompt):
+    # As with --stop_at_eos; a twist head away from its initialisation so the frozen twist values matter
+    monkeypatch.setattr(custom_transformer_prob_utils, "default_eos_token_id", EOS)
+    huggingface_model, params_p, params_twist = shared_trunk_model
+    leaves, treedef = jax.tree_util.tree_flatten(params_twist)
+    keys = jax.random.split(jax.random.PRNGKey(5), len(leaves))
+    params_twist = jax.tree_util.tree_unflatten(treedef, [leaf + 0.05 * jax.random.normal(k, leaf.shape) for leaf, k in zip(leaves, keys)])
+    return huggingface_model, params_p, params_twist
+
+
+def _all_eos_padded_sequences(prompt, n_vocab):
+    # Every sequence the EOS stopped model can generate: after an EOS, only EOS
+    s_1, s_2 = jnp.meshgrid(jnp.arange(n_vocab), jnp.arange(n_vocab), indexing="ij")
+    s_1, s_2 = s_1.reshape(-1), s_2.reshape(-1)
+    keep = (s_1 != EOS) | (s_2 == EOS)
+    outputs = jnp.stack((s_1[keep], s_2[keep]), axis=-1).astype(jnp.int32)
+    return jnp.concatenate((jnp.broadcast_to(prompt, (outputs.shape[0], prompt.shape[0])), outputs), axis=-1)
+
+
+def _exact_log_z(seqs, params_p, prompt_len, huggingface_model):
+    log_p = evaluate_log_p_theta_1_to_t(seqs, params_p, prompt_len, OUTPUT_LEN, huggingface_model=huggingface_model)
+    return jax.nn.logsumexp(log_p + evaluate_log_phi_final(seqs, final_twist_rewards_eos))
+
+
+def test_scores_of_eos_padded_sequences_are_normalized(eos_setup, prompt):
+    # Over all the sequences the EOS stopped model (and proposal) can generate, p and q sum to 1,
+    # and the IWAE weights (iwae_backward) average to the exact Z under q
+    huggingface_model, params_p, params_twist = eos_setup
+    seqs = _all_eos_padded_sequences(prompt, 50)
+    scores = get_sequence_scores(seqs, prompt.shape[0], params_p, params_twist, None, huggingface_model=huggingface_model)
+    assert jnp.allclose(jax.nn.logsumexp(scores.log_p_total), 0., atol=1e-4)
+    assert jnp.allclose(jax.nn.logsumexp(scores.normalized_log_q_total), 0., atol=1e-4)
+
+    log_w = iwae_backward(seqs, prompt, params_p, params_twist, OUTPUT_LEN, final_twist_rewards_eos, None,
+                          huggingface_model=huggingface_model)
+    assert jnp.allclose(jax.nn.logsumexp(scores.normalized_log_q_total + log_w),
+                        _exact_log_z(seqs, params_p, prompt.shape[0], huggingface_model), atol=1e-4)
+    # psi after the EOS is the value at the EOS, as in the SMC
+    after_eos = seqs[:, prompt.shape[0]] == EOS
+    assert (scores.log_psi[after_eos, 1] == scores.log_psi[after_eos, 0]).all()
+
+
+def test_smc_weights_match_the_scorers_after_eos(eos_setup, prompt):
+    # Without resampling, the SMC weights of each particle are the IWAE weights iwae_backward gives for its sequence
+    huggingface_model, params_p, params_twist = eos_setup
+    (log_w_t, _, _), samples = smc_procedure(
+        jax.random.PRNGKey(6), prompt, params_p, params_twist, final_twist_rewards_eos, OUTPUT_LEN, 512,
+        huggingface_model=huggingface_model, resample=False)
+    assert (samples[:, prompt.shape[0]] == EOS).any()
+    log_w = iwae_backward(samples, prompt, params_p, params_twist, OUTPUT_LEN, final_twist_rewards_eos, None,
+                          huggingface_model=huggingface_model)
+    assert jnp.allclose(log_w_t, log_w, atol=1e-4)
+
+
+def test_smc_log_z_matches_exact_enumeration_with_eos(eos_setup, prompt):
+    # The estimates have a standard deviation of ~0.02 with this many particles
+    huggingface_model, params_p, params_twist = eos_setup
+    exact_log_z = _exact_log_z(_all_eos_padded_sequences(prompt, 50), params_p, prompt.shape[0], huggingface_model)
+    (log_w_t, _, _), _ = smc_procedure(
+        jax.random.PRNGKey(7), prompt, params_p, params_twist, final_twist_rewards_eos, OUTPUT_LEN, 20000,
+        huggingface_model=huggingface_model, resample=False)
+    iwae_log_z = jax.nn.logsumexp(log_w_t) - jnp.log(log_w_t.shape[0])
+    (_, smc_log_z, _), _ = smc_procedure(
+        jax.random.PRNGKey(8), prompt, params_p, params_twist, final_twist_rewards_eos, OUTPUT_LEN, 20000,
+        huggingface_model=huggingface_model, resampling_scheme="multinomial", resample_criterion="every_step")
+    assert jnp.abs(iwae_log_z - exact_log_z) < 0.06
+    assert jnp.abs(smc_log_z - exact_log_z) < 0.06
@@ -0,0 +1,87 @@
+import jax
+import jax.numpy as jnp
+import pytest
+
+import custom_transformer_prob_utils
+from custom_transformer_prob_utils import stochastic_transformer_sample, stochastic_transformer_sample_jitted, smc_procedure, \
+    get_p_logits_and_log_psi_all_vocab, get_log_psi_all_vocab
+from reward_models import curried_log_p_of_continuation
+from conftest import final_twist_last_token_mod_3
+
+
+def test_kv_cached_sampling_matches_full_forward(shared_trunk_model, prompt):
+    huggingface_model, params_p, _ = shared_trunk_model
+    samples, p_evals = stochastic_transformer_sample(jax.random.PRNGKey(1), params_p, prompt, 8, 16, huggingface_model=huggingface_model,
+                                                     return_p_eval=True, use_kv_cache=False)
+    samples_kv, p_evals_kv = stochastic_transformer_sample(jax.random.PRNGKey(1), params_p, prompt, 8, 16, huggingface_model=huggingface_model,
+                                                           return_p_eval=True, use_kv_cache=True)
+    assert (samples == samples_kv).all()
+    assert jnp.allclose(p_evals, p_evals_kv, atol=1e-5)
+
+
+def test_kv_cache_decoding_default_is_not_baked_into_the_trace(monkeypatch, shared_trunk_model, prompt):
+    # kv_cache_decoding is resolved before jit, so changing it after the first call gives a new compilation with the KV cache
+    huggingface_model, params_p, _ = shared_trunk_model
+    n_samples = 13 # not used by any other test, so the jit cache entries here are new
+    cache_size = stochastic_transformer_sample_jitted._cache_size()
+    for use_kv_cache in [False, True]:
+        monkeypatch.setattr(custom_transformer_prob_utils, "kv_cache_decoding", use_kv_cache)
+        stochastic_transformer_sample(jax.random.PRNGKey(1), params_p, prompt, 4, n_samples, huggingface_model=huggingface_model)
+    assert stochastic_transformer_sample_jitted._cache_size() == cache_size + 2
+
+
+@pytest.mark.parametrize("model_fixture", ["shared_trunk_model", "separate_twist_model", "p_psi_combined_model"])
+def test_log_psi_is_sliced_to_the_output_positions(request, model_fixture, prompt):
+    # All model setups give log psi for the output positions only, (batch, output_len, n_vocab)
+    huggingface_model, params_p, params_twist = request.getfixturevalue(model_fixture)
+    seq = stochastic_transformer_sample(jax.random.PRNGKey(2), params_p, prompt, 5, 3, huggingface_model=huggingface_model)
+    p_logits, log_psi = get_p_logits_and_log_psi_all_vocab(seq, params_p, params_twist, None, huggingface_model, prompt_len=prompt.shape[0])
+    assert log_psi.shape == (3, 5, 50)
+    if model_fixture == "p_psi_combined_model":
+        twist_output = huggingface_model['twist'](input_ids=seq, ret="twist", hface_model_params=params_twist[0], params_twist_head=params_twist[1])
+        expected = (twist_output - p_logits)[:, prompt.shape[0] - 1: -1]
+    else:
+        expected = get_log_psi_all_vocab(seq, params_twist, None, huggingface_model, prompt_len=prompt.shape[0])
+    assert jnp.allclose(log_psi, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize("model_fixture", ["shared_trunk_model", "separate_twist_model", "p_psi_combined_model"])
+def test_kv_cached_smc_matches_full_forward(request, model_fixture, prompt):
+    huggingface_model, params_p, params_twist = request.getfixturevalue(model_fixture)
+    results = []
+    for use_kv_cache in [False, True]:
+        (log_w_t, log_z_hat_t, _), samples = smc_procedure(
+            jax.random.PRNGKey(3), prompt, params_p, params_twist, final_twist_last_token_mod_3, 6, 8,
+            huggingface_model=huggingface_model, use_kv_cache=use_kv_cache, resampling_scheme="multinomial", resample_criterion="every_step")
+        results.append((log_w_t, log_z_hat_t, samples))
+    assert (results[0][2] == results[1][2]).all()
+    assert jnp.allclose(results[0][0], results[1][0], atol=1e-4)
+    assert jnp.allclose(results[0][1], results[1][1], atol=1e-4)
+
+
+@pytest.mark.parametrize("model_fixture", ["shared_trunk_model", "separate_twist_model", "p_psi_combined_model"])
+def test_kv_cached_final_twist_log_z_matches_uncached(request, model_fixture, prompt):
+    # A p_continuation final twist scored from the final SMC step's KV cache gives the log Z of scoring it with a full forward pass
+    huggingface_model, params_p, params_twist = request.getfixturevalue(model_fixture)
+    log_p_of_continuation = curried_log_p_of_continuation(params_p, jnp.array([5, 9, 21]), huggingface_model=huggingface_model)
+    got_kv_cache = []
+
+    def cached_final_twist(seq, kv_cache=None):
+        got_kv_cache.append(kv_cache is not None)
+        return log_p_of_continuation(seq, kv_cache=kv_cache)
+    cached_final_twist.accepts_kv_cache = True
+
+    def uncached_final_twist(seq):
+        return log_p_of_continuation(seq)
+
+    results = []
+    for final_twist, use_kv_cache in [(cached_final_twist, True), (uncached_final_twist, True), (uncached_final_twist, False)]:
+        (log_w_t, log_z_hat_t, _), samples = smc_procedure(
+            jax.random.PRNGKey(4), prompt, params_p, params_twist, final_twist, 6, 8,
+            huggingface_model=huggingface_model, use_kv_cache=use_kv_cache, resampling_scheme="multinomial", resample_criterion="every_step")
+        results.append((log_w_t, log_z_hat_t, samples))
+    assert got_kv_cache and all(got_kv_cache)
+    for log_w_t, log_z_hat_t, samples in results[1:]:
+        assert (samples == results[0][2]).all()
+        assert jnp.allclose(log_w_t, results[0][0], atol=1e-4)
+        assert jnp.allclose(log_z_hat_t, results[0][1], atol=1e-4)
@@ -0,0 +1,34 @@
+import jax
+import jax.numpy as jnp
+import pytest
+
+import losses
+from conftest import final_twist_last_token_mod_3
+
+
+def _ebm_one_sample_loss(params_twist, params_p, huggingface_model, prompt):
+    return losses.get_l_ebm_one_sample(
+        None, huggingface_model, final_twist_last_token_mod_3, 8, 5, params_p, None, params_twist, None, prompt,
+        prompt.shape[0], False, None, False, jax.random.PRNGKey(4), "jit", None)
+
+
+def _ebm_negative_sample_term(params_twist, params_p, huggingface_model, prompt):
+    return losses.calculate_l_ebm_negative_sample_term(
+        None, huggingface_model, final_twist_last_token_mod_3, 8, 5, params_p, None, params_twist, prompt, False,
+        True, jax.random.PRNGKey(4), "jit")[0]
+
+
+@pytest.mark.parametrize("loss_fn", [_ebm_one_sample_loss, _ebm_negative_sample_term])
+def test_lean_twist_grad_matches_full_backprop(monkeypatch, shared_trunk_model, prompt, loss_fn):
+    # With resample=False (what lean_twist_grad needs), both modes see the same samples, so the losses and twist gradients agree
+    huggingface_model, params_p, params_twist = shared_trunk_model
+    results = []
+    for lean in [False, True]:
+        monkeypatch.setattr(losses, "lean_twist_grad", lean)
+        results.append(jax.value_and_grad(loss_fn)(params_twist, params_p, huggingface_model, prompt))
+    (loss_full, grads_full), (loss_lean, grads_lean) = results
+
+    assert jnp.allclose(loss_full, loss_lean, atol=1e-5)
+    for g_full, g_lean in zip(jax.tree_util.tree_leaves(grads_full), jax.tree_util.tree_leaves(grads_lean)):
+        assert jnp.allclose(g_full, g_lean, atol=1e-5)
+    assert any(jnp.abs(g).max() > 0 for g in jax.tree_util.tree_leaves(grads_lean))
@@ -0,0 +1,113 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+from custom_transformer_prob_utils import evaluate_log_p_theta_1_to_t, evaluate_log_phi_final
+from do_training_and_log_Z_bounds import inspect_and_record_evidence_setting_for_index_jit, \
+    inspect_and_record_evidence_setting_for_indices_jit, collect_info_across_trueposts_batched, \
+    inspect_and_record_evidence_setting_for_indices_nested_jit
+from conftest import final_twist_last_token_mod_3
+
+OUTPUT_LEN = 3
+
+
+@pytest.fixture
+def true_posterior_samples(prompt):
+    # The bounds only need some sequences to stand in for the true posterior samples here
+    outputs = jax.random.randint(jax.random.PRNGKey(5), (4, OUTPUT_LEN), 1, 50)
+    return jnp.concatenate((jnp.broadcast_to(prompt, (4, prompt.shape[0])), outputs), axis=-1).astype(jnp.int32)
+
+
+def _empty_accumulators(n_samples_for_plots):
+    return [[[] for _ in n_samples_for_plots] for _ in range(4)] + [[[]] + [0.] * 8]
+
+
+def test_vmapped_seeds_match_one_call_per_seed(shared_trunk_model, prompt, true_posterior_samples):
+    huggingface_model, params_p, params_twist = shared_trunk_model
+    rng_keys = jax.random.split(jax.random.PRNGKey(2), 3)
+    batched, _ = inspect_and_record_evidence_setting_for_indices_jit(
+        rng_keys, prompt, params_p, params_twist, OUTPUT_LEN, final_twist_last_token_mod_3, 8,
+        true_posterior_samples, "jit", huggingface_model=huggingface_model, indices_of_true_posterior_samples=jnp.arange(3))
+    for i in range(3):
+        per_seed, _ = inspect_and_record_evidence_setting_for_index_jit(
+            rng_keys[i], prompt, params_p, params_twist, OUTPUT_LEN, final_twist_last_token_mod_3, 8,
+            true_posterior_samples, "jit", huggingface_model=huggingface_model, index_of_true_posterior_sample=i)
+        # The IWAE and SMC bounds, f_q and the KL estimates
+        assert len(batched) == len(per_seed) == 9
+        for batched_value, per_seed_value in zip(batched, per_seed):
+            assert jnp.allclose(batched_value[i], per_seed_value, atol=1e-4)
+
+
+def test_seed_batch_size_does_not_change_the_bounds(shared_trunk_model, prompt, true_posterior_samples):
+    huggingface_model, params_p, params_twist = shared_trunk_model
+    n_samples_for_plots = [4, 8]
+    results = []
+    for seed_batch_size in [None, 3]:
+        results.append(collect_info_across_trueposts_batched(
+            jax.random.PRNGKey(3), 0., 4, n_samples_for_plots, prompt, params_p, params_twist, OUTPUT_LEN,
+            final_twist_last_token_mod_3, true_posterior_samples, "jit", False, None, huggingface_model, None,
+            *_empty_accumulators(n_samples_for_plots), seed_batch_size=seed_batch_size))
+    all_at_once, in_chunks = results
+    # The four bounds for each number of samples, one per seed
+    for accumulator_all_at_once, accumulator_in_chunks in zip(all_at_once[:4], in_chunks[:4]):
+        for n in range(len(n_samples_for_plots)):
+            assert len(accumulator_all_at_once[n]) == 4
+            assert np.allclose(accumulator_all_at_once[n], accumulator_in_chunks[n], atol=1e-4)
+    assert np.allclose(all_at_once[4][0], in_chunks[4][0], atol=1e-4)
+    assert np.allclose(all_at_once[4][1:], in_chunks[4][1:], atol=1e-3)
+
+
+def _exact_log_z_and_posterior_samples(rng_key, prompt, params_p, huggingface_model, n_samples):
+    # With 2 output tokens over the vocab of 50, sigma can be enumerated: the exact log Z, and exact samples from sigma
+    outputs = jnp.stack(jnp.meshgrid(jnp.arange(50), jnp.arange(50), indexing="ij"), axis=-1).reshape(-1, 2)
+    seqs = jnp.concatenate((jnp.broadcast_to(prompt, (outputs.shape[0], prompt.shape[0])), outputs), axis=-1).astype(jnp.int32)
+    log_sigma_unnormalized = evaluate_log_p_theta_1_to_t(seqs, params_p, prompt.shape[0], 2, huggingface_model=huggingface_model) \
+        + evaluate_log_phi_final(seqs, final_twist_last_token_mod_3)
+    return jax.nn.logsumexp(log_sigma_unnormalized), seqs[jax.random.categorical(rng_key, log_sigma_unnormalized, shape=(n_samples,))]
+
+
+def test_nested_iwae_bounds_for_the_largest_n_are_those_of_one_run(shared_trunk_model, prompt, true_posterior_samples):
+    # The IWAE run is the same one (same key), so for the largest number of samples nothing is subsetted
+    huggingface_model, params_p, params_twist = shared_trunk_model
+    rng_keys = jax.random.split(jax.random.PRNGKey(6), 2)
+    nested = inspect_and_record_evidence_setting_for_indices_nested_jit(
+        rng_keys, prompt, params_p, params_twist, OUTPUT_LEN, final_twist_last_token_mod_3, (4, 16),
+        true_posterior_samples, "jit", huggingface_model=huggingface_model, indices_of_true_posterior_samples=jnp.arange(2))
+    single, _ = inspect_and_record_evidence_setting_for_indices_jit(
+        rng_keys, prompt, params_p, params_twist, OUTPUT_LEN, final_twist_last_token_mod_3, 16,
+        true_posterior_samples, "jit", huggingface_model=huggingface_model, indices_of_true_posterior_samples=jnp.arange(2))
+    assert nested[0].shape == (2, 2)
+    for i in range(2): # IWAE upper and lower bounds
+        assert jnp.allclose(nested[i][:, -1], single[i], atol=1e-5)
+    assert jnp.allclose(nested[4], single[4], atol=1e-5) # f_qs
+
+
+def test_nested_bounds_match_independent_runs(shared_trunk_model, prompt):
+    # For each number of samples, the bounds from the subsets of one run have the same mean over seeds as those of separate
+    # runs with that many samples, and sit on the right side of the exact log Z
+    huggingface_model, params_p, params_twist = shared_trunk_model
+    # A twist head near zero (q close to p) keeps the variance of the bounds low, so the comparison is a tight one
+    params_twist = jax.tree_util.tree_map(lambda x: 0.1 * x, params_twist)
+    n_seeds, n_samples_for_plots = 64, (4, 16)
+    exact_log_z, posterior_samples = _exact_log_z_and_posterior_samples(
+        jax.random.PRNGKey(7), prompt, params_p, huggingface_model, n_seeds)
+    indices = jnp.arange(n_seeds)
+
+    nested = inspect_and_record_evidence_setting_for_indices_nested_jit(
+        jax.random.split(jax.random.PRNGKey(8), n_seeds), prompt, params_p, params_twist, 2, final_twist_last_token_mod_3,
+        n_samples_for_plots, posterior_samples, "jit", huggingface_model=huggingface_model, indices_of_true_posterior_samples=indices)
+    for n_index, n in enumerate(n_samples_for_plots):
+        independent, _ = inspect_and_record_evidence_setting_for_indices_jit(
+            jax.random.split(jax.random.PRNGKey(9 + n_index), n_seeds), prompt, params_p, params_twist, 2,
+            final_twist_last_token_mod_3, n, posterior_samples, "jit", huggingface_model=huggingface_model,
+            indices_of_true_posterior_samples=indices)
+        # IWAE upper, IWAE lower, SMC upper, SMC lower
+        for i, is_upper_bound in enumerate([True, False, True, False]):
+            nested_bounds, independent_bounds = np.asarray(nested[i][:, n_index]), np.asarray(independent[i])
+            standard_error = np.sqrt((nested_bounds.var() + independent_bounds.var()) / n_seeds)
+            assert abs(nested_bounds.mean() - independent_bounds.mean()) < 4 * standard_error + 1e-3, (n, i)
+            if is_upper_bound:
+                assert nested_bounds.mean() > exact_log_z - 4 * standard_error - 1e-3, (n, i)
+            else:
+                assert nested_bounds.mean() < exact_log_z + 4 * standard_error + 1e-3, (n, i)
@@ -0,0 +1,57 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+from custom_transformer_prob_utils import smc_procedure, smc_multi_prompt, evaluate_log_phi_final_multi_prompt
+from conftest import final_twist_last_token_mod_3
+
+PROMPTS = {
+    "same_length": [jnp.array([3, 7, 11, 2]), jnp.array([5, 1, 9, 4]), jnp.array([8, 8, 2, 6])],
+    "different_lengths": [jnp.array([3, 7, 11, 2]), jnp.array([5, 1]), jnp.array([8, 8, 2, 6, 13, 4])],
+}
+
+
+def final_twist_first_output_token_mod_2(seq, condition_twist_on_tokens=None):
+    return -1. * (seq[:, -2] % 2)
+
+
+@pytest.mark.parametrize("prompts_name", PROMPTS)
+@pytest.mark.parametrize("model_fixture", ["shared_trunk_model", "separate_twist_model"])
+def test_multi_prompt_log_z_matches_separate_smc(request, model_fixture, prompts_name):
+    # Each prompt's log Z estimate and samples from one smc_multi_prompt call are those of an smc_procedure call for that prompt alone
+    huggingface_model, params_p, params_twist = request.getfixturevalue(model_fixture)
+    prompts = PROMPTS[prompts_name]
+    # Two distinct final twists, so the final twist is evaluated in more than one group
+    log_true_final_twists = [final_twist_last_token_mod_3, final_twist_first_output_token_mod_2, final_twist_last_token_mod_3]
+    rng_key = jax.random.PRNGKey(11)
+    (log_w_t, log_z_hat_t, _), samples = smc_multi_prompt(
+        rng_key, prompts, params_p, params_twist, log_true_final_twists, 5, 16, huggingface_model=huggingface_model,
+        resampling_scheme="multinomial", resample_criterion="every_step")
+    assert log_z_hat_t.shape == (3,)
+
+    rng_keys = jax.random.split(rng_key, len(prompts))
+    for i, prompt in enumerate(prompts):
+        (log_w_t_i, log_z_hat_t_i, _), samples_i = smc_procedure(
+            rng_keys[i], prompt, params_p, params_twist, log_true_final_twists[i], 5, 16, huggingface_model=huggingface_model,
+            use_kv_cache=True, resampling_scheme="multinomial", resample_criterion="every_step")
+        assert samples[i].shape == samples_i.shape
+        assert (samples[i] == samples_i).all()
+        assert jnp.allclose(log_w_t[i], log_w_t_i, atol=1e-4)
+        assert jnp.allclose(log_z_hat_t[i], log_z_hat_t_i, atol=1e-4)
+
+
+def test_final_twists_are_evaluated_once_per_group():
+    # Prompts sharing a final twist and a padded length are scored in one call, on the sequences without the padding
+    calls = []
+
+    def final_twist(seq, condition_twist_on_tokens=None):
+        calls.append(seq.shape)
+        return seq.sum(axis=-1).astype(jnp.float32)
+
+    full_seqs = jax.random.randint(jax.random.PRNGKey(0), (4, 3, 7), 1, 50)
+    n_padding_tokens = np.array([0, 2, 0, 2])
+    log_phi_t_evals = evaluate_log_phi_final_multi_prompt(full_seqs, n_padding_tokens, [final_twist] * 4)
+    assert sorted(calls) == [(6, 5), (6, 7)]
+    for i, n_pad in enumerate(n_padding_tokens):
+        assert (log_phi_t_evals[i] == full_seqs[i, :, n_pad:].sum(axis=-1)).all()
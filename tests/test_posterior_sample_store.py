@@ -0,0 +1,45 @@
+import multiprocessing
+
+import numpy as np
+
+from posterior_sample_store import PosteriorSampleStore
+
+SETTINGS = [{"prompt": [1, 2], "rm_type": "toxicity_threshold", "seed": 0}, {"prompt": [1, 2], "rm_type": "toxicity_threshold", "seed": 1}]
+N_APPENDS = 20
+
+
+def _append_worker(store_dir, worker_id):
+    # Each worker is like a separate collection run: its own store instance, opened before the others have written anything
+    store = PosteriorSampleStore(store_dir)
+    for i in range(N_APPENDS):
+        store.append(SETTINGS[i % 2], np.full((3, 4), worker_id * 1000 + i, dtype=np.int32))
+
+
+def test_concurrent_appends_keep_every_shard(tmp_path):
+    n_workers = 4
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=_append_worker, args=(str(tmp_path), worker_id)) for worker_id in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    store = PosteriorSampleStore(str(tmp_path))
+    assert store.n_shards() == n_workers * N_APPENDS
+    for setting in SETTINGS:
+        assert store.n_samples(setting) == n_workers * N_APPENDS // 2 * 3
+    samples = store.load({"prompt": [1, 2], "rm_type": "toxicity_threshold"})
+    expected = sorted(worker_id * 1000 + i for worker_id in range(n_workers) for i in range(N_APPENDS))
+    assert sorted(samples[::3, 0].tolist()) == expected
+    assert (samples.reshape(-1, 3, 4) == samples[::3, :1, None]).all()
+
+
+def test_store_sees_appends_from_another_instance(tmp_path):
+    store_a = PosteriorSampleStore(str(tmp_path))
+    store_b = PosteriorSampleStore(str(tmp_path))
+    store_a.append(SETTINGS[0], np.zeros((2, 4), dtype=np.int32))
+    store_b.append(SETTINGS[0], np.ones((5, 4), dtype=np.int32))
+    assert store_b.n_samples(SETTINGS[0]) == 7
+    store_a.reload()
+    assert store_a.load(SETTINGS[0]).shape == (7, 4)
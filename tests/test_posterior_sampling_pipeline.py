@@ -0,0 +1,71 @@
+import time
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+from custom_transformer_prob_utils import stochastic_transformer_sample
+from reward_models import collect_true_posterior_samples_pipelined
+
+N_TOKENS, N_SAMPLES_AT_A_TIME, N_SAMPLES_NEEDED = 3, 8, 10
+
+
+def accept_last_token_mod_3(rng_key, p_samples, delay=0.):
+    # Stands in for a reward model threshold (about 1 in 3 samples accepted). With a random delay, batches finish out of order
+    if delay:
+        time.sleep(np.random.uniform(0., delay))
+    return rng_key, p_samples[np.asarray(p_samples[:, -1] % 3 == 0)]
+
+
+def collect_serially(rng_key, prompt, params_p, huggingface_model, accept_fn, n_samples_needed):
+    # The sample/accept loop without any overlap: the next batch is only drawn once the last one has been scored
+    accepted = []
+    while sum(a.shape[0] for a in accepted) < n_samples_needed:
+        rng_key, sk_sample, sk_accept = jax.random.split(rng_key, 3)
+        p_samples = stochastic_transformer_sample(sk_sample, params_p, prompt, N_TOKENS, N_SAMPLES_AT_A_TIME,
+                                                  huggingface_model=huggingface_model)
+        accepted.append(np.asarray(accept_fn(sk_accept, p_samples)[1]))
+    return np.concatenate(accepted)[:n_samples_needed]
+
+
+@pytest.mark.parametrize("n_scoring_threads", [1, 3])
+def test_pipelined_acceptances_match_serial(shared_trunk_model, prompt, n_scoring_threads):
+    huggingface_model, params_p, _ = shared_trunk_model
+    rng_key = jax.random.PRNGKey(3)
+    accepted_batches = []
+    _, samples = collect_true_posterior_samples_pipelined(
+        rng_key, [prompt], params_p, N_TOKENS, N_SAMPLES_AT_A_TIME, huggingface_model,
+        [lambda sk, p_samples: accept_last_token_mod_3(sk, p_samples, delay=0.05)], N_SAMPLES_NEEDED,
+        n_scoring_threads=n_scoring_threads, on_accepted=lambda i, accepted: accepted_batches.append(accepted))
+    expected = collect_serially(rng_key, prompt, params_p, huggingface_model, accept_last_token_mod_3, N_SAMPLES_NEEDED)
+
+    assert samples[0].shape == (N_SAMPLES_NEEDED, prompt.shape[0] + N_TOKENS)
+    assert (np.asarray(samples[0]) == expected).all()
+    assert (np.concatenate(accepted_batches)[:N_SAMPLES_NEEDED] == expected).all()
+
+
+def test_pipelined_collection_is_deterministic_across_prompts(shared_trunk_model):
+    # Which batch is scored first varies from run to run, but the batches are consumed in the order they were queued
+    huggingface_model, params_p, _ = shared_trunk_model
+    prompts = [jnp.array([3, 7, 11, 2]), jnp.array([5, 1, 9])]
+    accept_fns = [lambda sk, p_samples: accept_last_token_mod_3(sk, p_samples, delay=0.05)] * 2
+    runs = [collect_true_posterior_samples_pipelined(
+        jax.random.PRNGKey(4), prompts, params_p, N_TOKENS, N_SAMPLES_AT_A_TIME, huggingface_model, accept_fns,
+        N_SAMPLES_NEEDED, n_scoring_threads=3)[1] for _ in range(2)]
+    for i, prompt in enumerate(prompts):
+        assert runs[0][i].shape == (N_SAMPLES_NEEDED, prompt.shape[0] + N_TOKENS)
+        assert (runs[0][i][:, :prompt.shape[0]] == prompt).all()
+        assert (runs[0][i][:, -1] % 3 == 0).all()
+        assert (runs[0][i] == runs[1][i]).all()
+
+
+def test_initial_samples_count_towards_the_total(shared_trunk_model, prompt):
+    huggingface_model, params_p, _ = shared_trunk_model
+    rng_key = jax.random.PRNGKey(5)
+    initial = collect_serially(jax.random.PRNGKey(6), prompt, params_p, huggingface_model, accept_last_token_mod_3, 4)
+    _, samples = collect_true_posterior_samples_pipelined(
+        rng_key, [prompt], params_p, N_TOKENS, N_SAMPLES_AT_A_TIME, huggingface_model, [accept_last_token_mod_3],
+        N_SAMPLES_NEEDED, initial_samples=[initial])
+    expected = collect_serially(rng_key, prompt, params_p, huggingface_model, accept_last_token_mod_3, N_SAMPLES_NEEDED - 4)
+    assert (np.asarray(samples[0]) == np.concatenate((initial, expected))).all()
@@ -0,0 +1,60 @@
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+import pytest
+
+import custom_transformer_prob_utils
+import losses
+from custom_transformer_prob_utils import smc_procedure
+from conftest import final_twist_last_token_mod_3
+
+LOSSES = {
+    "ebm": losses.get_l_ebm_ml_partial_jit,
+    "one_total_kl": losses.get_l_one_total_kl,
+    "rl_q": partial(losses.get_l_rl_based_partial_jit, evaluate_over_samples_from="q"),
+    "nvi": losses.get_l_nvi_partial_jit,
+}
+
+
+def _set_proposal_truncation(monkeypatch, top_k, top_p):
+    # As with --proposal_top_k / --proposal_top_p
+    monkeypatch.setattr(custom_transformer_prob_utils, "default_proposal_top_k", top_k)
+    monkeypatch.setattr(custom_transformer_prob_utils, "default_proposal_top_p", top_p)
+
+
+def _smc(shared_trunk_model, prompt, **kwargs):
+    huggingface_model, params_p, params_twist = shared_trunk_model
+    (log_w_t, log_z_hat_t, _), samples = smc_procedure(
+        jax.random.PRNGKey(3), prompt, params_p, params_twist, final_twist_last_token_mod_3, 5, 8,
+        huggingface_model=huggingface_model, resample=False, **kwargs)
+    return log_w_t, samples
+
+
+def test_explicit_no_truncation_overrides_the_defaults(monkeypatch, shared_trunk_model, prompt):
+    log_w_t, samples = _smc(shared_trunk_model, prompt)
+    _set_proposal_truncation(monkeypatch, 3, 0.5)
+    log_w_t_truncated, samples_truncated = _smc(shared_trunk_model, prompt)
+    assert not jnp.allclose(log_w_t, log_w_t_truncated) # the defaults are used...
+    log_w_t_untruncated, samples_untruncated = _smc(shared_trunk_model, prompt, proposal_top_k=0, proposal_top_p=1.)
+    assert (samples == samples_untruncated).all() # ...unless truncation is explicitly off
+    assert jnp.allclose(log_w_t, log_w_t_untruncated)
+
+
+@pytest.mark.parametrize("loss_name", LOSSES)
+def test_twist_losses_ignore_proposal_truncation(monkeypatch, shared_trunk_model, prompt, loss_name):
+    # The SMC in the twist losses always uses the untruncated twist, so --proposal_top_k/--proposal_top_p don't change the losses
+    huggingface_model, params_p, params_twist = shared_trunk_model
+
+    def loss(params_twist):
+        return LOSSES[loss_name](jax.random.PRNGKey(4), prompt, params_p, params_twist, final_twist_last_token_mod_3, 5, 8,
+                                 None, "jit", huggingface_model=huggingface_model)
+
+    results = []
+    for top_k, top_p in [(None, None), (3, 0.5)]:
+        _set_proposal_truncation(monkeypatch, top_k, top_p)
+        results.append(jax.value_and_grad(loss)(params_twist))
+    (loss_ref, grads_ref), (loss_truncated, grads_truncated) = results
+    assert jnp.allclose(loss_ref, loss_truncated, atol=1e-5)
+    for g_ref, g_truncated in zip(jax.tree_util.tree_leaves(grads_ref), jax.tree_util.tree_leaves(grads_truncated)):
+        assert jnp.allclose(g_ref, g_truncated, atol=1e-5)
@@ -0,0 +1,23 @@
+import jax
+import jax.numpy as jnp
+import pytest
+
+from huggingface_models_custom import CustomLMWithTwistHead, REMAT_POLICIES
+
+
+@pytest.mark.parametrize("remat_policy", REMAT_POLICIES)
+def test_every_offered_remat_policy_runs(tiny_gpt2_dir, remat_policy):
+    # Every choice of --twist_remat_policy works with the installed jax, and doesn't change the twist values or gradients
+    model = CustomLMWithTwistHead(jax.random.PRNGKey(1), tiny_gpt2_dir)
+    model_remat = CustomLMWithTwistHead(jax.random.PRNGKey(1), tiny_gpt2_dir, remat_policy=remat_policy)
+    params = [model.huggingface_model.params, model.twist_head_params]
+    seq = jax.random.randint(jax.random.PRNGKey(2), (3, 10), 0, 50)
+
+    def loss(params, model):
+        return model(input_ids=seq, ret="twist", hface_model_params=params[0], params_twist_head=params[1]).mean()
+
+    loss_ref, grads_ref = jax.value_and_grad(loss)(params, model)
+    loss_remat, grads_remat = jax.value_and_grad(loss)(params, model_remat)
+    assert jnp.allclose(loss_ref, loss_remat, atol=1e-6)
+    for g_ref, g_remat in zip(jax.tree_util.tree_leaves(grads_ref), jax.tree_util.tree_leaves(grads_remat)):
+        assert jnp.allclose(g_ref, g_remat, atol=1e-5)
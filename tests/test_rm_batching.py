@@ -0,0 +1,93 @@
+import jax.numpy as jnp
+import numpy as np
+import pytest
+from tokenizers import ByteLevelBPETokenizer, processors
+from transformers import GPT2TokenizerFast, RobertaTokenizerFast, RobertaConfig, FlaxRobertaForSequenceClassification
+
+import reward_models
+from reward_models import get_rm_logits_from_text
+
+# Small tokenizers and a small random RoBERTa classifier, trained/initialised here so the tests run without downloading anything
+CORPUS = [
+    "The quick brown fox jumps over the lazy dog.", "It's 2024, and I don't know what we're doing!",
+    "Hello, world? Yes: hello again; numbers like 123 and 4567.", "She said 'no' and left.\nThen he came back.",
+] * 20
+
+STRINGS = [
+    "Hello", "The dog.", "It's 2024, and I don't know what we're doing!", "She said 'no'.",
+    "The quick brown fox jumps over the lazy dog. The quick brown fox jumps over the lazy dog. Hello, world? Yes: hello again.",
+    "numbers like 123", "Then he came back.", "Yes", "hello again; numbers like 123 and 4567.", "The lazy dog",
+]
+
+
+@pytest.fixture(scope="module")
+def tokenizers():
+    lm_tokenizer = ByteLevelBPETokenizer()
+    lm_tokenizer.train_from_iterator(CORPUS, vocab_size=400, min_frequency=1, special_tokens=["<|endoftext|>"])
+    rm_tokenizer = ByteLevelBPETokenizer()
+    rm_tokenizer.train_from_iterator(CORPUS, vocab_size=300, min_frequency=1, special_tokens=["<s>", "<pad>", "</s>", "<unk>"])
+    rm_tokenizer._tokenizer.post_processor = processors.RobertaProcessing(
+        ("</s>", rm_tokenizer.token_to_id("</s>")), ("<s>", rm_tokenizer.token_to_id("<s>")))
+    return (GPT2TokenizerFast(tokenizer_object=lm_tokenizer._tokenizer, eos_token="<|endoftext|>", bos_token="<|endoftext|>", unk_token="<|endoftext|>"),
+            RobertaTokenizerFast(tokenizer_object=rm_tokenizer._tokenizer, bos_token="<s>", eos_token="</s>", pad_token="<pad>",
+                                 unk_token="<unk>", cls_token="<s>", sep_token="</s>"))
+
+
+@pytest.fixture(autouse=True)
+def fresh_rm_jitted_calls(monkeypatch):
+    # The jitted calls are keyed by id(reward model), which a model from another test may have had
+    monkeypatch.setattr(reward_models, "rm_jitted_calls", {})
+
+
+def _reward_model(dtype=jnp.float32):
+    config = RobertaConfig(vocab_size=300, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64,
+                           max_position_embeddings=520, num_labels=2, pad_token_id=1)
+    reward_model = FlaxRobertaForSequenceClassification(config, seed=0, dtype=dtype)
+    if dtype == jnp.bfloat16:
+        # As get_tokenizer_and_rewardModel with --rm_bf16
+        reward_model.params = reward_model.to_bf16(reward_model.params)
+    return reward_model
+
+
+def _lm_batch(lm_tokenizer, strings):
+    # As the SMC samples: one (batch, seq_len) array, shorter rows padded at the end with EOS
+    ids = [lm_tokenizer(string)["input_ids"] for string in strings]
+    seq_len = max(len(row) for row in ids)
+    return jnp.array([row + [lm_tokenizer.eos_token_id] * (seq_len - len(row)) for row in ids], dtype=jnp.int32)
+
+
+def _padded_logits(seq, reward_model, rm_tokenizer, lm_tokenizer):
+    # The single call padded to the longest sequence in the batch, as the reward models were called before
+    texts = lm_tokenizer.batch_decode(np.asarray(seq), skip_special_tokens=True)
+    inputs = rm_tokenizer(texts, truncation=True, padding=True, max_length=512, return_token_type_ids=False, return_tensors="np")
+    return np.asarray(reward_model(**inputs)[0])
+
+
+@pytest.mark.parametrize("rm_batch_chunk_size", [None, 4])
+def test_bucketed_logits_match_one_padded_call(monkeypatch, tokenizers, rm_batch_chunk_size):
+    lm_tokenizer, rm_tokenizer = tokenizers
+    monkeypatch.setattr(reward_models, "rm_batch_chunk_size", rm_batch_chunk_size)
+    reward_model = _reward_model()
+    seq = _lm_batch(lm_tokenizer, STRINGS)
+    logits = get_rm_logits_from_text(seq, reward_model, rm_tokenizer, lm_tokenizer)
+    assert logits.shape == (len(STRINGS), 2) and logits.dtype == jnp.float32
+    assert np.allclose(logits, _padded_logits(seq, reward_model, rm_tokenizer, lm_tokenizer), atol=1e-5)
+
+
+def test_rm_compiles_once_per_bucket(tokenizers):
+    # Batches with different longest sequences (but in the same length bucket, and the same batch bucket) reuse one compile
+    lm_tokenizer, rm_tokenizer = tokenizers
+    reward_model = _reward_model()
+    for strings in [STRINGS[:2], [STRINGS[3], STRINGS[5], STRINGS[6]], [STRINGS[7], STRINGS[9], STRINGS[1]]]: # 6, 13 and 8 RM tokens at most
+        get_rm_logits_from_text(_lm_batch(lm_tokenizer, strings), reward_model, rm_tokenizer, lm_tokenizer)
+    assert reward_models.rm_jitted_calls[id(reward_model)]._cache_size() == 1
+
+
+def test_bf16_rm_gives_fp32_logits_close_to_fp32_rm(tokenizers):
+    lm_tokenizer, rm_tokenizer = tokenizers
+    seq = _lm_batch(lm_tokenizer, STRINGS)
+    logits_fp32 = get_rm_logits_from_text(seq, _reward_model(), rm_tokenizer, lm_tokenizer)
+    logits_bf16 = get_rm_logits_from_text(seq, _reward_model(jnp.bfloat16), rm_tokenizer, lm_tokenizer)
+    assert logits_bf16.dtype == jnp.float32
+    assert np.allclose(logits_bf16, logits_fp32, atol=0.05)
+    assert not np.array_equal(logits_bf16, logits_fp32) # actually computed in bf16
@@ -0,0 +1,73 @@
+import numpy as np
+
+import reward_models
+from reward_models import RMScoreCache, get_rm_logits
+
+
+def _outputs(seqs):
+    # Stands in for the reward model logits: a deterministic function of each row
+    seqs = np.asarray(seqs)
+    return np.stack((seqs.sum(axis=-1), (seqs * np.arange(1, seqs.shape[-1] + 1)).sum(axis=-1)), axis=-1).astype(np.float32)
+
+
+def test_hashes_are_distinct_and_deterministic():
+    rng = np.random.default_rng(0)
+    seqs = np.unique(rng.integers(0, 50257, size=(20000, 6)), axis=0)
+    keys = RMScoreCache.hash_rows(seqs)
+    assert np.unique(keys[0]).shape[0] == seqs.shape[0]
+    assert (RMScoreCache.hash_rows(seqs[::-1]) == keys[:, ::-1]).all()
+    # Rows that differ only by a swap, or by length, get different keys
+    assert (RMScoreCache.hash_rows([[1, 2, 3]])[0] != RMScoreCache.hash_rows([[2, 1, 3]])[0]).all()
+    assert RMScoreCache.hash_rows([[0, 0]])[0, 0] != RMScoreCache.hash_rows([[0, 0, 0]])[0, 0]
+
+
+def test_lookup_hits_and_misses():
+    cache = RMScoreCache(max_size=100)
+    seqs = np.arange(40).reshape(10, 4)
+    found, found_outputs = cache.lookup(cache.hash_rows(seqs))
+    assert not found.any() and found_outputs is None
+
+    cache.insert(cache.hash_rows(seqs[::2]), _outputs(seqs[::2]))
+    found, found_outputs = cache.lookup(cache.hash_rows(seqs))
+    assert (found == (np.arange(10) % 2 == 0)).all()
+    assert (found_outputs == _outputs(seqs[::2])).all()
+    # Inserting keys that are already there doesn't duplicate them
+    cache.insert(cache.hash_rows(seqs[:4]), _outputs(seqs[:4]))
+    assert cache.stats()["size"] == 7
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = RMScoreCache(max_size=4)
+    seqs = np.arange(12).reshape(6, 2)
+    keys = cache.hash_rows(seqs)
+    cache.insert(keys[:, :4], _outputs(seqs[:4]))
+    cache.lookup(keys[:, [0, 2]]) # 1 and 3 are now the least recently used
+    cache.insert(keys[:, 4:], _outputs(seqs[4:]))
+    found, found_outputs = cache.lookup(keys)
+    assert (found == np.array([True, False, True, False, True, True])).all()
+    assert (found_outputs == _outputs(seqs[[0, 2, 4, 5]])).all()
+    assert cache.stats()["size"] == 4
+
+
+def test_get_rm_logits_only_scores_misses(monkeypatch):
+    scored = []
+
+    def get_rm_logits_uncached(seq, rewardModel, tokenizer_RM, tokenizer):
+        scored.append(np.asarray(seq))
+        return _outputs(seq)
+
+    monkeypatch.setattr(reward_models, "get_rm_logits_uncached", get_rm_logits_uncached)
+    monkeypatch.setattr(reward_models, "rm_score_caches", {})
+    monkeypatch.setattr(reward_models, "rm_score_cache_size", 1000)
+    reward_model = object()
+
+    seqs = np.array([[1, 2, 3], [4, 5, 6], [1, 2, 3], [7, 8, 9]])
+    assert (np.asarray(get_rm_logits(seqs, reward_model, None, None)) == _outputs(seqs)).all()
+    assert len(scored) == 1 and scored[0].shape[0] == 3 # the duplicate in the batch is scored once
+
+    more_seqs = np.array([[7, 8, 9], [1, 1, 1], [4, 5, 6], [1, 1, 1]])
+    assert (np.asarray(get_rm_logits(more_seqs, reward_model, None, None)) == _outputs(more_seqs)).all()
+    assert len(scored) == 2 and (scored[1] == np.array([[1, 1, 1]])).all() # only the new row goes to the reward model
+
+    stats = reward_models.get_rm_score_cache(reward_model).stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (4, 4, 4)
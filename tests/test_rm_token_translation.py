@@ -0,0 +1,108 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+from tokenizers import ByteLevelBPETokenizer, BertWordPieceTokenizer, processors
+from transformers import GPT2TokenizerFast, RobertaTokenizerFast, BertTokenizerFast
+
+from reward_models import RMTokenTranslator
+
+# Small tokenizers trained here, so the tests run without downloading anything: a GPT2 style byte level BPE for the LM,
+# and a RoBERTa style (byte level BPE) and a BERT style (lower cased WordPiece) one for the reward model
+CORPUS = [
+    "The quick brown fox jumps over the lazy dog.", "It's 2024, and I don't know what we're doing!",
+    "Hello, world? Yes: hello again; numbers like 123 and 4567.", "She said 'no' and left.\nThen he came back.",
+    "This man is a doctor, a teacher, and a friend.", "I bought this product and it was great!!",
+    "Once upon a time, there was a cat.",
+] * 20
+
+STRINGS = [
+    "Hello, world!", "It's 2024, and I don't know.", "The dog jumps over the fox.", "She said 'no'.\nThen he left.",
+    " leading space", "numbers 123 and 4567!!", "a man, a doctor; a friend?", "I bought this and it was great.",
+    "Once upon a time,  there was a cat", "we're here , aren't we ?", "hello.\n\nThe end", "café au lait",
+    "The lazy dog", "What? No!", "1,234.5", "(the fox)",
+]
+
+
+@pytest.fixture(scope="module")
+def lm_tokenizer():
+    tokenizer = ByteLevelBPETokenizer()
+    tokenizer.train_from_iterator(CORPUS, vocab_size=1000, min_frequency=1, special_tokens=["<|endoftext|>"])
+    return GPT2TokenizerFast(tokenizer_object=tokenizer._tokenizer, eos_token="<|endoftext|>", bos_token="<|endoftext|>", unk_token="<|endoftext|>")
+
+
+def _roberta_style_rm_tokenizer():
+    tokenizer = ByteLevelBPETokenizer()
+    tokenizer.train_from_iterator(CORPUS, vocab_size=350, min_frequency=1, special_tokens=["<s>", "<pad>", "</s>", "<unk>"])
+    tokenizer._tokenizer.post_processor = processors.RobertaProcessing(("</s>", tokenizer.token_to_id("</s>")), ("<s>", tokenizer.token_to_id("<s>")))
+    return RobertaTokenizerFast(tokenizer_object=tokenizer._tokenizer, bos_token="<s>", eos_token="</s>", pad_token="<pad>", unk_token="<unk>",
+                                cls_token="<s>", sep_token="</s>")
+
+
+def _bert_style_rm_tokenizer():
+    tokenizer = BertWordPieceTokenizer(lowercase=True)
+    tokenizer.train_from_iterator(CORPUS, vocab_size=300, min_frequency=1)
+    tokenizer._tokenizer.post_processor = processors.BertProcessing(("[SEP]", tokenizer.token_to_id("[SEP]")), ("[CLS]", tokenizer.token_to_id("[CLS]")))
+    return BertTokenizerFast(tokenizer_object=tokenizer._tokenizer, unk_token="[UNK]", sep_token="[SEP]", pad_token="[PAD]", cls_token="[CLS]", mask_token="[MASK]")
+
+
+@pytest.fixture(scope="module", params=["roberta_style", "bert_style"])
+def rm_tokenizer(request):
+    return {"roberta_style": _roberta_style_rm_tokenizer, "bert_style": _bert_style_rm_tokenizer}[request.param]()
+
+
+def _lm_batch(lm_tokenizer, strings):
+    # As the SMC samples: one (batch, seq_len) array, shorter rows padded at the end with EOS
+    ids = [lm_tokenizer(string)["input_ids"] for string in strings]
+    seq_len = max(len(row) for row in ids)
+    return jnp.array([row + [lm_tokenizer.eos_token_id] * (seq_len - len(row)) for row in ids], dtype=jnp.int32)
+
+
+def _text_path_input_ids(seq, lm_tokenizer, rm_tokenizer):
+    # What get_rm_logits_from_text gives the reward model
+    texts = lm_tokenizer.batch_decode(np.asarray(seq), skip_special_tokens=True)
+    return rm_tokenizer(texts, truncation=True, max_length=512)["input_ids"]
+
+
+def test_exact_rows_match_the_text_path(lm_tokenizer, rm_tokenizer):
+    translator = RMTokenTranslator(lm_tokenizer, rm_tokenizer)
+    seq = _lm_batch(lm_tokenizer, STRINGS)
+    input_ids, attention_mask, exact = jax.jit(translator)(seq)
+    expected = _text_path_input_ids(seq, lm_tokenizer, rm_tokenizer)
+    for i in range(seq.shape[0]):
+        if exact[i]:
+            assert [int(x) for x in input_ids[i][attention_mask[i] == 1]] == expected[i], STRINGS[i]
+            assert (input_ids[i][attention_mask[i] == 0] == rm_tokenizer.pad_token_id).all()
+    # Not vacuous: the strings made of whole words of the corpus go through the jnp path (words the LM tokenizer
+    # wasn't trained on get split into pieces with unsafe boundaries, so those are flagged)
+    assert exact.sum() >= 4
+
+
+def test_random_token_sequences_are_flagged_or_exact(lm_tokenizer, rm_tokenizer):
+    # Any sequence of LM tokens (including ones no text would tokenize to) is either flagged as not exact, or translated exactly
+    translator = RMTokenTranslator(lm_tokenizer, rm_tokenizer)
+    seq = jax.random.randint(jax.random.PRNGKey(0), (400, 4), 0, len(lm_tokenizer))
+    input_ids, attention_mask, exact = translator(seq)
+    expected = _text_path_input_ids(seq, lm_tokenizer, rm_tokenizer)
+    for i in np.flatnonzero(np.asarray(exact)):
+        assert [int(x) for x in input_ids[i][attention_mask[i] == 1]] == expected[i]
+    assert exact.any()
+
+
+def test_fallback_flags(lm_tokenizer, rm_tokenizer):
+    translator = RMTokenTranslator(lm_tokenizer, rm_tokenizer)
+    eos = lm_tokenizer.eos_token_id
+    words = lm_tokenizer(" the dog")["input_ids"]
+    letter_a, letter_b = lm_tokenizer.convert_tokens_to_ids(["a", "b"])
+    partial_utf8 = lm_tokenizer.convert_tokens_to_ids("Ã") # the byte 0xc3 on its own, decodes to a replacement character
+    rows = {
+        "words": (words + [eos, eos], True),
+        "trailing_eos_only": ([eos] * (len(words) + 2), True),
+        "eos_in_the_middle": ([words[0], eos] + words[1:] + [eos], False),
+        "letters_joined_without_a_space": ([letter_a, letter_b] + [eos] * len(words), False),
+        "partial_utf8_byte": ([partial_utf8] + words + [eos], False),
+        "out_of_vocab": ([len(lm_tokenizer) + 5] + words + [eos], False),
+    }
+    _, _, exact = translator(jnp.array([row for row, _ in rows.values()], dtype=jnp.int32))
+    for (name, (_, expected_exact)), row_exact in zip(rows.items(), exact):
+        assert bool(row_exact) == expected_exact, name
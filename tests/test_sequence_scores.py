@@ -0,0 +1,98 @@
+import jax
+import jax.numpy as jnp
+import pytest
+
+from custom_transformer_prob_utils import get_sequence_scores, evaluate_log_p_theta_1_to_t, evaluate_normalized_log_q_1_to_t, \
+    evaluate_log_psi_selected_tokens, get_log_p_all_tokens, get_log_psi_all_vocab, get_transformer_p_embeddings, get_transformer_p_logits, \
+    gather_selected_tokens, freeze_log_psi_after_eos
+
+OUTPUT_LEN = 6
+EOS = 0
+
+
+@pytest.fixture
+def seq(prompt):
+    # Random outputs, with an EOS in the middle of some of them so the scores after it are masked/frozen
+    outputs = jax.random.randint(jax.random.PRNGKey(2), (5, OUTPUT_LEN), 1, 50).at[1, 2].set(EOS).at[3, 0].set(EOS)
+    return jnp.concatenate((jnp.broadcast_to(prompt, (5, prompt.shape[0])), outputs), axis=-1).astype(jnp.int32)
+
+
+def _separate_scores(seq, prompt_len, params_p, params_twist, huggingface_model, proposal_is_p, eos_token_id, params_proposal=None):
+    # What the losses computed before, with one call (and forward pass) per score
+    log_p = evaluate_log_p_theta_1_to_t(seq, params_p, prompt_len, OUTPUT_LEN, output_log_p_for_each_t=True,
+                                        huggingface_model=huggingface_model, eos_token_id=eos_token_id)
+    log_psi = evaluate_log_psi_selected_tokens(seq, prompt_len, params_twist, None, huggingface_model=huggingface_model,
+                                               params_proposal=params_proposal, params_p=params_p, eos_token_id=eos_token_id)
+    if isinstance(huggingface_model, dict) and huggingface_model['call_type'] == "p_psi_combined":
+        # evaluate_log_psi_selected_tokens gives the raw twist output (log p + log psi logits) for this call type; the table has log psi itself
+        selected_p_logits = gather_selected_tokens(get_transformer_p_logits(params_p, seq, huggingface_model)[:, prompt_len - 1: -1],
+                                                   seq[:, prompt_len:])
+        log_psi = log_psi - freeze_log_psi_after_eos(selected_p_logits, seq, prompt_len, eos_token_id)
+    if proposal_is_p:
+        return log_p, log_psi, jnp.cumsum(log_p, axis=-1)
+    normalized_log_q_1_to_t = evaluate_normalized_log_q_1_to_t(
+        seq, params_p, params_twist, prompt_len, None, huggingface_model=huggingface_model, return_cumsum=True,
+        params_proposal=params_proposal, eos_token_id=eos_token_id)
+    return log_p, log_psi, normalized_log_q_1_to_t
+
+
+@pytest.mark.parametrize("eos_token_id", [None, EOS])
+@pytest.mark.parametrize("proposal_is_p", [False, True])
+@pytest.mark.parametrize("model_fixture", ["shared_trunk_model", "separate_twist_model", "p_psi_combined_model"])
+def test_sequence_scores_match_separate_evaluations(request, seq, prompt, model_fixture, proposal_is_p, eos_token_id):
+    huggingface_model, params_p, params_twist = request.getfixturevalue(model_fixture)
+    prompt_len = prompt.shape[0]
+    scores = get_sequence_scores(seq, prompt_len, params_p, params_twist, None, huggingface_model=huggingface_model,
+                                 proposal_is_p=proposal_is_p, eos_token_id=eos_token_id)
+    log_p, log_psi, normalized_log_q_1_to_t = _separate_scores(seq, prompt_len, params_p, params_twist, huggingface_model,
+                                                               proposal_is_p, eos_token_id)
+    assert scores.log_p.shape == scores.log_psi.shape == scores.normalized_log_q.shape == (5, OUTPUT_LEN)
+    assert jnp.allclose(scores.log_p, log_p, atol=1e-5)
+    assert jnp.allclose(scores.log_psi, log_psi, atol=1e-5)
+    assert jnp.allclose(scores.normalized_log_q_1_to_t, normalized_log_q_1_to_t, atol=1e-5)
+    assert jnp.allclose(scores.log_p_total, evaluate_log_p_theta_1_to_t(
+        seq, params_p, prompt_len, OUTPUT_LEN, huggingface_model=huggingface_model, eos_token_id=eos_token_id), atol=1e-5)
+    if not proposal_is_p:
+        assert jnp.allclose(scores.normalized_log_q_total, evaluate_normalized_log_q_1_to_t(
+            seq, params_p, params_twist, prompt_len, None, huggingface_model=huggingface_model, eos_token_id=eos_token_id), atol=1e-5)
+    if eos_token_id is not None:
+        # p = q = 1 after the EOS, and psi stays at its value at the EOS
+        assert (scores.log_p[1, 3:] == 0.).all() and (scores.normalized_log_q[3, 1:] == 0.).all()
+        assert (scores.log_psi[1, 3:] == scores.log_psi[1, 2]).all()
+
+
+@pytest.mark.parametrize("model_fixture", ["shared_trunk_model", "separate_twist_model"])
+def test_all_vocab_scores_match_the_full_logits(request, seq, prompt, model_fixture):
+    huggingface_model, params_p, params_twist = request.getfixturevalue(model_fixture)
+    prompt_len = prompt.shape[0]
+    scores = get_sequence_scores(seq, prompt_len, params_p, params_twist, None, huggingface_model=huggingface_model,
+                                 with_all_vocab=True)
+    assert jnp.allclose(scores.log_p_all_vocab, get_log_p_all_tokens(seq, params_p, huggingface_model)[:, prompt_len - 1: -1], atol=1e-5)
+    assert jnp.allclose(scores.log_psi_all_vocab, get_log_psi_all_vocab(seq, params_twist, None, huggingface_model,
+                                                                        prompt_len=prompt_len), atol=1e-5)
+    log_p, log_psi, normalized_log_q_1_to_t = _separate_scores(seq, prompt_len, params_p, params_twist, huggingface_model, False, None)
+    assert jnp.allclose(scores.log_p, log_p, atol=1e-5)
+    assert jnp.allclose(scores.normalized_log_q_1_to_t, normalized_log_q_1_to_t, atol=1e-5)
+
+
+def test_sequence_scores_with_params_proposal(separate_twist_model, seq, prompt):
+    # log psi is that of q/p * psi', and q is the proposal's own twisted proposal, as in the separate calls
+    huggingface_model, params_p, params_twist = separate_twist_model
+    params_proposal = jax.tree_util.tree_map(lambda x: 0.5 * x, params_twist)
+    scores = get_sequence_scores(seq, prompt.shape[0], params_p, params_twist, None, huggingface_model=huggingface_model,
+                                 params_proposal=params_proposal)
+    log_p, log_psi, normalized_log_q_1_to_t = _separate_scores(seq, prompt.shape[0], params_p, params_twist, huggingface_model,
+                                                               False, None, params_proposal=params_proposal)
+    assert jnp.allclose(scores.log_p, log_p, atol=1e-5)
+    assert jnp.allclose(scores.log_psi, log_psi, atol=1e-4)
+    assert jnp.allclose(scores.normalized_log_q_1_to_t, normalized_log_q_1_to_t, atol=1e-5)
+
+
+def test_sequence_scores_with_trunk_embeddings(shared_trunk_model, seq, prompt):
+    huggingface_model, params_p, params_twist = shared_trunk_model
+    scores = get_sequence_scores(seq, prompt.shape[0], params_p, params_twist, None, huggingface_model=huggingface_model,
+                                 with_all_vocab=True)
+    cached = get_sequence_scores(seq, prompt.shape[0], params_p, params_twist, None, huggingface_model=huggingface_model,
+                                 with_all_vocab=True, trunk_embeddings=get_transformer_p_embeddings(params_p, seq, huggingface_model))
+    for value, cached_value in zip(scores, cached):
+        assert jnp.allclose(value, cached_value, atol=1e-5)
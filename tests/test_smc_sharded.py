@@ -0,0 +1,59 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+# The host device count has to be set before jax starts, so the sharded SMC runs in a subprocess with 2 CPU devices
+SCRIPT = textwrap.dedent("""
+    import json
+    import sys
+    sys.path[:0] = sys.argv[2:4]
+    import jax
+    import jax.numpy as jnp
+    import custom_transformer_prob_utils
+    from custom_transformer_prob_utils import smc_procedure, smc_sharded, evaluate_log_p_theta_1_to_t, evaluate_log_phi_final
+    from huggingface_models_custom import CustomLMWithTwistHead
+    from conftest import final_twist_last_token_mod_3
+
+    assert jax.device_count() == 2
+    model = CustomLMWithTwistHead(jax.random.PRNGKey(0), sys.argv[1])
+    # A twist head near zero (q close to p) keeps the variance of the estimates low
+    huggingface_model, params_p = model.__call__, model.huggingface_model.params
+    params_twist = jax.tree_util.tree_map(lambda x: 0.1 * x, model.twist_head_params)
+    prompt = jnp.array([3, 7, 11, 2])
+    output_len, n_smc_samples = 2, 4096
+
+    # Every output of length 2 over the vocab of 50
+    outputs = jnp.stack(jnp.meshgrid(jnp.arange(50), jnp.arange(50), indexing="ij"), axis=-1).reshape(-1, 2)
+    seqs = jnp.concatenate((jnp.broadcast_to(prompt, (outputs.shape[0], 4)), outputs), axis=-1).astype(jnp.int32)
+    exact_log_z = jax.nn.logsumexp(evaluate_log_p_theta_1_to_t(seqs, params_p, 4, output_len, huggingface_model=huggingface_model)
+                                   + evaluate_log_phi_final(seqs, final_twist_last_token_mod_3))
+
+    smc_kwargs = dict(huggingface_model=huggingface_model, resampling_scheme="multinomial", resample_criterion="every_step")
+    (_, sharded_log_z, _), sharded_samples = smc_sharded(
+        jax.random.PRNGKey(1), prompt, params_p, params_twist, final_twist_last_token_mod_3, output_len, n_smc_samples, **smc_kwargs)
+    (_, unsharded_log_z, _), _ = smc_procedure(
+        jax.random.PRNGKey(2), prompt, params_p, params_twist, final_twist_last_token_mod_3, output_len, n_smc_samples, **smc_kwargs)
+    # As with --shard_smc_particles
+    custom_transformer_prob_utils.shard_smc_particles = True
+    (_, dispatched_log_z, _), _ = smc_procedure(
+        jax.random.PRNGKey(1), prompt, params_p, params_twist, final_twist_last_token_mod_3, output_len, n_smc_samples, **smc_kwargs)
+
+    print(json.dumps({"exact": float(exact_log_z), "sharded": float(sharded_log_z), "unsharded": float(unsharded_log_z),
+                      "dispatched": float(dispatched_log_z), "n_samples": int(sharded_samples.shape[0])}))
+""")
+
+
+def test_sharded_log_z_matches_unsharded_and_exact(tiny_gpt2_dir):
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    env = {**os.environ, "XLA_FLAGS": "--xla_force_host_platform_device_count=2", "JAX_PLATFORMS": "cpu"}
+    result = subprocess.run([sys.executable, "-c", SCRIPT, tiny_gpt2_dir, os.path.dirname(tests_dir), tests_dir],
+                            env=env, capture_output=True, text=True, timeout=900)
+    assert result.returncode == 0, result.stderr[-3000:]
+    log_z = json.loads(result.stdout.strip().splitlines()[-1])
+    assert log_z["n_samples"] == 4096
+    # The estimates have a standard deviation of ~0.012 with this many particles
+    assert abs(log_z["sharded"] - log_z["exact"]) < 0.05
+    assert abs(log_z["unsharded"] - log_z["exact"]) < 0.05
+    assert log_z["dispatched"] == log_z["sharded"] # smc_procedure with shard_smc_particles is smc_sharded
@@ -0,0 +1,69 @@
+import jax
+import numpy as np
+import pytest
+
+from custom_transformer_prob_utils import stochastic_transformer_sample
+from reward_models import calibrate_threshold_screen, get_probe_features, get_probe_features_from_output_embeddings
+
+
+def _synthetic_samples(rng, n, weights, noise_sd=1.):
+    # Features with a linear signal plus noise; with a high threshold, the positives are the rare far tail that ridge under-predicts
+    features = rng.normal(size=(n, weights.shape[0]))
+    return features, features @ weights + noise_sd * rng.normal(size=n)
+
+
+@pytest.mark.parametrize("pos_threshold", [True, False])
+def test_screen_fn_rate_on_rare_positives(pos_threshold):
+    rng = np.random.default_rng(0)
+    weights = rng.normal(size=16) * 0.5
+    sign = 1. if pos_threshold else -1.
+    features, scores = _synthetic_samples(rng, 40000, weights)
+    threshold = sign * np.quantile(sign * scores, 0.98) # ~2% positives, ~400 of them in the held out half
+    fn_target = 0.02
+
+    screen = calibrate_threshold_screen(features, scores, threshold, pos_threshold, fn_target=fn_target, l2_reg=1000.)
+    assert screen is not None
+
+    test_features, test_scores = _synthetic_samples(rng, 400000, weights)
+    is_positive = (test_scores > threshold) if pos_threshold else (test_scores < threshold)
+    passed_screen = screen.passes(screen.predict(test_features))
+    fn_rate = (~passed_screen[is_positive]).mean()
+    assert fn_rate <= fn_target * 1.5, fn_rate # some slack for the ~8000 test positives
+    assert passed_screen.mean() < 0.5 # and the screen still screens most samples out
+
+
+def test_screen_disabled_with_too_few_positives():
+    rng = np.random.default_rng(1)
+    weights = rng.normal(size=16)
+    features, scores = _synthetic_samples(rng, 4000, weights)
+    threshold = np.quantile(scores, 0.99) # ~20 held out positives
+    assert calibrate_threshold_screen(features, scores, threshold, True, fn_target=0.02, min_positives=100) is None
+    # fn_target 1e-3 can't be calibrated on ~20 positives even without a minimum
+    assert calibrate_threshold_screen(features, scores, threshold, True, fn_target=1e-3, min_positives=0) is None
+
+
+def test_screen_cutoff_fixed_after_audit_false_negatives():
+    rng = np.random.default_rng(2)
+    weights = rng.normal(size=16)
+    features, scores = _synthetic_samples(rng, 40000, weights)
+    screen = calibrate_threshold_screen(features, scores, np.quantile(scores, 0.9), True, fn_target=0.02)
+    cutoff = screen.cutoff
+    screen.record(100, 10, 5, np.array([cutoff - 10.]))
+    assert screen.cutoff == cutoff
+    assert screen.stats()["false_negatives"] == 1
+
+
+@pytest.mark.parametrize("use_kv_cache", [False, True])
+@pytest.mark.parametrize("model_fixture", ["shared_trunk_model", "separate_twist_model"])
+def test_probe_features_from_the_sampling_pass(request, model_fixture, use_kv_cache, prompt):
+    # The screen's features come from the pass that samples, without a second forward over the samples
+    huggingface_model, params_p, _ = request.getfixturevalue(model_fixture)
+    samples = stochastic_transformer_sample(jax.random.PRNGKey(1), params_p, prompt, 6, 8, huggingface_model=huggingface_model,
+                                            use_kv_cache=use_kv_cache)
+    samples_emb, output_embeddings = stochastic_transformer_sample(
+        jax.random.PRNGKey(1), params_p, prompt, 6, 8, huggingface_model=huggingface_model, use_kv_cache=use_kv_cache,
+        return_output_embeddings=True)
+    assert (samples == samples_emb).all()
+    assert output_embeddings.shape[:2] == (8, 6)
+    assert np.allclose(get_probe_features_from_output_embeddings(output_embeddings),
+                       get_probe_features(params_p, samples, prompt.shape[0], huggingface_model=huggingface_model), atol=1e-5)
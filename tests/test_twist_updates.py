@@ -0,0 +1,76 @@
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+import pytest
+
+import losses
+from twist_updates import twist_update_step, scan_twist_update_steps
+from conftest import final_twist_last_token_mod_3
+
+
+class Momentum:
+    # Stands in for optax.adamw in these tests: an optimizer with state, and the update(grads, state, params) interface
+    def __init__(self, lr=0.1, decay=0.9):
+        self.lr = lr
+        self.decay = decay
+
+    def init(self, params):
+        return {"velocity": jax.tree_util.tree_map(jnp.zeros_like, params), "count": jnp.zeros((), jnp.int32)}
+
+    def update(self, grads, state, params):
+        velocity = jax.tree_util.tree_map(lambda v, g: self.decay * v + g, state["velocity"], grads)
+        updates = jax.tree_util.tree_map(lambda v: -self.lr * v, velocity)
+        return updates, {"velocity": velocity, "count": state["count"] + 1}
+
+
+def _grad_fn(model, prompt):
+    # As ExperimentConfig.get_grad_params_twist with return_loss=True
+    huggingface_model, params_p, _ = model
+
+    def get_grad_params_twist_and_loss(rng_key, params_twist):
+        rng_key, sk = jax.random.split(rng_key)
+        loss, grad_params_twist = jax.value_and_grad(losses.get_l_one_total_kl, argnums=3)(
+            sk, prompt, params_p, params_twist, final_twist_last_token_mod_3, 4, 8, None, "jit", huggingface_model=huggingface_model)
+        return rng_key, grad_params_twist, loss
+    return get_grad_params_twist_and_loss
+
+
+def _assert_trees_close(tree_1, tree_2, atol=1e-5):
+    leaves_1, leaves_2 = jax.tree_util.tree_leaves(tree_1), jax.tree_util.tree_leaves(tree_2)
+    assert len(leaves_1) == len(leaves_2)
+    for x_1, x_2 in zip(leaves_1, leaves_2):
+        assert jnp.allclose(x_1, x_2, atol=atol)
+
+
+@pytest.mark.parametrize("model_fixture", ["shared_trunk_model", "separate_twist_model"])
+def test_scanned_updates_match_separate_updates(request, model_fixture, prompt):
+    # n scanned (and donated) updates in one call give the same params, optimizer state and rng as n separate updates
+    model = request.getfixturevalue(model_fixture)
+    get_grad_params_twist_and_loss = _grad_fn(model, prompt)
+    optimizer_twist = Momentum()
+    n_updates = 3
+
+    rng_key = jax.random.PRNGKey(9)
+    params_twist = model[2]
+    optim_twist_state = optimizer_twist.init(params_twist)
+    step_losses = []
+    for _ in range(n_updates):
+        rng_key, params_twist, optim_twist_state, metrics = twist_update_step(
+            get_grad_params_twist_and_loss, optimizer_twist, rng_key, params_twist, optim_twist_state)
+        step_losses.append(metrics["loss"])
+
+    # Copies, as with --fused_twist_updates, since the arrays passed in are donated
+    params_twist_scanned = jax.tree_util.tree_map(jnp.copy, model[2])
+    scanned = jax.jit(partial(scan_twist_update_steps, get_grad_params_twist_and_loss, optimizer_twist),
+                      static_argnames="n_updates", donate_argnums=(1, 2))
+    rng_key_scanned, params_twist_scanned, optim_twist_state_scanned, metrics_scanned = scanned(
+        jax.random.PRNGKey(9), params_twist_scanned, optimizer_twist.init(params_twist_scanned), n_updates=n_updates)
+
+    assert (rng_key_scanned == rng_key).all()
+    _assert_trees_close(params_twist_scanned, params_twist)
+    _assert_trees_close(optim_twist_state_scanned, optim_twist_state)
+    assert jnp.allclose(metrics_scanned["loss"], jnp.stack(step_losses).mean(), atol=1e-5)
+    assert jnp.allclose(metrics_scanned["last_loss"], step_losses[-1], atol=1e-5)
+    # The updates did something
+    assert not jnp.allclose(jax.tree_util.tree_leaves(params_twist)[0], jax.tree_util.tree_leaves(model[2])[0])
@@ -0,0 +1,70 @@
+import jax
+import jax.numpy as jnp
+import pytest
+
+import custom_transformer_prob_utils
+from custom_transformer_prob_utils import get_sequence_scores, get_sequence_scores_jitted, evaluate_normalized_log_q_1_to_t, \
+    evaluate_log_p_selected_tokens, stochastic_transformer_sample, get_transformer_p_embeddings
+
+
+def _scores(chunked, seq, prompt_len, params_p, params_twist, huggingface_model, **kwargs):
+    # vocab 50 with chunks of 16 covers both the fori_loop over full chunks and the remainder chunk
+    return get_sequence_scores(seq, prompt_len, params_p, params_twist, None, huggingface_model=huggingface_model,
+                               chunk_size=16, chunked_heads=chunked, **kwargs)
+
+
+@pytest.fixture
+def seq(shared_trunk_model, prompt):
+    huggingface_model, params_p, _ = shared_trunk_model
+    return stochastic_transformer_sample(jax.random.PRNGKey(2), params_p, prompt, 6, 5, huggingface_model=huggingface_model)
+
+
+@pytest.mark.parametrize("model_fixture", ["shared_trunk_model", "separate_twist_model"])
+@pytest.mark.parametrize("proposal_is_p", [False, True])
+def test_chunked_heads_match_full_logits(request, seq, prompt, model_fixture, proposal_is_p):
+    huggingface_model, params_p, params_twist = request.getfixturevalue(model_fixture)
+    full = _scores(False, seq, prompt.shape[0], params_p, params_twist, huggingface_model, proposal_is_p=proposal_is_p)
+    chunked = _scores(True, seq, prompt.shape[0], params_p, params_twist, huggingface_model, proposal_is_p=proposal_is_p)
+    for name in ["log_p", "log_psi", "normalized_log_q"]:
+        assert jnp.allclose(getattr(full, name), getattr(chunked, name), atol=1e-5), name
+
+    assert jnp.allclose(evaluate_log_p_selected_tokens(seq, prompt.shape[0], params_p, huggingface_model, chunk_size=16), full.log_p, atol=1e-5)
+    if not proposal_is_p:
+        assert jnp.allclose(evaluate_normalized_log_q_1_to_t(seq, params_p, params_twist, prompt.shape[0], None, huggingface_model, return_cumsum=True,
+                                                             chunk_size=16, chunked_heads=True),
+                            full.normalized_log_q_1_to_t, atol=1e-5)
+
+
+def test_chunked_heads_with_trunk_embeddings(shared_trunk_model, seq, prompt):
+    huggingface_model, params_p, params_twist = shared_trunk_model
+    full = _scores(False, seq, prompt.shape[0], params_p, params_twist, huggingface_model)
+    trunk_embeddings = get_transformer_p_embeddings(params_p, seq, huggingface_model)
+    chunked = _scores(True, seq, prompt.shape[0], params_p, params_twist, huggingface_model, trunk_embeddings=trunk_embeddings)
+    assert jnp.allclose(full.normalized_log_q, chunked.normalized_log_q, atol=1e-5)
+
+
+def test_chunked_heads_twist_gradients_match(shared_trunk_model, seq, prompt):
+    huggingface_model, params_p, params_twist = shared_trunk_model
+
+    def loss(params_twist, chunked):
+        scores = _scores(chunked, seq, prompt.shape[0], params_p, params_twist, huggingface_model)
+        return (scores.normalized_log_q_total + scores.log_psi[:, -1]).mean()
+
+    grads_full = jax.grad(loss)(params_twist, False)
+    grads_chunked = jax.grad(loss)(params_twist, True)
+    for g_full, g_chunked in zip(jax.tree_util.tree_leaves(grads_full), jax.tree_util.tree_leaves(grads_chunked)):
+        assert jnp.allclose(g_full, g_chunked, atol=1e-5)
+
+
+def test_vocab_chunking_settings_are_not_baked_into_the_trace(monkeypatch, shared_trunk_model, seq, prompt):
+    # vocab_chunk_size/vocab_chunked_heads are resolved before jit, so changing them after the first call gives a new compilation
+    huggingface_model, params_p, params_twist = shared_trunk_model
+    cache_size = get_sequence_scores_jitted._cache_size()
+    scores = []
+    for chunked_heads, chunk_size in [(False, 16), (True, 16), (True, 7)]:
+        monkeypatch.setattr(custom_transformer_prob_utils, "vocab_chunked_heads", chunked_heads)
+        monkeypatch.setattr(custom_transformer_prob_utils, "vocab_chunk_size", chunk_size)
+        scores.append(get_sequence_scores(seq[:, :-1], prompt.shape[0], params_p, params_twist, None, huggingface_model=huggingface_model))
+    assert get_sequence_scores_jitted._cache_size() == cache_size + 3
+    for other in scores[1:]:
+        assert jnp.allclose(scores[0].normalized_log_q, other.normalized_log_q, atol=1e-5)
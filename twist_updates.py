@@ -0,0 +1,53 @@
+import jax
+import jax.numpy as jnp
+
+# The optimizer step of the twist updates, shared by the update loop in do_training_and_log_Z_bounds.do_twist_updates
+# and the fused, jitted updates (ExperimentConfig.update_twist_jitted / update_twist_scanned).
+# optimizer_twist is an optax GradientTransformation, or anything else with update(grads, state, params) -> (updates, state).
+
+
+def apply_updates(params, updates):
+    # As optax.apply_updates
+    return jax.tree_util.tree_map(lambda p, u: jnp.asarray(p + u).astype(jnp.asarray(p).dtype), params, updates)
+
+
+def global_norm(tree):
+    # As optax.global_norm
+    return jnp.sqrt(sum(jnp.sum(jnp.square(x)) for x in jax.tree_util.tree_leaves(tree)))
+
+
+def get_new_params_twist_and_optim_twist_state(optimizer_twist, grad_params_twist, optim_twist_state, params_twist):
+    updates_twist, optim_twist_state = optimizer_twist.update(
+        grad_params_twist, optim_twist_state, params_twist)
+
+    params_twist = apply_updates(params_twist, updates_twist)
+
+    return params_twist, optim_twist_state
+
+
+def twist_update_step(get_grad_params_twist_and_loss, optimizer_twist, rng_key, params_twist, optim_twist_state):
+    # One fused twist update (loss, grad, optimizer step).
+    # get_grad_params_twist_and_loss(rng_key, params_twist) returns (rng_key, grad_params_twist, loss),
+    # e.g. ExperimentConfig.get_grad_params_twist with return_loss=True and everything else filled in
+    rng_key, grad_params_twist, loss = get_grad_params_twist_and_loss(rng_key, params_twist)
+    params_twist, optim_twist_state = get_new_params_twist_and_optim_twist_state(optimizer_twist, grad_params_twist, optim_twist_state, params_twist)
+
+    metrics = {"loss": loss, "grad_norm": global_norm(grad_params_twist)}
+    return rng_key, params_twist, optim_twist_state, metrics
+
+
+def scan_twist_update_steps(get_grad_params_twist_and_loss, optimizer_twist, rng_key, params_twist, optim_twist_state, n_updates):
+    # n_updates twist_update_steps in a lax.scan, with the rng threaded through as in n separate calls.
+    # Returns the mean of the per step metrics, plus the loss of the last step.
+    def scan_iter(carry, unused):
+        rng_key, params_twist, optim_twist_state = carry
+        rng_key, params_twist, optim_twist_state, metrics = twist_update_step(
+            get_grad_params_twist_and_loss, optimizer_twist, rng_key, params_twist, optim_twist_state)
+        return (rng_key, params_twist, optim_twist_state), metrics
+
+    (rng_key, params_twist, optim_twist_state), metrics_by_step = jax.lax.scan(
+        scan_iter, (rng_key, params_twist, optim_twist_state), None, n_updates)
+
+    metrics = jax.tree_util.tree_map(jnp.mean, metrics_by_step)
+    metrics["last_loss"] = metrics_by_step["loss"][-1]
+    return rng_key, params_twist, optim_twist_state, metrics